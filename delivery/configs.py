@@ -27,6 +27,9 @@ class DeliveryConfigs:
         "POSTS_SERVICE_URL",
         "http://posts-service:3000"
     )
+    
+    # Redis (шина событий: outbox relay + consumer groups)
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://redis:6379/0")
     FRONTEND_URL: str = os.getenv("FRONTEND_URL", "http://localhost:8080")
     
     # JWT
@@ -44,10 +47,46 @@ class DeliveryConfigs:
     DPD_REAL_API_BASE_URL: str = os.getenv("DPD_REAL_API_BASE_URL", "https://eserviss.dpd.lv/api/v1")
     DPD_TEST_API_BASE_URL: str = os.getenv("DPD_TEST_API_BASE_URL", "https://sandbox-eserviss.dpd.lv/api/v1")
     OMNIVA_TEST_API_BASE_URL: str = os.getenv("OMNIVA_TEST_API_BASE_URL", "https://test-omx.omniva.eu/api/v01/omx")
+
+    # HTTP к провайдерам (providers/http.py): общий пул, таймауты по операциям (сек), повторы
+    PROVIDER_HTTP_MAX_CONNECTIONS: int = int(os.getenv("PROVIDER_HTTP_MAX_CONNECTIONS", "20"))
+    PROVIDER_HTTP_MAX_KEEPALIVE: int = int(os.getenv("PROVIDER_HTTP_MAX_KEEPALIVE", "10"))
+    PROVIDER_HTTP_RETRIES: int = int(os.getenv("PROVIDER_HTTP_RETRIES", "2"))
+    PROVIDER_HTTP_BACKOFF_SECONDS: float = float(os.getenv("PROVIDER_HTTP_BACKOFF_SECONDS", "0.5"))
+    DPD_SHIPMENT_TIMEOUT_SECONDS: float = float(os.getenv("DPD_SHIPMENT_TIMEOUT_SECONDS", "15"))
+    DPD_TRACKING_TIMEOUT_SECONDS: float = float(os.getenv("DPD_TRACKING_TIMEOUT_SECONDS", "10"))
+    DPD_SUBSCRIPTION_TIMEOUT_SECONDS: float = float(os.getenv("DPD_SUBSCRIPTION_TIMEOUT_SECONDS", "5"))
     
     # Simulation settings
     USE_SIMULATION_MODE: bool = os.getenv("USE_SIMULATION_MODE", "true").lower() == "true"
+    # Ускорение симуляции доставки (delivery_simulator.py): 10 — все задержки в 10 раз короче
+    SIMULATION_TIME_SCALE: float = float(os.getenv("SIMULATION_TIME_SCALE", "1"))
+    SIMULATION_BATCH_SIZE: int = int(os.getenv("SIMULATION_BATCH_SIZE", "500"))  # переходов в одном commit
     
+    # Пакетный поллер трекинга DPD (tracking_poller.py) — страховка на случай пропущенных webhook
+    DPD_TRACKING_POLL_SECONDS: int = int(os.getenv("DPD_TRACKING_POLL_SECONDS", "300"))
+    DPD_TRACKING_BATCH_SIZE: int = int(os.getenv("DPD_TRACKING_BATCH_SIZE", "50"))  # номеров в одном запросе
+    DPD_TRACKING_MAX_PER_RUN: int = int(os.getenv("DPD_TRACKING_MAX_PER_RUN", "1000"))
+    DPD_TRACKING_CONCURRENCY: int = int(os.getenv("DPD_TRACKING_CONCURRENCY", "2"))
+    # Интервал повторной проверки по стадиям (в минутах)
+    DPD_TRACKING_INTERVAL_CREATED_MINUTES: int = int(os.getenv("DPD_TRACKING_INTERVAL_CREATED_MINUTES", "120"))
+    DPD_TRACKING_INTERVAL_IN_TRANSIT_MINUTES: int = int(os.getenv("DPD_TRACKING_INTERVAL_IN_TRANSIT_MINUTES", "30"))
+    DPD_TRACKING_INTERVAL_AT_PICKUP_POINT_MINUTES: int = int(
+        os.getenv("DPD_TRACKING_INTERVAL_AT_PICKUP_POINT_MINUTES", "180")
+    )
+    # Повтор для доставок, по которым DPD не ответил (ошибка запроса или нет статуса в ответе)
+    DPD_TRACKING_RETRY_MINUTES: int = int(os.getenv("DPD_TRACKING_RETRY_MINUTES", "5"))
+
+    # Очередь DPD webhook (dpd_inbox.py): события одной посылки за окно схлопываются в одно применение
+    DPD_WEBHOOK_COALESCE_SECONDS: int = int(os.getenv("DPD_WEBHOOK_COALESCE_SECONDS", "3"))
+    DPD_WEBHOOK_BATCH_SIZE: int = int(os.getenv("DPD_WEBHOOK_BATCH_SIZE", "500"))
+    DPD_WEBHOOK_MAX_ATTEMPTS: int = int(os.getenv("DPD_WEBHOOK_MAX_ATTEMPTS", "5"))
+    DPD_WEBHOOK_RETENTION_DAYS: int = int(os.getenv("DPD_WEBHOOK_RETENTION_DAYS", "7"))
+
+    # Списки и история (delivery_router: /, /{delivery_id}/history, /export)
+    DELIVERY_HISTORY_LIMIT: int = int(os.getenv("DELIVERY_HISTORY_LIMIT", "50"))  # записей истории в ответе трекинга
+    DELIVERY_EXPORT_CHUNK_SIZE: int = int(os.getenv("DELIVERY_EXPORT_CHUNK_SIZE", "1000"))
+
     # Delivery timing (в часах)
     TRANSIT_TIME_HOURS: int = int(os.getenv("TRANSIT_TIME_HOURS", "24"))  # 24 часа в пути
     PICKUP_WAIT_DAYS: int = int(os.getenv("PICKUP_WAIT_DAYS", "7"))  # 7 дней хранение
@@ -1,8 +1,13 @@
 # database.py - Подключение к базе данных
 
+import logging
+
 from sqlmodel import SQLModel, create_engine, Session
 from configs import configs
 from models import PickupPoint
+import outbox  # OutboxEvent, ProcessedEvent (шина событий) — до create_all
+
+logger = logging.getLogger(__name__)
 
 
 # Создаем движок базы данных
@@ -18,10 +23,44 @@ engine = create_engine(
 def create_db_and_tables():
     """Создание таблиц в базе данных"""
     SQLModel.metadata.create_all(engine)
+    _apply_schema_patches()
     _seed_pickup_points()
     print("✅ Database tables created successfully")
 
 
+# Колонки, добавленные в уже существующие таблицы (create_all их не добавит).
+# Только PostgreSQL: локальную SQLite-базу проще пересоздать.
+SCHEMA_PATCHES = [
+    "ALTER TABLE pickup_points ADD COLUMN IF NOT EXISTS content_hash VARCHAR(40)",
+    "ALTER TABLE pickup_points ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')",
+    "ALTER TABLE pickup_points ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION",
+    "ALTER TABLE pickup_points ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION",
+    "ALTER TABLE delivery ADD COLUMN IF NOT EXISTS tracking_checked_at TIMESTAMP",
+    "ALTER TABLE delivery ADD COLUMN IF NOT EXISTS next_tracking_check_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_next_tracking_check_at ON delivery (next_tracking_check_at)",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_status_created_at ON delivery (status, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_provider_created_at ON delivery (provider, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_delivery_created_at_id ON delivery (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_deliverystatushistory_delivery_id_created_at "
+    "ON deliverystatushistory (delivery_id, created_at, id)",
+    # dedup_key уникален только среди pending-событий
+    "ALTER TABLE dpd_webhook_events DROP CONSTRAINT IF EXISTS dpd_webhook_events_dedup_key_key",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_dpd_webhook_events_pending_dedup "
+    "ON dpd_webhook_events (dedup_key) WHERE status = 'pending'",
+]
+
+
+def _apply_schema_patches():
+    if engine.dialect.name != "postgresql":
+        return
+    try:
+        with engine.begin() as connection:
+            for statement in SCHEMA_PATCHES:
+                connection.exec_driver_sql(statement)
+    except Exception:
+        logger.exception("Failed to apply delivery schema patches")
+
+
 def _seed_pickup_points():
     """Первичное заполнение справочника пунктов выдачи"""
     dpd_mode = configs.get_dpd_mode()
@@ -35,6 +74,8 @@ def _seed_pickup_points():
             "address": "Brivibas iela 105",
             "postal_code": "LV-1001",
             "country_code": "LV",
+            "latitude": 56.9606,
+            "longitude": 24.1335,
         },
         {
             "system_point_id": "LV90008",
@@ -45,6 +86,8 @@ def _seed_pickup_points():
             "address": "Maskavas iela 257",
             "postal_code": "LV-1019",
             "country_code": "LV",
+            "latitude": 56.9234,
+            "longitude": 24.1849,
         },
         {
             "system_point_id": "LV22017",
@@ -55,6 +98,8 @@ def _seed_pickup_points():
             "address": "Cietoksna iela 60",
             "postal_code": "LV-5401",
             "country_code": "LV",
+            "latitude": 55.8833,
+            "longitude": 26.5137,
         },
         {
             "system_point_id": "EE30001",
@@ -65,6 +110,8 @@ def _seed_pickup_points():
             "address": "Narva mnt 7",
             "postal_code": "10117",
             "country_code": "EE",
+            "latitude": 59.4367,
+            "longitude": 24.7536,
         },
         {
             "system_point_id": "LT40011",
@@ -75,6 +122,8 @@ def _seed_pickup_points():
             "address": "Gedimino pr. 9",
             "postal_code": "01103",
             "country_code": "LT",
+            "latitude": 54.6858,
+            "longitude": 25.2869,
         },
     ]
 
@@ -1,21 +1,29 @@
 ﻿# delivery_router.py - API endpoints для delivery service (УЛУЧШЕННАЯ ВЕРСИЯ)
 
-from fastapi import APIRouter, Depends, HTTPException, Query, Request, BackgroundTasks
-from sqlmodel import Session, select
-from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from sqlmodel import Session
+from fastapi.responses import StreamingResponse
+from typing import Any, Dict, Optional
+from datetime import datetime
+import csv
+import io
 import logging
 import json
 
-from database import get_session
+from database import engine, get_session
 from models import (
     Delivery, DeliveryCreate, DeliveryResponse, 
     DeliveryStatusUpdate, DeliveryTrackingResponse,
     OrderTrackingPageResponse,
     DeliveryStatusHistory,
+    DeliveryHistoryItem,
+    PickupPointNearestResponse,
     PickupPointResponse,
     PickupPointResolveResponse
 )
 from delivery_service import DeliveryService
+from delivery_simulator import delivery_simulator
+from pickup_directory import if_none_match, pickup_directory
 
 
 delivery_router = APIRouter(prefix="/api/v1/delivery", tags=["Delivery"])
@@ -42,19 +50,39 @@ async def list_pickup_points(
     provider: Optional[str] = Query(None, description="Провайдер: dpd/omniva"),
     country_code: Optional[str] = Query(None, description="Код страны: LV/EE/LT"),
     city: Optional[str] = Query(None, description="Город"),
+    postal_code: Optional[str] = Query(None, description="Почтовый индекс"),
     limit: int = Query(200, ge=1, le=500),
+    if_none_match_header: Optional[str] = Header(None, alias="If-None-Match"),
     db: Session = Depends(get_session)
 ):
     """
     Справочник пунктов выдачи (пакоматы/пунселлы).
     
     Используется фронтенд для выбора пункта на странице доставки.
+    Отвечает из снимка в памяти (pickup_directory.py): готовый JSON + ETag, 304 при совпадении.
     """
+    snapshot = pickup_directory.snapshot
+    if snapshot is not None:
+        filters = {
+            "provider": DeliveryService._normalize_provider(provider) if provider else None,
+            "country_code": country_code.strip().upper() if country_code else None,
+            "city": city.strip() if city else None,
+            "postal_code": postal_code.strip() if postal_code else None,
+        }
+        key = (*filters.values(), limit)
+        body, etag = snapshot.serialized_list(key, snapshot.filter(**filters)[:limit])
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+        if if_none_match(if_none_match_header, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    # Снимок ещё не загружен (БД была недоступна при старте) — прежний запрос
     service = DeliveryService(db)
     points = service.get_pickup_points(
         provider=provider,
         country_code=country_code,
         city=city,
+        postal_code=postal_code,
         limit=limit,
     )
 
@@ -74,13 +102,46 @@ async def list_pickup_points(
     ]
 
 
+@delivery_router.get("/pickup-points/nearest", response_model=list[PickupPointNearestResponse])
+async def nearest_pickup_points(
+    lat: float = Query(..., ge=-90, le=90, description="Широта"),
+    lon: float = Query(..., ge=-180, le=180, description="Долгота"),
+    k: int = Query(5, ge=1, le=50, description="Сколько ближайших пунктов вернуть"),
+    provider: Optional[str] = Query(None, description="Провайдер: dpd/omniva"),
+):
+    """Ближайшие к точке пункты выдачи (пункты без координат не участвуют)"""
+    snapshot = pickup_directory.snapshot
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="Pickup point directory is not loaded yet")
+
+    nearest = snapshot.nearest(
+        lat,
+        lon,
+        k,
+        provider=DeliveryService._normalize_provider(provider) if provider else None,
+    )
+    return [
+        PickupPointNearestResponse(**point, distance_km=round(distance, 3))
+        for distance, point in nearest
+    ]
+
+
 @delivery_router.get("/pickup-points/resolve", response_model=PickupPointResolveResponse)
 async def resolve_pickup_point(
     provider: str = Query(..., description="Провайдер: dpd/omniva"),
     system_point_id: str = Query(..., description="ID точки в системе провайдера"),
     db: Session = Depends(get_session)
 ):
-    """Проверка что пункт выдачи существует и доступен"""
+    """Проверка что пункт выдачи существует и доступен (из снимка в памяти, если он загружен)"""
+    snapshot = pickup_directory.snapshot
+    if snapshot is not None:
+        point = snapshot.resolve(DeliveryService._normalize_provider(provider), system_point_id)
+        return PickupPointResolveResponse(
+            found=point is not None,
+            pickup_point=PickupPointResponse(**point) if point else None,
+        )
+
+    # Снимок ещё не загружен — запрос в БД
     service = DeliveryService(db)
     point = service.resolve_pickup_point(provider=provider, system_point_id=system_point_id)
     
@@ -154,7 +215,8 @@ async def create_delivery(
     service = DeliveryService(db)
     
     try:
-        delivery = service.create_delivery(delivery_data)
+        delivery = await service.create_delivery(delivery_data)
+        delivery_simulator.on_delivery_created(delivery)
         return delivery
     except ValueError as e:
         raise HTTPException(
@@ -292,7 +354,6 @@ async def get_delivery_by_order(
 async def order_paid_handler(
     request: Request,
     order_id: int,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_session)
 ):
     service = DeliveryService(db)
@@ -306,7 +367,7 @@ async def order_paid_handler(
         
         logger.info(f"Payment success handler | order_id={order_id} | delivery_id={delivery.id}")
         
-        background_tasks.add_task(_simulate_dpd_delivery, delivery.id, db)
+        delivery_simulator.on_order_paid(delivery.id)
         
         return {"ok": True, "delivery_id": delivery.id}
     
@@ -315,59 +376,28 @@ async def order_paid_handler(
         return {"ok": True}
     
 
-async def _simulate_dpd_delivery(delivery_id: int, db: Session):
-    import asyncio
-    from models import DeliveryStatusUpdate
-    
-    service = DeliveryService(db)
-    
-    try:
-        delivery = db.get(Delivery, delivery_id)
-        if not delivery:
-            return
-        
-        logger.info(f"Starting DPD delivery simulation | delivery_id={delivery_id}")
-        
-        # Этап 1: в пути (сразу)
-        if delivery.status == "created":
-            service.update_delivery_status(
-                delivery_id,
-                DeliveryStatusUpdate(
-                    status="in_transit",
-                    notes="DPD simulation: Picked up by courier"
-                )
-            )
-        
-        # Этап 2: в пункте выдачи (через 2 сек)
-        await asyncio.sleep(2)
-
-        delivery = db.get(Delivery, delivery_id)
-        if delivery and delivery.status == "in_transit":
-            service.update_delivery_status(
-                delivery_id,
-                DeliveryStatusUpdate(
-                    status="at_pickup_point",
-                    notes="DPD simulation: Delivered to pickup point"
-                )
-            )
+# === ОБРАБОТЧИКИ СОБЫТИЙ ИЗ ШИНЫ (events:payments, events:posts) ===
 
-        # Этап 3: получено покупателем (через 10 сек — симуляция скана PIN у пакомата)
-        await asyncio.sleep(10)
-
-        delivery = db.get(Delivery, delivery_id)
-        if delivery and delivery.status == "at_pickup_point":
-            service.update_delivery_status(
-                delivery_id,
-                DeliveryStatusUpdate(
-                    status="picked_up",
-                    notes="DPD simulation: Picked up by recipient"
-                )
-            )
+async def _on_order_paid(db: Session, payload: Dict[str, Any]) -> None:
+    """То же, что /orders/{order_id}/after-payment, но по событию оплаты"""
+    order_id = payload.get("order_id")
+    delivery = DeliveryService(db).get_delivery_by_order(order_id) if order_id else None
+    if not delivery:
+        logger.warning(f"No delivery found for order {order_id}")
+        return
 
-        logger.info(f"DPD delivery simulation completed | delivery_id={delivery_id}")
-    
-    except Exception as e:
-        logger.error(f"DPD delivery simulation failed: {e}")
+    # payment.succeeded и order.paid приходят на один и тот же заказ — вторую симуляцию не запускаем
+    if delivery_simulator.on_order_paid(delivery.id):
+        logger.info(f"Payment event handler | order_id={order_id} | delivery_id={delivery.id}")
+
+
+PAYMENT_EVENT_HANDLERS = {
+    "payment.succeeded": _on_order_paid,
+}
+
+POSTS_EVENT_HANDLERS = {
+    "order.paid": _on_order_paid,
+}
     
 
 @delivery_router.post("/{delivery_id}/status")
@@ -406,7 +436,6 @@ async def update_delivery_status_universal(
 @delivery_router.post("/dpd/webhook")
 async def dpd_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_session)
 ):
     """
@@ -434,29 +463,20 @@ async def dpd_webhook(
         ]
     }
     ```
+    
+    Событие только записывается в очередь dpd_webhook_events и сразу подтверждается;
+    статус применяет фоновая задача delivery.dpd_webhook_inbox (dpd_inbox.py), схлопывая
+    события одной посылки за короткое окно.
     """
     try:
         payload = await request.json()
         
-        parcel_number = payload.get("parcelNumber")
-        if not parcel_number:
+        if not isinstance(payload, dict) or not payload.get("parcelNumber"):
             logger.warning("DPD webhook: missing parcelNumber")
             return {"ok": True}  # всегда 200, иначе DPD повторяет запрос
         
-        # Находим доставку по provider_tracking_number (DPD parcelNumber)
-        service = DeliveryService(db)
-        delivery = service.get_delivery_by_provider_tracking(str(parcel_number))
-        
-        if not delivery:
-            logger.warning(f"DPD webhook: delivery not found for parcel {parcel_number}")
-            return {"ok": True}
-        
-        logger.info(
-            f"DPD webhook received | order_id={delivery.order_id} | parcel={parcel_number}"
-        )
-        
-        # Синхронизируем статус в фоне
-        background_tasks.add_task(service.sync_dpd_tracking, delivery.id)
+        queued = DeliveryService(db).ingest_dpd_webhook(payload)
+        logger.info(f"DPD webhook received | parcel={payload['parcelNumber']} | duplicate={not queued}")
         
         return {"ok": True}
     
@@ -464,36 +484,106 @@ async def dpd_webhook(
         logger.error("DPD webhook: invalid JSON")
         return {"ok": True}
     except Exception as e:
+        # Событие не записано в очередь — не подтверждаем, DPD повторит callback
         logger.error(f"DPD webhook error: {e}")
-        return {"ok": True}
+        raise HTTPException(status_code=503, detail="Webhook not queued")
 
 
 # === ADMIN & LIST ===
 
 @delivery_router.get("/", response_model=list[DeliveryResponse])
 async def list_deliveries(
+    response: Response,
     status: Optional[str] = Query(None, description="Filter by status"),
     provider: Optional[str] = Query(None, description="Filter by provider"),
-    limit: int = Query(50, le=100),
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor из предыдущей страницы"),
     db: Session = Depends(get_session)
 ):
     """
-    Список доставок с фильтрацией.
+    Список доставок с фильтрацией (новые сверху).
     
-    Для администрирования и отладки.
+    Для администрирования и отладки. Постраничный обход — по курсору (created_at, id):
+    курсор следующей страницы приходит в заголовке X-Next-Cursor, на последней странице его нет.
     """
-    query = select(Delivery)
-    
-    if status:
-        query = query.where(Delivery.status == status)
-    
-    if provider:
-        query = query.where(Delivery.provider == provider)
+    service = DeliveryService(db)
+    try:
+        deliveries, next_cursor = service.list_deliveries(
+            status=status, provider=provider, limit=limit, cursor=cursor
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return deliveries
+
+
+@delivery_router.get("/export")
+async def export_deliveries(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    status: Optional[str] = Query(None, description="Filter by status"),
+    provider: Optional[str] = Query(None, description="Filter by provider"),
+    created_from: Optional[datetime] = Query(None),
+    created_to: Optional[datetime] = Query(None),
+):
+    """
+    Выгрузка доставок в CSV или NDJSON потоком.
     
-    query = query.limit(limit).order_by(Delivery.created_at.desc())
+    Строки читаются чанками по DELIVERY_EXPORT_CHUNK_SIZE и сразу отдаются клиенту —
+    выгрузка не собирается в памяти целиком.
+    """
+    filters = dict(status=status, provider=provider, created_from=created_from, created_to=created_to)
+
+    def rows():
+        # Своя сессия: генератор работает уже после того, как зависимость get_session закрылась
+        with Session(engine) as db:
+            yield from DeliveryService(db).iter_export_rows(**filters)
+
+    def as_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=DeliveryService.EXPORT_COLUMNS)
+        writer.writeheader()
+        for row in rows():
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def as_ndjson():
+        for row in rows():
+            yield json.dumps(row, default=str, ensure_ascii=False) + "\n"
+
+    if format == "csv":
+        return StreamingResponse(
+            as_csv(),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="deliveries.csv"'},
+        )
+    return StreamingResponse(as_ndjson(), media_type="application/x-ndjson")
+
+
+@delivery_router.get("/{delivery_id}/history", response_model=list[DeliveryHistoryItem])
+async def delivery_history(
+    delivery_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[int] = Query(None, description="id последней полученной записи"),
+    db: Session = Depends(get_session)
+):
+    """
+    История статусов доставки, новые сверху.
     
-    deliveries = db.exec(query).all()
-    return deliveries
+    Следующая страница — before=<id последней записи предыдущей страницы>.
+    """
+    service = DeliveryService(db)
+    if not db.get(Delivery, delivery_id):
+        raise HTTPException(status_code=404, detail="Delivery not found")
+    try:
+        return service.get_delivery_history(delivery_id, limit=limit, before_id=before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @delivery_router.get("/health")
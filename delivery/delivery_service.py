@@ -1,25 +1,33 @@
 # delivery_service.py - Бизнес-логика delivery service (УЛУЧШЕННАЯ ВЕРСИЯ)
 
+import base64
+import hashlib
+import json
 import secrets
 import string
-import httpx
 import logging
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, Tuple
+from sqlalchemy import and_, or_, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlmodel import Session, select
 
 from models import (
     Delivery, DeliveryStatusHistory, DeliveryStatus, 
     DeliveryProvider, DeliveryCreate, DeliveryStatusUpdate,
-    PickupPoint
+    PickupPoint, DPDWebhookEvent, WebhookEventStatus
 )
 from configs import configs
 from providers.factory import DeliveryProviderFactory
+from outbox import add_outbox_event
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Поток событий delivery-service: events:delivery
+OUTBOX_SOURCE = "delivery"
+
 
 class DeliveryService:
     """
@@ -47,6 +55,7 @@ class DeliveryService:
         provider: Optional[str] = None,
         country_code: Optional[str] = None,
         city: Optional[str] = None,
+        postal_code: Optional[str] = None,
         limit: int = 200
     ) -> list[PickupPoint]:
         """Получить список пунктов выдачи с фильтрацией"""
@@ -58,6 +67,8 @@ class DeliveryService:
             query = query.where(PickupPoint.country_code == country_code.strip().upper())
         if city:
             query = query.where(PickupPoint.city == city.strip())
+        if postal_code:
+            query = query.where(PickupPoint.postal_code == postal_code.strip())
 
         query = query.order_by(PickupPoint.city, PickupPoint.name).limit(limit)
         return self.db.exec(query).all()
@@ -71,7 +82,7 @@ class DeliveryService:
             .where(PickupPoint.is_active == True)
         ).first()
 
-    def _dispatch_provider_integration(self, delivery_data: DeliveryCreate) -> Optional[Dict[str, Any]]:
+    async def _dispatch_provider_integration(self, delivery_data: DeliveryCreate) -> Optional[Dict[str, Any]]:
         """
         Интеграция с провайдером доставки.
         
@@ -107,7 +118,7 @@ class DeliveryService:
         )
         
         try:
-            result = client.create_shipment(delivery_data)
+            result = await client.create_shipment(delivery_data)
             
             # Результат должен быть dict с provider_tracking_number
             if isinstance(result, dict):
@@ -143,7 +154,7 @@ class DeliveryService:
         """Генерация 6-значного кода для получения из пакомата"""
         return ''.join(secrets.choice(string.digits) for _ in range(6))
     
-    def create_delivery(self, delivery_data: DeliveryCreate) -> Delivery:
+    async def create_delivery(self, delivery_data: DeliveryCreate) -> Delivery:
         """
         Создание новой доставки с интеграцией в провайдера.
         
@@ -188,7 +199,7 @@ class DeliveryService:
         shipment_id = None
         
         if delivery_data.provider in [DeliveryProvider.DPD, DeliveryProvider.OMNIVA]:
-            integration_result = self._dispatch_provider_integration(delivery_data)
+            integration_result = await self._dispatch_provider_integration(delivery_data)
             
             if integration_result:
                 # Извлекаем данные из ответа провайдера
@@ -237,15 +248,16 @@ class DeliveryService:
         )
         
         self.db.add(delivery)
+        self.db.flush()
+        
+        # === 6. СОБЫТИЕ ДЛЯ POSTS-SERVICE (в той же транзакции, что и доставка) ===
+        self._queue_delivery_created_event(delivery)
         self.db.commit()
         self.db.refresh(delivery)
         
-        # === 6. ПОДПИСКА НА WEBHOOK (для DPD) ===
+        # === 7. ПОДПИСКА НА WEBHOOK (для DPD) ===
         if delivery_data.provider == DeliveryProvider.DPD and provider_tracking_number:
-            self._subscribe_to_dpd_updates(delivery, provider_tracking_number)
-        
-        # === 7. УВЕДОМЛЕНИЕ POSTS-SERVICE ===
-        self._notify_posts_service_delivery_created(delivery)
+            await self._subscribe_to_dpd_updates(delivery, provider_tracking_number)
         
         logger.info(
             "Delivery created | order_id=%s | delivery_id=%s | "
@@ -258,7 +270,7 @@ class DeliveryService:
         
         return delivery
     
-    def _subscribe_to_dpd_updates(self, delivery: Delivery, parcel_number: str):
+    async def _subscribe_to_dpd_updates(self, delivery: Delivery, parcel_number: str):
         """
         Подписаться на webhook обновления от DPD.
         
@@ -274,7 +286,7 @@ class DeliveryService:
         callback_url = f"{configs.FRONTEND_URL}api/v1/delivery/dpd/webhook"
         
         try:
-            success = self.dpd_client.subscribe_to_tracking(parcel_number, callback_url)
+            success = await self.dpd_client.subscribe_to_tracking(parcel_number, callback_url)
             
             if success:
                 logger.info(
@@ -315,13 +327,160 @@ class DeliveryService:
             select(Delivery).where(Delivery.provider_tracking_number == provider_tracking_number)
         ).first()
 
-    def get_delivery_history(self, delivery_id: int) -> list[DeliveryStatusHistory]:
-        """Получить историю изменений статуса доставки"""
+    def ingest_dpd_webhook(self, payload: Dict[str, Any]) -> bool:
+        """
+        Записать DPD webhook во входящую очередь (dpd_webhook_events).
+        
+        До ответа DPD — только один INSERT ... ON CONFLICT DO NOTHING: повторная доставка
+        того же callback (одинаковые parcelNumber и details), пока первый ещё ждёт обработки,
+        не ставится в очередь второй раз. Сверка только с pending-записями: следующий callback
+        с пустыми или неизменными details после обработки предыдущего принимается.
+        Применяет события dpd_inbox.DPDWebhookInbox.
+        
+        Returns:
+            True, если событие новое
+        """
+        parcel_number = str(payload["parcelNumber"])
+        dedup_key = hashlib.sha1(
+            json.dumps([parcel_number, payload.get("details")], sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+        insert = postgresql.insert if self.db.get_bind().dialect.name == "postgresql" else sqlite.insert
+        result = self.db.execute(
+            insert(DPDWebhookEvent.__table__)
+            .values(
+                parcel_number=parcel_number,
+                dedup_key=dedup_key,
+                payload=payload,
+                status=WebhookEventStatus.PENDING.value,
+                attempts=0,
+                received_at=datetime.utcnow(),
+            )
+            .on_conflict_do_nothing(index_elements=["dedup_key"], index_where=text("status = 'pending'"))
+        )
+        self.db.commit()
+        return bool(result.rowcount)
+
+    def get_delivery_history(
+        self,
+        delivery_id: int,
+        *,
+        limit: Optional[int] = None,
+        before_id: Optional[int] = None,
+    ) -> list[DeliveryStatusHistory]:
+        """Последние записи истории статусов (не больше limit), before_id — продолжение списка"""
+        query = select(DeliveryStatusHistory).where(DeliveryStatusHistory.delivery_id == delivery_id)
+        if before_id is not None:
+            before = self.db.get(DeliveryStatusHistory, before_id)
+            if before is None or before.delivery_id != delivery_id:
+                raise ValueError("Invalid history cursor")
+            query = query.where(
+                or_(
+                    DeliveryStatusHistory.created_at < before.created_at,
+                    and_(
+                        DeliveryStatusHistory.created_at == before.created_at,
+                        DeliveryStatusHistory.id < before.id,
+                    ),
+                )
+            )
         return self.db.exec(
-            select(DeliveryStatusHistory)
-            .where(DeliveryStatusHistory.delivery_id == delivery_id)
-            .order_by(DeliveryStatusHistory.created_at.desc())
+            query
+            .order_by(DeliveryStatusHistory.created_at.desc(), DeliveryStatusHistory.id.desc())
+            .limit(limit or configs.DELIVERY_HISTORY_LIMIT)
+        ).all()
+
+    # === СПИСОК И ВЫГРУЗКА (keyset по created_at desc, id desc) ===
+
+    @staticmethod
+    def encode_cursor(delivery: Delivery) -> str:
+        raw = f"{delivery.created_at.isoformat()}|{delivery.id}"
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+            created_at, delivery_id = raw.split("|", 1)
+            return datetime.fromisoformat(created_at), int(delivery_id)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Invalid cursor")
+
+    @staticmethod
+    def _filtered(
+        query,
+        *,
+        status: Optional[str] = None,
+        provider: Optional[str] = None,
+        created_from: Optional[datetime] = None,
+        created_to: Optional[datetime] = None,
+    ):
+        if status:
+            query = query.where(Delivery.status == status)
+        if provider:
+            query = query.where(Delivery.provider == provider)
+        if created_from:
+            query = query.where(Delivery.created_at >= created_from)
+        if created_to:
+            query = query.where(Delivery.created_at < created_to)
+        return query
+
+    @staticmethod
+    def _after(query, created_at: datetime, delivery_id: int):
+        return query.where(
+            or_(
+                Delivery.created_at < created_at,
+                and_(Delivery.created_at == created_at, Delivery.id < delivery_id),
+            )
+        )
+
+    def list_deliveries(
+        self,
+        *,
+        status: Optional[str] = None,
+        provider: Optional[str] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+    ) -> Tuple[list[Delivery], Optional[str]]:
+        """Страница доставок (новые сверху) и курсор следующей страницы (None — последняя)"""
+        query = self._filtered(select(Delivery), status=status, provider=provider)
+        if cursor:
+            query = self._after(query, *self.decode_cursor(cursor))
+
+        deliveries = self.db.exec(
+            query.order_by(Delivery.created_at.desc(), Delivery.id.desc()).limit(limit + 1)
         ).all()
+        next_cursor = self.encode_cursor(deliveries[limit - 1]) if len(deliveries) > limit else None
+        return deliveries[:limit], next_cursor
+
+    EXPORT_COLUMNS = (
+        "id", "order_id", "provider", "tracking_number", "provider_tracking_number", "status",
+        "pickup_point_id", "created_at", "shipped_at", "arrived_at_pickup_point_at", "picked_up_at",
+    )
+
+    def iter_export_rows(
+        self,
+        *,
+        status: Optional[str] = None,
+        provider: Optional[str] = None,
+        created_from: Optional[datetime] = None,
+        created_to: Optional[datetime] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Все подходящие доставки чанками по DELIVERY_EXPORT_CHUNK_SIZE (keyset, только нужные колонки)"""
+        columns = [getattr(Delivery, name) for name in self.EXPORT_COLUMNS]
+        base = self._filtered(
+            select(*columns), status=status, provider=provider, created_from=created_from, created_to=created_to
+        )
+        last: Optional[Tuple[datetime, int]] = None
+        while True:
+            query = base if last is None else self._after(base, *last)
+            rows = self.db.exec(
+                query.order_by(Delivery.created_at.desc(), Delivery.id.desc()).limit(configs.DELIVERY_EXPORT_CHUNK_SIZE)
+            ).all()
+            for row in rows:
+                yield dict(zip(self.EXPORT_COLUMNS, row))
+            if len(rows) < configs.DELIVERY_EXPORT_CHUNK_SIZE:
+                return
+            last = (rows[-1].created_at, rows[-1].id)
 
     def update_delivery_status(
         self,
@@ -345,8 +504,21 @@ class DeliveryService:
             logger.info(f"Status unchanged for delivery {delivery_id}")
             return delivery
 
-        old_status = delivery.status
         new_status = status_update.status.value
+        self.apply_status_change(delivery, new_status, status_update.notes)
+
+        self.db.commit()
+        self.db.refresh(delivery)
+
+        self.notify_status_change(delivery, new_status)
+        return delivery
+
+    def apply_status_change(self, delivery: Delivery, new_status: str, notes: Optional[str]) -> None:
+        """Переход статуса без commit: статус, история, временные метки, события outbox.
+
+        Общий для update_delivery_status и пакетного поллера трекинга (один commit на пачку).
+        """
+        old_status = delivery.status
 
         # Обновляем статус
         delivery.status = new_status
@@ -356,7 +528,7 @@ class DeliveryService:
         history = DeliveryStatusHistory(
             delivery_id=delivery.id,
             status=new_status,
-            notes=status_update.notes,
+            notes=notes,
         )
         self.db.add(history)
         
@@ -370,9 +542,7 @@ class DeliveryService:
                 delivery.pickup_code = self.generate_pickup_code()
         elif new_status == DeliveryStatus.PICKED_UP.value:
             delivery.picked_up_at = datetime.utcnow()
-
-        self.db.commit()
-        self.db.refresh(delivery)
+            self._queue_delivery_picked_up_event(delivery)
 
         logger.info(
             "Delivery status updated | delivery_id=%s | order_id=%s | "
@@ -381,11 +551,11 @@ class DeliveryService:
             delivery.order_id,
             old_status,
             new_status,
-            status_update.notes or "N/A",
+            notes or "N/A",
         )
 
-        # === ОТПРАВКА УВЕДОМЛЕНИЙ ===
-        
+    def notify_status_change(self, delivery: Delivery, new_status: str) -> None:
+        """Уведомления после commit перехода"""
         # SMS при прибытии в пункт выдачи
         if new_status == DeliveryStatus.AT_PICKUP_POINT.value:
             self._notify_pickup_point_arrival(delivery)
@@ -393,11 +563,8 @@ class DeliveryService:
         # SMS при получении
         elif new_status == DeliveryStatus.PICKED_UP.value:
             self._notify_pickup_confirmation(delivery)
-            self._notify_posts_service_delivery_received(delivery)
-
-        return delivery
     
-    def sync_dpd_tracking(self, delivery_id: int) -> Optional[Delivery]:
+    async def sync_dpd_tracking(self, delivery_id: int) -> Optional[Delivery]:
         """
         Синхронизировать статус с DPD по demand.
         
@@ -419,7 +586,7 @@ class DeliveryService:
             return delivery
 
         # Запрашиваем текущий статус у DPD
-        tracking_data = self.dpd_client.get_tracking_status(parcel_number)
+        tracking_data = await self.dpd_client.get_tracking_status(parcel_number)
 
         if tracking_data.get("dpd_status") in ("error", "unknown"):
             logger.warning(f"DPD tracking unavailable for parcel {parcel_number}")
@@ -496,53 +663,23 @@ class DeliveryService:
         except Exception as e:
             logger.error(f"Failed to send confirmation: {e}")
 
-    def _notify_posts_service_delivery_created(self, delivery: Delivery):
-        """Уведомить posts-service что доставка создана"""
-        try:
-            logger.info(f"Notifying posts-service about delivery creation | order_id={delivery.order_id}")
-            
-            with httpx.Client(timeout=5.0) as client:
-                response = client.post(
-                    f"{configs.POSTS_SERVICE_URL}/api/v1/orders/delivery-events/created",
-                    json={
-                        "order_id": delivery.order_id,
-                        "tracking_number": delivery.tracking_number,
-                        "provider": delivery.provider,
-                        "provider_tracking_number": delivery.provider_tracking_number,
-                        "created_at": delivery.created_at.isoformat()
-                    }
-                )
-                
-                if response.status_code == 200:
-                    logger.info(f"Posts-service notified | order_id={delivery.order_id}")
-                else:
-                    logger.warning(f"Posts-service notification failed: {response.status_code}")
-        
-        except Exception as e:
-            logger.error(f"Failed to notify posts-service: {e}")
-
-    def _notify_posts_service_delivery_received(self, delivery: Delivery):
-        """Уведомить posts-service что доставка получена"""
-        try:
-            logger.info(f"Notifying posts-service about delivery receipt | order_id={delivery.order_id}")
-            
-            with httpx.Client(timeout=5.0) as client:
-                response = client.post(
-                    f"{configs.POSTS_SERVICE_URL}/api/v1/orders/delivery-events/receipts",
-                    json={
-                        "order_id": delivery.order_id,
-                        "tracking_number": delivery.tracking_number,
-                        "picked_up_at": delivery.picked_up_at.isoformat() if delivery.picked_up_at else None
-                    }
-                )
-                
-                if response.status_code == 200:
-                    logger.info(f"Posts-service receipt notified | order_id={delivery.order_id}")
-                else:
-                    logger.warning(f"Posts-service receipt notification failed: {response.status_code}")
-        
-        except Exception as e:
-            logger.error(f"Failed to notify posts-service about receipt: {e}")
+    def _queue_delivery_created_event(self, delivery: Delivery):
+        """Событие delivery.created для posts-service (публикует OutboxRelay)"""
+        add_outbox_event(self.db, OUTBOX_SOURCE, "delivery.created", {
+            "order_id": delivery.order_id,
+            "tracking_number": delivery.tracking_number,
+            "provider": delivery.provider,
+            "provider_tracking_number": delivery.provider_tracking_number,
+            "created_at": delivery.created_at.isoformat(),
+        })
+
+    def _queue_delivery_picked_up_event(self, delivery: Delivery):
+        """Событие delivery.picked_up для posts-service (публикует OutboxRelay)"""
+        add_outbox_event(self.db, OUTBOX_SOURCE, "delivery.picked_up", {
+            "order_id": delivery.order_id,
+            "tracking_number": delivery.tracking_number,
+            "picked_up_at": delivery.picked_up_at.isoformat() if delivery.picked_up_at else None,
+        })
 
     def simulate_delivery_process(self, delivery_id: int):
         """Имитация процесса доставки для тестирования"""
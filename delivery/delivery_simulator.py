@@ -0,0 +1,243 @@
+# delivery_simulator.py - Симуляция доставки DPD (test/staging) через очередь отложенных переходов
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import configs
+from database import engine
+from delivery_service import DeliveryService
+from models import DELIVERY_PROGRESS_RANK, Delivery, DeliveryStatus
+
+logger = logging.getLogger(__name__)
+
+
+# Этап: (задержка от предыдущего этапа в секундах, ожидаемый статус, новый статус, заметка)
+Stage = Tuple[float, str, str, str]
+
+# Созданная DPD-доставка уходит в путь через 5 секунд (раньше — опрос auto_simulate раз в 5 секунд)
+CREATED_PLAN: List[Stage] = [
+    (5.0, DeliveryStatus.CREATED.value, DeliveryStatus.IN_TRANSIT.value, "Автоматическая симуляция: товар в пути"),
+]
+
+# После оплаты: в пути сразу, в пункте выдачи через 2 с, получено ещё через 10 с (скан PIN у пакомата)
+PAID_PLAN: List[Stage] = [
+    (0.0, DeliveryStatus.CREATED.value, DeliveryStatus.IN_TRANSIT.value, "DPD simulation: Picked up by courier"),
+    (2.0, DeliveryStatus.IN_TRANSIT.value, DeliveryStatus.AT_PICKUP_POINT.value,
+     "DPD simulation: Delivered to pickup point"),
+    (10.0, DeliveryStatus.AT_PICKUP_POINT.value, DeliveryStatus.PICKED_UP.value,
+     "DPD simulation: Picked up by recipient"),
+]
+
+# Сколько ждать, чтобы собрать переходы с близкими сроками в одну пачку
+BATCH_WINDOW_SECONDS = 0.05
+
+
+@dataclass(order=True)
+class _Transition:
+    due: float
+    seq: int
+    delivery_id: int = field(compare=False)
+    plan: str = field(compare=False)
+    stages: List[Stage] = field(compare=False)
+
+
+class DeliverySimulator:
+    """
+    Очередь отложенных переходов статуса (heap по сроку) с одной задачей-исполнителем.
+
+    - План переходов ставится в момент события (создание доставки, оплата), опроса БД нет:
+      исполнитель спит до ближайшего срока или до постановки более раннего перехода.
+    - Созревшие переходы применяются пачкой: одна выборка доставок, apply_status_change
+      для тех, чей статус совпал с ожидаемым, один commit; следующий этап плана ставится
+      в очередь только после применения текущего.
+    - Доставка, уже дошедшая до цели этапа (CREATED_PLAN увёл её в путь до order.paid),
+      считает этап пройденным без изменения, и план продолжается со следующего этапа.
+    - SIMULATION_TIME_SCALE ускоряет все задержки (10 — в 10 раз быстрее) для нагрузочных прогонов.
+    - Очередь живёт в памяти реплики; при старте незавершённые симуляции восстанавливаются
+      одним запросом. Повторное применение на другой реплике отсекает проверка статуса под FOR UPDATE.
+    """
+
+    def __init__(self, engine: Engine, *, time_scale: Optional[float] = None, batch_size: Optional[int] = None):
+        self.engine = engine
+        self.time_scale = max(time_scale or configs.SIMULATION_TIME_SCALE, 0.001)
+        self.batch_size = batch_size or configs.SIMULATION_BATCH_SIZE
+        self._queue: List[_Transition] = []
+        self._seq = itertools.count()
+        self._scheduled: Set[Tuple[int, str]] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, Any] = {
+            "scheduled": 0,
+            "applied": 0,
+            "skipped": 0,
+            "caught_up": 0,
+            "batches": 0,
+            "max_batch": 0,
+            "max_lag_ms": 0,
+            "errors": 0,
+        }
+
+    # === ПЛАНИРОВАНИЕ ===
+
+    def on_delivery_created(self, delivery: Delivery) -> None:
+        """Созданная DPD-доставка в режиме simulation уходит в путь через несколько секунд"""
+        if configs.is_dpd_simulation_enabled() and delivery.provider == "dpd":
+            self._schedule(delivery.id, "created", CREATED_PLAN)
+
+    def on_order_paid(self, delivery_id: int) -> bool:
+        """Полный цикл после оплаты. False, если цикл для доставки уже запланирован."""
+        return self._schedule(delivery_id, "paid", PAID_PLAN)
+
+    def _schedule(self, delivery_id: int, plan: str, stages: List[Stage]) -> bool:
+        if (delivery_id, plan) in self._scheduled:
+            return False
+        self._scheduled.add((delivery_id, plan))
+        self._push(delivery_id, plan, stages)
+        return True
+
+    def _push(self, delivery_id: int, plan: str, stages: List[Stage]) -> None:
+        due = time.monotonic() + stages[0][0] / self.time_scale
+        was_earliest = not self._queue or due < self._queue[0].due
+        heapq.heappush(self._queue, _Transition(due, next(self._seq), delivery_id, plan, stages))
+        self.metrics["scheduled"] += 1
+        if was_earliest:
+            self._wakeup.set()
+
+    # === ИСПОЛНИТЕЛЬ ===
+
+    async def start(self) -> None:
+        try:
+            for delivery_id, plan, stages in await asyncio.to_thread(self._unfinished):
+                self._schedule(delivery_id, plan, stages)
+        except Exception as exc:
+            self.metrics["errors"] += 1
+            logger.warning("Delivery simulation recovery failed | error_type=%s", type(exc).__name__)
+        self._task = asyncio.create_task(self._run(), name="delivery-simulator")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._queue:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._queue[0].due - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            horizon = time.monotonic() + BATCH_WINDOW_SECONDS
+            batch: List[_Transition] = []
+            while self._queue and self._queue[0].due <= horizon and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._queue))
+
+            try:
+                applied = await asyncio.to_thread(self._apply, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.metrics["errors"] += 1
+                logger.warning(
+                    "Delivery simulation batch failed | size=%s | error_type=%s", len(batch), type(exc).__name__
+                )
+                applied = set()
+
+            now = time.monotonic()
+            for transition in batch:
+                self.metrics["max_lag_ms"] = max(self.metrics["max_lag_ms"], int((now - transition.due) * 1000))
+                if transition.seq in applied and len(transition.stages) > 1:
+                    self._push(transition.delivery_id, transition.plan, transition.stages[1:])
+                else:
+                    self._scheduled.discard((transition.delivery_id, transition.plan))
+
+    def _apply(self, batch: List[_Transition]) -> Set[int]:
+        """Применяет пачку переходов одним commit. Возвращает seq прошедших переходов."""
+        applied: Set[int] = set()
+        changed = []
+        with Session(self.engine) as db:
+            service = DeliveryService(db)
+            query = select(Delivery).where(Delivery.id.in_({transition.delivery_id for transition in batch}))
+            if self.engine.dialect.name == "postgresql":
+                query = query.with_for_update(skip_locked=True)
+            deliveries = {delivery.id: delivery for delivery in db.exec(query).all()}
+
+            for transition in batch:
+                _, expected_status, new_status, notes = transition.stages[0]
+                delivery = deliveries.get(transition.delivery_id)
+                if delivery is not None and delivery.status != expected_status and self._reached(
+                    delivery.status, new_status
+                ):
+                    # Статус уже на цели этапа или дальше: этап пройден, план идёт дальше
+                    self.metrics["caught_up"] += 1
+                    applied.add(transition.seq)
+                    continue
+                # Доставку изменили снаружи (отмена, возврат) или её держит другая реплика
+                if delivery is None or delivery.status != expected_status:
+                    self.metrics["skipped"] += 1
+                    continue
+                service.apply_status_change(delivery, new_status, notes)
+                changed.append((delivery, new_status))
+                applied.add(transition.seq)
+            db.commit()
+
+            for delivery, new_status in changed:
+                db.refresh(delivery)
+                service.notify_status_change(delivery, new_status)
+
+        self.metrics["applied"] += len(changed)
+        self.metrics["batches"] += 1
+        self.metrics["max_batch"] = max(self.metrics["max_batch"], len(batch))
+        return applied
+
+    @staticmethod
+    def _reached(status: str, target: str) -> bool:
+        """Доставка уже на цели этапа или дальше по пути (DELIVERY_PROGRESS_RANK)"""
+        rank = DELIVERY_PROGRESS_RANK.get(status)
+        return rank is not None and rank >= DELIVERY_PROGRESS_RANK[target]
+
+    def _unfinished(self) -> List[Tuple[int, str, List[Stage]]]:
+        """Незавершённые симуляции после рестарта: доставки DPD на промежуточных стадиях"""
+        if not configs.is_dpd_simulation_enabled():
+            return []
+        resume = {
+            DeliveryStatus.CREATED.value: ("created", CREATED_PLAN),
+            DeliveryStatus.IN_TRANSIT.value: ("paid", PAID_PLAN[1:]),
+            DeliveryStatus.AT_PICKUP_POINT.value: ("paid", PAID_PLAN[2:]),
+        }
+        with Session(self.engine) as db:
+            rows = db.exec(
+                select(Delivery.id, Delivery.status).where(
+                    Delivery.provider == "dpd",
+                    Delivery.status.in_(list(resume)),
+                )
+            ).all()
+        if rows:
+            logger.info("Delivery simulation recovered | deliveries=%s", len(rows))
+        return [(delivery_id, *resume[status]) for delivery_id, status in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.metrics,
+            "pending": len(self._queue),
+            "time_scale": self.time_scale,
+        }
+
+
+delivery_simulator = DeliverySimulator(engine)
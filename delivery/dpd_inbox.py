@@ -0,0 +1,242 @@
+# dpd_inbox.py - Обработка очереди DPD webhook (dpd_webhook_events)
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from sqlalchemy import delete, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import configs
+from delivery_service import DeliveryService
+from models import Delivery, DPDWebhookEvent, WebhookEventStatus
+from providers.dpd import DPDProviderClient
+from tracking_poller import tracking_interval
+
+logger = logging.getLogger(__name__)
+
+
+CLEANUP_INTERVAL_SECONDS = 3600
+
+
+def latest_known_status(events: List[DPDWebhookEvent]) -> Optional[str]:
+    """Самый свежий статус DPD из details всех событий посылки, который мы умеем маппить.
+
+    Сортировка по dateTime ("YYYY-MM-DD HH:MM:SS" сравнивается как строка), при равенстве —
+    более позднее событие очереди, внутри одного payload DPD кладёт свежие записи первыми.
+    """
+    candidates = []
+    for event in events:
+        details = event.payload.get("details") if isinstance(event.payload, dict) else None
+        if not isinstance(details, list):
+            continue
+        for position, detail in enumerate(details):
+            if not isinstance(detail, dict):
+                continue
+            status = detail.get("status") or ""
+            if DPDProviderClient.map_dpd_status_to_internal(status):
+                candidates.append((str(detail.get("dateTime") or ""), event.id, -position, status))
+    return max(candidates)[3] if candidates else None
+
+
+class DPDWebhookInbox:
+    """
+    Один проход очереди DPD webhook:
+
+    1. берёт pending-события, пролежавшие не меньше DPD_WEBHOOK_COALESCE_SECONDS (окно схлопывания),
+       и все остальные pending-события тех же посылок;
+    2. по каждой посылке — один статус: самый свежий из details payload'ов, и только если
+       в details нет ни одного известного статуса — запрос трекинга (пачкой на все такие посылки);
+    3. применяет переходы через DeliveryService.apply_status_change одним commit, события помечает
+       processed / ignored одним UPDATE. Ошибка запроса к DPD оставляет события pending
+       (attempts + 1, после DPD_WEBHOOK_MAX_ATTEMPTS — failed).
+
+    Запускается JobScheduler'ом (одна реплика на запуск), поэтому без блокировок строк.
+    """
+
+    def __init__(self, engine: Engine, dpd_client: Optional[DPDProviderClient] = None):
+        self.engine = engine
+        self.dpd_client = dpd_client or DPDProviderClient()
+        self.metrics: Dict[str, Any] = {
+            "runs": 0,
+            "events": 0,
+            "parcels": 0,
+            "applied_from_payload": 0,
+            "tracking_fetches": 0,
+            "status_changes": 0,
+            "ignored": 0,
+            "retried": 0,
+            "failed": 0,
+            "last_run_ms": None,
+        }
+        self._last_cleanup = 0.0
+
+    async def process_pending(self) -> Dict[str, int]:
+        started = time.monotonic()
+        events = await asyncio.to_thread(self._claim)
+        report = {"events": len(events), "parcels": 0, "changed": 0}
+        if not events:
+            await asyncio.to_thread(self._cleanup)
+            return report
+
+        by_parcel: Dict[str, List[DPDWebhookEvent]] = {}
+        for event in events:
+            by_parcel.setdefault(event.parcel_number, []).append(event)
+        report["parcels"] = len(by_parcel)
+
+        statuses = {parcel: latest_known_status(parcel_events) for parcel, parcel_events in by_parcel.items()}
+        self.metrics["applied_from_payload"] += sum(1 for status in statuses.values() if status)
+
+        fetch_failed: Set[str] = set()
+        missing = [parcel for parcel, status in statuses.items() if status is None]
+        if missing and configs.get_dpd_mode() != "simulation":
+            batch_size = max(1, configs.DPD_TRACKING_BATCH_SIZE)
+            for offset in range(0, len(missing), batch_size):
+                chunk = missing[offset:offset + batch_size]
+                self.metrics["tracking_fetches"] += 1
+                try:
+                    tracking = await self.dpd_client.get_tracking_statuses(chunk)
+                except Exception as exc:
+                    fetch_failed.update(chunk)
+                    logger.warning(
+                        "DPD webhook tracking fetch failed | parcels=%s | error_type=%s", len(chunk), type(exc).__name__
+                    )
+                    continue
+                for parcel in chunk:
+                    dpd_status = (tracking.get(parcel) or {}).get("dpd_status")
+                    if self.dpd_client.map_dpd_status_to_internal(dpd_status or ""):
+                        statuses[parcel] = dpd_status
+
+        report["changed"] = await asyncio.to_thread(self._apply, by_parcel, statuses, fetch_failed)
+        await asyncio.to_thread(self._cleanup)
+
+        self.metrics["runs"] += 1
+        self.metrics["events"] += report["events"]
+        self.metrics["parcels"] += report["parcels"]
+        self.metrics["status_changes"] += report["changed"]
+        self.metrics["last_run_ms"] = int((time.monotonic() - started) * 1000)
+        logger.info(
+            "DPD webhook inbox | events=%s | parcels=%s | changed=%s | fetch_failed=%s | duration_ms=%s",
+            report["events"], report["parcels"], report["changed"], len(fetch_failed), self.metrics["last_run_ms"],
+        )
+        return report
+
+    def _claim(self) -> List[DPDWebhookEvent]:
+        cutoff = datetime.utcnow() - timedelta(seconds=configs.DPD_WEBHOOK_COALESCE_SECONDS)
+        with Session(self.engine, expire_on_commit=False) as db:
+            parcels = db.exec(
+                select(DPDWebhookEvent.parcel_number)
+                .where(
+                    DPDWebhookEvent.status == WebhookEventStatus.PENDING.value,
+                    DPDWebhookEvent.received_at <= cutoff,
+                )
+                .order_by(DPDWebhookEvent.id)
+                .limit(configs.DPD_WEBHOOK_BATCH_SIZE)
+            ).all()
+            if not parcels:
+                return []
+            events = db.exec(
+                select(DPDWebhookEvent)
+                .where(
+                    DPDWebhookEvent.status == WebhookEventStatus.PENDING.value,
+                    DPDWebhookEvent.parcel_number.in_(set(parcels)),
+                )
+                .order_by(DPDWebhookEvent.id)
+            ).all()
+            return list(events)
+
+    def _apply(
+        self,
+        by_parcel: Dict[str, List[DPDWebhookEvent]],
+        statuses: Dict[str, Optional[str]],
+        fetch_failed: Set[str],
+    ) -> int:
+        now = datetime.utcnow()
+        processed_ids: List[int] = []
+        ignored_ids: List[int] = []
+        retry_ids: List[int] = []
+        changed_deliveries = []
+
+        with Session(self.engine) as db:
+            service = DeliveryService(db)
+            deliveries = {
+                delivery.provider_tracking_number: delivery
+                for delivery in db.exec(
+                    select(Delivery).where(Delivery.provider_tracking_number.in_(list(by_parcel)))
+                ).all()
+            }
+
+            for parcel, parcel_events in by_parcel.items():
+                event_ids = [event.id for event in parcel_events]
+                delivery = deliveries.get(parcel)
+                if delivery is None:
+                    logger.warning(f"DPD webhook: delivery not found for parcel {parcel}")
+                    ignored_ids.extend(event_ids)
+                    continue
+                if parcel in fetch_failed:
+                    retry_ids.extend(event_ids)
+                    continue
+
+                processed_ids.extend(event_ids)
+                dpd_status_text = statuses.get(parcel)
+                internal_status = self.dpd_client.map_dpd_status_to_internal(dpd_status_text or "")
+                if internal_status and internal_status != delivery.status:
+                    service.apply_status_change(delivery, internal_status, f"DPD webhook: {dpd_status_text}")
+                    changed_deliveries.append((delivery, internal_status))
+                # Свежий статус от DPD: поллеру трекинга не нужно проверять посылку раньше срока
+                delivery.tracking_checked_at = now
+                delivery.next_tracking_check_at = now + tracking_interval(delivery.status)
+                db.add(delivery)
+
+            for status, event_ids in (
+                (WebhookEventStatus.PROCESSED.value, processed_ids),
+                (WebhookEventStatus.IGNORED.value, ignored_ids),
+            ):
+                if event_ids:
+                    db.execute(
+                        update(DPDWebhookEvent)
+                        .where(DPDWebhookEvent.id.in_(event_ids))
+                        .values(status=status, processed_at=now)
+                    )
+            if retry_ids:
+                db.execute(
+                    update(DPDWebhookEvent)
+                    .where(DPDWebhookEvent.id.in_(retry_ids))
+                    .values(attempts=DPDWebhookEvent.attempts + 1, last_error="DPD tracking fetch failed")
+                )
+                failed = db.execute(
+                    update(DPDWebhookEvent)
+                    .where(
+                        DPDWebhookEvent.id.in_(retry_ids),
+                        DPDWebhookEvent.attempts >= configs.DPD_WEBHOOK_MAX_ATTEMPTS,
+                    )
+                    .values(status=WebhookEventStatus.FAILED.value, processed_at=now)
+                )
+                self.metrics["failed"] += failed.rowcount or 0
+            db.commit()
+
+            for delivery, new_status in changed_deliveries:
+                db.refresh(delivery)
+                service.notify_status_change(delivery, new_status)
+
+        self.metrics["ignored"] += len(ignored_ids)
+        self.metrics["retried"] += len(retry_ids)
+        return len(changed_deliveries)
+
+    def _cleanup(self) -> None:
+        """Обработанные события старше DPD_WEBHOOK_RETENTION_DAYS удаляются (не чаще раза в час)"""
+        if time.monotonic() - self._last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return
+        self._last_cleanup = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(days=configs.DPD_WEBHOOK_RETENTION_DAYS)
+        with Session(self.engine) as db:
+            db.execute(
+                delete(DPDWebhookEvent).where(
+                    DPDWebhookEvent.status != WebhookEventStatus.PENDING.value,
+                    DPDWebhookEvent.received_at < cutoff,
+                )
+            )
+            db.commit()
@@ -0,0 +1,194 @@
+# fake_dpd.py - Локальный фейковый DPD API для ручных проверок и замеров пропускной способности
+#
+# Запуск сервера:
+#   python fake_dpd.py serve --port 8765 --latency-ms 150 --error-rate 0.02
+# Замер DPDProviderClient против него (DPD_TEST_API_BASE_URL подменяется на адрес фейка):
+#   python fake_dpd.py bench --url http://127.0.0.1:8765 --operation tracking --requests 2000 --concurrency 100
+
+import argparse
+import asyncio
+import random
+import secrets
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request, Response
+
+
+# Статусы DPD в порядке прохождения посылки (см. DPDProviderClient.map_dpd_status_to_internal)
+STATUS_FLOW = [
+    "Dropped in Pickup Point",
+    "Picked up by Courier",
+    "En route",
+    "Delivered to Pickup Point",
+    "Picked up by Consignee from Pickup point",
+]
+
+
+def create_app(*, latency_ms: int = 0, error_rate: float = 0.0, step_seconds: float = 30.0) -> FastAPI:
+    """
+    Фейк повторяет форму ответов DPD, которую разбирает providers/dpd.py:
+    - POST /shipments → [{"id", "parcelNumbers", "dplPin"}]
+    - GET /status/tracking?pknr=a,b → [{"parcelNumber", "details": [...]}], свежие записи первыми
+    - GET /status/events/(un)subscribetoparcel → 200
+
+    Посылка проходит STATUS_FLOW по шагу в step_seconds. latency_ms и error_rate (доля ответов 503)
+    задают поведение для проверки таймаутов и повторов.
+    """
+    app = FastAPI(title="Fake DPD API")
+    parcels: Dict[str, datetime] = {}
+    stats = {"shipments": 0, "tracking_requests": 0, "tracked_parcels": 0, "errors": 0}
+
+    @app.middleware("http")
+    async def latency_and_errors(request: Request, call_next):
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000 * random.uniform(0.5, 1.5))
+        if error_rate and request.url.path != "/stats" and random.random() < error_rate:
+            stats["errors"] += 1
+            return Response(status_code=503, content="fake dpd unavailable")
+        return await call_next(request)
+
+    def details(parcel_number: str) -> List[Dict[str, Any]]:
+        created_at = parcels.setdefault(parcel_number, datetime.utcnow())
+        reached = min(int((datetime.utcnow() - created_at).total_seconds() // step_seconds), len(STATUS_FLOW) - 1)
+        return [
+            {
+                "status": STATUS_FLOW[step],
+                "dateTime": (created_at + timedelta(seconds=step * step_seconds)).strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for step in range(reached, -1, -1)
+        ]
+
+    @app.post("/shipments")
+    async def create_shipments(request: Request):
+        shipments = await request.json()
+        result = []
+        for _ in shipments if isinstance(shipments, list) else [shipments]:
+            parcel_number = "".join(secrets.choice("0123456789") for _ in range(14))
+            parcels[parcel_number] = datetime.utcnow()
+            stats["shipments"] += 1
+            result.append({
+                "id": secrets.token_hex(8),
+                "parcelNumbers": [parcel_number],
+                "dplPin": [{"pin": f"{secrets.randbelow(10 ** 6):06d}"}],
+            })
+        return result
+
+    @app.get("/status/tracking")
+    async def tracking(pknr: str):
+        numbers = [number for number in pknr.split(",") if number]
+        stats["tracking_requests"] += 1
+        stats["tracked_parcels"] += len(numbers)
+        return [{"parcelNumber": number, "details": details(number)} for number in numbers]
+
+    @app.get("/status/events/subscribetoparcel")
+    async def subscribe(parcelnumber: str, callbackurl: str):
+        return {"ok": True}
+
+    @app.get("/status/events/unsubscribetoparcel")
+    async def unsubscribe(parcelnumber: str, callbackurl: str):
+        return {"ok": True}
+
+    @app.get("/stats")
+    async def get_stats():
+        return {**stats, "parcels": len(parcels)}
+
+    return app
+
+
+async def run_benchmark(url: str, operation: str, requests: int, concurrency: int) -> None:
+    from configs import DeliveryConfigs, configs
+
+    # Режим test против фейка; get_dpd_mode — classmethod, поэтому правим атрибуты класса
+    DeliveryConfigs.DPD_TEST_MODE = True
+    DeliveryConfigs.DPD_INNER_SYSTEM_SIMULATION = False
+    DeliveryConfigs.DPD_TEST_API_BASE_URL = url.rstrip("/")
+    DeliveryConfigs.DPD_TEST_API_KEY = DeliveryConfigs.DPD_TEST_API_KEY or "fake"
+
+    from models import DeliveryCreate, DeliveryProvider
+    from providers.dpd import DPDProviderClient
+    from providers.http import close_http_client
+
+    client = DPDProviderClient()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def one(index: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if operation == "shipment":
+                    await client.create_shipment(DeliveryCreate(
+                        order_id=index + 1,
+                        provider=DeliveryProvider.DPD,
+                        pickup_point_id="LV90001",
+                        recipient_name="Bench Recipient",
+                        recipient_phone="+37120000000",
+                        recipient_email="bench@example.com",
+                        sender_name="Bench Sender",
+                        sender_phone="+37120000001",
+                    ))
+                elif operation == "tracking":
+                    result = await client.get_tracking_status(f"{index:014d}")
+                    if result.get("dpd_status") in ("error", "unknown"):
+                        failures += 1
+                else:
+                    numbers = [f"{index * configs.DPD_TRACKING_BATCH_SIZE + offset:014d}"
+                               for offset in range(configs.DPD_TRACKING_BATCH_SIZE)]
+                    await client.get_tracking_statuses(numbers)
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    elapsed = time.perf_counter() - started
+    await close_http_client()
+
+    latencies.sort()
+    print(
+        f"operation={operation} requests={requests} concurrency={concurrency} failures={failures}\n"
+        f"elapsed_s={elapsed:.2f} rps={requests / elapsed:.1f}\n"
+        f"latency_ms p50={statistics.median(latencies) * 1000:.1f} "
+        f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} "
+        f"max={latencies[-1] * 1000:.1f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake DPD API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--latency-ms", type=int, default=0)
+    serve.add_argument("--error-rate", type=float, default=0.0)
+    serve.add_argument("--step-seconds", type=float, default=30.0)
+
+    bench = commands.add_parser("bench")
+    bench.add_argument("--url", default="http://127.0.0.1:8765")
+    bench.add_argument("--operation", choices=["shipment", "tracking", "tracking_batch"], default="tracking")
+    bench.add_argument("--requests", type=int, default=1000)
+    bench.add_argument("--concurrency", type=int, default=50)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        import uvicorn
+
+        uvicorn.run(
+            create_app(latency_ms=args.latency_ms, error_rate=args.error_rate, step_seconds=args.step_seconds),
+            host=args.host,
+            port=args.port,
+            log_level="warning",
+        )
+    else:
+        asyncio.run(run_benchmark(args.url, args.operation, args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,18 @@ import asyncio
 import httpx
 import logging
 
-from database import create_db_and_tables
-from delivery_router import delivery_router
+from database import create_db_and_tables, engine
+from delivery_simulator import delivery_simulator
+from dpd_inbox import DPDWebhookInbox
+from delivery_router import delivery_router, PAYMENT_EVENT_HANDLERS, POSTS_EVENT_HANDLERS
+from delivery_service import OUTBOX_SOURCE
 from configs import configs
+from outbox import OutboxRelay, StreamConsumer
+from pickup_directory import pickup_directory
+from pickup_sync import apply_pickup_points, last_sync_report, stage_dpd_lockers
+from providers.http import close_http_client
+from scheduler import JobScheduler
+from tracking_poller import DPDTrackingPoller
 
 logger = logging.getLogger(__name__)
 
@@ -18,189 +27,99 @@ logger = logging.getLogger(__name__)
 # ФОНОВЫЕ ЗАДАЧИ
 # ═══════════════════════════════════════════════════════════════════════════
 
-# Флаг для предотвращения одновременного запуска синхронизации
-_sync_in_progress = False
+# Одна реплика на запуск задачи: advisory lock + общее расписание в таблице scheduler_job
+scheduler = JobScheduler(engine)
+
+# Шина событий: delivery.* публикуются через outbox, оплаты приходят из events:payments и events:posts
+outbox_relay = OutboxRelay(engine, configs.REDIS_URL, OUTBOX_SOURCE)
+event_consumers = [
+    StreamConsumer(engine, configs.REDIS_URL, source="payments", group="delivery", handlers=PAYMENT_EVENT_HANDLERS),
+    StreamConsumer(engine, configs.REDIS_URL, source="posts", group="delivery", handlers=POSTS_EVENT_HANDLERS),
+]
+
+# Страховка для пропущенных DPD webhook: пакетный опрос трекинга активных доставок
+tracking_poller = DPDTrackingPoller(engine)
+
+# Очередь DPD webhook: эндпоинт только пишет событие, применяет эта задача
+dpd_webhook_inbox = DPDWebhookInbox(engine)
 
 
 async def sync_dpd_pickup_points():
     """Синхронизирует pickup points с DPD API.
     
-    Запускается:
-    - При старте сервиса
-    - 2 раза в день (каждые 12 часов)
+    Запускается планировщиком:
+    - при первом старте (задачи ещё нет в scheduler_job)
+    - 2 раза в день (cron 03:00 и 15:00 UTC)
+
+    Payload разбирается в staging (pickup_sync.stage_dpd_lockers) и применяется
+    чанками upsert + одним UPDATE деактивации в отдельном потоке.
     """
-    global _sync_in_progress
-    
-    if _sync_in_progress:
-        logger.info("DPD pickup points sync already in progress, skipping...")
+    if not configs.DPD_TEST_API_KEY:
+        logger.warning("DPD_TEST_API_KEY not configured, skipping pickup points sync")
         return
     
-    _sync_in_progress = True
-    try:
-        from sqlmodel import Session
-        from database import engine
-        from models import PickupPoint
-        from sqlmodel import select
-        
-        if not configs.DPD_TEST_API_KEY:
-            logger.warning("DPD_TEST_API_KEY not configured, skipping pickup points sync")
-            return
-        
-        endpoint = f"{configs.DPD_TEST_API_BASE_URL}/lockers"
-        headers = {
-            "Authorization": f"Bearer {configs.DPD_TEST_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                # Запрашиваем pickup points из DPD API
-                response = await client.get(
-                    endpoint,
-                    headers=headers,
-                    params={
-                        "countryCode": "LV",
-                        "lockerType": "PickupStation",
-                    }
-                )
-                
-                if response.status_code == 200:
-                    payload = response.json() or {}
-                    # DPD API returns array directly, not wrapped in an object
-                    if isinstance(payload, list):
-                        lockers = payload
-                    else:
-                        lockers = payload.get("lockers") or payload.get("data") or payload.get("items") or payload
-                        if isinstance(lockers, dict):
-                            lockers = lockers.get("lockers") or lockers.get("items") or []
-                    if not isinstance(lockers, list):
-                        lockers = []
-
-                    incoming_ids = set()
-
-                    with Session(engine) as db:
-                        for locker in lockers:
-                            locker_id = str(locker.get("id") or locker.get("systemPointId") or locker.get("pointId") or locker.get("lockerId") or "").strip()
-                            if not locker_id:
-                                continue
-
-                            incoming_ids.add(locker_id)
-                            address = locker.get("address") or {}
-                            existing = db.exec(
-                                select(PickupPoint).where(
-                                    PickupPoint.provider == "dpd",
-                                    PickupPoint.system_point_id == locker_id,
-                                )
-                            ).first()
-
-                            point_name = locker.get("name") or locker.get("title") or locker.get("description") or locker_id
-                            city = address.get("city") or locker.get("city") or ""
-                            street = address.get("street") or address.get("addressLine1") or locker.get("address") or ""
-                            postal_code = address.get("postcode") or address.get("postalCode") or locker.get("postalCode") or locker.get("zip") or ""
-                            country_code = (address.get("country") or locker.get("country") or "LV")[:2].upper()
-
-                            if existing:
-                                existing.locker_index = str(locker.get("locker_index") or locker.get("code") or locker_id)
-                                existing.name = point_name
-                                existing.city = city or existing.city
-                                existing.address = street or existing.address
-                                existing.postal_code = postal_code or existing.postal_code
-                                existing.country_code = country_code or existing.country_code
-                                existing.is_active = True
-                            else:
-                                db.add(
-                                    PickupPoint(
-                                        system_point_id=locker_id,
-                                        provider="dpd",
-                                        locker_index=str(locker.get("locker_index") or locker.get("code") or locker_id),
-                                        name=point_name,
-                                        city=city or "Riga",
-                                        address=street,
-                                        postal_code=postal_code,
-                                        country_code=country_code,
-                                        is_active=True,
-                                    )
-                                )
-
-                        existing_points = db.exec(
-                            select(PickupPoint).where(PickupPoint.provider == "dpd")
-                        ).all()
-                        for point in existing_points:
-                            if point.system_point_id not in incoming_ids:
-                                point.is_active = False
-
-                        db.commit()
-                        logger.info(f"✅ DPD pickup points synced | count={len(incoming_ids)}")
-                else:
-                    logger.error(
-                        f"DPD API error | status={response.status_code} | response={response.text}"
-                    )
-        except httpx.RequestError as e:
-            logger.error(f"DPD API request error: {str(e)}")
-        except Exception as e:
-            logger.error(f"DPD sync error: {str(e)}")
-    
-    finally:
-        _sync_in_progress = False
-
-
-# Фоновая задача для автоматической симуляции доставки
-async def auto_simulate_deliveries():
-    """Автоматически обновляет статусы доставок"""
-    from sqlmodel import Session, select
-    from database import engine
-    from models import Delivery, DeliveryStatus
-    from delivery_service import DeliveryService
-    from models import DeliveryStatusUpdate
-    from datetime import datetime, timedelta
+    endpoint = f"{configs.DPD_TEST_API_BASE_URL}/lockers"
+    headers = {
+        "Authorization": f"Bearer {configs.DPD_TEST_API_KEY}",
+        "Content-Type": "application/json",
+    }
     
-    while True:
-        try:
-            await asyncio.sleep(5)  # Проверяем каждые 5 секунд
-
-            if not configs.is_dpd_simulation_enabled():
-                await asyncio.sleep(30)
-                continue
-            
-            with Session(engine) as db:
-                service = DeliveryService(db)
-                
-                # Находим доставки в статусе "created" старше 5 секунд
-                deliveries = db.exec(
-                    select(Delivery).where(
-                        Delivery.status == DeliveryStatus.CREATED.value,
-                        Delivery.provider == "dpd"
-                    )
-                ).all()
-                
-                for delivery in deliveries:
-                    age = datetime.utcnow() - delivery.created_at
-                    if age.total_seconds() >= 5:
-                        logger.info(f"🤖 Auto-simulating: {delivery.tracking_number} -> in_transit")
-                        service.update_delivery_status(
-                            delivery.id,
-                            DeliveryStatusUpdate(
-                                status=DeliveryStatus.IN_TRANSIT,
-                                notes="Автоматическая симуляция: товар в пути"
-                            )
-                        )
-        except Exception as e:
-            logger.error(f"Auto-simulate error: {str(e)}")
-            await asyncio.sleep(10)
-
-
-# Фоновая задача для периодической синхронизации pickup points
-async def periodic_sync_pickup_points():
-    """Синхронизирует pickup points каждые 12 часов"""
-    await asyncio.sleep(12 * 60 * 60)
-    while True:
-        try:
-            await sync_dpd_pickup_points()
-            # Следующая синхронизация через 12 часов
-            await asyncio.sleep(12 * 60 * 60)
-        except Exception as e:
-            logger.error(f"Periodic sync error: {str(e)}")
-            await asyncio.sleep(60)
+    try:
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            # Запрашиваем pickup points из DPD API
+            response = await client.get(
+                endpoint,
+                headers=headers,
+                params={
+                    "countryCode": "LV",
+                    "lockerType": "PickupStation",
+                }
+            )
+    except httpx.RequestError as e:
+        logger.error(f"DPD API request error: {str(e)}")
+        return
+
+    if response.status_code != 200:
+        logger.error(
+            f"DPD API error | status={response.status_code} | response={response.text}"
+        )
+        return
+
+    try:
+        staged = stage_dpd_lockers(response.json())
+        report = await asyncio.to_thread(apply_pickup_points, engine, staged)
+        # Снимок этой реплики — сразу; остальные увидят новый отпечаток таблицы в течение минуты
+        await asyncio.to_thread(pickup_directory.reload)
+    except Exception as e:
+        logger.error(f"DPD sync error: {str(e)}")
+        raise
+
+    logger.info(
+        "✅ DPD pickup points synced | received=%s | inserted=%s | updated=%s | unchanged=%s | "
+        "deactivated=%s | duration_ms=%s",
+        report["received"], report["inserted"], report["updated"], report["unchanged"],
+        report["deactivated"], report["duration_ms"],
+    )
+
+
+scheduler.add_cron_job(
+    "delivery.sync_pickup_points",
+    sync_dpd_pickup_points,
+    "0 3,15 * * *",
+    jitter_seconds=60,
+    run_immediately=True,
+)
+scheduler.add_interval_job(
+    "delivery.dpd_tracking_poll",
+    tracking_poller.poll_once,
+    configs.DPD_TRACKING_POLL_SECONDS,
+    jitter_seconds=30,
+)
+scheduler.add_interval_job(
+    "delivery.dpd_webhook_inbox",
+    dpd_webhook_inbox.process_pending,
+    configs.DPD_WEBHOOK_COALESCE_SECONDS,
+)
 
 
 @asynccontextmanager
@@ -209,23 +128,31 @@ async def lifespan(app: FastAPI):
     print("🚀 Starting Delivery Service...")
     create_db_and_tables()
     print("✅ Database tables created")
-    
-    # Запускаем фоновую симуляцию
-    simulation_task = asyncio.create_task(auto_simulate_deliveries())
-    print("🤖 Auto-simulation started")
 
-    # Запускаем первичную синхронизацию и периодический refresh pickup points
-    pickup_sync_task = asyncio.create_task(periodic_sync_pickup_points())
-    try:
-        await sync_dpd_pickup_points()
-    except Exception as exc:
-        logger.warning(f"Initial DPD pickup points sync failed: {exc}")
+    await pickup_directory.start()
+    
+    # Симуляция доставок — очередь отложенных переходов, без опроса БД
+    await delivery_simulator.start()
+    
+    # Синхронизация pickup points и опрос трекинга — через планировщик
+    await scheduler.start()
+    print("🤖 Background jobs scheduled")
+    
+    await outbox_relay.start()
+    for consumer in event_consumers:
+        await consumer.start()
+    print("📨 Event bus started")
     
     yield
     
     # Shutdown
-    simulation_task.cancel()
-    pickup_sync_task.cancel()
+    for consumer in event_consumers:
+        await consumer.stop()
+    await outbox_relay.stop()
+    await scheduler.stop()
+    await pickup_directory.stop()
+    await delivery_simulator.stop()
+    await close_http_client()
     print("👋 Shutting down Delivery Service...")
 
 
@@ -279,6 +206,28 @@ async def root():
     }
 
 
+@app.get("/scheduler/jobs")
+async def get_scheduler_jobs():
+    """Метрики фоновых задач этой реплики"""
+    return {
+        "jobs": scheduler.metrics(),
+        "pickup_points_sync": last_sync_report,
+        "pickup_directory": pickup_directory.stats(),
+        "delivery_simulator": delivery_simulator.stats(),
+        "dpd_tracking_poll": tracking_poller.metrics,
+        "dpd_webhook_inbox": dpd_webhook_inbox.metrics,
+    }
+
+
+@app.get("/events/metrics")
+async def get_event_bus_metrics():
+    """Метрики шины событий этой реплики: outbox relay и потребители"""
+    return {
+        "outbox_relay": outbox_relay.metrics,
+        "consumers": {consumer.stream: await consumer.stats() for consumer in event_consumers},
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
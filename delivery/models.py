@@ -1,8 +1,9 @@
 # models.py - Модели для delivery service
 
+from sqlalchemy import Column, Index, JSON, text
 from sqlmodel import Field, SQLModel
 from pydantic import BaseModel, Field as PydanticField
-from typing import Optional
+from typing import Any, Dict, Optional
 from datetime import datetime
 from enum import Enum
 
@@ -28,12 +29,43 @@ class DeliveryStatus(str, Enum):
     RETURNED = "returned"  # Возвращено отправителю
 
 
+# Порядок статусов на пути посылки (cancelled/returned вне порядка): откат назад — устаревшее событие
+DELIVERY_PROGRESS_RANK: Dict[str, int] = {
+    DeliveryStatus.CREATED.value: 0,
+    DeliveryStatus.IN_TRANSIT.value: 1,
+    DeliveryStatus.AT_PICKUP_POINT.value: 2,
+    DeliveryStatus.PICKED_UP.value: 3,
+}
+
+
+def is_status_regression(current: str, new: str) -> bool:
+    """True, если new — более ранняя стадия пути, чем current"""
+    current_rank = DELIVERY_PROGRESS_RANK.get(current)
+    new_rank = DELIVERY_PROGRESS_RANK.get(new)
+    return current_rank is not None and new_rank is not None and new_rank < current_rank
+
+
+class WebhookEventStatus(str, Enum):
+    """Статусы записи во входящей очереди DPD webhook"""
+    PENDING = "pending"  # Ждёт обработки
+    PROCESSED = "processed"  # Применено (или статус не изменился)
+    IGNORED = "ignored"  # Доставка с таким parcelNumber не найдена
+    FAILED = "failed"  # Исчерпаны попытки
+
+
 # =============================================================================
 # DATABASE MODELS
 # =============================================================================
 
 class Delivery(SQLModel, table=True):
     """Таблица доставок"""
+    __table_args__ = (
+        # Keyset-пагинация списка (created_at desc, id desc) с фильтром по статусу / провайдеру и без
+        Index("ix_delivery_status_created_at", "status", "created_at", "id"),
+        Index("ix_delivery_provider_created_at", "provider", "created_at", "id"),
+        Index("ix_delivery_created_at_id", "created_at", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     
     # Связь с заказом (без foreign key - микросервисная архитектура)
@@ -87,9 +119,17 @@ class Delivery(SQLModel, table=True):
     notification_sent_at_pickup_point: bool = Field(default=False)  # SMS с кодом отправлен
     notification_sent_picked_up: bool = Field(default=False)  # SMS о получении отправлен
 
+    # Поллер трекинга DPD: когда проверяли и когда проверить снова (зависит от стадии)
+    tracking_checked_at: Optional[datetime] = Field(default=None)
+    next_tracking_check_at: Optional[datetime] = Field(default=None, index=True)
+
 
 class DeliveryStatusHistory(SQLModel, table=True):
     """История изменения статусов доставки"""
+    __table_args__ = (
+        Index("ix_deliverystatushistory_delivery_id_created_at", "delivery_id", "created_at", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     
     delivery_id: int = Field(index=True)
@@ -112,8 +152,41 @@ class PickupPoint(SQLModel, table=True):
     address: str = Field(max_length=255)
     postal_code: str = Field(max_length=20, index=True)
     country_code: str = Field(default="LV", max_length=2, index=True)
+    latitude: Optional[float] = Field(default=None)
+    longitude: Optional[float] = Field(default=None)
     is_active: bool = Field(default=True, index=True)
+    # sha1 полей из DPD: синхронизация пропускает неизменившиеся пункты (pickup_sync.py)
+    content_hash: Optional[str] = Field(default=None, max_length=40)
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class DPDWebhookEvent(SQLModel, table=True):
+    """Входящая очередь DPD webhook: пишет эндпоинт, применяет dpd_inbox.DPDWebhookInbox"""
+    __tablename__ = "dpd_webhook_events"
+    __table_args__ = (
+        Index("ix_dpd_webhook_events_pending", "id", postgresql_where=text("status = 'pending'")),
+        # Уникальность только среди ещё не обработанных: повтор callback, пока он в очереди,
+        # схлопывается, а более поздний callback с теми же details после обработки принимается
+        Index(
+            "ux_dpd_webhook_events_pending_dedup",
+            "dedup_key",
+            unique=True,
+            postgresql_where=text("status = 'pending'"),
+            sqlite_where=text("status = 'pending'"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    parcel_number: str = Field(max_length=100, index=True)
+    # sha1(parcelNumber + details): повторы одного и того же callback от DPD не ставятся в очередь
+    dedup_key: str = Field(max_length=40)
+    payload: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+    status: str = Field(default=WebhookEventStatus.PENDING.value, max_length=20)
+    attempts: int = Field(default=0)
+    last_error: Optional[str] = Field(default=None, max_length=500)
+    received_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+    processed_at: Optional[datetime] = Field(default=None)
 
 
 # =============================================================================
@@ -230,6 +303,14 @@ class DeliveryTrackingResponse(BaseModel):
     status_history: list = []
 
 
+class DeliveryHistoryItem(BaseModel):
+    """Запись истории статусов (GET /{delivery_id}/history)"""
+    id: int
+    status: str
+    notes: Optional[str]
+    created_at: datetime
+
+
 class OrderTrackingPageResponse(BaseModel):
     """Ответ для страницы заказа по tracking_number"""
     tracking_number: str
@@ -271,6 +352,10 @@ class PickupPointResponse(BaseModel):
     country_code: str
 
 
+class PickupPointNearestResponse(PickupPointResponse):
+    distance_km: float
+
+
 class PickupPointResolveResponse(BaseModel):
     found: bool
     pickup_point: Optional[PickupPointResponse] = None
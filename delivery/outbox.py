@@ -0,0 +1,530 @@
+# outbox.py - Transactional outbox + шина событий на Redis Streams
+#
+# Одинаковая копия лежит в каждом сервисе, который публикует или потребляет события
+# (posts, delivery, payments, notifications): сервисы собираются из своих папок и общего пакета у них нет.
+#
+# Публикация: add_outbox_event() пишет событие в outbox_event в той же транзакции, что и изменение
+# состояния. OutboxRelay забирает неопубликованные строки своего source (FOR UPDATE SKIP LOCKED —
+# реплики не мешают друг другу) и делает XADD в поток events:<source>. Упавший XADD просто
+# повторяется на следующем проходе: строка остаётся в БД и переживает рестарт.
+#
+# Потребление: StreamConsumer читает поток через consumer group. Обработчики сами коммитят свои
+# изменения (через сервисы), поэтому отметка processed_event пишется отдельным шагом только после
+# успешного обработчика: упавший посреди работы обработчик не оставляет отметки, и событие
+# доставляется снова. Уже отмеченное событие повторно не обрабатывается; обработчики должны быть
+# идемпотентны для узкого окна между их коммитом и отметкой (at-least-once). Сообщение без XACK
+# остаётся в pending и через reclaim_idle_ms забирается заново; после max_deliveries попыток
+# уходит в поток <stream>:dead.
+#
+# Пакетная обработка: batch_handlers получают все события своего типа из одного XREADGROUP разом
+# (один SELECT по processed_event, один вызов обработчика, одна запись отметок, один XACK). Если пакет упал, он разбирается
+# поштучно, чтобы одно битое событие не держало остальные.
+#
+# Длина потоков ограничена: XADD MAXLEN ~ DEFAULT_STREAM_MAXLEN. Отставание группы (lag) видно
+# в StreamConsumer.stats().
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+from sqlalchemy import Column, Index, JSON, delete, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Field, Session, SQLModel, select
+
+logger = logging.getLogger("outbox")
+
+# Приблизительный предел длины потока (XADD MAXLEN ~): старые записи вытесняются,
+# необработанные к тому времени сообщения reclaim подтверждает как вытесненные
+DEFAULT_STREAM_MAXLEN = 100_000
+
+
+def stream_name(source: str) -> str:
+    return f"events:{source}"
+
+
+def stream_id_ms(message_id: Optional[str]) -> int:
+    """Время записи в потоке (мс) из её id вида <ms>-<seq>."""
+    if not message_id:
+        return 0
+    return int(str(message_id).split("-", 1)[0])
+
+
+class OutboxEvent(SQLModel, table=True):
+    """Событие, ожидающее публикации в Redis Streams."""
+    __tablename__ = "outbox_event"
+    __table_args__ = (
+        Index(
+            "ix_outbox_event_unpublished",
+            "source",
+            "id",
+            postgresql_where=text("published_at IS NULL"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    source: str = Field(max_length=50)
+    event_type: str = Field(max_length=100)
+    payload: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    published_at: Optional[datetime] = Field(default=None)
+    attempts: int = Field(default=0)
+    last_error: Optional[str] = Field(default=None, max_length=500)
+
+
+class ProcessedEvent(SQLModel, table=True):
+    """Событие, уже обработанное consumer group (идемпотентность потребителя)."""
+    __tablename__ = "processed_event"
+
+    consumer_group: str = Field(primary_key=True, max_length=100)
+    event_id: str = Field(primary_key=True, max_length=150)
+    processed_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+def add_outbox_event(db: Session, source: str, event_type: str, payload: Dict[str, Any]) -> OutboxEvent:
+    """Кладёт событие в outbox в текущей транзакции db; relay опубликует его после коммита."""
+    event = OutboxEvent(
+        source=source,
+        event_type=event_type,
+        # datetime/Decimal -> строки: payload уходит в JSON-колонку и в поток как есть
+        payload=json.loads(json.dumps(payload, default=str)),
+    )
+    db.add(event)
+    return event
+
+
+class OutboxRelay:
+    def __init__(
+        self,
+        engine: Engine,
+        redis_url: str,
+        source: str,
+        *,
+        batch_size: int = 100,
+        poll_interval_seconds: float = 0.5,
+        retention_hours: int = 24,
+        maxlen: int = DEFAULT_STREAM_MAXLEN,
+    ):
+        self.engine = engine
+        self.redis_url = redis_url
+        self.source = source
+        self.stream = stream_name(source)
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.poll_interval_seconds = poll_interval_seconds
+        self.retention = timedelta(hours=retention_hours)
+        self._redis: Optional[aioredis.Redis] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+        self.metrics: Dict[str, Any] = {
+            "published": 0,
+            "failed_batches": 0,
+            "purged": 0,
+            "last_published_at": None,
+            "last_error": None,
+        }
+
+    async def start(self) -> None:
+        self._redis = aioredis.Redis.from_url(self.redis_url, decode_responses=True)
+        self._task = asyncio.create_task(self._run(), name=f"outbox-relay:{self.source}")
+        logger.info("Outbox relay started | source=%s | stream=%s", self.source, self.stream)
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._redis:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def _run(self) -> None:
+        delay = self.poll_interval_seconds
+        while True:
+            try:
+                published = await self.relay_once()
+                delay = self.poll_interval_seconds
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                published = 0
+                delay = min(delay * 2, 30.0)
+                self.metrics["failed_batches"] += 1
+                self.metrics["last_error"] = type(exc).__name__
+                logger.warning("Outbox relay error | source=%s | error_type=%s", self.source, type(exc).__name__)
+
+            self._purge_published()
+            # Пока есть хвост — выгребаем без пауз
+            if not published:
+                await asyncio.sleep(delay)
+
+    async def relay_once(self) -> int:
+        with Session(self.engine) as db:
+            events = db.exec(
+                select(OutboxEvent)
+                .where(OutboxEvent.source == self.source, OutboxEvent.published_at == None)
+                .order_by(OutboxEvent.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not events:
+                return 0
+
+            event_ids = [event.id for event in events]
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    for event in events:
+                        pipe.xadd(
+                            self.stream,
+                            {
+                                "event_id": f"{self.source}:{event.id}",
+                                "event_type": event.event_type,
+                                "payload": json.dumps(event.payload or {}),
+                                "created_at": event.created_at.isoformat(),
+                            },
+                            maxlen=self.maxlen,
+                            approximate=True,
+                        )
+                    await pipe.execute()
+            except Exception as exc:
+                db.rollback()
+                db.execute(
+                    update(OutboxEvent)
+                    .where(OutboxEvent.id.in_(event_ids))
+                    .values(attempts=OutboxEvent.attempts + 1, last_error=f"{type(exc).__name__}: {exc}"[:500])
+                )
+                db.commit()
+                raise
+
+            now = datetime.utcnow()
+            db.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_(event_ids))
+                .values(published_at=now, attempts=OutboxEvent.attempts + 1, last_error=None)
+            )
+            db.commit()
+
+        self.metrics["published"] += len(event_ids)
+        self.metrics["last_published_at"] = now.isoformat()
+        return len(event_ids)
+
+    def _purge_published(self) -> None:
+        if time.monotonic() - self._last_purge < 600:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            with Session(self.engine) as db:
+                result = db.execute(
+                    delete(OutboxEvent).where(
+                        OutboxEvent.source == self.source,
+                        OutboxEvent.published_at != None,
+                        OutboxEvent.published_at < datetime.utcnow() - self.retention,
+                    )
+                )
+                db.commit()
+            self.metrics["purged"] += result.rowcount or 0
+        except Exception as exc:
+            logger.warning("Outbox purge failed | source=%s | error_type=%s", self.source, type(exc).__name__)
+
+
+EventHandler = Callable[[Session, Dict[str, Any]], Awaitable[None]]
+BatchEventHandler = Callable[[Session, List[Dict[str, Any]]], Awaitable[None]]
+StreamMessage = Tuple[str, Dict[str, str]]
+
+
+class StreamConsumer:
+    def __init__(
+        self,
+        engine: Engine,
+        redis_url: str,
+        *,
+        source: str,
+        group: str,
+        handlers: Optional[Dict[str, EventHandler]] = None,
+        batch_handlers: Optional[Dict[str, BatchEventHandler]] = None,
+        batch_size: int = 10,
+        block_ms: int = 5000,
+        reclaim_idle_ms: int = 60000,
+        max_deliveries: int = 10,
+    ):
+        self.engine = engine
+        self.redis_url = redis_url
+        self.stream = stream_name(source)
+        self.group = group
+        self.handlers = handlers or {}
+        self.batch_handlers = batch_handlers or {}
+        self.consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.reclaim_idle_ms = reclaim_idle_ms
+        self.max_deliveries = max_deliveries
+        self._redis: Optional[aioredis.Redis] = None
+        self._task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, Any] = {
+            "processed": 0,
+            "duplicates": 0,
+            "ignored": 0,
+            "failed": 0,
+            "failed_batches": 0,
+            "batches": 0,
+            "reclaimed": 0,
+            "dead_lettered": 0,
+            "last_processed_at": None,
+        }
+
+    async def start(self) -> None:
+        self._redis = aioredis.Redis.from_url(self.redis_url, decode_responses=True)
+        try:
+            await self._redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+        self._task = asyncio.create_task(self._run(), name=f"stream-consumer:{self.group}:{self.stream}")
+        logger.info(
+            "Stream consumer started | stream=%s | group=%s | consumer=%s",
+            self.stream,
+            self.group,
+            self.consumer_name,
+        )
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._redis:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def stats(self) -> Dict[str, Any]:
+        """Счётчики реплики + отставание группы по данным Redis (общее для всех реплик)."""
+        try:
+            lag = await self._lag()
+        except Exception as exc:
+            lag = {"error": type(exc).__name__}
+        return {**self.metrics, "lag": lag}
+
+    async def _lag(self) -> Dict[str, Any]:
+        stream_info = await self._redis.xinfo_stream(self.stream)
+        group_info = next(
+            (group for group in await self._redis.xinfo_groups(self.stream) if group["name"] == self.group),
+            None,
+        )
+        if group_info is None:
+            return {"stream_length": stream_info["length"], "group": None}
+
+        pending = await self._redis.xpending(self.stream, self.group)
+        now_ms = int(time.time() * 1000)
+        last_generated_ms = stream_id_ms(stream_info.get("last-generated-id"))
+        last_delivered_ms = stream_id_ms(group_info.get("last-delivered-id"))
+        return {
+            "stream_length": stream_info["length"],
+            # Записей, ещё не выданных группе (Redis 7+; на старых версиях None)
+            "entries_behind": group_info.get("lag"),
+            "pending": group_info["pending"],
+            # На сколько миллисекунд последняя выданная группе запись старше последней записанной
+            "lag_ms": max(0, last_generated_ms - last_delivered_ms) if last_delivered_ms else None,
+            "oldest_pending_age_ms": (
+                max(0, now_ms - stream_id_ms(pending["min"])) if pending and pending.get("pending") else 0
+            ),
+        }
+
+    async def _run(self) -> None:
+        last_reclaim = 0.0
+        while True:
+            try:
+                if time.monotonic() - last_reclaim >= self.reclaim_idle_ms / 1000:
+                    last_reclaim = time.monotonic()
+                    await self._reclaim()
+
+                response = await self._redis.xreadgroup(
+                    self.group,
+                    self.consumer_name,
+                    {self.stream: ">"},
+                    count=self.batch_size,
+                    block=self.block_ms,
+                )
+                for _stream, messages in response or []:
+                    await self._process(messages)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning(
+                    "Stream consumer error | stream=%s | group=%s | error_type=%s",
+                    self.stream,
+                    self.group,
+                    type(exc).__name__,
+                )
+                await asyncio.sleep(1)
+
+    async def _process(self, messages: List[StreamMessage]) -> None:
+        batches: Dict[str, List[StreamMessage]] = {}
+        ignored: List[str] = []
+        for message_id, fields in messages:
+            event_type = fields.get("event_type")
+            if event_type in self.batch_handlers:
+                batches.setdefault(event_type, []).append((message_id, fields))
+            elif event_type in self.handlers:
+                await self._handle(message_id, fields)
+            else:
+                # Чужое для этой группы событие
+                ignored.append(message_id)
+
+        if ignored:
+            await self._redis.xack(self.stream, self.group, *ignored)
+            self.metrics["ignored"] += len(ignored)
+
+        for event_type, batch in batches.items():
+            if await self._handle_batch(event_type, batch) or len(batch) == 1:
+                continue
+            # Пакет не прошёл — разбираем поштучно, чтобы изолировать битое событие
+            for message in batch:
+                await self._handle_batch(event_type, [message])
+
+    async def _reclaim(self) -> None:
+        """Забирает сообщения, зависшие в pending (упавший обработчик, умершая реплика)."""
+        pending = await self._redis.xpending_range(
+            self.stream,
+            self.group,
+            min="-",
+            max="+",
+            count=self.batch_size,
+            idle=self.reclaim_idle_ms,
+        )
+        if not pending:
+            return
+
+        deliveries = {entry["message_id"]: entry["times_delivered"] for entry in pending}
+        claimed = await self._redis.xclaim(
+            self.stream,
+            self.group,
+            self.consumer_name,
+            min_idle_time=self.reclaim_idle_ms,
+            message_ids=list(deliveries),
+        )
+        # Не попавшие в claimed сообщения уже забрала другая реплика
+
+        retry: List[StreamMessage] = []
+        for message_id, fields in claimed:
+            if fields is None:
+                # Запись вытеснена из потока (MAXLEN) — подтверждать больше нечего
+                if message_id:
+                    await self._redis.xack(self.stream, self.group, message_id)
+                continue
+
+            if deliveries.get(message_id, 0) >= self.max_deliveries:
+                await self._redis.xadd(
+                    f"{self.stream}:dead",
+                    {**fields, "consumer_group": self.group, "message_id": message_id},
+                    maxlen=DEFAULT_STREAM_MAXLEN,
+                    approximate=True,
+                )
+                await self._redis.xack(self.stream, self.group, message_id)
+                self.metrics["dead_lettered"] += 1
+                logger.error(
+                    "Stream event dead-lettered | stream=%s | group=%s | event_id=%s | deliveries=%s",
+                    self.stream,
+                    self.group,
+                    fields.get("event_id"),
+                    deliveries.get(message_id),
+                )
+                continue
+
+            retry.append((message_id, fields))
+
+        if retry:
+            self.metrics["reclaimed"] += len(retry)
+            await self._process(retry)
+
+    async def _handle(self, message_id: str, fields: Dict[str, str]) -> None:
+        event_id = fields.get("event_id") or message_id
+        event_type = fields.get("event_type")
+        handler = self.handlers[event_type]
+
+        with Session(self.engine) as db:
+            if db.get(ProcessedEvent, (self.group, event_id)) is not None:
+                await self._redis.xack(self.stream, self.group, message_id)
+                self.metrics["duplicates"] += 1
+                return
+
+            try:
+                await handler(db, json.loads(fields.get("payload") or "{}"))
+                db.commit()
+                # Отметка — только после успешного обработчика, отдельным коммитом
+                self._mark_processed(db, [event_id])
+            except Exception as exc:
+                db.rollback()
+                self.metrics["failed"] += 1
+                logger.warning(
+                    "Stream event failed | group=%s | event_id=%s | event_type=%s | error_type=%s",
+                    self.group,
+                    event_id,
+                    event_type,
+                    type(exc).__name__,
+                )
+                return
+
+        await self._redis.xack(self.stream, self.group, message_id)
+        self.metrics["processed"] += 1
+        self.metrics["last_processed_at"] = datetime.utcnow().isoformat()
+
+    def _mark_processed(self, db: Session, event_ids: List[str]) -> None:
+        """Отметки обработанных событий. Уже поставленные параллельной обработкой пропускаются."""
+        for event_id in event_ids:
+            db.add(ProcessedEvent(consumer_group=self.group, event_id=event_id))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Та же пачка (или её часть) обработана другой репликой: дописываем недостающие
+            db.rollback()
+            for event_id in event_ids:
+                if db.get(ProcessedEvent, (self.group, event_id)) is None:
+                    db.add(ProcessedEvent(consumer_group=self.group, event_id=event_id))
+            db.commit()
+
+    async def _handle_batch(self, event_type: str, messages: List[StreamMessage]) -> bool:
+        """Один вызов batch-обработчика на пачку событий одного типа. False — пачка не обработана."""
+        handler = self.batch_handlers[event_type]
+        event_ids = {message_id: fields.get("event_id") or message_id for message_id, fields in messages}
+
+        with Session(self.engine) as db:
+            done = set(
+                db.exec(
+                    select(ProcessedEvent.event_id).where(
+                        ProcessedEvent.consumer_group == self.group,
+                        ProcessedEvent.event_id.in_(list(event_ids.values())),
+                    )
+                ).all()
+            )
+            fresh = [(message_id, fields) for message_id, fields in messages if event_ids[message_id] not in done]
+            try:
+                if fresh:
+                    await handler(db, [json.loads(fields.get("payload") or "{}") for _, fields in fresh])
+                    db.commit()
+                    self._mark_processed(db, [event_ids[message_id] for message_id, _ in fresh])
+            except Exception as exc:
+                db.rollback()
+                self.metrics["failed_batches" if len(messages) > 1 else "failed"] += 1
+                logger.warning(
+                    "Stream batch failed | group=%s | event_type=%s | size=%s | error_type=%s",
+                    self.group,
+                    event_type,
+                    len(messages),
+                    type(exc).__name__,
+                )
+                return False
+
+        await self._redis.xack(self.stream, self.group, *event_ids)
+        self.metrics["batches"] += 1
+        self.metrics["processed"] += len(fresh)
+        self.metrics["duplicates"] += len(messages) - len(fresh)
+        if fresh:
+            self.metrics["last_processed_at"] = datetime.utcnow().isoformat()
+        return True
@@ -0,0 +1,282 @@
+# pickup_directory.py - Снимок справочника пунктов выдачи в памяти процесса
+
+import asyncio
+import hashlib
+import heapq
+import json
+import logging
+import math
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+
+from database import engine
+from models import PickupPoint
+
+logger = logging.getLogger(__name__)
+
+
+GRID_CELL_DEGREES = 0.25  # ~28 км по широте
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+MAX_CACHED_LISTS = 256
+
+# Поля ответа /pickup-points (PickupPointResponse)
+RESPONSE_FIELDS = (
+    "id", "system_point_id", "provider", "locker_index", "name",
+    "city", "address", "postal_code", "country_code",
+)
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell(lat: float, lon: float) -> Tuple[int, int]:
+    return int(math.floor(lat / GRID_CELL_DEGREES)), int(math.floor(lon / GRID_CELL_DEGREES))
+
+
+class PickupPointSnapshot:
+    """Неизменяемый снимок активных пунктов: индексы по полям фильтров + сетка для поиска ближайших.
+
+    Пункты отсортированы по (city, name), как и прежний ответ из БД; индексы хранят позиции
+    в этом списке, поэтому пересечение индексов сразу даёт нужный порядок.
+    """
+
+    def __init__(self, points: List[Dict[str, Any]], fingerprint: str):
+        self.points = sorted(points, key=lambda point: (point["city"], point["name"]))
+        self.version = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+        self.built_at = datetime.utcnow()
+
+        self.by_provider: Dict[str, List[int]] = defaultdict(list)
+        self.by_country: Dict[str, List[int]] = defaultdict(list)
+        self.by_city: Dict[str, List[int]] = defaultdict(list)
+        self.by_postal_code: Dict[str, List[int]] = defaultdict(list)
+        self.by_key: Dict[Tuple[str, str], int] = {}
+        self.grid: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        self.geo_positions: List[int] = []
+        self.geo_count_by_provider: Dict[str, int] = defaultdict(int)
+
+        for position, point in enumerate(self.points):
+            self.by_provider[point["provider"]].append(position)
+            self.by_country[point["country_code"]].append(position)
+            self.by_city[point["city"]].append(position)
+            self.by_postal_code[point["postal_code"]].append(position)
+            self.by_key[(point["provider"], point["system_point_id"])] = position
+            if point["latitude"] is not None and point["longitude"] is not None:
+                self.grid[_cell(point["latitude"], point["longitude"])].append(position)
+                self.geo_positions.append(position)
+                self.geo_count_by_provider[point["provider"]] += 1
+
+        self._serialized: Dict[Tuple, Tuple[bytes, str]] = {}
+
+    def _public(self, position: int) -> Dict[str, Any]:
+        point = self.points[position]
+        return {field: point[field] for field in RESPONSE_FIELDS}
+
+    def filter(
+        self,
+        *,
+        provider: Optional[str] = None,
+        country_code: Optional[str] = None,
+        city: Optional[str] = None,
+        postal_code: Optional[str] = None,
+    ) -> List[int]:
+        candidates: Optional[List[int]] = None
+        for index, value in (
+            (self.by_provider, provider),
+            (self.by_country, country_code),
+            (self.by_city, city),
+            (self.by_postal_code, postal_code),
+        ):
+            if value is None:
+                continue
+            positions = index.get(value, [])
+            if candidates is None:
+                candidates = positions
+            else:
+                allowed = set(positions)
+                candidates = [position for position in candidates if position in allowed]
+            if not candidates:
+                return []
+        return list(range(len(self.points))) if candidates is None else candidates
+
+    def serialized_list(self, key: Tuple, positions: List[int]) -> Tuple[bytes, str]:
+        """JSON-ответ и ETag для набора фильтров; сериализуется один раз на версию снимка."""
+        cached = self._serialized.get(key)
+        if cached is None:
+            body = json.dumps([self._public(position) for position in positions], ensure_ascii=False).encode("utf-8")
+            etag = f'"{self.version}-{hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]}"'
+            cached = (body, etag)
+            if len(self._serialized) < MAX_CACHED_LISTS:
+                self._serialized[key] = cached
+        return cached
+
+    def resolve(self, provider: str, system_point_id: str) -> Optional[Dict[str, Any]]:
+        position = self.by_key.get((provider, system_point_id))
+        return None if position is None else self._public(position)
+
+    def nearest(
+        self, lat: float, lon: float, k: int, *, provider: Optional[str] = None
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """k ближайших пунктов: обход колец сетки вокруг точки, пока k-е расстояние не меньше
+        минимально возможного расстояния до ещё не просмотренных ячеек.
+
+        Если точка далеко от всех пунктов (кольца охватили бы больше ячеек, чем занято в сетке),
+        дешевле линейный проход по всем пунктам с координатами."""
+        candidates = self.geo_count_by_provider.get(provider, 0) if provider else len(self.geo_positions)
+        k = min(k, candidates)
+        if k <= 0:
+            return []
+
+        def distance(position: int) -> float:
+            point = self.points[position]
+            return haversine_km(lat, lon, point["latitude"], point["longitude"])
+
+        center_lat, center_lon = _cell(lat, lon)
+        occupied = len(self.grid)
+        found: List[Tuple[float, int]] = []
+        ring = 0
+        while (2 * ring + 1) ** 2 <= occupied:
+            for cell in self._ring_cells(center_lat, center_lon, ring):
+                for position in self.grid.get(cell, ()):
+                    if provider and self.points[position]["provider"] != provider:
+                        continue
+                    found.append((distance(position), position))
+
+            if len(found) >= k:
+                found.sort()
+                # Всё, что за пределами кольца ring, не ближе этой границы
+                widest_lat = min(89.0, abs(lat) + (ring + 1) * GRID_CELL_DEGREES)
+                bound_km = ring * GRID_CELL_DEGREES * KM_PER_DEGREE * math.cos(math.radians(widest_lat))
+                if found[k - 1][0] <= bound_km:
+                    return [(d, self._public(position)) for d, position in found[:k]]
+            ring += 1
+
+        nearest = heapq.nsmallest(
+            k,
+            (
+                (distance(position), position)
+                for position in self.geo_positions
+                if not provider or self.points[position]["provider"] == provider
+            ),
+        )
+        return [(d, self._public(position)) for d, position in nearest]
+
+    @staticmethod
+    def _ring_cells(center_lat: int, center_lon: int, ring: int):
+        """Только периметр кольца: 8 * ring ячеек (одна при ring == 0)"""
+        if ring == 0:
+            yield center_lat, center_lon
+            return
+        for cell_lon in range(center_lon - ring, center_lon + ring + 1):
+            yield center_lat - ring, cell_lon
+            yield center_lat + ring, cell_lon
+        for cell_lat in range(center_lat - ring + 1, center_lat + ring):
+            yield cell_lat, center_lon - ring
+            yield cell_lat, center_lon + ring
+
+
+class PickupPointDirectory:
+    """Версионированный снимок pickup_points на процесс.
+
+    Перестраивается после синхронизации с DPD (на реплике, которая её выполнила) и по
+    изменению отпечатка таблицы (count + max(updated_at)), который проверяется раз в
+    refresh_interval_seconds на всех репликах.
+    """
+
+    def __init__(self, engine: Engine, *, refresh_interval_seconds: float = 60.0):
+        self.engine = engine
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.snapshot: Optional[PickupPointSnapshot] = None
+        self._fingerprint: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, Any] = {"rebuilds": 0, "last_rebuild_ms": None, "refresh_errors": 0}
+
+    def _read_fingerprint(self, conn) -> str:
+        table = PickupPoint.__table__
+        total, active, last_updated = conn.execute(
+            select(
+                func.count(table.c.id),
+                func.count(table.c.id).filter(table.c.is_active == True),
+                func.max(table.c.updated_at),
+            )
+        ).one()
+        return f"{total}:{active}:{last_updated}"
+
+    def reload(self, *, force: bool = False) -> bool:
+        """Перестраивает снимок, если таблица изменилась. Синхронный: из async-кода — через to_thread."""
+        started = datetime.utcnow()
+        table = PickupPoint.__table__
+        with self.engine.connect() as conn:
+            fingerprint = self._read_fingerprint(conn)
+            if not force and fingerprint == self._fingerprint:
+                return False
+            rows = conn.execute(
+                select(
+                    table.c.id, table.c.system_point_id, table.c.provider, table.c.locker_index,
+                    table.c.name, table.c.city, table.c.address, table.c.postal_code,
+                    table.c.country_code, table.c.latitude, table.c.longitude,
+                ).where(table.c.is_active == True)
+            ).mappings().all()
+
+        self.snapshot = PickupPointSnapshot([dict(row) for row in rows], fingerprint)
+        self._fingerprint = fingerprint
+        self.metrics["rebuilds"] += 1
+        self.metrics["last_rebuild_ms"] = int((datetime.utcnow() - started).total_seconds() * 1000)
+        logger.info(
+            "Pickup point snapshot rebuilt | version=%s | points=%s | duration_ms=%s",
+            self.snapshot.version, len(self.snapshot.points), self.metrics["last_rebuild_ms"],
+        )
+        return True
+
+    async def start(self) -> None:
+        try:
+            await asyncio.to_thread(self.reload, force=True)
+        except Exception as exc:
+            self.metrics["refresh_errors"] += 1
+            logger.warning("Pickup point snapshot load failed | error_type=%s", type(exc).__name__)
+        self._task = asyncio.create_task(self._refresh_loop(), name="pickup-point-directory")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval_seconds)
+            try:
+                await asyncio.to_thread(self.reload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.metrics["refresh_errors"] += 1
+                logger.warning("Pickup point snapshot refresh failed | error_type=%s", type(exc).__name__)
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            **self.metrics,
+            "version": snapshot.version if snapshot else None,
+            "points": len(snapshot.points) if snapshot else 0,
+            "with_coordinates": sum(len(cell) for cell in snapshot.grid.values()) if snapshot else 0,
+            "built_at": snapshot.built_at.isoformat() if snapshot else None,
+        }
+
+
+pickup_directory = PickupPointDirectory(engine)
+
+def if_none_match(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
@@ -0,0 +1,206 @@
+# pickup_sync.py - Синхронизация справочника пунктов выдачи DPD
+
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+from models import PickupPoint
+
+logger = logging.getLogger(__name__)
+
+
+SYNC_CHUNK_SIZE = 500
+
+# Поля, из которых считается content_hash: неизменившийся пункт не переписывается
+HASHED_FIELDS = (
+    "provider", "locker_index", "name", "city", "address", "postal_code", "country_code", "latitude", "longitude",
+)
+
+# Последний отчёт синхронизации этой реплики (GET /scheduler/jobs)
+last_sync_report: Dict[str, Any] = {}
+
+
+def extract_lockers(payload: Any) -> List[Dict[str, Any]]:
+    """DPD отдаёт массив напрямую, но встречались и обёртки {lockers|data|items: [...]}"""
+    if isinstance(payload, list):
+        lockers = payload
+    elif isinstance(payload, dict):
+        lockers = payload.get("lockers") or payload.get("data") or payload.get("items") or payload
+        if isinstance(lockers, dict):
+            lockers = lockers.get("lockers") or lockers.get("items") or []
+    else:
+        return []
+    if not isinstance(lockers, list):
+        return []
+    return [locker for locker in lockers if isinstance(locker, dict)]
+
+
+def content_hash(row: Dict[str, Any]) -> str:
+    return hashlib.sha1(
+        json.dumps([row.get(field) for field in HASHED_FIELDS], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def _coordinate(*values: Any) -> Optional[float]:
+    for value in values:
+        try:
+            if value is not None and value != "":
+                return round(float(value), 6)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def parse_dpd_locker(locker: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    locker_id = str(
+        locker.get("id") or locker.get("systemPointId") or locker.get("pointId") or locker.get("lockerId") or ""
+    ).strip()
+    if not locker_id:
+        return None
+
+    address = locker.get("address") if isinstance(locker.get("address"), dict) else {}
+    coordinates = locker.get("coordinates") if isinstance(locker.get("coordinates"), dict) else {}
+    row = {
+        "system_point_id": locker_id,
+        "provider": "dpd",
+        "locker_index": str(locker.get("locker_index") or locker.get("code") or locker_id),
+        "name": locker.get("name") or locker.get("title") or locker.get("description") or locker_id,
+        "city": address.get("city") or locker.get("city") or "",
+        "address": address.get("street") or address.get("addressLine1") or (
+            locker.get("address") if isinstance(locker.get("address"), str) else ""
+        ),
+        "postal_code": (
+            address.get("postcode") or address.get("postalCode") or locker.get("postalCode") or locker.get("zip") or ""
+        ),
+        "country_code": (address.get("country") or locker.get("country") or "LV")[:2].upper(),
+        "latitude": _coordinate(
+            address.get("latitude"), locker.get("latitude"), locker.get("lat"), coordinates.get("lat"),
+        ),
+        "longitude": _coordinate(
+            address.get("longitude"), locker.get("longitude"), locker.get("lng"), locker.get("lon"),
+            coordinates.get("lng"),
+        ),
+    }
+    row["content_hash"] = content_hash(row)
+    return row
+
+
+def stage_dpd_lockers(payload: Any) -> Dict[str, Dict[str, Any]]:
+    """Payload DPD → staging: system_point_id → строка pickup_points (дубликаты схлопываются)"""
+    staged: Dict[str, Dict[str, Any]] = {}
+    for locker in extract_lockers(payload):
+        row = parse_dpd_locker(locker)
+        if row:
+            staged[row["system_point_id"]] = row
+    return staged
+
+
+def _insert(engine: Engine):
+    return postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+
+
+def _upsert_chunk(conn, engine: Engine, rows: List[Dict[str, Any]]) -> None:
+    table = PickupPoint.__table__
+    statement = _insert(engine)(table).values(rows)
+    excluded = statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.system_point_id],
+        set_={
+            "provider": excluded.provider,
+            "locker_index": excluded.locker_index,
+            "name": excluded.name,
+            # Пустые поля из DPD не затирают уже известные значения
+            "city": func.coalesce(func.nullif(excluded.city, ""), table.c.city),
+            "address": func.coalesce(func.nullif(excluded.address, ""), table.c.address),
+            "postal_code": func.coalesce(func.nullif(excluded.postal_code, ""), table.c.postal_code),
+            "country_code": func.coalesce(func.nullif(excluded.country_code, ""), table.c.country_code),
+            "latitude": func.coalesce(excluded.latitude, table.c.latitude),
+            "longitude": func.coalesce(excluded.longitude, table.c.longitude),
+            "content_hash": excluded.content_hash,
+            "is_active": True,
+            "updated_at": excluded.updated_at,
+        },
+    )
+    conn.execute(statement)
+
+
+def apply_pickup_points(
+    engine: Engine,
+    staged: Dict[str, Dict[str, Any]],
+    *,
+    provider: str = "dpd",
+    chunk_size: int = SYNC_CHUNK_SIZE,
+) -> Dict[str, Any]:
+    """Применяет staging к pickup_points: чанками INSERT ... ON CONFLICT DO UPDATE, затем один UPDATE деактивации.
+
+    Каждый чанк — отдельная короткая транзакция; существующие строки чанка читаются одним
+    запросом, строки с тем же content_hash (и активные) пропускаются.
+    Синхронный код: вызывать через asyncio.to_thread, чтобы не держать event loop.
+    """
+    started = time.monotonic()
+    table = PickupPoint.__table__
+    now = datetime.utcnow()
+    report = {"received": len(staged), "inserted": 0, "updated": 0, "unchanged": 0, "deactivated": 0}
+
+    point_ids = list(staged)
+    for offset in range(0, len(point_ids), chunk_size):
+        chunk_ids = point_ids[offset:offset + chunk_size]
+        with engine.begin() as conn:
+            existing = {
+                row.system_point_id: row
+                for row in conn.execute(
+                    select(table.c.system_point_id, table.c.content_hash, table.c.is_active)
+                    .where(table.c.system_point_id.in_(chunk_ids))
+                )
+            }
+
+            changed = []
+            for point_id in chunk_ids:
+                current = existing.get(point_id)
+                unchanged = (
+                    current is not None
+                    and current.is_active
+                    and current.content_hash == staged[point_id]["content_hash"]
+                )
+                if unchanged:
+                    report["unchanged"] += 1
+                    continue
+                row = {**staged[point_id], "is_active": True, "created_at": now, "updated_at": now}
+                if current is None:
+                    report["inserted"] += 1
+                    row["city"] = row["city"] or "Riga"
+                else:
+                    report["updated"] += 1
+                changed.append(row)
+
+            if changed:
+                _upsert_chunk(conn, engine, changed)
+
+    # Пустой ответ DPD — скорее сбой, чем закрытие всей сети: не деактивируем всё подряд
+    if staged:
+        with engine.begin() as conn:
+            result = conn.execute(
+                update(table)
+                .where(
+                    and_(
+                        table.c.provider == provider,
+                        table.c.is_active == True,
+                        table.c.system_point_id.not_in(point_ids),
+                    )
+                )
+                .values(is_active=False, updated_at=now)
+            )
+            report["deactivated"] = result.rowcount or 0
+
+    report["duration_ms"] = int((time.monotonic() - started) * 1000)
+    report["finished_at"] = datetime.utcnow().isoformat()
+    last_sync_report.clear()
+    last_sync_report.update(report)
+    return report
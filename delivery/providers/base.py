@@ -6,10 +6,14 @@ from typing import Optional
 
 
 class DeliveryProviderClient(ABC):
-    """Абстракция интеграции с конкретной службой доставки."""
+    """Абстракция интеграции с конкретной службой доставки.
+
+    Сетевые методы асинхронные и ходят через общий клиент providers.http:
+    вызываются из async-эндпоинтов и не должны блокировать event loop.
+    """
 
     @abstractmethod
-    def create_shipment(self, delivery_data: DeliveryCreate) -> str:
+    async def create_shipment(self, delivery_data: DeliveryCreate) -> str:
         """Создать отправление во внешней/внутренней системе.
 
         Returns:
@@ -18,7 +22,7 @@ class DeliveryProviderClient(ABC):
         raise NotImplementedError
     
     @abstractmethod
-    def get_tracking_status(self, provider_tracking_number: str) -> Optional[str]:
+    async def get_tracking_status(self, provider_tracking_number: str) -> Optional[str]:
         """Запросить статус у стороннего API и вернуть ВНУТРЕННИЙ статус (DeliveryStatus)"""
         raise NotImplementedError
 
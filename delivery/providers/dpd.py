@@ -9,11 +9,12 @@
 import logging
 import httpx
 import urllib.parse
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 from configs import configs
 from models import DeliveryCreate
 from providers.base import DeliveryProviderClient
+from providers.http import request_with_retries
 
 
 logger = logging.getLogger(__name__)
@@ -28,12 +29,13 @@ class DPDProviderClient(DeliveryProviderClient):
     2. Возвращает структурированный ответ
     3. Поддерживает подписку на webhook
     4. Универсальный код для test и real сред
+    5. Асинхронный: общий пул соединений, таймаут на операцию, повторы идемпотентных запросов
     """
     
     def get_provider_name(self) -> str:
         return "dpd"
 
-    def create_shipment(self, delivery_data: DeliveryCreate) -> Dict[str, Any]:
+    async def create_shipment(self, delivery_data: DeliveryCreate) -> Dict[str, Any]:
         """
         Создание shipment в DPD и возврат parcelNumber.
         
@@ -50,7 +52,7 @@ class DPDProviderClient(DeliveryProviderClient):
         if mode == "simulation":
             return self._simulate(delivery_data)
         
-        return self._create_shipment_universal(delivery_data)
+        return await self._create_shipment_universal(delivery_data)
 
     def _simulate(self, delivery_data: DeliveryCreate) -> Dict[str, Any]:
         """Режим симуляции для локальной разработки"""
@@ -69,7 +71,7 @@ class DPDProviderClient(DeliveryProviderClient):
             "status": "created",
         }
 
-    def _create_shipment_universal(self, delivery_data: DeliveryCreate) -> Dict[str, Any]:
+    async def _create_shipment_universal(self, delivery_data: DeliveryCreate) -> Dict[str, Any]:
         """
         Универсальный метод для test и real окружений.
         
@@ -82,14 +84,7 @@ class DPDProviderClient(DeliveryProviderClient):
         is_test_mode = mode == "test"
         
         # Выбираем параметры в зависимости от режима
-        if is_test_mode:
-            base_url = configs.DPD_TEST_API_BASE_URL
-            auth_header = {"Authorization": f"Bearer {configs.DPD_TEST_API_KEY}"}
-            auth_tuple = None
-        else:
-            base_url = configs.DPD_REAL_API_BASE_URL
-            auth_header = {}
-            auth_tuple = (configs.DPD_API_KEY, configs.DPD_API_SECRET)
+        base_url, auth_header, auth_tuple = self._api_credentials(mode)
         
         endpoint = f"{base_url}/shipments"
         
@@ -150,67 +145,75 @@ class DPDProviderClient(DeliveryProviderClient):
                 **auth_header
             }
             
-            with httpx.Client(timeout=15.0) as client:
-                response = client.post(endpoint, json=payload, headers=headers, auth=auth_tuple)
-                
-                # Логируем для отладки
-                if response.status_code not in (200, 201):
-                    logger.error(
-                        "DPD API failed | order_id=%s | status=%s | response=%s",
-                        delivery_data.order_id,
-                        response.status_code,
-                        response.text[:500],
-                    )
-                
-                if response.status_code not in (200, 201):
-                    raise ValueError(
-                        f"DPD API failed with status {response.status_code}: {response.text[:500]}"
-                    )
-                
-                response_data = response.json()
-                
-                # DPD возвращает список если payload был список
-                if isinstance(response_data, list):
-                    response_data = response_data[0] if response_data else {}
-                
-                # === ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ ОТВЕТА ===
-                
-                # DPD parcelNumber (14 цифр) - это основной трекинг номер
-                parcel_number = None
-                parcel_numbers = response_data.get("parcelNumbers", [])
-                if parcel_numbers:
-                    parcel_number = str(parcel_numbers[0])
-                
-                if not parcel_number:
-                    # Если parcelNumbers не в списке, смотрим в parcels
-                    parcels = response_data.get("parcels", [])
-                    for parcel in parcels:
-                        if isinstance(parcel, dict) and "parcelNumber" in parcel:
-                            parcel_number = str(parcel["parcelNumber"])
-                            break
-                
-                if not parcel_number:
-                    raise ValueError("DPD API did not return parcelNumber")
-                
-                # PIN код для цифровой метки (для пакоматов)
-                pin_code = self._extract_pin_from_response(response_data)
-                
-                # Shipment ID для будущих операций
-                shipment_id = response_data.get("id")
-                
-                logger.info(
-                    "DPD shipment created | order_id=%s | parcel_number=%s | pin_code=%s",
+            # Не идемпотентно: повтор только если соединение не установилось
+            response = await request_with_retries(
+                "POST",
+                endpoint,
+                timeout=configs.DPD_SHIPMENT_TIMEOUT_SECONDS,
+                idempotent=False,
+                json=payload,
+                headers=headers,
+                auth=auth_tuple,
+            )
+            
+            # Логируем для отладки
+            if response.status_code not in (200, 201):
+                logger.error(
+                    "DPD API failed | order_id=%s | status=%s | response=%s",
                     delivery_data.order_id,
-                    parcel_number,
-                    pin_code or "N/A",
+                    response.status_code,
+                    response.text[:500],
+                )
+            
+            if response.status_code not in (200, 201):
+                raise ValueError(
+                    f"DPD API failed with status {response.status_code}: {response.text[:500]}"
                 )
-                
-                return {
-                    "provider_tracking_number": parcel_number,  # ← ВАЖНО: сохраняем в БД
-                    "pin_code": pin_code,
-                    "shipment_id": shipment_id,
-                    "status": "created",
-                }
+            
+            response_data = response.json()
+            
+            # DPD возвращает список если payload был список
+            if isinstance(response_data, list):
+                response_data = response_data[0] if response_data else {}
+            
+            # === ИЗВЛЕЧЕНИЕ ДАННЫХ ИЗ ОТВЕТА ===
+            
+            # DPD parcelNumber (14 цифр) - это основной трекинг номер
+            parcel_number = None
+            parcel_numbers = response_data.get("parcelNumbers", [])
+            if parcel_numbers:
+                parcel_number = str(parcel_numbers[0])
+            
+            if not parcel_number:
+                # Если parcelNumbers не в списке, смотрим в parcels
+                parcels = response_data.get("parcels", [])
+                for parcel in parcels:
+                    if isinstance(parcel, dict) and "parcelNumber" in parcel:
+                        parcel_number = str(parcel["parcelNumber"])
+                        break
+            
+            if not parcel_number:
+                raise ValueError("DPD API did not return parcelNumber")
+            
+            # PIN код для цифровой метки (для пакоматов)
+            pin_code = self._extract_pin_from_response(response_data)
+            
+            # Shipment ID для будущих операций
+            shipment_id = response_data.get("id")
+            
+            logger.info(
+                "DPD shipment created | order_id=%s | parcel_number=%s | pin_code=%s",
+                delivery_data.order_id,
+                parcel_number,
+                pin_code or "N/A",
+            )
+            
+            return {
+                "provider_tracking_number": parcel_number,  # ← ВАЖНО: сохраняем в БД
+                "pin_code": pin_code,
+                "shipment_id": shipment_id,
+                "status": "created",
+            }
         
         except httpx.RequestError as e:
             logger.error(
@@ -220,7 +223,7 @@ class DPDProviderClient(DeliveryProviderClient):
             )
             raise ValueError(f"DPD API request failed: {str(e)}")
     
-    def get_tracking_status(self, parcel_number: str) -> Dict[str, Any]:
+    async def get_tracking_status(self, parcel_number: str) -> Dict[str, Any]:
         """
         Получить статус посылки из DPD по demand.
         
@@ -244,16 +247,7 @@ class DPDProviderClient(DeliveryProviderClient):
                 "parcel_number": parcel_number,
             }
         
-        is_test_mode = mode == "test"
-        
-        if is_test_mode:
-            base_url = configs.DPD_TEST_API_BASE_URL
-            auth_header = {"Authorization": f"Bearer {configs.DPD_TEST_API_KEY}"}
-            auth_tuple = None
-        else:
-            base_url = configs.DPD_REAL_API_BASE_URL
-            auth_header = {}
-            auth_tuple = (configs.DPD_API_KEY, configs.DPD_API_SECRET)
+        base_url, auth_header, auth_tuple = self._api_credentials(mode)
         
         try:
             headers = {
@@ -261,52 +255,111 @@ class DPDProviderClient(DeliveryProviderClient):
                 **auth_header
             }
             
-            with httpx.Client(timeout=10.0) as client:
-                response = client.get(
-                    f"{base_url}/status/tracking",
-                    headers=headers,
-                    auth=auth_tuple,
-                    params={
-                        "pknr": parcel_number,  # 14-значный номер
-                        "detail": 0,  # basic: только текстовый статус + dateTime
-                        "show_all": 1,  # Вся история
-                        "lang": "en",
-                    },
-                )
-                
-                if response.status_code != 200:
-                    logger.warning(
-                        f"DPD tracking failed | parcel={parcel_number} | status={response.status_code}"
-                    )
-                    return {"dpd_status": "unknown", "dpd_datetime": "", "events": []}
-                
-                data = response.json()
-                
-                # Ответ - список событий для каждой посылки
-                parcel_data = next(
-                    (p for p in data if str(p.get("parcelNumber")) == str(parcel_number)),
-                    data[0] if data else {}
+            response = await request_with_retries(
+                "GET",
+                f"{base_url}/status/tracking",
+                timeout=configs.DPD_TRACKING_TIMEOUT_SECONDS,
+                idempotent=True,
+                headers=headers,
+                auth=auth_tuple,
+                params={
+                    "pknr": parcel_number,  # 14-значный номер
+                    "detail": 0,  # basic: только текстовый статус + dateTime
+                    "show_all": 1,  # Вся история
+                    "lang": "en",
+                },
+            )
+            
+            if response.status_code != 200:
+                logger.warning(
+                    f"DPD tracking failed | parcel={parcel_number} | status={response.status_code}"
                 )
-                
-                if "error" in parcel_data:
-                    logger.warning(f"DPD error for {parcel_number}: {parcel_data['error']}")
-                    return {"dpd_status": "unknown", "dpd_datetime": "", "events": []}
-                
-                events = parcel_data.get("details", [])
-                latest = events[0] if events else {}
-                
-                return {
-                    "dpd_status": latest.get("status", "unknown"),
-                    "dpd_datetime": latest.get("dateTime", ""),
-                    "events": events,
-                    "parcel_number": parcel_number,
-                }
+                return {"dpd_status": "unknown", "dpd_datetime": "", "events": []}
+            
+            data = response.json()
+            
+            # Ответ - список событий для каждой посылки
+            parcel_data = next(
+                (p for p in data if str(p.get("parcelNumber")) == str(parcel_number)),
+                data[0] if data else {}
+            )
+            return self._parse_tracking_entry(parcel_number, parcel_data)
         
         except Exception as e:
             logger.error(f"DPD tracking error | parcel={parcel_number} | error={e}")
             return {"dpd_status": "error", "dpd_datetime": "", "events": []}
+
+    async def get_tracking_statuses(self, parcel_numbers: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Статусы нескольких посылок одним запросом (pknr через запятую, не больше
+        DPD_TRACKING_BATCH_SIZE номеров).
+        
+        Returns:
+            {parcel_number: {"dpd_status": ..., "dpd_datetime": ..., "events": [...]}}
+            Посылки, которых нет в ответе, отсутствуют в словаре.
+        
+        Raises:
+            httpx.HTTPError / ValueError — пачку целиком стоит перепроверить позже
+        """
+        if not parcel_numbers:
+            return {}
+
+        base_url, auth_header, auth_tuple = self._api_credentials(configs.get_dpd_mode())
+        response = await request_with_retries(
+            "GET",
+            f"{base_url}/status/tracking",
+            timeout=configs.DPD_TRACKING_TIMEOUT_SECONDS,
+            idempotent=True,
+            headers={"Accept": "application/json", **auth_header},
+            auth=auth_tuple,
+            params={
+                "pknr": ",".join(parcel_numbers),
+                "detail": 0,
+                "show_all": 1,
+                "lang": "en",
+            },
+        )
+        if response.status_code != 200:
+            raise ValueError(f"DPD tracking failed with status {response.status_code}: {response.text[:300]}")
+
+        data = response.json()
+        if not isinstance(data, list):
+            data = [data] if isinstance(data, dict) else []
+
+        requested = set(parcel_numbers)
+        result: Dict[str, Dict[str, Any]] = {}
+        for parcel_data in data:
+            if not isinstance(parcel_data, dict):
+                continue
+            parcel_number = str(parcel_data.get("parcelNumber") or "")
+            if parcel_number in requested:
+                result[parcel_number] = self._parse_tracking_entry(parcel_number, parcel_data)
+        return result
+
+    @staticmethod
+    def _parse_tracking_entry(parcel_number: str, parcel_data: Dict[str, Any]) -> Dict[str, Any]:
+        if "error" in parcel_data:
+            logger.warning(f"DPD error for {parcel_number}: {parcel_data['error']}")
+            return {"dpd_status": "unknown", "dpd_datetime": "", "events": []}
+
+        events = parcel_data.get("details", [])
+        latest = events[0] if events else {}
+
+        return {
+            "dpd_status": latest.get("status", "unknown"),
+            "dpd_datetime": latest.get("dateTime", ""),
+            "events": events,
+            "parcel_number": parcel_number,
+        }
+
+    @staticmethod
+    def _api_credentials(mode: str):
+        """(base_url, auth_header, auth_tuple) для test / real"""
+        if mode == "test":
+            return configs.DPD_TEST_API_BASE_URL, {"Authorization": f"Bearer {configs.DPD_TEST_API_KEY}"}, None
+        return configs.DPD_REAL_API_BASE_URL, {}, (configs.DPD_API_KEY, configs.DPD_API_SECRET)
     
-    def subscribe_to_tracking(self, parcel_number: str, callback_url: str) -> bool:
+    async def subscribe_to_tracking(self, parcel_number: str, callback_url: str) -> bool:
         """
         Подписаться на обновления статуса посылки.
         
@@ -325,30 +378,23 @@ class DPDProviderClient(DeliveryProviderClient):
             logger.info(f"DPD: simulated subscription for {parcel_number}")
             return True
         
-        is_test_mode = mode == "test"
-        
-        if is_test_mode:
-            base_url = configs.DPD_TEST_API_BASE_URL
-            auth_header = {"Authorization": f"Bearer {configs.DPD_TEST_API_KEY}"}
-            auth_tuple = None
-        else:
-            base_url = configs.DPD_REAL_API_BASE_URL
-            auth_header = {}
-            auth_tuple = (configs.DPD_API_KEY, configs.DPD_API_SECRET)
+        base_url, auth_header, auth_tuple = self._api_credentials(mode)
         
         try:
             headers = {**auth_header}
             
-            with httpx.Client(timeout=5.0) as client:
-                response = client.get(
-                    f"{base_url}/status/events/subscribetoparcel",
-                    headers=headers,
-                    auth=auth_tuple,
-                    params={
-                        "parcelnumber": parcel_number,
-                        "callbackurl": urllib.parse.quote(callback_url, safe=""),
-                    },
-                )
+            response = await request_with_retries(
+                "GET",
+                f"{base_url}/status/events/subscribetoparcel",
+                timeout=configs.DPD_SUBSCRIPTION_TIMEOUT_SECONDS,
+                idempotent=True,
+                headers=headers,
+                auth=auth_tuple,
+                params={
+                    "parcelnumber": parcel_number,
+                    "callbackurl": urllib.parse.quote(callback_url, safe=""),
+                },
+            )
             
             success = response.status_code == 200
             logger.info(
@@ -361,37 +407,30 @@ class DPDProviderClient(DeliveryProviderClient):
             logger.error(f"DPD subscription error | parcel={parcel_number} | error={e}")
             return False
     
-    def unsubscribe_from_tracking(self, parcel_number: str, callback_url: str) -> bool:
+    async def unsubscribe_from_tracking(self, parcel_number: str, callback_url: str) -> bool:
         """Отписаться от обновлений статуса посылки"""
         mode = configs.get_dpd_mode()
         
         if mode == "simulation":
             return True
         
-        is_test_mode = mode == "test"
-        
-        if is_test_mode:
-            base_url = configs.DPD_TEST_API_BASE_URL
-            auth_header = {"Authorization": f"Bearer {configs.DPD_TEST_API_KEY}"}
-            auth_tuple = None
-        else:
-            base_url = configs.DPD_REAL_API_BASE_URL
-            auth_header = {}
-            auth_tuple = (configs.DPD_API_KEY, configs.DPD_API_SECRET)
+        base_url, auth_header, auth_tuple = self._api_credentials(mode)
         
         try:
             headers = {**auth_header}
             
-            with httpx.Client(timeout=5.0) as client:
-                response = client.get(
-                    f"{base_url}/status/events/unsubscribetoparcel",
-                    headers=headers,
-                    auth=auth_tuple,
-                    params={
-                        "parcelnumber": parcel_number,
-                        "callbackurl": urllib.parse.quote(callback_url, safe=""),
-                    },
-                )
+            response = await request_with_retries(
+                "GET",
+                f"{base_url}/status/events/unsubscribetoparcel",
+                timeout=configs.DPD_SUBSCRIPTION_TIMEOUT_SECONDS,
+                idempotent=True,
+                headers=headers,
+                auth=auth_tuple,
+                params={
+                    "parcelnumber": parcel_number,
+                    "callbackurl": urllib.parse.quote(callback_url, safe=""),
+                },
+            )
             
             return response.status_code == 200
         
@@ -0,0 +1,82 @@
+"""Общий HTTP-клиент провайдеров доставки: один пул соединений, таймауты по операциям, повторы."""
+
+import asyncio
+import logging
+import random
+from typing import Any, Optional
+
+import httpx
+
+from configs import configs
+
+
+logger = logging.getLogger(__name__)
+
+# Ответы, после которых повтор идемпотентного запроса имеет смысл
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+# Один AsyncClient на процесс: keep-alive к DPD/Omniva вместо соединения на каждый запрос
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(15.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=configs.PROVIDER_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=configs.PROVIDER_HTTP_MAX_KEEPALIVE,
+            ),
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def request_with_retries(
+    method: str,
+    url: str,
+    *,
+    timeout: float,
+    idempotent: bool,
+    retries: Optional[int] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    """
+    Запрос через общий клиент с таймаутом операции.
+
+    Идемпотентные запросы повторяются с экспоненциальной задержкой при сетевых ошибках
+    и ответах 429/502/503/504. Неидемпотентные (создание отправления) — только если
+    соединение не установилось: запрос до провайдера точно не дошёл.
+    """
+    retries = configs.PROVIDER_HTTP_RETRIES if retries is None else retries
+    client = get_http_client()
+    attempt = 0
+    while True:
+        try:
+            response = await client.request(
+                method, url, timeout=httpx.Timeout(timeout, connect=min(timeout, 5.0)), **kwargs
+            )
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            if attempt >= retries:
+                raise
+        except httpx.TransportError:
+            if not idempotent or attempt >= retries:
+                raise
+        else:
+            if not idempotent or response.status_code not in RETRYABLE_STATUS_CODES or attempt >= retries:
+                return response
+
+        backoff = min(configs.PROVIDER_HTTP_BACKOFF_SECONDS * 2 ** attempt, 10.0) * (0.5 + random.random() / 2)
+        attempt += 1
+        logger.warning(
+            "Provider request retry | method=%s | url=%s | attempt=%s | backoff_s=%.2f",
+            method, url, attempt, backoff,
+        )
+        await asyncio.sleep(backoff)
@@ -10,10 +10,11 @@ class OmnivaProviderClient(DeliveryProviderClient):
     def get_provider_name(self) -> str:
         return "omniva"
 
-    def create_shipment(self, delivery_data: DeliveryCreate) -> str:
+    async def create_shipment(self, delivery_data: DeliveryCreate) -> str:
         # Текущая интеграция Omniva реализуется внутренней логикой доставки.
-        # Модуль выделен, чтобы проще добавить real/test API без правок DeliveryService.
+        # Модуль выделен, чтобы проще добавить real/test API без правок DeliveryService:
+        # запросы к API — через providers.http.request_with_retries, как в DPD.
         return "omniva_internal"
     
-    def get_tracking_status(self, parcel_number: str) -> Dict[str, Any]:
+    async def get_tracking_status(self, parcel_number: str) -> Dict[str, Any]:
         pass
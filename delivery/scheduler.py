@@ -0,0 +1,249 @@
+# scheduler.py - Фоновые задачи по расписанию (interval/cron) с выбором лидера
+#
+# Одинаковая копия лежит в каждом сервисе с фоновыми задачами (posts, delivery):
+# сервисы собираются из своих папок и общего пакета у них нет.
+#
+# Каждая задача исполняется ровно одной репликой за запуск:
+# - лидер на время запуска выбирается через pg_try_advisory_lock (SQLite — без блокировки, один процесс);
+# - общее состояние (next_run_at, итог прошлого запуска) хранится в таблице scheduler_job,
+#   поэтому реплика, проснувшаяся позже, не повторяет уже выполненный запуск;
+# - пропущенные запуски (сервис лежал, задача шла дольше периода) не "догоняются", а схлопываются в один.
+
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import Field, SQLModel
+
+logger = logging.getLogger("scheduler")
+
+
+class SchedulerJobState(SQLModel, table=True):
+    """Общее для всех реплик состояние задачи."""
+    __tablename__ = "scheduler_job"
+
+    name: str = Field(primary_key=True, max_length=100)
+    next_run_at: Optional[datetime] = Field(default=None)
+    last_started_at: Optional[datetime] = Field(default=None)
+    last_finished_at: Optional[datetime] = Field(default=None)
+    last_duration_ms: Optional[int] = Field(default=None)
+    last_status: Optional[str] = Field(default=None, max_length=20)
+    last_error: Optional[str] = Field(default=None, max_length=500)
+    run_count: int = Field(default=0)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+JobFunc = Callable[[], Awaitable[Any]]
+
+
+@dataclass
+class ScheduledJob:
+    name: str
+    func: JobFunc
+    interval_seconds: Optional[float] = None
+    cron: Optional[str] = None
+    jitter_seconds: float = 0.0
+    run_immediately: bool = False
+    stats: Dict[str, Any] = field(default_factory=lambda: {
+        "runs": 0,
+        "failures": 0,
+        "skipped_not_leader": 0,
+        "missed_runs_coalesced": 0,
+        "last_status": None,
+        "last_started_at": None,
+        "last_duration_ms": None,
+        "max_duration_ms": 0,
+        "total_duration_ms": 0,
+        "next_run_at": None,
+    })
+
+    @property
+    def lock_key(self) -> int:
+        digest = hashlib.sha1(f"scheduler:{self.name}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big", signed=True)
+
+    def next_after(self, moment: datetime) -> datetime:
+        if self.cron:
+            from croniter import croniter
+
+            return croniter(self.cron, moment).get_next(datetime)
+        return moment + timedelta(seconds=self.interval_seconds or 0)
+
+    def period_seconds(self, moment: datetime) -> float:
+        return max(1.0, (self.next_after(moment) - moment).total_seconds())
+
+
+class JobScheduler:
+    def __init__(self, engine: Engine, *, idle_poll_seconds: float = 30.0):
+        self.engine = engine
+        self.idle_poll_seconds = idle_poll_seconds
+        self.use_advisory_locks = engine.dialect.name == "postgresql"
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def add_interval_job(
+        self,
+        name: str,
+        func: JobFunc,
+        seconds: float,
+        *,
+        jitter_seconds: float = 0.0,
+        run_immediately: bool = False,
+    ) -> ScheduledJob:
+        job = ScheduledJob(
+            name=name,
+            func=func,
+            interval_seconds=seconds,
+            jitter_seconds=jitter_seconds,
+            run_immediately=run_immediately,
+        )
+        self.jobs[name] = job
+        return job
+
+    def add_cron_job(
+        self,
+        name: str,
+        func: JobFunc,
+        cron: str,
+        *,
+        jitter_seconds: float = 0.0,
+        run_immediately: bool = False,
+    ) -> ScheduledJob:
+        job = ScheduledJob(
+            name=name,
+            func=func,
+            cron=cron,
+            jitter_seconds=jitter_seconds,
+            run_immediately=run_immediately,
+        )
+        self.jobs[name] = job
+        return job
+
+    async def start(self) -> None:
+        SchedulerJobState.__table__.create(self.engine, checkfirst=True)
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._job_loop(job), name=f"scheduler:{job.name}"))
+        logger.info(
+            "Scheduler started | jobs=%s | advisory_locks=%s",
+            ",".join(self.jobs),
+            self.use_advisory_locks,
+        )
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {name: dict(job.stats) for name, job in self.jobs.items()}
+
+    async def _job_loop(self, job: ScheduledJob) -> None:
+        while True:
+            try:
+                next_run_at = await self._tick(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Scheduler tick error | job=%s | error_type=%s", job.name, type(exc).__name__)
+                next_run_at = None
+
+            if next_run_at is None:
+                delay = self.idle_poll_seconds
+            else:
+                job.stats["next_run_at"] = next_run_at.isoformat()
+                delay = max(1.0, (next_run_at - datetime.utcnow()).total_seconds())
+            # Джиттер разводит реплики во времени, чтобы они не ломились за блокировкой одновременно
+            await asyncio.sleep(delay + random.uniform(0, job.jitter_seconds))
+
+    async def _tick(self, job: ScheduledJob) -> Optional[datetime]:
+        with self.engine.connect() as conn:
+            if self.use_advisory_locks:
+                acquired = conn.execute(
+                    text("SELECT pg_try_advisory_lock(:key)"), {"key": job.lock_key}
+                ).scalar()
+                conn.commit()
+                if not acquired:
+                    # Задачу прямо сейчас выполняет другая реплика — перепроверим позже
+                    job.stats["skipped_not_leader"] += 1
+                    return None
+            try:
+                return await self._run_if_due(conn, job)
+            finally:
+                if self.use_advisory_locks:
+                    conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": job.lock_key})
+                    conn.commit()
+
+    async def _run_if_due(self, conn: Connection, job: ScheduledJob) -> datetime:
+        table = SchedulerJobState.__table__
+        now = datetime.utcnow()
+
+        row = conn.execute(select(table.c.next_run_at).where(table.c.name == job.name)).first()
+        if row is None:
+            next_run_at = now if job.run_immediately else job.next_after(now)
+            conn.execute(insert(table).values(name=job.name, next_run_at=next_run_at, run_count=0, updated_at=now))
+            conn.commit()
+        else:
+            next_run_at = row[0] or now
+
+        if next_run_at > now:
+            return next_run_at
+
+        overdue_seconds = (now - next_run_at).total_seconds()
+        if overdue_seconds > job.period_seconds(next_run_at):
+            job.stats["missed_runs_coalesced"] += 1
+            logger.info(
+                "Scheduler missed runs coalesced | job=%s | overdue_seconds=%s",
+                job.name,
+                int(overdue_seconds),
+            )
+
+        conn.execute(update(table).where(table.c.name == job.name).values(last_started_at=now, updated_at=now))
+        conn.commit()
+
+        started = time.monotonic()
+        status, error = "success", None
+        try:
+            await job.func()
+        except Exception as exc:
+            status, error = "failed", f"{type(exc).__name__}: {exc}"[:500]
+            logger.warning("Scheduler job failed | job=%s | error_type=%s", job.name, type(exc).__name__)
+        duration_ms = int((time.monotonic() - started) * 1000)
+
+        finished = datetime.utcnow()
+        upcoming = job.next_after(finished if job.cron else now)
+        if upcoming <= finished:
+            upcoming = job.next_after(finished)
+
+        conn.execute(
+            update(table)
+            .where(table.c.name == job.name)
+            .values(
+                next_run_at=upcoming,
+                last_finished_at=finished,
+                last_duration_ms=duration_ms,
+                last_status=status,
+                last_error=error,
+                run_count=table.c.run_count + 1,
+                updated_at=finished,
+            )
+        )
+        conn.commit()
+
+        stats = job.stats
+        stats["runs"] += 1
+        stats["failures"] += 1 if error else 0
+        stats["last_status"] = status
+        stats["last_started_at"] = now.isoformat()
+        stats["last_duration_ms"] = duration_ms
+        stats["max_duration_ms"] = max(stats["max_duration_ms"], duration_ms)
+        stats["total_duration_ms"] += duration_ms
+        logger.info("Scheduler job finished | job=%s | status=%s | duration_ms=%s", job.name, status, duration_ms)
+        return upcoming
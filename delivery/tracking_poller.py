@@ -0,0 +1,191 @@
+# tracking_poller.py - Пакетный опрос трекинга DPD (страховка на случай пропущенных webhook)
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import configs
+from delivery_service import DeliveryService
+from models import Delivery, DeliveryStatus, is_status_regression
+from providers.dpd import DPDProviderClient
+
+logger = logging.getLogger(__name__)
+
+
+# Стадии, на которых статус ещё может измениться
+ACTIVE_STATUSES = (
+    DeliveryStatus.CREATED.value,
+    DeliveryStatus.IN_TRANSIT.value,
+    DeliveryStatus.AT_PICKUP_POINT.value,
+)
+
+
+def tracking_interval(status: str) -> timedelta:
+    """Как скоро перепроверять доставку на этой стадии: в пути — часто, в ожидании — реже"""
+    minutes = {
+        DeliveryStatus.CREATED.value: configs.DPD_TRACKING_INTERVAL_CREATED_MINUTES,
+        DeliveryStatus.IN_TRANSIT.value: configs.DPD_TRACKING_INTERVAL_IN_TRANSIT_MINUTES,
+        DeliveryStatus.AT_PICKUP_POINT.value: configs.DPD_TRACKING_INTERVAL_AT_PICKUP_POINT_MINUTES,
+    }.get(status, configs.DPD_TRACKING_INTERVAL_CREATED_MINUTES)
+    return timedelta(minutes=minutes)
+
+
+class DPDTrackingPoller:
+    """
+    Один проход: выбирает DPD-доставки на активных стадиях, у которых подошёл
+    next_tracking_check_at, и запрашивает DPD пачками по DPD_TRACKING_BATCH_SIZE номеров.
+
+    - реальные переходы применяются через DeliveryService.apply_status_change одним commit на пачку;
+    - доставки без изменений получают новый next_tracking_check_at одним UPDATE на стадию;
+      так же — доставки, чей статус уже сменил webhook, и ответы DPD с откатом на более раннюю
+      стадию (устаревший статус не применяется);
+    - интервал следующей проверки зависит от стадии (tracking_interval);
+    - доставки без ответа DPD (упавшая пачка, error/unknown в ответе) не считаются проверенными:
+      tracking_checked_at не трогается, повтор через DPD_TRACKING_RETRY_MINUTES.
+
+    Запускается JobScheduler'ом (одна реплика на запуск), поэтому без блокировок строк.
+    """
+
+    def __init__(self, engine: Engine, dpd_client: Optional[DPDProviderClient] = None):
+        self.engine = engine
+        self.dpd_client = dpd_client or DPDProviderClient()
+        self.metrics: Dict[str, Any] = {
+            "runs": 0,
+            "deliveries_checked": 0,
+            "status_changes": 0,
+            "requests": 0,
+            "request_errors": 0,
+            "last_run_ms": None,
+        }
+
+    async def poll_once(self) -> Dict[str, int]:
+        report = {"due": 0, "checked": 0, "changed": 0, "failed_batches": 0}
+        if configs.get_dpd_mode() == "simulation":
+            # В симуляции статусы двигает внутренний симулятор, DPD опрашивать нечего
+            return report
+
+        started = time.monotonic()
+        due = await asyncio.to_thread(self._select_due)
+        report["due"] = len(due)
+
+        batch_size = max(1, configs.DPD_TRACKING_BATCH_SIZE)
+        batches = [due[offset:offset + batch_size] for offset in range(0, len(due), batch_size)]
+        semaphore = asyncio.Semaphore(max(1, configs.DPD_TRACKING_CONCURRENCY))
+
+        async def run_batch(batch: List[Dict[str, Any]]) -> None:
+            async with semaphore:
+                self.metrics["requests"] += 1
+                try:
+                    statuses = await self.dpd_client.get_tracking_statuses(
+                        [item["parcel_number"] for item in batch]
+                    )
+                except Exception as exc:
+                    self.metrics["request_errors"] += 1
+                    report["failed_batches"] += 1
+                    logger.warning(
+                        "DPD tracking batch failed | size=%s | error_type=%s", len(batch), type(exc).__name__
+                    )
+                    statuses = {}  # вся пачка уйдёт на короткий повтор
+            checked, changed = await asyncio.to_thread(self._apply, batch, statuses)
+            report["checked"] += checked
+            report["changed"] += changed
+
+        await asyncio.gather(*(run_batch(batch) for batch in batches))
+
+        self.metrics["runs"] += 1
+        self.metrics["deliveries_checked"] += report["checked"]
+        self.metrics["status_changes"] += report["changed"]
+        self.metrics["last_run_ms"] = int((time.monotonic() - started) * 1000)
+        if due:
+            logger.info(
+                "DPD tracking poll | due=%s | checked=%s | changed=%s | failed_batches=%s | duration_ms=%s",
+                report["due"], report["checked"], report["changed"], report["failed_batches"],
+                self.metrics["last_run_ms"],
+            )
+        return report
+
+    def _select_due(self) -> List[Dict[str, Any]]:
+        now = datetime.utcnow()
+        with Session(self.engine) as db:
+            rows = db.exec(
+                select(Delivery.id, Delivery.provider_tracking_number, Delivery.status)
+                .where(
+                    Delivery.provider == "dpd",
+                    Delivery.status.in_(ACTIVE_STATUSES),
+                    Delivery.provider_tracking_number != None,
+                    or_(Delivery.next_tracking_check_at == None, Delivery.next_tracking_check_at <= now),
+                )
+                .order_by(Delivery.next_tracking_check_at.nulls_first(), Delivery.id)
+                .limit(configs.DPD_TRACKING_MAX_PER_RUN)
+            ).all()
+        return [
+            {"id": delivery_id, "parcel_number": str(parcel_number), "status": status}
+            for delivery_id, parcel_number, status in rows
+        ]
+
+    def _apply(self, batch: List[Dict[str, Any]], statuses: Dict[str, Dict[str, Any]]) -> tuple:
+        """Применяет ответ DPD по одной пачке. Возвращает (checked, changed)."""
+        now = datetime.utcnow()
+        changes = {}
+        retry_ids = []
+        for item in batch:
+            tracking = statuses.get(item["parcel_number"])
+            if not tracking or tracking.get("dpd_status") in ("error", "unknown"):
+                retry_ids.append(item["id"])
+                continue
+            internal_status = self.dpd_client.map_dpd_status_to_internal(tracking.get("dpd_status", ""))
+            if (
+                internal_status
+                and internal_status != item["status"]
+                and not is_status_regression(item["status"], internal_status)
+            ):
+                changes[item["id"]] = (internal_status, tracking.get("dpd_status", ""))
+
+        unchanged_by_status = defaultdict(list)
+        for item in batch:
+            if item["id"] not in changes and item["id"] not in retry_ids:
+                unchanged_by_status[item["status"]].append(item["id"])
+
+        changed_deliveries = []
+        with Session(self.engine) as db:
+            service = DeliveryService(db)
+            if changes:
+                for delivery in db.exec(select(Delivery).where(Delivery.id.in_(list(changes)))).all():
+                    new_status, dpd_status_text = changes[delivery.id]
+                    # Статус мог измениться webhook'ом, пока шёл запрос к DPD: переход уже не нужен
+                    # (или стал откатом), доставка просто считается проверенной
+                    if delivery.status == new_status or is_status_regression(delivery.status, new_status):
+                        delivery.tracking_checked_at = now
+                        delivery.next_tracking_check_at = now + tracking_interval(delivery.status)
+                        continue
+                    service.apply_status_change(delivery, new_status, f"DPD: {dpd_status_text}")
+                    delivery.tracking_checked_at = now
+                    delivery.next_tracking_check_at = now + tracking_interval(new_status)
+                    changed_deliveries.append((delivery, new_status))
+
+            for status, delivery_ids in unchanged_by_status.items():
+                db.execute(
+                    update(Delivery)
+                    .where(Delivery.id.in_(delivery_ids))
+                    .values(tracking_checked_at=now, next_tracking_check_at=now + tracking_interval(status))
+                )
+            if retry_ids:
+                db.execute(
+                    update(Delivery)
+                    .where(Delivery.id.in_(retry_ids))
+                    .values(next_tracking_check_at=now + timedelta(minutes=configs.DPD_TRACKING_RETRY_MINUTES))
+                )
+            db.commit()
+
+            for delivery, new_status in changed_deliveries:
+                db.refresh(delivery)
+                service.notify_status_change(delivery, new_status)
+
+        return len(batch) - len(retry_ids), len(changed_deliveries)
@@ -23,12 +23,32 @@ class Configs:
     # Frontend URL
     frontend_url: str = os.getenv("FRONTEND_URL", "http://localhost:8080")
     
+    # Redis (шина событий: уведомления из events:posts)
+    redis_url: str = os.getenv("REDIS_URL", "redis://redis:6379/0")
+    
     # SendBerry API
     sendberry_api_key: str = os.getenv("SENDBERRY_API_KEY", "")
     sendberry_api_name: str = os.getenv("SENDBERRY_API_NAME", "")
     sendberry_api_password: str = os.getenv("SENDBERRY_API_PASSWORD", "")
     sendberry_sender_id: str = os.getenv("SENDBERRY_SENDER_ID", "SMS Inform")  # Default sender ID for test mode
     
+    # Очередь отправки SMS (sms_queue.py)
+    sms_queue_concurrency: int = int(os.getenv("SMS_QUEUE_CONCURRENCY", "5"))  # Одновременных отправок на провайдера
+    sms_queue_batch_size: int = int(os.getenv("SMS_QUEUE_BATCH_SIZE", "50"))
+    sms_batch_max_recipients: int = int(os.getenv("SMS_BATCH_MAX_RECIPIENTS", "50"))  # to[] в одном вызове SendBerry
+    bulk_max_items: int = int(os.getenv("BULK_MAX_ITEMS", "500"))  # Событий в одном POST /bulk
+    sms_queue_poll_interval_seconds: float = float(os.getenv("SMS_QUEUE_POLL_INTERVAL_SECONDS", "2"))
+    sms_max_attempts: int = int(os.getenv("SMS_MAX_ATTEMPTS", "5"))
+    sms_retry_base_seconds: float = float(os.getenv("SMS_RETRY_BASE_SECONDS", "30"))
+    sms_retry_max_seconds: float = float(os.getenv("SMS_RETRY_MAX_SECONDS", "1800"))
+    sms_send_lease_seconds: int = int(os.getenv("SMS_SEND_LEASE_SECONDS", "120"))
+    sms_max_age_hours: int = int(os.getenv("SMS_MAX_AGE_HOURS", "24"))  # Старше — не отправляем, failed
+    
+    # Хранение истории: завершённые записи старше N дней переносятся в notificationlog_archive
+    notification_retention_days: int = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "90"))
+    notification_archive_batch_size: int = int(os.getenv("NOTIFICATION_ARCHIVE_BATCH_SIZE", "1000"))
+    notification_archive_interval_seconds: int = int(os.getenv("NOTIFICATION_ARCHIVE_INTERVAL_SECONDS", "3600"))
+    
     # JWT для валидации (если нужно защитить API)
     secret_key: str = os.getenv("SECRET_KEY", "My secret key")
     token_algoritm: str = os.getenv("TOKEN_ALGORITHM", "HS256")
@@ -3,6 +3,7 @@
 import logging
 from sqlmodel import SQLModel, create_engine, Session
 from configs import configs
+import outbox  # OutboxEvent, ProcessedEvent (шина событий) — до create_all
 
 logger = logging.getLogger("notification.database")
 
@@ -17,9 +18,50 @@ engine = create_engine(
 def create_db_and_tables():
     """Создание всех таблиц в базе данных"""
     SQLModel.metadata.create_all(engine)
+    _apply_schema_patches()
     logger.info("Database tables created/verified")
 
 
+# Колонки, добавленные в уже существующие таблицы (create_all их не добавит).
+# Только PostgreSQL: локальную SQLite-базу проще пересоздать.
+SCHEMA_PATCHES = [
+    "ALTER TABLE notificationlog ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_notificationlog_queue ON notificationlog (next_attempt_at) "
+    "WHERE status IN ('pending', 'retry', 'sending')",
+    # Дубли, принятые до уникального индекса: остаётся отправленная (или самая ранняя) запись.
+    # Один раз — пока индекса нет; на обычном старте полный проход по notificationlog не нужен
+    "DO $$ BEGIN IF to_regclass('ux_notificationlog_accepted') IS NULL THEN "
+    "UPDATE notificationlog SET status = 'duplicate' WHERE id IN ("
+    "SELECT id FROM (SELECT id, row_number() OVER ("
+    "PARTITION BY notification_type, order_id, recipient_phone "
+    "ORDER BY (status = 'sent') DESC, id) AS rn "
+    "FROM notificationlog WHERE status IN ('pending', 'sending', 'retry', 'sent') "
+    "AND order_id IS NOT NULL AND recipient_phone IS NOT NULL) ranked WHERE rn > 1); "
+    "END IF; END $$",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_notificationlog_accepted "
+    "ON notificationlog (notification_type, order_id, recipient_phone) "
+    "WHERE status IN ('pending', 'sending', 'retry', 'sent')",
+    "CREATE INDEX IF NOT EXISTS ix_notificationlog_created_at_id ON notificationlog (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_notificationlog_order_created_at ON notificationlog (order_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_notificationlog_status_created_at ON notificationlog (status, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_notificationlog_type_created_at "
+    "ON notificationlog (notification_type, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_notificationlog_phone_created_at "
+    "ON notificationlog (recipient_phone, created_at, id)",
+]
+
+
+def _apply_schema_patches():
+    if engine.dialect.name != "postgresql":
+        return
+    try:
+        with engine.begin() as connection:
+            for statement in SCHEMA_PATCHES:
+                connection.exec_driver_sql(statement)
+    except Exception:
+        logger.exception("Failed to apply notification schema patches")
+
+
 def get_session():
     """Генератор сессий для работы с БД"""
     with Session(engine) as session:
@@ -5,9 +5,12 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
-from database import create_db_and_tables
-from notification_router import notification_router
+from database import create_db_and_tables, engine
+from notification_router import notification_router, POSTS_EVENT_HANDLERS
 from configs import configs
+from outbox import StreamConsumer
+from sms_queue import sms_dispatcher
+from retention import notification_archiver
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,6 +19,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger("notification.main")
 
+# Уведомления, поставленные posts-service в outbox, приходят из потока events:posts
+posts_events_consumer = StreamConsumer(
+    engine,
+    configs.redis_url,
+    source="posts",
+    group="notifications",
+    handlers=POSTS_EVENT_HANDLERS,
+)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -24,8 +36,14 @@ async def lifespan(app: FastAPI):
     logger.info("Starting Notification Service")
     create_db_and_tables()
     logger.info("Database tables ready")
+    await sms_dispatcher.start()
+    await notification_archiver.start()
+    await posts_events_consumer.start()
     yield
     # Shutdown
+    await posts_events_consumer.stop()
+    await notification_archiver.stop()
+    await sms_dispatcher.stop()
     logger.info("Shutting down Notification Service")
 
 
@@ -74,6 +92,24 @@ async def root():
     }
 
 
+@app.get("/events/metrics")
+async def get_event_bus_metrics():
+    """Метрики потребителя событий этой реплики"""
+    return {"consumers": {posts_events_consumer.stream: await posts_events_consumer.stats()}}
+
+
+@app.get("/queue/metrics")
+async def get_sms_queue_metrics():
+    """Очередь SMS: глубина по статусам, возраст старейшей записи, задержки отправки, слоты провайдеров"""
+    return await sms_dispatcher.stats()
+
+
+@app.get("/retention/metrics")
+async def get_retention_metrics():
+    """Перенос старой истории в notificationlog_archive"""
+    return notification_archiver.stats()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
@@ -1,8 +1,9 @@
 # models.py - Модели для notification service
 
+from sqlalchemy import Index, text
 from sqlmodel import Field, SQLModel
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import Any, Dict, Literal, Optional
 from datetime import datetime
 from enum import Enum
 
@@ -35,9 +36,22 @@ class NotificationChannel(str, Enum):
 class NotificationStatus(str, Enum):
     """Статусы доставки уведомлений"""
     PENDING = "pending"
+    SENDING = "sending"  # Забрано воркером очереди, до next_attempt_at (аренда)
     SENT = "sent"
     FAILED = "failed"
     RETRY = "retry"
+    DUPLICATE = "duplicate"  # Повтор уже принятого уведомления (записи до уникального индекса)
+
+
+# Уведомление в очереди или уже отправлено — повторно не ставим.
+# Порядок совпадает с условием ux_notificationlog_accepted (ON CONFLICT сверяет предикат индекса).
+ACCEPTED_STATUSES = (
+    NotificationStatus.PENDING.value,
+    NotificationStatus.SENDING.value,
+    NotificationStatus.RETRY.value,
+    NotificationStatus.SENT.value,
+)
+ACCEPTED_STATUSES_SQL = "status IN ('pending', 'sending', 'retry', 'sent')"
 
 
 # =============================================================================
@@ -45,7 +59,32 @@ class NotificationStatus(str, Enum):
 # =============================================================================
 
 class NotificationLog(SQLModel, table=True):
-    """История отправленных уведомлений"""
+    """История отправленных уведомлений и очередь отправки (pending/retry/sending)"""
+    __table_args__ = (
+        Index(
+            "ix_notificationlog_queue",
+            "next_attempt_at",
+            postgresql_where=text("status IN ('pending', 'retry', 'sending')"),
+        ),
+        # Одно принятое уведомление на (тип, заказ, телефон): проверка дубля — проба по индексу,
+        # а INSERT ... ON CONFLICT DO NOTHING закрывает гонку параллельных запросов
+        Index(
+            "ux_notificationlog_accepted",
+            "notification_type",
+            "order_id",
+            "recipient_phone",
+            unique=True,
+            postgresql_where=text(ACCEPTED_STATUSES_SQL),
+            sqlite_where=text(ACCEPTED_STATUSES_SQL),
+        ),
+        # История (keyset по created_at desc, id desc) с фильтрами
+        Index("ix_notificationlog_created_at_id", "created_at", "id"),
+        Index("ix_notificationlog_order_created_at", "order_id", "created_at", "id"),
+        Index("ix_notificationlog_status_created_at", "status", "created_at", "id"),
+        Index("ix_notificationlog_type_created_at", "notification_type", "created_at", "id"),
+        Index("ix_notificationlog_phone_created_at", "recipient_phone", "created_at", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     
     # Тип уведомления
@@ -68,6 +107,7 @@ class NotificationLog(SQLModel, table=True):
     status: str = Field(default="pending", max_length=20, index=True)
     error_message: Optional[str] = Field(default=None, max_length=1000)
     retry_count: int = Field(default=0)
+    next_attempt_at: Optional[datetime] = Field(default=None)  # Когда воркер может взять запись
     
     # Временные метки
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -99,6 +139,43 @@ class NotificationTemplate(SQLModel, table=True):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 
+class NotificationLogArchive(SQLModel, table=True):
+    """
+    Архив notificationlog: завершённые записи старше notification_retention_days.
+    Без текста и темы сообщения — только то, что нужно для разбора истории.
+    """
+    __tablename__ = "notificationlog_archive"
+    __table_args__ = (
+        Index("ix_notificationlog_archive_created_at_id", "created_at", "id"),
+        Index("ix_notificationlog_archive_order_created_at", "order_id", "created_at", "id"),
+        Index("ix_notificationlog_archive_phone_created_at", "recipient_phone", "created_at", "id"),
+    )
+
+    id: int = Field(primary_key=True)  # id исходной записи notificationlog
+    notification_type: str = Field(max_length=50)
+    channel: str = Field(max_length=10)
+    recipient_email: Optional[str] = Field(default=None, max_length=255)
+    recipient_phone: Optional[str] = Field(default=None, max_length=20)
+    order_id: Optional[int] = Field(default=None)
+    status: str = Field(max_length=20)
+    error_message: Optional[str] = Field(default=None, max_length=1000)
+    retry_count: int = Field(default=0)
+    created_at: datetime
+    sent_at: Optional[datetime] = Field(default=None)
+    external_id: Optional[str] = Field(default=None, max_length=255)
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class OrderRecipientLanguage(SQLModel, table=True):
+    """Язык получателя по заказу: запоминается при оплате, читается запросом на отзыв"""
+    __tablename__ = "order_recipient_language"
+
+    order_id: int = Field(primary_key=True)
+    recipient_phone: str = Field(primary_key=True, max_length=20)
+    language: str = Field(max_length=5)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
 # =============================================================================
 # PYDANTIC MODELS FOR API
 # =============================================================================
@@ -165,6 +242,31 @@ class SendNotificationResponse(BaseModel):
     errors: Optional[list[str]] = None
 
 
+class BulkNotificationItem(BaseModel):
+    """Событие пакета: то же, что тело соответствующего эндпоинта (/order-paid, /order-delivered, /dispute-event)"""
+    event: Literal["order-paid", "order-delivered", "dispute-event"]
+    data: Dict[str, Any]
+
+
+class BulkNotificationRequest(BaseModel):
+    items: list[BulkNotificationItem]
+
+
+class BulkNotificationResult(BaseModel):
+    """Результат по одному событию пакета (index — позиция в запросе)"""
+    index: int
+    success: bool
+    notification_ids: list[int] = []
+    duplicates: int = 0  # Уже в очереди или отправлены — не поставлены повторно
+    errors: list[str] = []
+
+
+class BulkNotificationResponse(BaseModel):
+    success: bool
+    queued: int
+    results: list[BulkNotificationResult]
+
+
 class NotificationHistoryResponse(BaseModel):
     """История уведомлений"""
     id: int
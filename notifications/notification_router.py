@@ -1,9 +1,11 @@
 # notification_router.py - API роутеры для notification service
 
-from fastapi import APIRouter, Depends, HTTPException, Cookie, status
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Query, Response, status
+from sqlalchemy import and_, or_
 from sqlmodel import Session, select
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 from datetime import datetime
+import base64
 from jose import jwt
 import logging
 
@@ -11,11 +13,12 @@ from database import get_session
 from configs import configs
 from models import (
     SendNotificationRequest, SendNotificationResponse,
-    NotificationHistoryResponse, NotificationLog,
+    NotificationHistoryResponse, NotificationLog, NotificationLogArchive,
     NotificationType, NotificationChannel, OrderNotificationData,
-    DisputeNotificationData
+    DisputeNotificationData, BulkNotificationRequest, BulkNotificationResponse
 )
 from notification_service import NotificationService, SendBerryService
+from sms_queue import sms_dispatcher
 
 notification_router = APIRouter(prefix="/api/v1/notifications", tags=["Notifications"])
 logger = logging.getLogger("notification.router")
@@ -36,6 +39,20 @@ def _decode_user(access_token: Optional[str]) -> dict:
     return payload
 
 
+def _encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, row_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 def _check_admin(access_token: Optional[str]) -> dict:
     payload = _decode_user(access_token)
     if payload.get("user_type", "regular") not in ["admin", "support"]:
@@ -51,6 +68,9 @@ async def send_notification(
     """
     Универсальный эндпоинт для отправки уведомлений
     
+    Уведомления ставятся в очередь (sms_queue.py), ответ не ждёт SMS-шлюза:
+    notification_ids — id записей notificationlog, статус отправки — в /history.
+    
     Поддерживаемые типы:
     - ORDER_PAID: SMS уведомление после оплаты (продавцу и покупателю)
     - ORDER_REVIEW_REQUEST: SMS запрос на отзыв
@@ -80,24 +100,27 @@ async def send_notification(
                 errors=[f"Unknown notification type: {request.notification_type}"]
             )
         
+        if notification_ids:
+            sms_dispatcher.wake()
+        
         # Формируем ответ
         if len(errors) == 0:
             return SendNotificationResponse(
                 success=True,
-                message="All notifications sent successfully",
+                message="All notifications queued",
                 notification_ids=notification_ids
             )
         elif len(notification_ids) > 0:
             return SendNotificationResponse(
                 success=True,
-                message="Some notifications sent with errors",
+                message="Some notifications queued with errors",
                 notification_ids=notification_ids,
                 errors=errors
             )
         else:
             return SendNotificationResponse(
                 success=False,
-                message="Failed to send notifications",
+                message="Failed to queue notifications",
                 errors=errors
             )
     
@@ -178,29 +201,22 @@ async def notify_pickup(
         notification_ids = []
         errors = []
         
-        # Отправляем в зависимости от предпочтения контакта
-        if contact_preference == "phone" and seller_phone:
-            logger.info(f"Sending SMS to seller phone: {seller_phone}")
-            sendberry = SendBerryService()
-            result = sendberry.send_sms(seller_phone, message)
-            if result.get("success"):
-                notification_ids.append(result.get("message_id"))
-            else:
-                errors.append(f"SMS send failed: {result.get('error')}")
-        elif seller_phone:  # Fallback to phone if email fails
-            logger.info(f"Email not available or preferred, sending SMS to: {seller_phone}")
-            sendberry = SendBerryService()
-            result = sendberry.send_sms(seller_phone, message)
-            if result.get("success"):
-                notification_ids.append(result.get("message_id"))
-            else:
-                errors.append(f"SMS send failed: {result.get('error')}")
+        # Email не поддерживается — при любом предпочтении контакта отправляем SMS, если есть телефон
+        if seller_phone:
+            if contact_preference != "phone":
+                logger.info("Email not available, sending pickup SMS to seller")
+            _, notification_ids, errors = service.send_pickup_notification(
+                order_id if isinstance(order_id, int) else None,
+                seller_phone,
+                message,
+            )
+            sms_dispatcher.wake()
         
         return {
             "success": len(errors) == 0,
             "notification_ids": notification_ids,
             "errors": errors,
-            "message": "Pickup notification processed" if len(errors) == 0 else "Pickup notification sent with errors"
+            "message": "Pickup notification queued" if len(errors) == 0 else "Pickup notification queued with errors"
         }
     
     except Exception as e:
@@ -222,11 +238,13 @@ async def notify_dispute_event(
     service = NotificationService(db)
     try:
         success, ids, errors = service.send_dispute_event(dispute_data)
+        if ids:
+            sms_dispatcher.wake()
         return {
             "success": success,
             "notification_ids": ids,
             "errors": errors,
-            "message": "Dispute notifications processed" if success else "Dispute notifications sent with errors"
+            "message": "Dispute notifications queued" if success else "Dispute notifications queued with errors"
         }
     except Exception as exc:
         logger.error(f"Dispute notification error: {type(exc).__name__}")
@@ -238,38 +256,121 @@ async def notify_dispute_event(
         }
 
 
+@notification_router.post("/bulk", response_model=BulkNotificationResponse)
+async def notify_bulk(
+    request: BulkNotificationRequest,
+    db: Session = Depends(get_session)
+):
+    """
+    Пакет событий (order-paid, order-delivered, dispute-event) одним запросом.
+    
+    Все уведомления пакета пишутся одним INSERT и одним commit; одинаковые тексты воркер
+    отправляет в SendBerry пакетами. Результат — по каждому событию в порядке запроса.
+    """
+    if len(request.items) > configs.bulk_max_items:
+        raise HTTPException(status_code=413, detail=f"Too many items (max {configs.bulk_max_items})")
+
+    service = NotificationService(db)
+    try:
+        results = service.enqueue_bulk(request.items)
+    except Exception as exc:
+        logger.error(f"Bulk notification error: {type(exc).__name__}")
+        raise HTTPException(status_code=503, detail="Notifications not queued")
+
+    queued = sum(len(result.notification_ids) for result in results)
+    if queued:
+        sms_dispatcher.wake()
+    return BulkNotificationResponse(
+        success=all(result.success for result in results),
+        queued=queued,
+        results=results,
+    )
+
+
+# === ОБРАБОТЧИКИ СОБЫТИЙ ИЗ ШИНЫ (events:posts) ===
+# posts-service ставит уведомления в outbox (тип notification.<endpoint>); обработчики
+# переиспользуют HTTP-эндпоинты, которые остаются для ручных вызовов и совместимости.
+
+async def _on_order_paid_event(db: Session, payload: Dict[str, Any]) -> None:
+    await notify_order_paid(OrderNotificationData(**payload), db)
+
+
+async def _on_order_delivered_event(db: Session, payload: Dict[str, Any]) -> None:
+    await notify_order_delivered(OrderNotificationData(**payload), db)
+
+
+async def _on_pickup_event(db: Session, payload: Dict[str, Any]) -> None:
+    await notify_pickup(payload, db)
+
+
+async def _on_dispute_event(db: Session, payload: Dict[str, Any]) -> None:
+    await notify_dispute_event(DisputeNotificationData(**payload), db)
+
+
+POSTS_EVENT_HANDLERS = {
+    "notification.order-paid": _on_order_paid_event,
+    "notification.order-delivered": _on_order_delivered_event,
+    "notification.pickup-notification": _on_pickup_event,
+    "notification.dispute-event": _on_dispute_event,
+}
+
+
 
 @notification_router.get("/history", response_model=list[NotificationHistoryResponse])
 async def get_notification_history(
+    response: Response,
     order_id: Optional[int] = None,
     email: Optional[str] = None,
     phone: Optional[str] = None,
-    limit: int = 50,
+    status: Optional[str] = None,
+    notification_type: Optional[str] = None,
+    archived: bool = False,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor из предыдущей страницы"),
     db: Session = Depends(get_session)
 ):
     """
-    Получение истории отправленных уведомлений
+    Получение истории отправленных уведомлений (новые сверху)
     
     Фильтры:
     - order_id: По номеру заказа
     - email: По email получателя
     - phone: По телефону получателя
+    - status: pending / sending / retry / sent / failed / duplicate
+    - notification_type: Тип уведомления
+    - archived: Искать в архиве (записи старше NOTIFICATION_RETENTION_DAYS)
     - limit: Максимальное количество записей (по умолчанию 50)
+    
+    Постранично — по курсору (created_at, id): курсор следующей страницы приходит
+    в заголовке X-Next-Cursor, на последней странице его нет.
     """
-    statement = select(NotificationLog)
+    model = NotificationLogArchive if archived else NotificationLog
+    statement = select(model)
     
-    # Применяем фильтры
+    # Применяем фильтры (каждый покрыт индексом (<колонка>, created_at, id))
     if order_id:
-        statement = statement.where(NotificationLog.order_id == order_id)
+        statement = statement.where(model.order_id == order_id)
     if email:
-        statement = statement.where(NotificationLog.recipient_email == email)
+        statement = statement.where(model.recipient_email == email)
     if phone:
-        statement = statement.where(NotificationLog.recipient_phone == phone)
+        statement = statement.where(model.recipient_phone == phone)
+    if status:
+        statement = statement.where(model.status == status)
+    if notification_type:
+        statement = statement.where(model.notification_type == notification_type)
+    if cursor:
+        created_at, row_id = _decode_cursor(cursor)
+        statement = statement.where(
+            or_(model.created_at < created_at, and_(model.created_at == created_at, model.id < row_id))
+        )
     
-    # Сортировка и лимит
-    statement = statement.order_by(NotificationLog.created_at.desc()).limit(limit)
+    # Сортировка и лимит (+1 — узнать, есть ли следующая страница)
+    statement = statement.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1)
     
     notifications = db.exec(statement).all()
+    if len(notifications) > limit:
+        notifications = notifications[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(notifications[-1].created_at, notifications[-1].id)
     
     return [
         NotificationHistoryResponse(
@@ -1,16 +1,22 @@
 # notification_service.py - Сервис для работы с SendBerry API
 
+import re
 import requests
-import time
 import logging
-from typing import Optional, Tuple
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlmodel import Session
 from sqlmodel import select
 from urllib.parse import urlencode
 
 from configs import configs
-from models import NotificationLog, NotificationTemplate, NotificationStatus, OrderNotificationData, DisputeNotificationData, DisputeEventType
+from models import (
+    ACCEPTED_STATUSES, NotificationLog, NotificationTemplate, NotificationStatus, OrderNotificationData,
+    DisputeNotificationData, DisputeEventType, OrderRecipientLanguage, BulkNotificationItem, BulkNotificationResult
+)
 
 
 # Настройка логирования
@@ -55,6 +61,43 @@ SMS_TEXTS = {
 }
 
 
+# Подстановка — буквальный {key} без вложенных скобок, как в прежнем text.replace("{key}", value)
+PLACEHOLDER_RE = re.compile(r"\{([^{}]+)\}")
+
+
+class CompiledTemplate:
+    """Шаблон, разобранный один раз: пары (литерал, имя подстановки {key})
+
+    Разбор — поиск буквальных {key}, а не str.format: CSS вида p{margin:0} и одиночные скобки
+    в HTML-шаблонах остаются как есть, неизвестные {key} тоже.
+    """
+
+    __slots__ = ("parts",)
+
+    def __init__(self, text: str):
+        self.parts: List[Tuple[str, Optional[str]]] = []
+        position = 0
+        for match in PLACEHOLDER_RE.finditer(text):
+            self.parts.append((text[position:match.start()], match.group(1)))
+            position = match.end()
+        self.parts.append((text[position:], None))
+
+    def render(self, data: dict) -> str:
+        chunks = []
+        for literal, field in self.parts:
+            chunks.append(literal)
+            if field is not None:
+                # Неизвестная переменная остаётся в тексте, как при прежней замене строк
+                chunks.append(str(data[field]) if field in data else f"{{{field}}}")
+        return "".join(chunks)
+
+
+@lru_cache(maxsize=512)
+def compile_template(text: str) -> CompiledTemplate:
+    """Ключ — сам текст: изменённый шаблон просто компилируется заново"""
+    return CompiledTemplate(text)
+
+
 class SendBerryService:
     """Сервис для отправки SMS через SendBerry API"""
     
@@ -83,13 +126,30 @@ class SendBerryService:
         """
         if not phone or not message:
             return False, None, "Phone or message is empty"
+        return self._send([phone], message, sms_id)
+
+    def send_sms_batch(self, phones: list[str], message: str) -> Tuple[bool, Optional[str], Optional[str]]:
+        """
+        Один текст нескольким получателям одним запросом (to[] повторяется).
         
-        # Форматируем телефон (E.164 формат)
+        Returns:
+            Tuple[success, external_id, error_message] — общий для всех получателей
+        """
+        phones = [phone for phone in phones if phone]
+        if not phones or not message:
+            return False, None, "Phone or message is empty"
+        return self._send(phones, message)
+
+    @staticmethod
+    def _format_phone(phone: str) -> str:
+        # E.164 формат
         formatted_phone = phone.strip().replace(" ", "").replace("-", "")
         if not formatted_phone.startswith("+"):
             formatted_phone = f"+{formatted_phone}"
-        
-        logger.info("Sending SMS via SendBerry")
+        return formatted_phone
+
+    def _send(self, phones: list[str], message: str, sms_id: Optional[str] = None) -> Tuple[bool, Optional[str], Optional[str]]:
+        logger.info(f"Sending SMS via SendBerry | recipients={len(phones)}")
         
         try:
             # Подготавливаем параметры запроса
@@ -98,7 +158,7 @@ class SendBerryService:
                 "name": self.api_name,
                 "password": self.api_password,
                 "from": self.sender_id,
-                "to[]": formatted_phone,
+                "to[]": [self._format_phone(phone) for phone in phones],
                 "content": message,
                 "response": "JSON"  # Получаем ответ в JSON формате
             }
@@ -211,7 +271,8 @@ class NotificationService:
     
     def __init__(self, db: Session):
         self.db = db
-        self.sendberry = SendBerryService()
+        # В режиме пакета (enqueue_bulk) _enqueue копит строки здесь, а не вставляет по одной
+        self._drafts: Optional[List[dict]] = None
     
     def _get_template(self, notification_type: str) -> Optional[NotificationTemplate]:
         """Получение шаблона уведомления"""
@@ -235,13 +296,18 @@ class NotificationService:
         if not buyer_phone:
             return normalized_fallback
 
+        record = self.db.get(OrderRecipientLanguage, (order_id, buyer_phone))
+        if record:
+            return self._normalize_language(record.language)
+
+        # Заказы, оплаченные до появления order_recipient_language: язык лежит в recipient_name лога
         statement = (
             select(NotificationLog)
             .where(
                 NotificationLog.order_id == order_id,
                 NotificationLog.notification_type == "order_paid_buyer",
                 NotificationLog.recipient_phone == buyer_phone,
-                NotificationLog.status == NotificationStatus.SENT.value,
+                NotificationLog.status.in_(ACCEPTED_STATUSES),
             )
             .order_by(NotificationLog.created_at.desc())
         )
@@ -255,30 +321,45 @@ class NotificationService:
 
         return normalized_fallback
 
+    def _remember_language(self, order_id: int, phone: Optional[str], language: str) -> None:
+        """Запомнить язык получателя по заказу (коммитится вместе с постановкой уведомления)"""
+        if not phone:
+            return
+        insert = postgresql.insert if self.db.get_bind().dialect.name == "postgresql" else sqlite.insert
+        statement = insert(OrderRecipientLanguage.__table__).values(
+            order_id=order_id,
+            recipient_phone=phone,
+            language=language,
+            updated_at=datetime.utcnow(),
+        )
+        self.db.execute(
+            statement.on_conflict_do_update(
+                index_elements=["order_id", "recipient_phone"],
+                set_={"language": statement.excluded.language, "updated_at": statement.excluded.updated_at},
+            )
+        )
+
     def _already_sent(self, notification_type: str, order_id: int, phone: Optional[str]) -> bool:
+        """Уже отправлено или стоит в очереди (проба по ux_notificationlog_accepted); failed можно поставить заново"""
         if not phone:
             return False
 
-        statement = select(NotificationLog).where(
+        statement = select(NotificationLog.id).where(
             NotificationLog.notification_type == notification_type,
             NotificationLog.order_id == order_id,
             NotificationLog.recipient_phone == phone,
-            NotificationLog.status == NotificationStatus.SENT.value,
-        )
+            NotificationLog.status.in_(ACCEPTED_STATUSES),
+        ).limit(1)
         return self.db.exec(statement).first() is not None
 
     def _build_default_sms(self, key: str, lang: str, data: dict) -> str:
         lang_code = self._normalize_language(lang)
         template = SMS_TEXTS.get(lang_code, SMS_TEXTS["ru"]).get(key, SMS_TEXTS["ru"][key])
-        return template.format(**data)
+        return compile_template(template).render(data)
     
     def _render_template(self, template_text: str, data: dict) -> str:
-        """Простая замена переменных в шаблоне"""
-        result = template_text
-        for key, value in data.items():
-            placeholder = f"{{{key}}}"
-            result = result.replace(placeholder, str(value))
-        return result
+        """Подстановка переменных в шаблон (разбор шаблона кэшируется)"""
+        return compile_template(template_text).render(data)
     
     def send_order_paid_notification(self, order_data: OrderNotificationData) -> Tuple[bool, list[int], list[str]]:
         """Отправка SMS уведомлений после оплаты заказа (продавцу и покупателю)"""
@@ -304,8 +385,9 @@ class NotificationService:
                 }
 
                 sms_message = self._build_default_sms("order_paid_seller", language, template_data)
+                self._remember_language(order_data.order_id, order_data.seller_phone, language)
 
-                success, external_id, error = self._send_with_retry(
+                success, log_id, error = self._enqueue(
                     "sms",
                     order_data.seller_phone,
                     None,
@@ -315,8 +397,8 @@ class NotificationService:
                     recipient_name=language,
                 )
 
-                if success and external_id:
-                    notification_ids.append(external_id)
+                if success and log_id:
+                    notification_ids.append(log_id)
                 elif error:
                     errors.append(f"SMS to seller: {error}")
         else:
@@ -343,8 +425,10 @@ class NotificationService:
                 }
 
                 sms_message = self._build_default_sms("order_paid_buyer", language, template_data)
+                # Запрос на отзыв придёт на том же языке (_get_buyer_language_for_order)
+                self._remember_language(order_data.order_id, order_data.buyer_phone, language)
 
-                success, external_id, error = self._send_with_retry(
+                success, log_id, error = self._enqueue(
                     "sms",
                     order_data.buyer_phone,
                     None,
@@ -354,8 +438,8 @@ class NotificationService:
                     recipient_name=language,
                 )
 
-                if success and external_id:
-                    notification_ids.append(external_id)
+                if success and log_id:
+                    notification_ids.append(log_id)
                 elif error:
                     errors.append(f"SMS to buyer: {error}")
         
@@ -394,7 +478,7 @@ class NotificationService:
         
         sms_message = self._build_default_sms("order_review_request", language, template_data)
         
-        success, external_id, error = self._send_with_retry(
+        success, log_id, error = self._enqueue(
             "sms",
             order_data.buyer_phone,
             None,
@@ -404,13 +488,91 @@ class NotificationService:
             recipient_name=language,
         )
         
-        if success and external_id:
-            notification_ids.append(external_id)
+        if success and log_id:
+            notification_ids.append(log_id)
         elif error:
             errors.append(f"SMS: {error}")
         
         return len(errors) == 0, notification_ids, errors
 
+    def _insert_logs_statement(self, rows: List[dict]):
+        insert = postgresql.insert if self.db.get_bind().dialect.name == "postgresql" else sqlite.insert
+        table = NotificationLog.__table__
+        return (
+            insert(table)
+            .values(rows)
+            .on_conflict_do_nothing(
+                index_elements=["notification_type", "order_id", "recipient_phone"],
+                index_where=table.c.status.in_(ACCEPTED_STATUSES),
+            )
+            .returning(table.c.id, table.c.notification_type, table.c.order_id, table.c.recipient_phone)
+        )
+
+    def enqueue_bulk(self, items: List[BulkNotificationItem]) -> List[BulkNotificationResult]:
+        """
+        Пакет событий: уведомления всех событий готовятся как обычно, но пишутся одним
+        INSERT ... ON CONFLICT DO NOTHING и одним commit. Ошибка события не мешает остальным.
+        """
+        handlers = {
+            "order-paid": lambda data: self.send_order_paid_notification(OrderNotificationData(**data)),
+            "order-delivered": lambda data: self.send_review_request(OrderNotificationData(**data)),
+            "dispute-event": lambda data: self.send_dispute_event(DisputeNotificationData(**data)),
+        }
+
+        self._drafts = []
+        prepared = []  # (срез self._drafts, ошибки) на событие
+        try:
+            for item in items:
+                start = len(self._drafts)
+                try:
+                    _, _, errors = handlers[item.event](item.data)
+                except Exception as exc:
+                    del self._drafts[start:]
+                    errors = [f"{type(exc).__name__}: {exc}"]
+                prepared.append((start, len(self._drafts), errors))
+            drafts = self._drafts
+        finally:
+            self._drafts = None
+
+        # Один и тот же получатель дважды в пакете — вставляем первую строку
+        key = lambda row: (row["notification_type"], row["order_id"], row["recipient_phone"])
+        unique_rows = list({key(row): row for row in reversed(drafts)}.values())
+        inserted = {}
+        if unique_rows:
+            for log_id, *row_key in self.db.execute(self._insert_logs_statement(unique_rows)).all():
+                inserted[tuple(row_key)] = log_id
+        self.db.commit()
+
+        results = []
+        claimed = set()
+        for index, (start, end, errors) in enumerate(prepared):
+            ids, duplicates = [], 0
+            for row in drafts[start:end]:
+                log_id = inserted.get(key(row))
+                if log_id is None or log_id in claimed:
+                    duplicates += 1
+                else:
+                    claimed.add(log_id)
+                    ids.append(log_id)
+            results.append(BulkNotificationResult(
+                index=index,
+                success=not errors,
+                notification_ids=ids,
+                duplicates=duplicates,
+                errors=errors,
+            ))
+
+        logger.info(f"Bulk notifications | items={len(items)} | queued={len(inserted)} | drafts={len(drafts)}")
+        return results
+
+    def send_pickup_notification(self, order_id: Optional[int], seller_phone: str, message: str) -> Tuple[bool, list[int], list[str]]:
+        """SMS продавцу о личной встрече (pickup)"""
+        ok, log_id, err = self._enqueue(
+            "sms", seller_phone, None, message, order_id,
+            notification_type="pickup_seller",
+        )
+        return ok, [log_id] if log_id else [], [err] if err else []
+
     def send_dispute_event(self, data: DisputeNotificationData) -> Tuple[bool, list[int], list[str]]:
         notification_ids = []
         errors = []
@@ -445,7 +607,7 @@ class NotificationService:
                         "tracking_url": tracking_url,
                     },
                 )
-                ok, log_id, err = self._send_with_retry(
+                ok, log_id, err = self._enqueue(
                     "sms", data.seller_phone, None, sms, data.order_id,
                     notification_type="dispute_opened_seller", recipient_name=language,
                 )
@@ -473,7 +635,7 @@ class NotificationService:
                     }
 
                 sms = self._build_default_sms(sms_key, language, sms_data)
-                ok, log_id, err = self._send_with_retry(
+                ok, log_id, err = self._enqueue(
                     "sms", data.buyer_phone, None, sms, data.order_id,
                     notification_type=f"dispute_seller_response_buyer_{data.dispute_id}", recipient_name=language,
                 )
@@ -493,7 +655,7 @@ class NotificationService:
                         "dispute_id": data.dispute_id,
                     },
                 )
-                ok, log_id, err = self._send_with_retry(
+                ok, log_id, err = self._enqueue(
                     "sms", data.seller_phone, None, sms, data.order_id,
                     notification_type=f"dispute_discount_closed_seller_{data.dispute_id}", recipient_name=language,
                 )
@@ -517,7 +679,7 @@ class NotificationService:
                         "tracking_url": tracking_url,
                     },
                 )
-                ok, log_id, err = self._send_with_retry(
+                ok, log_id, err = self._enqueue(
                     "sms", data.buyer_phone, None, sms_buyer, data.order_id,
                     notification_type=f"dispute_platform_result_buyer_{data.dispute_id}", recipient_name=language,
                 )
@@ -538,7 +700,7 @@ class NotificationService:
                         "tracking_url": tracking_url,
                     },
                 )
-                ok, log_id, err = self._send_with_retry(
+                ok, log_id, err = self._enqueue(
                     "sms", data.seller_phone, None, sms_seller, data.order_id,
                     notification_type=f"dispute_platform_result_seller_{data.dispute_id}", recipient_name=language,
                 )
@@ -549,20 +711,23 @@ class NotificationService:
 
         return len(errors) == 0, notification_ids, errors
     
-    def _send_with_retry(self, 
-                        channel: str, 
-                        phone: Optional[str], 
-                        email: Optional[str],
-                        message: str,
-                        order_id: int,
-                        notification_type: str,
-                        recipient_name: Optional[str] = None,
-                        subject: Optional[str] = None,
-                        max_retries: int = 3) -> Tuple[bool, Optional[int], Optional[str]]:
-        """Отправка уведомления с retry механизмом"""
+    def _enqueue(self,
+                 channel: str,
+                 phone: Optional[str],
+                 email: Optional[str],
+                 message: str,
+                 order_id: int,
+                 notification_type: str,
+                 recipient_name: Optional[str] = None,
+                 subject: Optional[str] = None) -> Tuple[bool, Optional[int], Optional[str]]:
+        """
+        Постановка уведомления в очередь: отправку и повторы делает SMSDispatcher (sms_queue.py).
         
-        # Создаем лог в БД
-        log = NotificationLog(
+        INSERT ... ON CONFLICT DO NOTHING по ux_notificationlog_accepted: если такое же уведомление
+        уже в очереди или отправлено, запись не создаётся и возвращается (True, None, None).
+        """
+        now = datetime.utcnow()
+        values = dict(
             notification_type=notification_type,
             channel=channel,
             recipient_phone=phone,
@@ -571,44 +736,20 @@ class NotificationService:
             subject=subject,
             message=message,
             order_id=order_id,
-            status=NotificationStatus.PENDING.value
+            status=NotificationStatus.PENDING.value,
+            retry_count=0,
+            created_at=now,
+            next_attempt_at=now,
         )
-        self.db.add(log)
+        if self._drafts is not None:
+            self._drafts.append(values)
+            return True, None, None
+
+        log_id = self.db.execute(self._insert_logs_statement([values])).scalar()
         self.db.commit()
-        self.db.refresh(log)
-        
-        # Пытаемся отправить с retry
-        for attempt in range(max_retries):
-            try:
-                if channel == "sms":
-                    success, external_id, error = self.sendberry.send_sms(phone, message)
-                else:
-                    success, external_id, error = False, None, f"Unknown channel: {channel}"
-                
-                if success:
-                    log.status = NotificationStatus.SENT.value
-                    log.sent_at = datetime.utcnow()
-                    log.external_id = external_id
-                    self.db.commit()
-                    return True, log.id, None
-                else:
-                    log.retry_count = attempt + 1
-                    log.error_message = error
-                    log.status = NotificationStatus.RETRY.value if attempt < max_retries - 1 else NotificationStatus.FAILED.value
-                    self.db.commit()
-                    
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Send attempt {attempt + 1}/{max_retries} failed, retrying — order_id={order_id} | error={error}")
-                        time.sleep(2 ** attempt)  # Exponential backoff
-                    
-            except Exception as e:
-                logger.error(f"❌ Send attempt {attempt + 1} failed: {e}")
-                log.retry_count = attempt + 1
-                log.error_message = str(e)
-                log.status = NotificationStatus.RETRY.value if attempt < max_retries - 1 else NotificationStatus.FAILED.value
-                self.db.commit()
-                
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-        
-        return False, log.id, log.error_message
+
+        if log_id is None:
+            logger.info(f"Skip duplicate notification | type={notification_type} | order_id={order_id}")
+            return True, None, None
+        logger.info(f"Notification queued | id={log_id} | type={notification_type} | order_id={order_id}")
+        return True, log_id, None
@@ -0,0 +1,109 @@
+# retention.py - Перенос старой истории notificationlog в компактный архив
+#
+# Завершённые записи (sent/failed/duplicate) старше notification_retention_days пачками
+# переносятся в notificationlog_archive: INSERT ... SELECT и DELETE в одной транзакции.
+# Пачка выбирается FOR UPDATE SKIP LOCKED — архиватор можно запускать на всех репликах.
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, insert, literal
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import configs
+from database import engine
+from models import NotificationLog, NotificationLogArchive, NotificationStatus
+
+logger = logging.getLogger("notification.retention")
+
+FINAL_STATUSES = (
+    NotificationStatus.SENT.value,
+    NotificationStatus.FAILED.value,
+    NotificationStatus.DUPLICATE.value,
+)
+
+ARCHIVE_COLUMNS = (
+    "id", "notification_type", "channel", "recipient_email", "recipient_phone", "order_id",
+    "status", "error_message", "retry_count", "created_at", "sent_at", "external_id",
+)
+
+
+class NotificationArchiver:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, Any] = {
+            "archived": 0,
+            "runs": 0,
+            "last_run_at": None,
+            "last_error": None,
+        }
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="notification-archiver")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                archived = await asyncio.to_thread(self.archive_once)
+                if archived:
+                    logger.info("Notifications archived | rows=%s", archived)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.metrics["last_error"] = type(exc).__name__
+                logger.warning("Notification archiving failed | error_type=%s", type(exc).__name__)
+            await asyncio.sleep(configs.notification_archive_interval_seconds)
+
+    def archive_once(self) -> int:
+        """Переносит все созревшие записи пачками; возвращает число перенесённых"""
+        cutoff = datetime.utcnow() - timedelta(days=configs.notification_retention_days)
+        total = 0
+        while True:
+            moved = self._archive_batch(cutoff)
+            total += moved
+            if moved < configs.notification_archive_batch_size:
+                break
+        self.metrics["archived"] += total
+        self.metrics["runs"] += 1
+        self.metrics["last_run_at"] = datetime.utcnow().isoformat()
+        return total
+
+    def _archive_batch(self, cutoff: datetime) -> int:
+        with Session(self.engine) as db:
+            # Индекс (created_at, id): старейшие записи первыми
+            ids = db.exec(
+                select(NotificationLog.id)
+                .where(NotificationLog.created_at < cutoff, NotificationLog.status.in_(FINAL_STATUSES))
+                .order_by(NotificationLog.created_at, NotificationLog.id)
+                .limit(configs.notification_archive_batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not ids:
+                return 0
+
+            source = select(
+                *(getattr(NotificationLog, column) for column in ARCHIVE_COLUMNS),
+                literal(datetime.utcnow()).label("archived_at"),
+            ).where(NotificationLog.id.in_(ids))
+            db.execute(
+                insert(NotificationLogArchive.__table__).from_select([*ARCHIVE_COLUMNS, "archived_at"], source)
+            )
+            db.execute(delete(NotificationLog).where(NotificationLog.id.in_(ids)))
+            db.commit()
+        return len(ids)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.metrics, "retention_days": configs.notification_retention_days}
+
+
+notification_archiver = NotificationArchiver(engine)
@@ -0,0 +1,311 @@
+# sms_queue.py - Очередь отправки SMS поверх notificationlog
+#
+# Эндпоинты только ставят NotificationLog в статусе pending и сразу отвечают. SMSDispatcher
+# забирает созревшие записи (FOR UPDATE SKIP LOCKED — реплики не мешают друг другу), помечает их
+# sending с арендой до next_attempt_at и отправляет вне транзакции. Неудача — статус retry и
+# next_attempt_at с экспоненциальной задержкой и джиттером; после sms_max_attempts — failed.
+# Запись, чья аренда истекла (реплика упала посреди отправки), забирается заново.
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import configs
+from database import engine
+from models import NotificationLog, NotificationStatus
+from notification_service import SendBerryService
+
+logger = logging.getLogger("notification.sms_queue")
+
+QUEUED_STATUSES = (NotificationStatus.PENDING.value, NotificationStatus.RETRY.value)
+
+# Отправка: (телефон, текст) -> (success, external_id, error)
+Sender = Callable[[str, str], Tuple[bool, Optional[str], Optional[str]]]
+# Один текст нескольким получателям одним вызовом: ([телефоны], текст) -> (success, external_id, error)
+BatchSender = Callable[[List[str], str], Tuple[bool, Optional[str], Optional[str]]]
+
+
+def retry_delay(attempt: int) -> float:
+    """Задержка перед попыткой attempt+1: base * 2^(attempt-1), не больше max, джиттер ±50%"""
+    delay = min(configs.sms_retry_base_seconds * 2 ** max(attempt - 1, 0), configs.sms_retry_max_seconds)
+    return delay * random.uniform(0.5, 1.5)
+
+
+class SMSDispatcher:
+    """
+    Пул отправителей: не больше sms_queue_concurrency одновременных вызовов провайдера.
+    
+    Одинаковые тексты (первая попытка) уходят одним вызовом на до sms_batch_max_recipients
+    получателей, если провайдер умеет пакеты; повторы и уникальные тексты — по одному, параллельно.
+    """
+
+    def __init__(self, engine: Engine, *, concurrency: Optional[int] = None):
+        self.engine = engine
+        self.concurrency = concurrency or configs.sms_queue_concurrency
+        sendberry = SendBerryService()
+        # Канал -> (провайдер, отправка, пакетная отправка или None). Пока SMS идут только через SendBerry.
+        self.senders: Dict[str, Tuple[str, Sender, Optional[BatchSender]]] = {
+            "sms": ("sendberry", sendberry.send_sms, sendberry.send_sms_batch),
+        }
+        self._slots = {provider: asyncio.Semaphore(self.concurrency) for provider, _, _ in self.senders.values()}
+        self._in_flight: Dict[str, int] = {provider: 0 for provider in self._slots}
+        self._tasks: set = set()
+        self._wakeup = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._send_latency_ms: deque = deque(maxlen=500)
+        self._queue_latency_ms: deque = deque(maxlen=500)
+        self.metrics: Dict[str, Any] = {
+            "sent": 0,
+            "batch_calls": 0,
+            "retried": 0,
+            "failed": 0,
+            "expired": 0,
+            "errors": 0,
+            "last_error": None,
+        }
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run(), name="sms-dispatcher")
+        logger.info("SMS dispatcher started | concurrency=%s", self.concurrency)
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Отправки в полёте дожидаемся: иначе запись останется в sending до конца аренды
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def wake(self) -> None:
+        """Новое уведомление в очереди — не ждать следующего опроса"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _capacity(self) -> int:
+        return sum(self.concurrency - count for count in self._in_flight.values())
+
+    async def _run(self) -> None:
+        while True:
+            claimed = limit = 0
+            try:
+                capacity = self._capacity()
+                if capacity > 0:
+                    limit = min(capacity * configs.sms_batch_max_recipients, configs.sms_queue_batch_size)
+                    logs = await asyncio.to_thread(self._claim, limit)
+                    claimed = len(logs)
+                    groups = self._group(logs)
+                    # Вызовов больше, чем свободных слотов, — лишнее возвращаем в очередь, не держим аренду
+                    if len(groups) > capacity:
+                        await asyncio.to_thread(self._release, [log.id for group in groups[capacity:] for log in group])
+                        groups = groups[:capacity]
+                    for group in groups:
+                        provider = self.senders[group[0].channel][0]
+                        self._in_flight[provider] += 1
+                        task = asyncio.create_task(self._send(group))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.metrics["errors"] += 1
+                self.metrics["last_error"] = type(exc).__name__
+                logger.warning("SMS queue claim failed | error_type=%s", type(exc).__name__)
+
+            # Забрали полную пачку — в очереди, вероятно, есть ещё: идём сразу, если есть слоты
+            if claimed and claimed == limit and self._capacity() > 0:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=configs.sms_queue_poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim(self, limit: int) -> List[NotificationLog]:
+        now = datetime.utcnow()
+        with Session(self.engine) as db:
+            # Слишком старые уведомления не отправляем (SMS о вчерашней оплате только путает)
+            expired = db.execute(
+                update(NotificationLog)
+                .where(
+                    NotificationLog.status.in_([*QUEUED_STATUSES, NotificationStatus.SENDING.value]),
+                    NotificationLog.created_at < now - timedelta(hours=configs.sms_max_age_hours),
+                )
+                .values(status=NotificationStatus.FAILED.value, error_message="Expired in queue", next_attempt_at=None)
+            ).rowcount or 0
+
+            logs = db.exec(
+                select(NotificationLog)
+                .where(
+                    NotificationLog.channel.in_(list(self.senders)),
+                    or_(
+                        and_(
+                            NotificationLog.status.in_(QUEUED_STATUSES),
+                            or_(NotificationLog.next_attempt_at == None, NotificationLog.next_attempt_at <= now),
+                        ),
+                        and_(
+                            NotificationLog.status == NotificationStatus.SENDING.value,
+                            NotificationLog.next_attempt_at <= now,
+                        ),
+                    ),
+                )
+                .order_by(NotificationLog.next_attempt_at, NotificationLog.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            ).all()
+
+            lease_until = now + timedelta(seconds=configs.sms_send_lease_seconds)
+            for log in logs:
+                log.status = NotificationStatus.SENDING.value
+                log.next_attempt_at = lease_until
+            db.commit()
+            for log in logs:
+                db.refresh(log)
+                db.expunge(log)
+
+        self.metrics["expired"] += expired
+        return logs
+
+    def _group(self, logs: List[NotificationLog]) -> List[List[NotificationLog]]:
+        """Вызовы провайдера: одинаковый текст первой попытки — один пакет, остальное — по одному"""
+        groups: List[List[NotificationLog]] = []
+        batches: Dict[Tuple[str, str], List[NotificationLog]] = {}
+        for log in logs:
+            # После неудачного пакета — по одному: один плохой номер не держит остальных
+            if self.senders[log.channel][2] is None or log.retry_count:
+                groups.append([log])
+                continue
+            batch = batches.get((log.channel, log.message))
+            if batch is None or len(batch) >= configs.sms_batch_max_recipients:
+                batch = batches[(log.channel, log.message)] = []
+                groups.append(batch)
+            batch.append(log)
+        return groups
+
+    def _release(self, log_ids: List[int]) -> None:
+        with Session(self.engine) as db:
+            db.execute(
+                update(NotificationLog)
+                .where(NotificationLog.id.in_(log_ids), NotificationLog.status == NotificationStatus.SENDING.value)
+                .values(status=NotificationStatus.PENDING.value, next_attempt_at=datetime.utcnow())
+            )
+            db.commit()
+
+    async def _send(self, group: List[NotificationLog]) -> None:
+        provider, send_one, send_batch = self.senders[group[0].channel]
+        try:
+            async with self._slots[provider]:
+                started = time.perf_counter()
+                try:
+                    if len(group) > 1:
+                        self.metrics["batch_calls"] += 1
+                        success, external_id, error = await asyncio.to_thread(
+                            send_batch, [log.recipient_phone for log in group], group[0].message
+                        )
+                    else:
+                        success, external_id, error = await asyncio.to_thread(
+                            send_one, group[0].recipient_phone, group[0].message
+                        )
+                except Exception as exc:
+                    success, external_id, error = False, None, str(exc)
+                self._send_latency_ms.append((time.perf_counter() - started) * 1000)
+        finally:
+            self._in_flight[provider] -= 1
+
+        log_ids = [log.id for log in group]
+        try:
+            await asyncio.to_thread(self._finish, log_ids, success, external_id, error)
+        except Exception as exc:
+            # Записи останутся в sending и после аренды уйдут на повтор
+            self.metrics["errors"] += 1
+            self.metrics["last_error"] = type(exc).__name__
+            logger.warning("SMS result not saved | notification_ids=%s | error_type=%s", log_ids, type(exc).__name__)
+
+    def _finish(self, log_ids: List[int], success: bool, external_id: Optional[str], error: Optional[str]) -> None:
+        now = datetime.utcnow()
+        with Session(self.engine) as db:
+            for log in db.exec(select(NotificationLog).where(NotificationLog.id.in_(log_ids))).all():
+                self._apply_result(log, now, success, external_id, error)
+            db.commit()
+
+    def _apply_result(
+        self, log: NotificationLog, now: datetime, success: bool, external_id: Optional[str], error: Optional[str]
+    ) -> None:
+        if success:
+            log.status = NotificationStatus.SENT.value
+            log.sent_at = now
+            log.external_id = external_id
+            log.error_message = None
+            log.next_attempt_at = None
+            self._queue_latency_ms.append((now - log.created_at).total_seconds() * 1000)
+            self.metrics["sent"] += 1
+        else:
+            log.retry_count += 1
+            log.error_message = (error or "Unknown error")[:1000]
+            if log.retry_count >= configs.sms_max_attempts:
+                log.status = NotificationStatus.FAILED.value
+                log.next_attempt_at = None
+                self.metrics["failed"] += 1
+                logger.error(
+                    "SMS failed | notification_id=%s | order_id=%s | attempts=%s",
+                    log.id, log.order_id, log.retry_count,
+                )
+            else:
+                log.status = NotificationStatus.RETRY.value
+                log.next_attempt_at = now + timedelta(seconds=retry_delay(log.retry_count))
+                self.metrics["retried"] += 1
+                logger.warning(
+                    "SMS retry scheduled | notification_id=%s | order_id=%s | attempt=%s",
+                    log.id, log.order_id, log.retry_count,
+                )
+
+    def _queue_depth(self) -> Dict[str, Any]:
+        with Session(self.engine) as db:
+            rows = db.exec(
+                select(NotificationLog.status, func.count(), func.min(NotificationLog.created_at))
+                .where(NotificationLog.status.in_([*QUEUED_STATUSES, NotificationStatus.SENDING.value]))
+                .group_by(NotificationLog.status)
+            ).all()
+        oldest = min((created_at for _, _, created_at in rows if created_at), default=None)
+        return {
+            "depth": {status: count for status, count, _ in rows},
+            "oldest_age_s": int((datetime.utcnow() - oldest).total_seconds()) if oldest else 0,
+        }
+
+    async def stats(self) -> Dict[str, Any]:
+        try:
+            queue = await asyncio.to_thread(self._queue_depth)
+        except Exception as exc:
+            queue = {"error": type(exc).__name__}
+        return {
+            **self.metrics,
+            "queue": queue,
+            "in_flight": dict(self._in_flight),
+            "concurrency": self.concurrency,
+            "send_latency_ms": _percentiles(self._send_latency_ms),
+            "queue_latency_ms": _percentiles(self._queue_latency_ms),
+        }
+
+
+def _percentiles(samples: deque) -> Dict[str, int]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {
+        "p50": int(ordered[len(ordered) // 2]),
+        "p95": int(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]),
+        "max": int(ordered[-1]),
+    }
+
+
+sms_dispatcher = SMSDispatcher(engine)
@@ -35,7 +35,29 @@ class Settings(BaseSettings):
 
     redis_url: str = "redis://redis:6379/0"
     redis_result_url: str = "redis://redis:6379/1"
-    payment_events_channel: str = "payments.events"
+    # Stripe gateway: per-call deadline, SDK network retries, stripe-mock base URL (http://stripe-mock:12111)
+    stripe_timeout_seconds: float = 10.0
+    stripe_max_network_retries: int = 2
+    stripe_api_base: str = ""
+
+    # Stripe webhook inbox workers (webhook_worker.py)
+    stripe_webhook_workers: int = 4
+    stripe_webhook_poll_seconds: float = 0.5
+    stripe_webhook_max_attempts: int = 8
+
+    # Payout batches (payout_engine.py): Stripe allows ~100 req/s in live mode, 25 in test mode
+    payout_batch_size: int = 200
+    payout_concurrency: int = 8
+    payout_max_requests_per_second: float = 20.0
+    payout_rate_limit_retries: int = 5
+    payout_claim_ttl_seconds: int = 900
+
+    # Reconciliation report: discrepancies stored with details (counters are always exact)
+    reconciliation_max_report_items: int = 500
+
+    redis_socket_timeout_seconds: float = 2.0
+    # Поток событий оплат events:payments: приблизительный предел длины (XADD MAXLEN ~)
+    payment_events_stream_maxlen: int = 100_000
 
 
 settings = Settings()
@@ -5,6 +5,7 @@ from sqlalchemy import text
 from sqlmodel import Session, SQLModel, create_engine
 
 from configs import settings
+import outbox  # OutboxEvent, ProcessedEvent (шина событий) — до create_all
 
 
 logger = logging.getLogger("payments.database")
@@ -50,6 +51,58 @@ def create_db_and_tables() -> None:
     except Exception:
         logger.exception("Failed to apply payments schema patch")
 
+    # Inbox вебхуков Stripe: старые строки уже применены, поэтому status по умолчанию 'processed'
+    try:
+        with engine.begin() as connection:
+            for column_sql in (
+                "payment_intent_id VARCHAR(255)",
+                "status VARCHAR(20) NOT NULL DEFAULT 'processed'",
+                "attempts INTEGER NOT NULL DEFAULT 0",
+                "last_error VARCHAR(2000)",
+                "next_attempt_at TIMESTAMP",
+                "received_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')",
+            ):
+                connection.exec_driver_sql(
+                    f"ALTER TABLE IF EXISTS payment_webhook_events ADD COLUMN IF NOT EXISTS {column_sql}"
+                )
+            connection.exec_driver_sql(
+                "ALTER TABLE IF EXISTS payment_webhook_events ALTER COLUMN processed_at DROP NOT NULL"
+            )
+            connection.exec_driver_sql(
+                """
+                CREATE INDEX IF NOT EXISTS ix_payment_webhook_events_pending
+                ON payment_webhook_events (payment_intent_id, id)
+                WHERE status = 'pending'
+                """
+            )
+        logger.info("Payments schema patch applied: payment_webhook_events inbox columns")
+    except Exception:
+        logger.exception("Failed to apply payment_webhook_events schema patch")
+
+
+    # Payout batches: claim columns on payments + partial index over the transfer backlog
+    try:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "ALTER TABLE IF EXISTS payments ADD COLUMN IF NOT EXISTS payout_batch_id INTEGER"
+            )
+            connection.exec_driver_sql(
+                "ALTER TABLE IF EXISTS payments ADD COLUMN IF NOT EXISTS payout_claimed_at TIMESTAMP"
+            )
+            connection.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_payments_payout_batch_id ON payments (payout_batch_id)"
+            )
+            connection.exec_driver_sql(
+                """
+                CREATE INDEX IF NOT EXISTS ix_payments_pending_transfer
+                ON payments (seller_id, id)
+                WHERE status = 'pending_transfer' AND seller_transfer_id IS NULL
+                """
+            )
+        logger.info("Payments schema patch applied: payout batch claim columns")
+    except Exception:
+        logger.exception("Failed to apply payout batch schema patch")
+
 
 def get_session() -> Generator[Session, None, None]:
     with Session(engine) as session:
@@ -1,6 +1,5 @@
 import logging
 
-import redis
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
@@ -8,14 +7,18 @@ from starlette.middleware.cors import CORSMiddleware
 
 from api_response import error_response, success_response
 from configs import settings
-from database import create_db_and_tables, db_health_check
+from database import create_db_and_tables, db_health_check, engine
 from middlewares import (
     RequestContextMiddleware,
     http_exception_handler,
     unhandled_exception_handler,
     validation_exception_handler,
 )
+from outbox import OutboxRelay
 from payment_router import payments_router
+from payment_service import OUTBOX_SOURCE, redis_client
+from stripe_gateway import close_stripe_gateway, get_stripe_gateway
+from webhook_worker import StripeWebhookWorkerPool
 
 
 logging.basicConfig(
@@ -63,11 +66,47 @@ app.add_middleware(
 
 app.include_router(payments_router)
 
+# payment.succeeded и прочие события публикуются из outbox_event в поток events:payments
+outbox_relay = OutboxRelay(engine, settings.redis_url, OUTBOX_SOURCE, maxlen=settings.payment_events_stream_maxlen)
+
+
+# Stripe webhooks are recorded by the endpoint and applied here, in order per payment intent
+app.state.stripe_webhook_workers = StripeWebhookWorkerPool(
+    engine,
+    workers=settings.stripe_webhook_workers,
+    poll_interval_seconds=settings.stripe_webhook_poll_seconds,
+    max_attempts=settings.stripe_webhook_max_attempts,
+)
+
+
+@app.on_event("startup")
+async def start_outbox_relay() -> None:
+    await outbox_relay.start()
+
+
+@app.on_event("startup")
+async def start_stripe_webhook_workers() -> None:
+    await app.state.stripe_webhook_workers.start()
+
+
+@app.on_event("shutdown")
+async def stop_outbox_relay() -> None:
+    await outbox_relay.stop()
+
+
+@app.on_event("shutdown")
+async def stop_stripe_webhook_workers() -> None:
+    await app.state.stripe_webhook_workers.stop()
+
+
+@app.on_event("shutdown")
+async def close_stripe_connections() -> None:
+    await close_stripe_gateway()
+
 
 def _redis_health_check() -> bool:
     try:
-        client = redis.Redis.from_url(settings.redis_url)
-        client.ping()
+        redis_client.ping()
         return True
     except Exception:
         logger.exception("Redis health check failed")
@@ -103,6 +142,22 @@ async def health_check(request: Request):
     )
 
 
+@app.get("/events/metrics")
+async def get_event_bus_metrics(request: Request):
+    return success_response(request, {"outbox_relay": outbox_relay.metrics})
+
+
+@app.get("/stripe/metrics")
+async def get_stripe_metrics(request: Request):
+    return success_response(
+        request,
+        {
+            "gateway": get_stripe_gateway().metrics,
+            "webhooks": app.state.stripe_webhook_workers.stats(),
+        },
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,9 +1,9 @@
 ﻿from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel, Field as PydanticField
-from sqlalchemy import JSON, Column
+from sqlalchemy import JSON, Column, Index, text
 from sqlmodel import Field, SQLModel
 
 
@@ -26,6 +26,15 @@ class PaymentProvider(str, Enum):
 
 class Payment(SQLModel, table=True):
     __tablename__ = "payments"
+    __table_args__ = (
+        # Payout backlog (see payout_engine.PayoutEngine._claim)
+        Index(
+            "ix_payments_pending_transfer",
+            "seller_id",
+            "id",
+            postgresql_where=text("status = 'pending_transfer' AND seller_transfer_id IS NULL"),
+        ),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
 
@@ -59,16 +68,116 @@ class Payment(SQLModel, table=True):
     seller_transfer_id: Optional[str] = Field(default=None, max_length=255)
     transferred_at: Optional[datetime] = Field(default=None)
     delivery_cost_cents: Optional[int] = Field(default=None)
+    # Claimed by a running payout batch; a claim older than payout_claim_ttl_seconds is considered abandoned
+    payout_batch_id: Optional[int] = Field(default=None, index=True)
+    payout_claimed_at: Optional[datetime] = Field(default=None)
+
+
+class PayoutBatchStatus(str, Enum):
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class PayoutBatch(SQLModel, table=True):
+    """One run of PayoutEngine: counters plus a compact per-payment result list."""
+    __tablename__ = "payout_batches"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    trigger: str = Field(default="manual", max_length=50)
+    seller_id: Optional[int] = Field(default=None, index=True)
+    status: str = Field(default=PayoutBatchStatus.RUNNING.value, max_length=20, index=True)
+
+    selected: int = Field(default=0)
+    transferred: int = Field(default=0)
+    failed: int = Field(default=0)
+    charges_resolved: int = Field(default=0)
+    rate_limited: int = Field(default=0)
+    transferred_amount_cents: int = Field(default=0)
+
+    results: List[Dict[str, Any]] = Field(default_factory=list, sa_column=Column(JSON))
+    error: Optional[str] = Field(default=None, max_length=2000)
+
+    started_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+    finished_at: Optional[datetime] = Field(default=None)
+    duration_ms: Optional[int] = Field(default=None)
+
+
+class ReconciliationRunStatus(str, Enum):
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class ReconciliationRun(SQLModel, table=True):
+    """Stripe ↔ payments reconciliation for one time window (reconciliation.py).
+
+    Counters are exact; items holds at most reconciliation_max_report_items discrepancies.
+    """
+    __tablename__ = "reconciliation_runs"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    window_start: datetime = Field(index=True)
+    window_end: datetime
+    status: str = Field(default=ReconciliationRunStatus.RUNNING.value, max_length=20, index=True)
+
+    charges_seen: int = Field(default=0)
+    transfers_seen: int = Field(default=0)
+    balance_transactions_seen: int = Field(default=0)
+    discrepancies: int = Field(default=0)
+    discrepancies_by_kind: Dict[str, int] = Field(default_factory=dict, sa_column=Column(JSON))
+    # balance transaction type -> {count, amount, fee, net}
+    balance_totals: Dict[str, Dict[str, int]] = Field(default_factory=dict, sa_column=Column(JSON))
+    items: List[Dict[str, Any]] = Field(default_factory=list, sa_column=Column(JSON))
+    truncated: bool = Field(default=False)
+    error: Optional[str] = Field(default=None, max_length=2000)
+
+    started_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = Field(default=None)
+
+
+class ReconciliationSeenIntent(SQLModel, table=True):
+    """PaymentIntents with a succeeded Stripe charge seen by a run; dropped when the run ends.
+
+    Kept in the database instead of a Python set, so a run uses the same memory for any window.
+    """
+    __tablename__ = "reconciliation_seen_intents"
+
+    run_id: int = Field(primary_key=True)
+    payment_intent_id: str = Field(primary_key=True, max_length=255)
+
+
+class WebhookEventStatus(str, Enum):
+    PENDING = "pending"
+    PROCESSED = "processed"
+    FAILED = "failed"
 
 
 class PaymentWebhookEvent(SQLModel, table=True):
+    """Raw Stripe event inbox: written by the webhook endpoint, applied by StripeWebhookWorkerPool."""
     __tablename__ = "payment_webhook_events"
+    __table_args__ = (
+        # Queue heads per payment intent (see webhook_worker.CLAIM_NEXT_EVENT_SQL)
+        Index(
+            "ix_payment_webhook_events_pending",
+            "payment_intent_id",
+            "id",
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     provider_event_id: str = Field(index=True, unique=True, max_length=255)
     event_type: str = Field(max_length=255)
     payload: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
-    processed_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+    # Ordering key: events of one payment intent are applied strictly one after another
+    payment_intent_id: Optional[str] = Field(default=None, max_length=255)
+    status: str = Field(default=WebhookEventStatus.PENDING.value, max_length=20)
+    attempts: int = Field(default=0)
+    last_error: Optional[str] = Field(default=None, max_length=2000)
+    next_attempt_at: Optional[datetime] = Field(default=None)
+    received_at: datetime = Field(default_factory=datetime.utcnow)
+    processed_at: Optional[datetime] = Field(default=None, index=True)
 
 
 class PaymentIntentCreateData(BaseModel):
@@ -123,10 +232,64 @@ class SellerPayoutAccount(SQLModel, table=True):
 
 class RefundCreateData(BaseModel):
     amount_cents: Optional[int] = PydanticField(default=None, ge=1)
+    # Клиентский id конкретного возврата: повтор запроса с тем же id не создаёт второй refund
+    request_id: Optional[str] = PydanticField(default=None, min_length=1, max_length=64)
     reason: Optional[str] = PydanticField(default=None, max_length=100)
     metadata: Dict[str, Any] = PydanticField(default_factory=dict)
 
 
+class PayoutBatchCreateData(BaseModel):
+    seller_id: Optional[int] = None
+    limit: Optional[int] = PydanticField(default=None, ge=1, le=1000)
+
+
+class PayoutBatchResponse(BaseModel):
+    id: int
+    trigger: str
+    seller_id: Optional[int] = None
+    status: str
+    selected: int
+    transferred: int
+    failed: int
+    charges_resolved: int
+    rate_limited: int
+    transferred_amount_cents: int
+    results: List[Dict[str, Any]]
+    error: Optional[str] = None
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    duration_ms: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+
+class ReconciliationRunCreateData(BaseModel):
+    window_start: datetime
+    window_end: datetime
+
+
+class ReconciliationRunResponse(BaseModel):
+    id: int
+    window_start: datetime
+    window_end: datetime
+    status: str
+    charges_seen: int
+    transfers_seen: int
+    balance_transactions_seen: int
+    discrepancies: int
+    discrepancies_by_kind: Dict[str, int]
+    balance_totals: Dict[str, Dict[str, int]]
+    items: List[Dict[str, Any]]
+    truncated: bool
+    error: Optional[str] = None
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
 class StripeWebhookPayload(BaseModel):
     id: str
     type: str
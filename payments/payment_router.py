@@ -1,17 +1,27 @@
-﻿from fastapi import APIRouter, Cookie, Depends, Header, Request, Response, status
+﻿import asyncio
+
+from fastapi import APIRouter, Cookie, Depends, Header, HTTPException, Request, Response, status
 from sqlmodel import Session
 
 from api_response import success_response
-from database import get_session
+from database import engine, get_session
 from models import (
     CheckoutSessionCreateData,
     CheckoutSessionResponse,
     CheckoutSessionStatusResponse,
     PaymentIntentCreateData,
     PaymentIntentResponse,
+    PayoutBatch,
+    PayoutBatchCreateData,
+    PayoutBatchResponse,
+    ReconciliationRun,
+    ReconciliationRunCreateData,
+    ReconciliationRunResponse,
     RefundCreateData,
 )
 from payment_service import PaymentService, decode_user_id_from_token
+from payout_engine import PayoutEngine
+from reconciliation import start_reconciliation
 from seller_service import SellerService
 
 
@@ -19,7 +29,7 @@ payments_router = APIRouter(prefix="/api/v1/payments", tags=["Payments"])
 
 
 @payments_router.post("/intents", status_code=status.HTTP_202_ACCEPTED)
-def create_payment_intent(
+async def create_payment_intent(
     request: Request,
     payload: PaymentIntentCreateData,
     access_token: str = Cookie(None),
@@ -29,7 +39,7 @@ def create_payment_intent(
     service = PaymentService(db)
     buyer_id = decode_user_id_from_token(access_token)
 
-    payment = service.create_payment_intent(
+    payment = await service.create_payment_intent(
         payload,
         request_id=x_request_id,
         buyer_id=buyer_id,
@@ -44,7 +54,7 @@ def create_payment_intent(
 
 
 @payments_router.post("/checkout-sessions", status_code=status.HTTP_202_ACCEPTED)
-def create_checkout_session(
+async def create_checkout_session(
     request: Request,
     payload: CheckoutSessionCreateData,
     access_token: str = Cookie(None),
@@ -54,7 +64,7 @@ def create_checkout_session(
     service = PaymentService(db)
     buyer_id = decode_user_id_from_token(access_token)
 
-    created = service.create_checkout_session(
+    created = await service.create_checkout_session(
         payload,
         request_id=x_request_id,
         buyer_id=buyer_id,
@@ -77,13 +87,13 @@ def create_checkout_session(
 
 
 @payments_router.get("/checkout-sessions/{session_id}")
-def get_checkout_session_status(
+async def get_checkout_session_status(
     request: Request,
     session_id: str,
     db: Session = Depends(get_session),
 ):
     service = PaymentService(db)
-    result = service.get_checkout_session_status(session_id)
+    result = await service.get_checkout_session_status(session_id)
     response_payload = CheckoutSessionStatusResponse(
         payment_id=result["payment"].id if result["payment"] else None,
         checkout_session_id=result["checkout_session_id"],
@@ -121,40 +131,94 @@ def get_payment_by_order(
 
 
 @payments_router.post("/{payment_id}/refund", status_code=status.HTTP_202_ACCEPTED)
-def create_refund(
+async def create_refund(
     request: Request,
     payment_id: int,
     payload: RefundCreateData,
     db: Session = Depends(get_session),
 ):
     service = PaymentService(db)
-    payment = service.refund_payment(payment_id=payment_id, payload=payload)
+    payment = await service.refund_payment(payment_id=payment_id, payload=payload)
     response_payload = PaymentIntentResponse.model_validate(payment).model_dump(mode="json")
     return success_response(request, response_payload)
 
 
 @payments_router.post("/{payment_id}/release-to-seller", status_code=status.HTTP_202_ACCEPTED)
-def release_payment_to_seller(
+async def release_payment_to_seller(
     request: Request,
     payment_id: int,
     db: Session = Depends(get_session),
 ):
     """Release held payment funds to the seller. Called after buyer confirms receipt."""
     service = PaymentService(db)
-    payment = service.release_payment_to_seller(payment_id)
+    payment = await service.release_payment_to_seller(payment_id)
     response_payload = PaymentIntentResponse.model_validate(payment).model_dump(mode="json")
     return success_response(request, response_payload)
 
+@payments_router.post("/payouts/batches", status_code=status.HTTP_201_CREATED)
+async def run_payout_batch(
+    request: Request,
+    payload: PayoutBatchCreateData,
+):
+    """Transfer the PENDING_TRANSFER backlog of onboarded sellers (nightly job / manual catch-up)."""
+    batch = await PayoutEngine(engine).run_batch(
+        seller_id=payload.seller_id,
+        trigger="api",
+        limit=payload.limit,
+    )
+    return success_response(request, PayoutBatchResponse.model_validate(batch).model_dump(mode="json"))
+
+
+@payments_router.get("/payouts/batches/{batch_id}")
+def get_payout_batch(
+    request: Request,
+    batch_id: int,
+    db: Session = Depends(get_session),
+):
+    batch = db.get(PayoutBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Payout batch not found")
+    return success_response(request, PayoutBatchResponse.model_validate(batch).model_dump(mode="json"))
+
+
+@payments_router.post("/reconciliation/runs", status_code=status.HTTP_202_ACCEPTED)
+async def run_reconciliation(
+    request: Request,
+    payload: ReconciliationRunCreateData,
+):
+    """Start Stripe ↔ payments reconciliation for a window; the report is read via GET."""
+    if payload.window_end <= payload.window_start:
+        raise HTTPException(status_code=400, detail="window_end must be after window_start")
+    run = await start_reconciliation(engine, payload.window_start, payload.window_end)
+    return success_response(request, ReconciliationRunResponse.model_validate(run).model_dump(mode="json"))
+
+
+@payments_router.get("/reconciliation/runs/{run_id}")
+def get_reconciliation_run(
+    request: Request,
+    run_id: int,
+    db: Session = Depends(get_session),
+):
+    run = db.get(ReconciliationRun, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Reconciliation run not found")
+    return success_response(request, ReconciliationRunResponse.model_validate(run).model_dump(mode="json"))
+
+
 @payments_router.post("/webhooks/stripe")
 async def stripe_webhook(
     request: Request,
     stripe_signature: str = Header(default="", alias="Stripe-Signature"),
     db: Session = Depends(get_session),
 ):
+    """Record the event and ack immediately; StripeWebhookWorkerPool applies it in the background."""
     service = PaymentService(db)
     payload = await request.body()
-    result = service.process_stripe_webhook(payload=payload, signature=stripe_signature)
-    return Response(content="ok", media_type="text/plain", status_code=200) if result else Response(status_code=204)
+    # Signature check + INSERT are sync (Session): off the event loop
+    result = await asyncio.to_thread(service.ingest_stripe_webhook, payload=payload, signature=stripe_signature)
+    if not result["duplicate"]:
+        request.app.state.stripe_webhook_workers.notify()
+    return Response(content="ok", media_type="text/plain", status_code=200)
 
 
 
@@ -172,7 +236,7 @@ def get_seller_onboarding_status(
 
 
 @payments_router.post("/sellers/{seller_id}/onboarding-link")
-def get_seller_onboarding_link(
+async def get_seller_onboarding_link(
     request: Request,
     seller_id: int,
     return_url: str,
@@ -180,23 +244,23 @@ def get_seller_onboarding_link(
     db: Session = Depends(get_session),
 ):
     service = SellerService(db)
-    url = service.create_onboarding_link(seller_id, return_url, refresh_url)
+    url = await service.create_onboarding_link(seller_id, return_url, refresh_url)
     return success_response(request, {"onboarding_url": url})
 
 
 @payments_router.post("/sellers/{seller_id}/sync-status")
-def sync_seller_status(
+async def sync_seller_status(
     request: Request,
     seller_id: int,
     db: Session = Depends(get_session),
 ):
     seller_svc = SellerService(db)
-    account = seller_svc.sync_account_status(seller_id)
+    account = await seller_svc.sync_account_status(seller_id)
 
     released = 0
     if account.payouts_enabled:
         payment_svc = PaymentService(db)
-        released = payment_svc.retry_pending_transfers_for_seller(seller_id)
+        released = await payment_svc.retry_pending_transfers_for_seller(seller_id)
 
     return success_response(request, {
         "payouts_enabled": account.payouts_enabled,
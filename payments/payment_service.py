@@ -1,5 +1,7 @@
-﻿import json
+﻿import asyncio
+import json
 import logging
+import uuid
 from datetime import datetime
 from typing import Any, Dict, Optional
 
@@ -7,8 +9,8 @@ import redis
 import stripe
 from fastapi import HTTPException, status
 from jose import jwt
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlmodel import Session, select
-import httpx
 
 
 from configs import settings
@@ -19,13 +21,19 @@ from models import (
     PaymentStatus,
     PaymentWebhookEvent,
     RefundCreateData,
+    WebhookEventStatus,
 )
 
+from outbox import add_outbox_event
 from seller_service import SellerService
+from stripe_gateway import StripeGateway, get_stripe_gateway, idempotency_key_for
 
 logger = logging.getLogger("payments.payment_service")
 stripe.api_key = settings.stripe_secret_key
 
+# Поток событий payments-service: events:payments
+OUTBOX_SOURCE = "payments"
+
 
 def decode_user_id_from_token(access_token: Optional[str]) -> Optional[int]:
     if not access_token:
@@ -51,17 +59,45 @@ def _to_metadata(payload: Dict[str, Any]) -> Dict[str, str]:
     return metadata
 
 
-def _publish_event(event_payload: Dict[str, Any]) -> None:
-    try:
-        redis_client = redis.Redis.from_url(settings.redis_url)
-        redis_client.lpush(settings.payment_events_channel, json.dumps(event_payload))
-    except Exception:
-        logger.exception("Failed to publish payment event to Redis")
+# Один клиент на процесс (пул соединений) — используется проверкой /health
+redis_client = redis.Redis.from_url(
+    settings.redis_url,
+    socket_timeout=settings.redis_socket_timeout_seconds,
+    socket_connect_timeout=settings.redis_socket_timeout_seconds,
+    health_check_interval=30,
+)
+
+
+def _queue_event(db: Session, event_payload: Dict[str, Any]) -> None:
+    """Кладёт событие в outbox текущей транзакции; в events:payments его публикует OutboxRelay.
+
+    Вызывается до commit вместе с изменением платежа: событие не теряется при сбое Redis и не
+    уходит в поток, если транзакция откатилась.
+    """
+    add_outbox_event(db, OUTBOX_SOURCE, event_payload.get("event", "unknown"), event_payload)
+
+
+def publish_transfer_event(db: Session, payment: Payment) -> None:
+    seller_amount = PaymentService.seller_amount_cents(payment)
+    _queue_event(db, {
+        "event": "payment_transferred_to_seller",
+        "payment_id": payment.id,
+        "order_id": payment.order_id,
+        "transfer_id": payment.seller_transfer_id,
+        "seller_amount_cents": seller_amount,
+    })
+
+    logger.info(
+        "Payment released to seller | payment_id=%s | order_id=%s | "
+        "transfer_id=%s | amount_cents=%s",
+        payment.id, payment.order_id, payment.seller_transfer_id, seller_amount,
+    )
 
 
 class PaymentService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, gateway: Optional[StripeGateway] = None):
         self.db = db
+        self.stripe = gateway or get_stripe_gateway()
 
     def get_payment_by_id(self, payment_id: int) -> Payment:
         payment = self.db.get(Payment, payment_id)
@@ -79,7 +115,7 @@ class PaymentService:
             raise HTTPException(status_code=404, detail="Payment not found for order")
         return payment
     
-    def create_payment_intent(
+    async def create_payment_intent(
         self,
         payload: PaymentIntentCreateData,
         *,
@@ -87,7 +123,7 @@ class PaymentService:
         buyer_id: Optional[int],
     ) -> Payment:
         if request_id:
-            existing = self.db.exec(select(Payment).where(Payment.idempotency_key == request_id)).first()
+            existing = await asyncio.to_thread(self._find_by_idempotency_key, request_id)
             if existing:
                 return existing
 
@@ -109,19 +145,22 @@ class PaymentService:
 
         try:
             seller_service = SellerService(self.db)
-            seller_stripe_id = seller_service.get_stripe_account_id(payload.seller_id)
+            seller_stripe_id = await asyncio.to_thread(seller_service.get_stripe_account_id, payload.seller_id)
 
             application_fee = int(payload.amount_cents * settings.application_fee)
 
-            intent = stripe.PaymentIntent.create(
-                amount=payload.amount_cents,
-                currency=payload.currency.lower(),
-                application_fee_amount=application_fee,  # 5% Ð¾ÑÑ‚Ð°Ñ‘Ñ‚ÑÑ Ñ‚ÐµÐ±Ðµ
-                transfer_data={
-                    "destination": seller_stripe_id,     # 95% â†’ Ð±Ð°Ð½Ðº Ð¿Ñ€Ð¾Ð´Ð°Ð²Ñ†Ð°
+            intent = await self.stripe.create_payment_intent(
+                {
+                    "amount": payload.amount_cents,
+                    "currency": payload.currency.lower(),
+                    "application_fee_amount": application_fee,  # 5% Ð¾ÑÑ‚Ð°Ñ‘Ñ‚ÑÑ Ñ‚ÐµÐ±Ðµ
+                    "transfer_data": {
+                        "destination": seller_stripe_id,     # 95% â†’ Ð±Ð°Ð½Ðº Ð¿Ñ€Ð¾Ð´Ð°Ð²Ñ†Ð°
+                    },
+                    "automatic_payment_methods": {"enabled": True, "allow_redirects": "never"},
+                    "metadata": stripe_metadata,
                 },
-                automatic_payment_methods={"enabled": True, "allow_redirects": "never"},
-                metadata=stripe_metadata,
+                idempotency_key=idempotency_key_for(request_id, "payment_intent"),
             )
 
             # create_payload: Dict[str, Any] = {
@@ -164,12 +203,9 @@ class PaymentService:
             request_id=request_id,
             updated_at=datetime.utcnow(),
         )
-        self.db.add(payment)
-        self.db.commit()
-        self.db.refresh(payment)
-        return payment
+        return await asyncio.to_thread(self._save, payment)
 
-    def create_checkout_session(
+    async def create_checkout_session(
         self,
         payload: CheckoutSessionCreateData,
         *,
@@ -177,7 +213,7 @@ class PaymentService:
         buyer_id: Optional[int],
     ) -> Dict[str, Any]:
         if request_id:
-            existing = self.db.exec(select(Payment).where(Payment.idempotency_key == request_id)).first()
+            existing = await asyncio.to_thread(self._find_by_idempotency_key, request_id)
             if existing and existing.provider_checkout_session_id:
                 return {
                     "payment": existing,
@@ -201,7 +237,7 @@ class PaymentService:
         if payload.seller_id:
             seller_service = SellerService(self.db)
             try:
-                seller_service.get_or_create_stripe_account(payload.seller_id)
+                await seller_service.get_or_create_stripe_account(payload.seller_id)
             except Exception:
                 logger.warning(
                     "Could not auto-create Stripe account for seller | seller_id=%s",
@@ -209,28 +245,31 @@ class PaymentService:
                 )
 
         try:
-            session = stripe.checkout.Session.create(
-                mode="payment",
-                success_url=payload.success_url,
-                cancel_url=payload.cancel_url,
-                customer_email=payload.buyer_email,
-                line_items=[
-                    {
-                        "price_data": {
-                            "currency": payload.currency.lower(),
-                            "product_data": {
-                                "name": payload.product_name,
-                                "description": payload.description,
+            session = await self.stripe.create_checkout_session(
+                {
+                    "mode": "payment",
+                    "success_url": payload.success_url,
+                    "cancel_url": payload.cancel_url,
+                    "customer_email": payload.buyer_email,
+                    "line_items": [
+                        {
+                            "price_data": {
+                                "currency": payload.currency.lower(),
+                                "product_data": {
+                                    "name": payload.product_name,
+                                    "description": payload.description,
+                                },
+                                "unit_amount": payload.amount_cents,
                             },
-                            "unit_amount": payload.amount_cents,
-                        },
-                        "quantity": 1,
-                    }
-                ],
-                metadata=stripe_metadata,
-                payment_intent_data={
+                            "quantity": 1,
+                        }
+                    ],
                     "metadata": stripe_metadata,
+                    "payment_intent_data": {
+                        "metadata": stripe_metadata,
+                    },
                 },
+                idempotency_key=idempotency_key_for(request_id, "checkout_session"),
             )
         except stripe.error.StripeError as exc:
             raise HTTPException(status_code=502, detail=f"Stripe checkout error: {str(exc)}")
@@ -254,9 +293,7 @@ class PaymentService:
             request_id=request_id,
             updated_at=datetime.utcnow(),
         )
-        self.db.add(payment)
-        self.db.commit()
-        self.db.refresh(payment)
+        payment = await asyncio.to_thread(self._save, payment)
 
         return {
             "payment": payment,
@@ -264,35 +301,26 @@ class PaymentService:
             "checkout_url": session.url,
         }
 
-    def get_checkout_session_status(self, session_id: str) -> Dict[str, Any]:
+    async def get_checkout_session_status(self, session_id: str) -> Dict[str, Any]:
         try:
-            session = stripe.checkout.Session.retrieve(session_id, expand=["payment_intent"])
+            session = await self.stripe.retrieve_checkout_session(session_id, expand=["payment_intent"])
         except stripe.error.StripeError as exc:
             raise HTTPException(status_code=502, detail=f"Stripe checkout status error: {str(exc)}")
 
-        payment = self.db.exec(
-            select(Payment).where(Payment.provider_checkout_session_id == session_id)
-        ).first()
-
         is_paid = (session.get("payment_status") == "paid")
         status_value = PaymentStatus.SUCCEEDED.value if is_paid else PaymentStatus.REQUIRES_PAYMENT_METHOD.value
         payment_intent = session.get("payment_intent")
         payment_intent_id = None
+        charge_id = None
         if isinstance(payment_intent, dict):
             payment_intent_id = payment_intent.get("id")
+            charge_id = payment_intent.get("latest_charge")
         elif isinstance(payment_intent, str):
             payment_intent_id = payment_intent
 
-        if payment:
-            payment.updated_at = datetime.utcnow()
-            payment.status = status_value
-            if payment_intent_id:
-                payment.provider_payment_intent_id = payment_intent_id
-            if is_paid and not payment.paid_at:
-                payment.paid_at = datetime.utcnow()
-            self.db.add(payment)
-            self.db.commit()
-            self.db.refresh(payment)
+        payment = await asyncio.to_thread(
+            self._sync_checkout_payment, session_id, status_value, payment_intent_id, charge_id, is_paid
+        )
 
         return {
             "payment": payment,
@@ -304,8 +332,8 @@ class PaymentService:
             "provider_payment_intent_id": payment_intent_id,
         }
 
-    def refund_payment(self, payment_id: int, payload: RefundCreateData) -> Payment:
-        payment = self.get_payment_by_id(payment_id)
+    async def refund_payment(self, payment_id: int, payload: RefundCreateData) -> Payment:
+        payment = await asyncio.to_thread(self.get_payment_by_id, payment_id)
 
         if not payment.provider_payment_intent_id:
             raise HTTPException(status_code=400, detail="Payment has no Stripe payment_intent id")
@@ -320,8 +348,22 @@ class PaymentService:
         if payload.metadata:
             refund_args["metadata"] = _to_metadata(payload.metadata)
 
+        # Key per refund, not per amount: two partial refunds of the same amount are distinct
+        # operations. A retried request carries the same request_id and is not sent twice; a full
+        # refund can only happen once, so it keys on "full". Partial refunds without request_id
+        # get a fresh key (no dedup, but never collide with an earlier refund).
+        if payload.request_id:
+            refund_key = f"req:{payload.request_id}"
+        elif payload.amount_cents:
+            refund_key = uuid.uuid4().hex
+        else:
+            refund_key = "full"
+
         try:
-            refund = stripe.Refund.create(**refund_args)
+            refund = await self.stripe.create_refund(
+                refund_args,
+                idempotency_key=idempotency_key_for(self._idempotency_base(payment), "refund", refund_key),
+            )
         except stripe.error.StripeError as exc:
             raise HTTPException(status_code=502, detail=f"Stripe refund error: {str(exc)}")
 
@@ -332,11 +374,9 @@ class PaymentService:
             payment.refunded_at = datetime.utcnow()
 
         payment.updated_at = datetime.utcnow()
-        self.db.add(payment)
-        self.db.commit()
-        self.db.refresh(payment)
-
-        _publish_event(
+        return await asyncio.to_thread(
+            self._save,
+            payment,
             {
                 "event": "payment_refunded",
                 "payment_id": payment.id,
@@ -344,12 +384,15 @@ class PaymentService:
                 "stripe_refund_id": refund.get("id"),
                 "status": payment.status,
                 "order_id": payment.order_id,
-            }
+            },
         )
 
-        return payment
+    def ingest_stripe_webhook(self, *, payload: bytes, signature: str) -> Dict[str, Any]:
+        """Verify the signature and durably record the raw event; applied later by the worker pool.
 
-    def process_stripe_webhook(self, *, payload: bytes, signature: str) -> Dict[str, Any]:
+        Nothing but one INSERT ... ON CONFLICT DO NOTHING happens before Stripe gets its 2xx,
+        so bursts and Stripe retries of the same event are cheap.
+        """
         if not settings.stripe_webhook_secret:
             raise HTTPException(status_code=503, detail="Stripe webhook secret is not configured")
 
@@ -365,23 +408,55 @@ class PaymentService:
         if not event_id or not event_type:
             raise HTTPException(status_code=400, detail="Malformed Stripe event")
 
-        already_processed = self.db.exec(
-            select(PaymentWebhookEvent).where(PaymentWebhookEvent.provider_event_id == event_id)
-        ).first()
-        if already_processed:
-            return {"processed": True, "duplicate": True, "event_id": event_id, "event_type": event_type}
-
-        event_object = event.get("data", {}).get("object", {})
+        raw_event = json.loads(payload)
+        event_object = raw_event.get("data", {}).get("object", {})
         payment_intent_id = event_object.get("id")
-        if event_type == "charge.refunded":
+        if event_type in ("charge.refunded", "checkout.session.completed"):
             payment_intent_id = event_object.get("payment_intent")
 
+        inserted = self.db.execute(
+            pg_insert(PaymentWebhookEvent.__table__)
+            .values(
+                provider_event_id=event_id,
+                event_type=event_type,
+                payload=raw_event,
+                payment_intent_id=payment_intent_id,
+                status=WebhookEventStatus.PENDING.value,
+                attempts=0,
+                received_at=datetime.utcnow(),
+            )
+            .on_conflict_do_nothing(index_elements=["provider_event_id"])
+            .returning(PaymentWebhookEvent.__table__.c.id)
+        ).first()
+        self.db.commit()
+
+        return {
+            "received": True,
+            "duplicate": inserted is None,
+            "event_id": event_id,
+            "event_type": event_type,
+        }
+
+    def apply_stripe_event(self, webhook_event: PaymentWebhookEvent) -> Optional[Payment]:
+        """Apply a recorded Stripe event to its Payment and mark it processed (one transaction)."""
+        event_type = webhook_event.event_type
+        event_object = (webhook_event.payload or {}).get("data", {}).get("object", {})
+        payment_intent_id = webhook_event.payment_intent_id
+
         payment = None
         if payment_intent_id:
             payment = self.db.exec(
                 select(Payment).where(Payment.provider_payment_intent_id == payment_intent_id)
             ).first()
 
+        if payment is None and event_type == "checkout.session.completed" and event_object.get("id"):
+            # Checkout payments learn their PaymentIntent here: later events (and payouts) find them by it
+            payment = self.db.exec(
+                select(Payment).where(Payment.provider_checkout_session_id == event_object.get("id"))
+            ).first()
+            if payment and payment_intent_id:
+                payment.provider_payment_intent_id = payment_intent_id
+
         if payment:
             payment.updated_at = datetime.utcnow()
 
@@ -392,7 +467,7 @@ class PaymentService:
                 if latest_charge:
                     payment.provider_charge_id = str(latest_charge)
 
-                self._notify_delivery_service_on_payment_success(payment)
+                self._queue_payment_succeeded_event(payment)
 
             elif event_type == "payment_intent.payment_failed":
                 payment.status = PaymentStatus.FAILED.value
@@ -413,35 +488,26 @@ class PaymentService:
 
             self.db.add(payment)
 
-        webhook_event = PaymentWebhookEvent(
-            provider_event_id=event_id,
-            event_type=event_type,
-            payload=event,
-            processed_at=datetime.utcnow(),
-        )
+        webhook_event.status = WebhookEventStatus.PROCESSED.value
+        webhook_event.processed_at = datetime.utcnow()
+        webhook_event.attempts += 1
+        webhook_event.last_error = None
         self.db.add(webhook_event)
-        self.db.commit()
-
-        _publish_event(
+        _queue_event(
+            self.db,
             {
                 "event": "stripe_webhook_processed",
                 "event_type": event_type,
-                "event_id": event_id,
+                "event_id": webhook_event.provider_event_id,
                 "payment_id": payment.id if payment else None,
-            }
+            },
         )
-
-        return {
-            "processed": True,
-            "duplicate": False,
-            "event_id": event_id,
-            "event_type": event_type,
-            "payment_id": payment.id if payment else None,
-        }
+        self.db.commit()
+        return payment
     
-    def release_payment_to_seller(self, payment_id: int) -> Payment:
+    async def release_payment_to_seller(self, payment_id: int) -> Payment:
         """Transfer held payment funds to the seller after buyer confirmation."""
-        payment = self.get_payment_by_id(payment_id)
+        payment = await asyncio.to_thread(self.get_payment_by_id, payment_id)
 
         if payment.seller_transfer_id:
             return payment  # idempotent
@@ -460,14 +526,12 @@ class PaymentService:
             raise HTTPException(status_code=400, detail="Payment has no seller_id")
 
         seller_service = SellerService(self.db)
-        account = seller_service.get_or_create_stripe_account(payment.seller_id)
+        account = await seller_service.get_or_create_stripe_account(payment.seller_id)
 
         if not account.payouts_enabled:
             payment.status = PaymentStatus.PENDING_TRANSFER.value
             payment.updated_at = datetime.utcnow()
-            self.db.add(payment)
-            self.db.commit()
-            self.db.refresh(payment)
+            payment = await asyncio.to_thread(self._save, payment)
             logger.warning(
                 "Payment queued for transfer -- seller onboarding incomplete | "
                 "payment_id=%s | seller_id=%s",
@@ -475,106 +539,136 @@ class PaymentService:
             )
             return payment
 
-        seller_stripe_id = account.stripe_account_id
-
-        delivery_cost_cents = payment.delivery_cost_cents or 0
-        product_cost_cents = payment.amount_cents - delivery_cost_cents
-        seller_amount = int(product_cost_cents / (1 + settings.application_fee))
-
-
-        # Resolve charge_id for source_transaction so the transfer draws from
-        # the specific charge funds (pending OK) instead of available balance.
+        # Normally stored by the payment_intent.succeeded webhook; fall back to the PaymentIntent
         charge_id = payment.provider_charge_id
         if not charge_id and payment.provider_payment_intent_id:
             try:
-                pi = stripe.PaymentIntent.retrieve(payment.provider_payment_intent_id)
+                pi = await self.stripe.retrieve_payment_intent(payment.provider_payment_intent_id)
                 charge_id = pi.get("latest_charge")
                 if charge_id:
                     payment.provider_charge_id = charge_id
-                    self.db.add(payment)
-                    self.db.commit()
+                    payment = await asyncio.to_thread(self._save, payment)
             except Exception:
                 logger.warning(
                     "Could not retrieve charge_id from PaymentIntent | payment_id=%s",
                     payment.id,
                 )
 
-        transfer_args: Dict[str, Any] = {
-            "amount": seller_amount,
-            "currency": payment.currency.lower(),
-            "destination": seller_stripe_id,
-            "transfer_group": f"order_{payment.order_id}",
-            "metadata": {"payment_id": str(payment.id), "order_id": str(payment.order_id)},
-        }
-        if charge_id:
-            transfer_args["source_transaction"] = charge_id
-
         try:
-            transfer = stripe.Transfer.create(**transfer_args)
+            transfer = await self.stripe.create_transfer(
+                self.transfer_params(payment, account.stripe_account_id, charge_id),
+                idempotency_key=self.transfer_idempotency_key(payment),
+            )
         except stripe.error.StripeError as exc:
             raise HTTPException(status_code=502, detail=f"Stripe transfer error: {str(exc)}")
 
-        payment.seller_transfer_id = transfer.id
-        payment.status = PaymentStatus.TRANSFERRED.value
-        payment.transferred_at = datetime.utcnow()
-        payment.updated_at = datetime.utcnow()
+        self.mark_transferred(payment, transfer.id)
+        return await asyncio.to_thread(self._save_transfer, payment)
+
+    async def retry_pending_transfers_for_seller(self, seller_id: int) -> int:
+        """Release PENDING_TRANSFER payments of a seller that just completed onboarding (one payout batch)."""
+        from payout_engine import PayoutEngine
+
+        batch = await PayoutEngine(self.db.get_bind(), gateway=self.stripe).run_batch(
+            seller_id=seller_id,
+            trigger="seller_onboarded",
+        )
+        return batch.transferred
+
+    # Sync Session work of the async methods above; they run it via asyncio.to_thread so the
+    # event loop is not blocked by the database. One call at a time per service (one Session).
+
+    def _find_by_idempotency_key(self, request_id: str) -> Optional[Payment]:
+        return self.db.exec(select(Payment).where(Payment.idempotency_key == request_id)).first()
+
+    def _save(self, payment: Payment, *events: Dict[str, Any]) -> Payment:
+        """Commit the payment together with its outbox events and reload it."""
         self.db.add(payment)
+        for event in events:
+            _queue_event(self.db, event)
         self.db.commit()
         self.db.refresh(payment)
+        return payment
 
-        _publish_event({
-            "event": "payment_transferred_to_seller",
-            "payment_id": payment.id,
-            "order_id": payment.order_id,
-            "transfer_id": transfer.id,
-            "seller_amount_cents": seller_amount,
-        })
-
-        logger.info(
-            "Payment released to seller | payment_id=%s | order_id=%s | "
-            "transfer_id=%s | amount_cents=%s",
-            payment.id, payment.order_id, transfer.id, seller_amount,
-        )
+    def _save_transfer(self, payment: Payment) -> Payment:
+        self.db.add(payment)
+        publish_transfer_event(self.db, payment)
+        self.db.commit()
+        self.db.refresh(payment)
         return payment
-    def retry_pending_transfers_for_seller(self, seller_id: int) -> int:
-        """Retry PENDING_TRANSFER payments for a seller that just completed onboarding."""
-        pending = self.db.exec(
-            select(Payment).where(
-                Payment.seller_id == seller_id,
-                Payment.status == PaymentStatus.PENDING_TRANSFER.value,
-                Payment.seller_transfer_id == None,
-            )
-        ).all()
 
-        released = 0
-        for payment in pending:
-            try:
-                self.release_payment_to_seller(payment.id)
-                released += 1
-            except Exception:
-                logger.exception(
-                    "Retry transfer failed | payment_id=%s | seller_id=%s",
-                    payment.id, seller_id,
-                )
-        return released
+    def _sync_checkout_payment(
+        self,
+        session_id: str,
+        status_value: str,
+        payment_intent_id: Optional[str],
+        charge_id: Any,
+        is_paid: bool,
+    ) -> Optional[Payment]:
+        payment = self.db.exec(
+            select(Payment).where(Payment.provider_checkout_session_id == session_id)
+        ).first()
+        if not payment:
+            return None
+        payment.updated_at = datetime.utcnow()
+        payment.status = status_value
+        if payment_intent_id:
+            payment.provider_payment_intent_id = payment_intent_id
+        if isinstance(charge_id, str) and not payment.provider_charge_id:
+            payment.provider_charge_id = charge_id
+        if is_paid and not payment.paid_at:
+            payment.paid_at = datetime.utcnow()
+        return self._save(payment)
+
+    @staticmethod
+    def seller_amount_cents(payment: Payment) -> int:
+        delivery_cost_cents = payment.delivery_cost_cents or 0
+        product_cost_cents = payment.amount_cents - delivery_cost_cents
+        return int(product_cost_cents / (1 + settings.application_fee))
 
-    def _notify_delivery_service_on_payment_success(self, payment: Payment) -> None:
-        """Ð£Ð²ÐµÐ´Ð¾Ð¼Ð¸Ñ‚ÑŒ delivery-service Ð¾ ÑƒÑÐ¿ÐµÑˆÐ½Ð¾Ð¹ Ð¾Ð¿Ð»Ð°Ñ‚Ðµ"""
-        if not payment.order_id:
-            return
-        
-        try:
-            with httpx.Client(timeout=5.0) as client:
-                response = client.post(
-                    f"{settings.delivery_service_url}/api/v1/delivery/orders/{payment.order_id}/after-payment",
-                    json={"order_id": payment.order_id, "payment_id": payment.id}
-                )
-                
-                if response.status_code in (200, 201):
-                    logger.info(f"Delivery service notified | order_id={payment.order_id}")
-        
-        except Exception as e:
-            logger.error(f"Failed to notify delivery service: {e}")
+    @classmethod
+    def transfer_params(cls, payment: Payment, destination: str, charge_id: Optional[str]) -> Dict[str, Any]:
+        transfer_args: Dict[str, Any] = {
+            "amount": cls.seller_amount_cents(payment),
+            "currency": payment.currency.lower(),
+            "destination": destination,
+            "transfer_group": f"order_{payment.order_id}",
+            "metadata": {"payment_id": str(payment.id), "order_id": str(payment.order_id)},
+        }
+        # source_transaction: the transfer draws from this charge's funds (pending OK)
+        # instead of the available balance.
+        if charge_id:
+            transfer_args["source_transaction"] = charge_id
+        return transfer_args
 
+    @classmethod
+    def transfer_idempotency_key(cls, payment: Payment) -> Optional[str]:
+        # Same key for the single release and payout batches: Stripe never transfers a payment twice
+        return idempotency_key_for(cls._idempotency_base(payment), "transfer")
 
+    @staticmethod
+    def mark_transferred(payment: Payment, transfer_id: str) -> None:
+        now = datetime.utcnow()
+        payment.seller_transfer_id = transfer_id
+        payment.status = PaymentStatus.TRANSFERRED.value
+        payment.transferred_at = now
+        payment.updated_at = now
+        payment.last_error = None
+        payment.payout_batch_id = None
+        payment.payout_claimed_at = None
+
+    @staticmethod
+    def _idempotency_base(payment: Payment) -> str:
+        return payment.idempotency_key or f"payment-{payment.id}"
+
+    def _queue_payment_succeeded_event(self, payment: Payment) -> None:
+        """Событие payment.succeeded для delivery-service: пишется в outbox в транзакции вебхука."""
+        if not payment.order_id:
+            return
 
+        add_outbox_event(
+            self.db,
+            OUTBOX_SOURCE,
+            "payment.succeeded",
+            {"order_id": payment.order_id, "payment_id": payment.id},
+        )
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Tuple
+
+import stripe
+from sqlalchemy import or_
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import settings
+from models import Payment, PaymentStatus, PayoutBatch, PayoutBatchStatus, SellerPayoutAccount
+from payment_service import PaymentService, publish_transfer_event
+from stripe_gateway import StripeGateway, get_stripe_gateway
+
+
+logger = logging.getLogger("payments.payout_engine")
+
+
+class _StripeRateLimiter:
+    """Spaces Stripe calls of one batch to max_per_second and pauses them all after a 429."""
+
+    def __init__(self, max_per_second: float):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class PayoutEngine:
+    """Transfers PENDING_TRANSFER payments of onboarded sellers in batches.
+
+    1. _claim: one short transaction selects eligible payments FOR UPDATE SKIP LOCKED and stamps
+       them with the batch id, so concurrent runs (replicas, the nightly job, seller onboarding)
+       never pick the same payment.
+    2. Charges missing provider_charge_id (normally stored by the payment_intent.succeeded webhook)
+       are resolved up front, concurrently.
+    3. Transfers run with bounded concurrency and a request rate cap; a 429 pauses the whole batch
+       with exponential backoff. The idempotency key is shared with release_payment_to_seller.
+    4. Every payment result is committed as soon as it is known; the batch row keeps the summary.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        gateway: Optional[StripeGateway] = None,
+        *,
+        batch_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        max_requests_per_second: Optional[float] = None,
+        rate_limit_retries: Optional[int] = None,
+        claim_ttl_seconds: Optional[int] = None,
+    ):
+        self.engine = engine
+        self.stripe = gateway or get_stripe_gateway()
+        self.batch_size = batch_size or settings.payout_batch_size
+        self.concurrency = concurrency or settings.payout_concurrency
+        self.max_requests_per_second = max_requests_per_second or settings.payout_max_requests_per_second
+        self.rate_limit_retries = (
+            rate_limit_retries if rate_limit_retries is not None else settings.payout_rate_limit_retries
+        )
+        self.claim_ttl_seconds = claim_ttl_seconds or settings.payout_claim_ttl_seconds
+
+    async def run_batch(
+        self,
+        *,
+        seller_id: Optional[int] = None,
+        trigger: str = "manual",
+        limit: Optional[int] = None,
+    ) -> PayoutBatch:
+        started = time.monotonic()
+        limiter = _StripeRateLimiter(self.max_requests_per_second)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        with Session(self.engine, expire_on_commit=False) as db:
+            batch = PayoutBatch(trigger=trigger, seller_id=seller_id)
+            db.add(batch)
+            db.commit()
+
+            try:
+                claimed = self._claim(db, batch, seller_id=seller_id, limit=limit or self.batch_size)
+                if claimed:
+                    await self._resolve_charge_ids(db, batch, claimed, limiter, semaphore)
+                    await asyncio.gather(
+                        *(
+                            self._transfer(db, batch, payment, destination, limiter, semaphore)
+                            for payment, destination in claimed
+                        )
+                    )
+                batch.status = PayoutBatchStatus.COMPLETED.value
+            except Exception as exc:
+                db.rollback()
+                batch.status = PayoutBatchStatus.FAILED.value
+                batch.error = f"{type(exc).__name__}: {exc}"[:2000]
+                logger.exception("Payout batch failed | batch_id=%s", batch.id)
+
+            batch.finished_at = datetime.utcnow()
+            batch.duration_ms = int((time.monotonic() - started) * 1000)
+            db.add(batch)
+            db.commit()
+
+        logger.info(
+            "Payout batch finished | batch_id=%s | trigger=%s | selected=%s | transferred=%s | "
+            "failed=%s | charges_resolved=%s | rate_limited=%s | duration_ms=%s",
+            batch.id, trigger, batch.selected, batch.transferred, batch.failed,
+            batch.charges_resolved, batch.rate_limited, batch.duration_ms,
+        )
+        return batch
+
+    def _claim(
+        self, db: Session, batch: PayoutBatch, *, seller_id: Optional[int], limit: int
+    ) -> List[Tuple[Payment, str]]:
+        now = datetime.utcnow()
+        statement = (
+            select(Payment, SellerPayoutAccount.stripe_account_id)
+            .join(SellerPayoutAccount, SellerPayoutAccount.seller_id == Payment.seller_id)
+            .where(
+                Payment.status == PaymentStatus.PENDING_TRANSFER.value,
+                Payment.seller_transfer_id == None,
+                SellerPayoutAccount.payouts_enabled == True,
+                or_(
+                    Payment.payout_batch_id == None,
+                    Payment.payout_claimed_at < now - timedelta(seconds=self.claim_ttl_seconds),
+                ),
+            )
+            .order_by(Payment.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True, of=Payment)
+        )
+        if seller_id is not None:
+            statement = statement.where(Payment.seller_id == seller_id)
+
+        claimed = list(db.exec(statement).all())
+        for payment, _ in claimed:
+            payment.payout_batch_id = batch.id
+            payment.payout_claimed_at = now
+            db.add(payment)
+        batch.selected = len(claimed)
+        db.add(batch)
+        db.commit()
+        return claimed
+
+    async def _resolve_charge_ids(
+        self,
+        db: Session,
+        batch: PayoutBatch,
+        claimed: List[Tuple[Payment, str]],
+        limiter: _StripeRateLimiter,
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        missing = [
+            payment for payment, _ in claimed
+            if not payment.provider_charge_id and payment.provider_payment_intent_id
+        ]
+        if not missing:
+            return
+
+        async def resolve(payment: Payment) -> None:
+            try:
+                intent = await self._call_stripe(
+                    batch, limiter, semaphore,
+                    lambda: self.stripe.retrieve_payment_intent(payment.provider_payment_intent_id),
+                )
+            except stripe.error.StripeError:
+                # The transfer still works without source_transaction (drawn from the available balance)
+                logger.warning("Could not resolve charge_id | payment_id=%s", payment.id)
+                return
+            charge_id = intent.get("latest_charge")
+            if charge_id:
+                payment.provider_charge_id = charge_id
+                batch.charges_resolved += 1
+
+        await asyncio.gather(*(resolve(payment) for payment in missing))
+        db.add_all(missing)
+        db.add(batch)
+        db.commit()
+
+    async def _transfer(
+        self,
+        db: Session,
+        batch: PayoutBatch,
+        payment: Payment,
+        destination: str,
+        limiter: _StripeRateLimiter,
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        params = PaymentService.transfer_params(payment, destination, payment.provider_charge_id)
+        try:
+            transfer = await self._call_stripe(
+                batch, limiter, semaphore,
+                lambda: self.stripe.create_transfer(
+                    params, idempotency_key=PaymentService.transfer_idempotency_key(payment)
+                ),
+            )
+        except stripe.error.StripeError as exc:
+            # Released back to the backlog: the next batch retries with the same idempotency key
+            payment.last_error = f"Stripe transfer error: {exc}"[:2000]
+            payment.payout_batch_id = None
+            payment.payout_claimed_at = None
+            payment.updated_at = datetime.utcnow()
+            batch.failed += 1
+            batch.results = [
+                *batch.results,
+                {"payment_id": payment.id, "status": "failed", "error": type(exc).__name__},
+            ]
+            db.add_all([payment, batch])
+            db.commit()
+            logger.warning(
+                "Payout transfer failed | batch_id=%s | payment_id=%s | error_type=%s",
+                batch.id, payment.id, type(exc).__name__,
+            )
+            return
+
+        PaymentService.mark_transferred(payment, transfer.id)
+        batch.transferred += 1
+        batch.transferred_amount_cents += params["amount"]
+        batch.results = [
+            *batch.results,
+            {"payment_id": payment.id, "status": "transferred", "transfer_id": transfer.id},
+        ]
+        db.add_all([payment, batch])
+        publish_transfer_event(db, payment)
+        db.commit()
+
+    async def _call_stripe(
+        self,
+        batch: PayoutBatch,
+        limiter: _StripeRateLimiter,
+        semaphore: asyncio.Semaphore,
+        call,
+    ) -> Any:
+        attempt = 0
+        while True:
+            async with semaphore:
+                await limiter.acquire()
+                try:
+                    return await call()
+                except stripe.error.RateLimitError:
+                    if attempt >= self.rate_limit_retries:
+                        raise
+                    batch.rate_limited += 1
+                    backoff = min(0.5 * 2 ** attempt, 30.0)
+                    limiter.pause(backoff)
+                    logger.warning(
+                        "Stripe rate limit hit, pausing payout batch | batch_id=%s | backoff_s=%s",
+                        batch.id, backoff,
+                    )
+            attempt += 1
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import delete, func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from configs import settings
+from models import (
+    Payment,
+    PaymentStatus,
+    ReconciliationRun,
+    ReconciliationRunStatus,
+    ReconciliationSeenIntent,
+)
+from stripe_gateway import StripeGateway, get_stripe_gateway
+
+
+logger = logging.getLogger("payments.reconciliation")
+
+
+STRIPE_PAGE_SIZE = 100  # максимум Stripe list API
+
+# Payment statuses that imply a succeeded Stripe charge
+CHARGED_STATUSES = (
+    PaymentStatus.SUCCEEDED.value,
+    PaymentStatus.PENDING_TRANSFER.value,
+    PaymentStatus.TRANSFERRED.value,
+    PaymentStatus.PARTIALLY_REFUNDED.value,
+    PaymentStatus.REFUNDED.value,
+)
+
+
+def _expected_status(charge: Dict[str, Any]) -> Iterable[str]:
+    if charge.get("refunded"):
+        return (PaymentStatus.REFUNDED.value,)
+    if int(charge.get("amount_refunded") or 0) > 0:
+        return (PaymentStatus.PARTIALLY_REFUNDED.value, PaymentStatus.REFUNDED.value)
+    return (
+        PaymentStatus.SUCCEEDED.value,
+        PaymentStatus.PENDING_TRANSFER.value,
+        PaymentStatus.TRANSFERRED.value,
+    )
+
+
+def _as_utc(value: datetime) -> datetime:
+    """Naive UTC, like every timestamp column of the service."""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _to_timestamp(value: datetime) -> int:
+    return int((value - datetime(1970, 1, 1)).total_seconds())
+
+
+class PaymentReconciler:
+    """Stripe ↔ payments reconciliation for a time window.
+
+    Streams charges, transfers and balance transactions page by page (one page in memory at a
+    time), matches every page against payments with one IN query on the indexed
+    provider_payment_intent_id / provider_charge_id columns and stores a compact report in
+    reconciliation_runs.
+
+    Local run against stripe-mock (docker compose --profile stripe-mock up stripe-mock):
+
+        STRIPE_API_BASE=http://localhost:12111 STRIPE_SECRET_KEY=sk_test_123 \\
+            python reconciliation.py --start 2026-10-01 --end 2026-10-02
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        gateway: Optional[StripeGateway] = None,
+        *,
+        max_report_items: Optional[int] = None,
+    ):
+        self.engine = engine
+        self.stripe = gateway or get_stripe_gateway()
+        self.max_report_items = max_report_items or settings.reconciliation_max_report_items
+
+    def create_run(self, window_start: datetime, window_end: datetime) -> ReconciliationRun:
+        with Session(self.engine, expire_on_commit=False) as db:
+            run = ReconciliationRun(window_start=_as_utc(window_start), window_end=_as_utc(window_end))
+            db.add(run)
+            db.commit()
+            return run
+
+    async def run(self, window_start: datetime, window_end: datetime) -> ReconciliationRun:
+        return await self.execute(self.create_run(window_start, window_end).id)
+
+    async def execute(self, run_id: int) -> ReconciliationRun:
+        with Session(self.engine, expire_on_commit=False) as db:
+            run = db.get(ReconciliationRun, run_id)
+            created = {"gte": _to_timestamp(run.window_start), "lt": _to_timestamp(run.window_end)}
+            try:
+                async for charges in self._pages(self.stripe.list_charges, created):
+                    self._check_charges(db, run, charges)
+                async for transfers in self._pages(self.stripe.list_transfers, created):
+                    self._check_transfers(db, run, transfers)
+                async for transactions in self._pages(self.stripe.list_balance_transactions, created):
+                    self._check_balance_transactions(db, run, transactions)
+                self._check_uncharged_payments(db, run)
+                run.status = ReconciliationRunStatus.COMPLETED.value
+            except Exception as exc:
+                db.rollback()
+                run.status = ReconciliationRunStatus.FAILED.value
+                run.error = f"{type(exc).__name__}: {exc}"[:2000]
+                logger.exception("Reconciliation failed | run_id=%s", run.id)
+
+            db.execute(delete(ReconciliationSeenIntent).where(ReconciliationSeenIntent.run_id == run.id))
+            run.finished_at = datetime.utcnow()
+            db.add(run)
+            db.commit()
+
+        logger.info(
+            "Reconciliation finished | run_id=%s | status=%s | charges=%s | transfers=%s | "
+            "balance_transactions=%s | discrepancies=%s",
+            run.id, run.status, run.charges_seen, run.transfers_seen,
+            run.balance_transactions_seen, run.discrepancies,
+        )
+        return run
+
+    async def _pages(self, list_call, created: Dict[str, int]):
+        params: Dict[str, Any] = {"limit": STRIPE_PAGE_SIZE, "created": created}
+        while True:
+            page = await list_call(params)
+            objects = list(page.get("data") or [])
+            if objects:
+                yield objects
+            if not page.get("has_more") or not objects:
+                return
+            params = {**params, "starting_after": objects[-1]["id"]}
+
+    def _report(self, run: ReconciliationRun, kind: str, object_id: Optional[str], **details: Any) -> None:
+        run.discrepancies += 1
+        run.discrepancies_by_kind = {
+            **run.discrepancies_by_kind,
+            kind: run.discrepancies_by_kind.get(kind, 0) + 1,
+        }
+        if len(run.items) >= self.max_report_items:
+            run.truncated = True
+            return
+        item = {"kind": kind, "object_id": object_id}
+        item.update({key: value for key, value in details.items() if value is not None})
+        run.items = [*run.items, item]
+
+    def _count_unreported(self, run: ReconciliationRun, kind: str, count: int) -> None:
+        if count <= 0:
+            return
+        run.discrepancies += count
+        run.discrepancies_by_kind = {
+            **run.discrepancies_by_kind,
+            kind: run.discrepancies_by_kind.get(kind, 0) + count,
+        }
+        run.truncated = True
+
+    def _check_charges(self, db: Session, run: ReconciliationRun, charges: List[Dict[str, Any]]) -> None:
+        succeeded = [charge for charge in charges if charge.get("status") == "succeeded"]
+        run.charges_seen += len(charges)
+        if not succeeded:
+            return
+
+        charge_ids = [charge["id"] for charge in succeeded]
+        intent_ids = [charge["payment_intent"] for charge in succeeded if charge.get("payment_intent")]
+        payments = db.exec(
+            select(Payment).where(
+                or_(
+                    Payment.provider_charge_id.in_(charge_ids),
+                    Payment.provider_payment_intent_id.in_(intent_ids),
+                )
+            )
+        ).all()
+        by_charge = {payment.provider_charge_id: payment for payment in payments if payment.provider_charge_id}
+        by_intent = {
+            payment.provider_payment_intent_id: payment
+            for payment in payments
+            if payment.provider_payment_intent_id
+        }
+
+        for charge in succeeded:
+            payment = by_charge.get(charge["id"]) or by_intent.get(charge.get("payment_intent"))
+            if payment is None:
+                self._report(run, "charge_without_payment", charge["id"], actual=int(charge.get("amount") or 0))
+                continue
+
+            if payment.provider_charge_id != charge["id"]:
+                self._report(
+                    run, "charge_id_not_recorded", charge["id"],
+                    payment_id=payment.id, actual=payment.provider_charge_id,
+                )
+            if int(charge.get("amount") or 0) != payment.amount_cents:
+                self._report(
+                    run, "amount_mismatch", charge["id"],
+                    payment_id=payment.id, expected=int(charge.get("amount") or 0), actual=payment.amount_cents,
+                )
+            expected = _expected_status(charge)
+            if payment.status not in expected:
+                self._report(
+                    run, "status_mismatch", charge["id"],
+                    payment_id=payment.id, expected="|".join(expected), actual=payment.status,
+                )
+
+        if intent_ids:
+            db.execute(
+                pg_insert(ReconciliationSeenIntent.__table__)
+                .values([{"run_id": run.id, "payment_intent_id": intent_id} for intent_id in intent_ids])
+                .on_conflict_do_nothing()
+            )
+        db.add(run)
+        db.commit()
+
+    def _check_transfers(self, db: Session, run: ReconciliationRun, transfers: List[Dict[str, Any]]) -> None:
+        run.transfers_seen += len(transfers)
+        payment_ids = {}
+        for transfer in transfers:
+            raw_payment_id = (transfer.get("metadata") or {}).get("payment_id")
+            if raw_payment_id and str(raw_payment_id).isdigit():
+                payment_ids[transfer["id"]] = int(raw_payment_id)
+
+        payments = {}
+        if payment_ids:
+            payments = {
+                payment.id: payment
+                for payment in db.exec(select(Payment).where(Payment.id.in_(set(payment_ids.values())))).all()
+            }
+
+        for transfer in transfers:
+            payment = payments.get(payment_ids.get(transfer["id"]))
+            if payment is None:
+                self._report(
+                    run, "transfer_without_payment", transfer["id"], actual=int(transfer.get("amount") or 0)
+                )
+            elif payment.seller_transfer_id != transfer["id"]:
+                self._report(
+                    run, "transfer_not_recorded", transfer["id"],
+                    payment_id=payment.id, actual=payment.seller_transfer_id,
+                )
+            elif transfer.get("reversed") and payment.status == PaymentStatus.TRANSFERRED.value:
+                self._report(run, "transfer_reversed", transfer["id"], payment_id=payment.id, actual=payment.status)
+        db.add(run)
+        db.commit()
+
+    def _check_balance_transactions(
+        self, db: Session, run: ReconciliationRun, transactions: List[Dict[str, Any]]
+    ) -> None:
+        run.balance_transactions_seen += len(transactions)
+        totals = {key: dict(value) for key, value in run.balance_totals.items()}
+        for transaction in transactions:
+            bucket = totals.setdefault(
+                transaction.get("type") or "unknown",
+                {"count": 0, "amount": 0, "fee": 0, "net": 0},
+            )
+            bucket["count"] += 1
+            bucket["amount"] += int(transaction.get("amount") or 0)
+            bucket["fee"] += int(transaction.get("fee") or 0)
+            bucket["net"] += int(transaction.get("net") or 0)
+        run.balance_totals = totals
+
+        # Charge money that landed on the balance must belong to a payment with that charge id
+        charge_sources = [
+            transaction.get("source")
+            for transaction in transactions
+            if transaction.get("type") in ("charge", "payment") and isinstance(transaction.get("source"), str)
+        ]
+        if charge_sources:
+            known = set(
+                db.exec(
+                    select(Payment.provider_charge_id).where(Payment.provider_charge_id.in_(charge_sources))
+                ).all()
+            )
+            for source in charge_sources:
+                if source not in known:
+                    self._report(run, "balance_transaction_unmatched", source)
+        db.add(run)
+        db.commit()
+
+    def _check_uncharged_payments(self, db: Session, run: ReconciliationRun) -> None:
+        """Payments paid in the window whose PaymentIntent had no succeeded charge in Stripe."""
+        seen = select(ReconciliationSeenIntent.payment_intent_id).where(
+            ReconciliationSeenIntent.run_id == run.id,
+            ReconciliationSeenIntent.payment_intent_id == Payment.provider_payment_intent_id,
+        )
+        conditions = (
+            Payment.paid_at >= run.window_start,
+            Payment.paid_at < run.window_end,
+            Payment.status.in_(CHARGED_STATUSES),
+            ~seen.exists(),
+        )
+        missing = db.exec(select(func.count(Payment.id)).where(*conditions)).one()
+        room = max(0, self.max_report_items - len(run.items))
+        rows = db.exec(select(Payment).where(*conditions).order_by(Payment.id).limit(room)).all() if room else []
+        for payment in rows:
+            self._report(
+                run, "payment_without_charge", payment.provider_payment_intent_id,
+                payment_id=payment.id, actual=payment.status,
+            )
+        self._count_unreported(run, "payment_without_charge", missing - len(rows))
+
+
+_running_tasks: Set[asyncio.Task] = set()
+
+
+async def start_reconciliation(engine: Engine, window_start: datetime, window_end: datetime) -> ReconciliationRun:
+    """Create the run row and execute it in the background; poll reconciliation_runs for the result."""
+    reconciler = PaymentReconciler(engine)
+    run = await asyncio.to_thread(reconciler.create_run, window_start, window_end)
+    task = asyncio.create_task(reconciler.execute(run.id), name=f"reconciliation:{run.id}")
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return run
+
+
+async def _main() -> None:
+    from database import engine
+
+    yesterday = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    parser = argparse.ArgumentParser(description="Reconcile payments with Stripe for a time window (UTC).")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=yesterday)
+    parser.add_argument("--end", type=datetime.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    run = await PaymentReconciler(engine).run(args.start, args.end or args.start + timedelta(days=1))
+    print(json.dumps(
+        {
+            "id": run.id,
+            "status": run.status,
+            "charges_seen": run.charges_seen,
+            "transfers_seen": run.transfers_seen,
+            "balance_transactions_seen": run.balance_transactions_seen,
+            "discrepancies_by_kind": run.discrepancies_by_kind,
+            "balance_totals": run.balance_totals,
+            "items": run.items,
+            "truncated": run.truncated,
+        },
+        indent=2,
+        default=str,
+    ))
+
+    from stripe_gateway import close_stripe_gateway
+
+    await close_stripe_gateway()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    asyncio.run(_main())
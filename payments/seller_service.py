@@ -1,32 +1,39 @@
-import stripe
+import asyncio
+from typing import Optional
+
 from fastapi import HTTPException
 from sqlmodel import Session, select
 from models import SellerPayoutAccount, SellerOnboardingStatus
 from datetime import datetime
 
+from stripe_gateway import StripeGateway, get_stripe_gateway
+
 
 class SellerService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, gateway: Optional[StripeGateway] = None):
         self.db = db
+        self.stripe = gateway or get_stripe_gateway()
 
-    def get_or_create_stripe_account(self, seller_id: int) -> SellerPayoutAccount:
-        existing = self.db.exec(
-            select(SellerPayoutAccount).where(SellerPayoutAccount.seller_id == seller_id)
-        ).first()
+    async def get_or_create_stripe_account(self, seller_id: int) -> SellerPayoutAccount:
+        existing = await asyncio.to_thread(self._get_account, seller_id)
         if existing:
             return existing
 
-        # Creating Express account for seller
-        account = stripe.Account.create(
-            type="express",
-            capabilities={
-                "transfers": {"requested": True},
-            },
-            settings={
-                "payouts": {
-                    "schedule": {"interval": "manual"},  # you control when
-                }
+        # Creating Express account for seller.
+        # Keyed by seller: concurrent checkouts for one seller get the same account back from Stripe.
+        account = await self.stripe.create_account(
+            {
+                "type": "express",
+                "capabilities": {
+                    "transfers": {"requested": True},
+                },
+                "settings": {
+                    "payouts": {
+                        "schedule": {"interval": "manual"},  # you control when
+                    }
+                },
             },
+            idempotency_key=f"seller-{seller_id}:account",
         )
 
         record = SellerPayoutAccount(
@@ -34,33 +41,30 @@ class SellerService:
             stripe_account_id=account.id,
             onboarding_status=SellerOnboardingStatus.PENDING.value,
         )
-        self.db.add(record)
-        self.db.commit()
-        self.db.refresh(record)
-        return record
+        return await asyncio.to_thread(self._save, record)
 
-    def create_onboarding_link(
+    async def create_onboarding_link(
         self, seller_id: int, return_url: str, refresh_url: str
     ) -> str:
-        account = self.get_or_create_stripe_account(seller_id)
+        account = await self.get_or_create_stripe_account(seller_id)
 
-        link = stripe.AccountLink.create(
-            account=account.stripe_account_id,
-            type="account_onboarding",
-            return_url=return_url,   # When seller finishes onboarding, they will be redirected here
-            refresh_url=refresh_url, # if the link expires
+        link = await self.stripe.create_account_link(
+            {
+                "account": account.stripe_account_id,
+                "type": "account_onboarding",
+                "return_url": return_url,   # When seller finishes onboarding, they will be redirected here
+                "refresh_url": refresh_url, # if the link expires
+            }
         )
         return link.url
 
-    def sync_account_status(self, seller_id: int) -> SellerPayoutAccount:
+    async def sync_account_status(self, seller_id: int) -> SellerPayoutAccount:
         """Call this after return_url or via the account.updated webhook"""
-        record = self.db.exec(
-            select(SellerPayoutAccount).where(SellerPayoutAccount.seller_id == seller_id)
-        ).first()
+        record = await asyncio.to_thread(self._get_account, seller_id)
         if not record:
             raise HTTPException(404, "Seller payout account not found")
 
-        account = stripe.Account.retrieve(record.stripe_account_id)
+        account = await self.stripe.retrieve_account(record.stripe_account_id)
         record.payouts_enabled = account.payouts_enabled
         record.details_submitted = account.details_submitted
         record.onboarding_status = (
@@ -69,6 +73,16 @@ class SellerService:
             else SellerOnboardingStatus.PENDING.value
         )
         record.updated_at = datetime.utcnow()
+        return await asyncio.to_thread(self._save, record)
+
+    # Sync Session work of the async methods, run via asyncio.to_thread (keeps the event loop free)
+
+    def _get_account(self, seller_id: int) -> Optional[SellerPayoutAccount]:
+        return self.db.exec(
+            select(SellerPayoutAccount).where(SellerPayoutAccount.seller_id == seller_id)
+        ).first()
+
+    def _save(self, record: SellerPayoutAccount) -> SellerPayoutAccount:
         self.db.add(record)
         self.db.commit()
         self.db.refresh(record)
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import stripe
+
+from configs import settings
+
+
+logger = logging.getLogger("payments.stripe_gateway")
+
+
+class StripeGatewayTimeout(stripe.error.APIConnectionError):
+    """Stripe call exceeded its per-call deadline. Handled like any other StripeError."""
+
+
+def idempotency_key_for(base: Optional[str], operation: str, *parts: Any) -> Optional[str]:
+    """Stable Stripe Idempotency-Key for one logical operation on a payment.
+
+    base is Payment.idempotency_key (X-Request-ID of the create call) or "payment-<id>" for
+    payments created without one. A retried request reuses the key, so Stripe returns the
+    original object instead of charging/refunding/transferring twice.
+    """
+    if not base:
+        return None
+    suffix = ":".join(str(part) for part in parts if part is not None)
+    return f"{base}:{operation}:{suffix}" if suffix else f"{base}:{operation}"
+
+
+class StripeGateway:
+    """Async access to the Stripe API.
+
+    Uses native async requests of StripeClient over one shared httpx.AsyncClient
+    (keep-alive pool per process) instead of the blocking module-level SDK calls.
+    Every call has its own deadline; network retries are done by the SDK, which
+    re-sends POSTs with the same idempotency key.
+
+    api_base points the gateway at stripe-mock (docker-compose profile "stripe-mock")
+    for local runs, tests and benchmarks.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        *,
+        api_base: Optional[str] = None,
+        timeout_seconds: float = 10.0,
+        max_network_retries: int = 2,
+    ):
+        self.timeout_seconds = timeout_seconds
+        self._http_client = stripe.HTTPXClient(timeout=timeout_seconds)
+        self._client = stripe.StripeClient(
+            api_key,
+            http_client=self._http_client,
+            max_network_retries=max_network_retries,
+            base_addresses={"api": api_base} if api_base else {},
+        )
+        self.metrics: Dict[str, Any] = {
+            "calls": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "total_duration_ms": 0,
+            "max_duration_ms": 0,
+        }
+
+    async def close(self) -> None:
+        await self._http_client.close_async()
+
+    async def _call(self, operation: str, request, timeout: Optional[float]):
+        deadline = timeout or self.timeout_seconds
+        started = time.monotonic()
+        self.metrics["calls"] += 1
+        try:
+            return await asyncio.wait_for(request, timeout=deadline)
+        except asyncio.TimeoutError:
+            self.metrics["timeouts"] += 1
+            logger.warning("Stripe call timed out | operation=%s | timeout_s=%s", operation, deadline)
+            raise StripeGatewayTimeout(f"Stripe {operation} timed out after {deadline}s")
+        except stripe.error.StripeError as exc:
+            self.metrics["errors"] += 1
+            logger.warning(
+                "Stripe call failed | operation=%s | error_type=%s | request_id=%s",
+                operation,
+                type(exc).__name__,
+                getattr(exc, "request_id", None),
+            )
+            raise
+        finally:
+            duration_ms = int((time.monotonic() - started) * 1000)
+            self.metrics["total_duration_ms"] += duration_ms
+            self.metrics["max_duration_ms"] = max(self.metrics["max_duration_ms"], duration_ms)
+
+    @staticmethod
+    def _options(idempotency_key: Optional[str]) -> Dict[str, Any]:
+        return {"idempotency_key": idempotency_key} if idempotency_key else {}
+
+    async def create_payment_intent(
+        self, params: Dict[str, Any], *, idempotency_key: Optional[str] = None, timeout: Optional[float] = None
+    ):
+        return await self._call(
+            "payment_intents.create",
+            self._client.v1.payment_intents.create_async(params=params, options=self._options(idempotency_key)),
+            timeout,
+        )
+
+    async def retrieve_payment_intent(self, payment_intent_id: str, *, timeout: Optional[float] = None):
+        return await self._call(
+            "payment_intents.retrieve",
+            self._client.v1.payment_intents.retrieve_async(payment_intent_id),
+            timeout,
+        )
+
+    async def create_checkout_session(
+        self, params: Dict[str, Any], *, idempotency_key: Optional[str] = None, timeout: Optional[float] = None
+    ):
+        return await self._call(
+            "checkout.sessions.create",
+            self._client.v1.checkout.sessions.create_async(params=params, options=self._options(idempotency_key)),
+            timeout,
+        )
+
+    async def retrieve_checkout_session(
+        self, session_id: str, *, expand: Optional[List[str]] = None, timeout: Optional[float] = None
+    ):
+        return await self._call(
+            "checkout.sessions.retrieve",
+            self._client.v1.checkout.sessions.retrieve_async(
+                session_id, params={"expand": expand} if expand else None
+            ),
+            timeout,
+        )
+
+    async def create_refund(
+        self, params: Dict[str, Any], *, idempotency_key: Optional[str] = None, timeout: Optional[float] = None
+    ):
+        return await self._call(
+            "refunds.create",
+            self._client.v1.refunds.create_async(params=params, options=self._options(idempotency_key)),
+            timeout,
+        )
+
+    async def create_transfer(
+        self, params: Dict[str, Any], *, idempotency_key: Optional[str] = None, timeout: Optional[float] = None
+    ):
+        return await self._call(
+            "transfers.create",
+            self._client.v1.transfers.create_async(params=params, options=self._options(idempotency_key)),
+            timeout,
+        )
+
+    async def create_account(
+        self, params: Dict[str, Any], *, idempotency_key: Optional[str] = None, timeout: Optional[float] = None
+    ):
+        return await self._call(
+            "accounts.create",
+            self._client.v1.accounts.create_async(params=params, options=self._options(idempotency_key)),
+            timeout,
+        )
+
+    async def retrieve_account(self, account_id: str, *, timeout: Optional[float] = None):
+        return await self._call(
+            "accounts.retrieve",
+            self._client.v1.accounts.retrieve_async(account_id),
+            timeout,
+        )
+
+    async def create_account_link(self, params: Dict[str, Any], *, timeout: Optional[float] = None):
+        return await self._call(
+            "account_links.create",
+            self._client.v1.account_links.create_async(params=params),
+            timeout,
+        )
+
+    # Single list pages (limit/starting_after/created in params): callers page explicitly,
+    # so one page at a time is held in memory and every page has its own deadline.
+    async def list_balance_transactions(self, params: Dict[str, Any], *, timeout: Optional[float] = None):
+        return await self._call(
+            "balance_transactions.list",
+            self._client.v1.balance_transactions.list_async(params=params),
+            timeout,
+        )
+
+    async def list_charges(self, params: Dict[str, Any], *, timeout: Optional[float] = None):
+        return await self._call(
+            "charges.list",
+            self._client.v1.charges.list_async(params=params),
+            timeout,
+        )
+
+    async def list_transfers(self, params: Dict[str, Any], *, timeout: Optional[float] = None):
+        return await self._call(
+            "transfers.list",
+            self._client.v1.transfers.list_async(params=params),
+            timeout,
+        )
+
+
+_gateway: Optional[StripeGateway] = None
+
+
+def get_stripe_gateway() -> StripeGateway:
+    """Process-wide gateway: one connection pool shared by all requests."""
+    global _gateway
+    if _gateway is None:
+        _gateway = StripeGateway(
+            settings.stripe_secret_key,
+            api_base=settings.stripe_api_base or None,
+            timeout_seconds=settings.stripe_timeout_seconds,
+            max_network_retries=settings.stripe_max_network_retries,
+        )
+    return _gateway
+
+
+async def close_stripe_gateway() -> None:
+    global _gateway
+    if _gateway is not None:
+        await _gateway.close()
+        _gateway = None
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from sqlalchemy import func, text, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from models import PaymentWebhookEvent, WebhookEventStatus
+from payment_service import PaymentService
+
+
+logger = logging.getLogger("payments.webhook_worker")
+
+
+# Oldest due event whose payment intent has no earlier pending event.
+# SKIP LOCKED: a head being applied by another worker is skipped, and its successors are not
+# eligible until it leaves 'pending' - so one intent is applied in order, different intents in parallel.
+CLAIM_NEXT_EVENT_SQL = text(
+    """
+    SELECT e.id
+    FROM payment_webhook_events e
+    WHERE e.status = 'pending'
+      AND (e.next_attempt_at IS NULL OR e.next_attempt_at <= :now)
+      AND NOT EXISTS (
+          SELECT 1
+          FROM payment_webhook_events prev
+          WHERE prev.status = 'pending'
+            AND prev.payment_intent_id = e.payment_intent_id
+            AND prev.id < e.id
+      )
+    ORDER BY e.id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+    """
+)
+
+
+class StripeWebhookWorkerPool:
+    """Applies events recorded by ingest_stripe_webhook in the background."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        *,
+        workers: int = 4,
+        poll_interval_seconds: float = 0.5,
+        max_attempts: int = 8,
+    ):
+        self.engine = engine
+        self.workers = workers
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.metrics: Dict[str, Any] = {
+            "processed": 0,
+            "retried": 0,
+            "failed": 0,
+            "last_lag_ms": None,
+            "max_lag_ms": 0,
+            "total_lag_ms": 0,
+            "last_processed_at": None,
+        }
+
+    async def start(self) -> None:
+        for index in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._run(), name=f"stripe-webhook-worker:{index}"))
+        logger.info("Stripe webhook workers started | workers=%s", self.workers)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def notify(self) -> None:
+        """Wake idle workers right after an event is recorded (other replicas pick it up by polling)."""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # DB claim, apply_stripe_event and the Redis XADD are blocking: keep them off the loop
+                applied = await asyncio.to_thread(self.process_next)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                applied = False
+                logger.warning("Stripe webhook worker error | error_type=%s", type(exc).__name__)
+
+            if applied:
+                # Yield to the loop between events, keep draining the backlog
+                await asyncio.sleep(0)
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def process_next(self) -> bool:
+        """Claim and apply one event. False if there was nothing due."""
+        with Session(self.engine) as db:
+            row = db.execute(CLAIM_NEXT_EVENT_SQL, {"now": datetime.utcnow()}).first()
+            if row is None:
+                db.rollback()
+                return False
+
+            webhook_event = db.get(PaymentWebhookEvent, row[0])
+            try:
+                PaymentService(db).apply_stripe_event(webhook_event)
+            except Exception as exc:
+                db.rollback()
+                self._record_failure(row[0], exc)
+                return True
+
+            self._record_lag(webhook_event)
+        return True
+
+    def _record_lag(self, webhook_event: PaymentWebhookEvent) -> None:
+        lag_ms = max(0, int((webhook_event.processed_at - webhook_event.received_at).total_seconds() * 1000))
+        self.metrics["processed"] += 1
+        self.metrics["last_lag_ms"] = lag_ms
+        self.metrics["max_lag_ms"] = max(self.metrics["max_lag_ms"], lag_ms)
+        self.metrics["total_lag_ms"] += lag_ms
+        self.metrics["last_processed_at"] = webhook_event.processed_at.isoformat()
+
+    def _record_failure(self, event_id: int, exc: Exception) -> None:
+        """Retry with backoff; after max_attempts the event is parked as failed so the intent's queue moves on."""
+        with Session(self.engine) as db:
+            webhook_event = db.get(PaymentWebhookEvent, event_id)
+            if webhook_event is None:
+                return
+            attempts = webhook_event.attempts + 1
+            give_up = attempts >= self.max_attempts
+            db.execute(
+                update(PaymentWebhookEvent)
+                .where(PaymentWebhookEvent.id == event_id)
+                .values(
+                    attempts=attempts,
+                    last_error=f"{type(exc).__name__}: {exc}"[:2000],
+                    status=WebhookEventStatus.FAILED.value if give_up else WebhookEventStatus.PENDING.value,
+                    next_attempt_at=datetime.utcnow() + timedelta(seconds=min(2 ** attempts, 300)),
+                )
+            )
+            db.commit()
+
+        self.metrics["failed" if give_up else "retried"] += 1
+        log = logger.error if give_up else logger.warning
+        log(
+            "Stripe webhook event failed | event_id=%s | attempts=%s | gave_up=%s | error_type=%s",
+            event_id,
+            attempts,
+            give_up,
+            type(exc).__name__,
+        )
+
+    def backlog(self) -> Dict[str, Any]:
+        """Inbox state shared by all replicas: pending count and age of the oldest pending event."""
+        with Session(self.engine) as db:
+            pending, oldest = db.exec(
+                select(func.count(PaymentWebhookEvent.id), func.min(PaymentWebhookEvent.received_at))
+                .where(PaymentWebhookEvent.status == WebhookEventStatus.PENDING.value)
+            ).one()
+            failed = db.exec(
+                select(func.count(PaymentWebhookEvent.id))
+                .where(PaymentWebhookEvent.status == WebhookEventStatus.FAILED.value)
+            ).one()
+        return {
+            "pending": pending,
+            "failed": failed,
+            "oldest_pending_age_ms": int((datetime.utcnow() - oldest).total_seconds() * 1000) if oldest else 0,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        processed = self.metrics["processed"]
+        return {
+            **self.metrics,
+            "avg_lag_ms": int(self.metrics["total_lag_ms"] / processed) if processed else None,
+            "backlog": self.backlog(),
+        }
@@ -10,6 +10,7 @@ from configs import Configs
 from database import get_session
 from bought_models import BoughtItem, BoughtItemCreate, BoughtItemPublic
 from models_v2 import Product
+from post_service_v2 import listings_cache
 
 import sys
 import os
@@ -160,6 +161,7 @@ async def create_purchase(
         
         db.commit()
         db.refresh(bought_item)
+        listings_cache.invalidate()
         
         logger.info(f"Purchase created | post_id={purchase_data.post_id}")
         
@@ -42,6 +42,9 @@ class Configs:
     # Notification Service URL
     NOTIFICATION_SERVICE_URL = os.getenv('NOTIFICATION_SERVICE_URL', 'http://notifications-service:6000')
     
+    # Redis (шина событий: outbox relay -> Redis Streams)
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+
     # Delivery Service URL
     DELIVERY_SERVICE_URL = os.getenv('DELIVERY_SERVICE_URL', 'http://delivery-service:7000')
 
@@ -56,6 +59,22 @@ class Configs:
     # Hours after picked_up before auto-confirming and releasing payment to seller
     ORDER_AUTO_CONFIRM_HOURS = int(os.getenv('ORDER_AUTO_CONFIRM_HOURS', '24'))
 
+    # Фоновые sweep-задачи (авто-подтверждение, авто-принятие скидки): размер батча и параллельность выплат
+    AUTO_SWEEP_BATCH_SIZE = int(os.getenv('AUTO_SWEEP_BATCH_SIZE', '100'))
+    AUTO_SWEEP_CONCURRENCY = int(os.getenv('AUTO_SWEEP_CONCURRENCY', '5'))
+
+    # TTL (сек) процессного кэша каталога: фасеты фильтров; предел числа ключей (LRU)
+    LISTINGS_CACHE_TTL_SECONDS = int(os.getenv('LISTINGS_CACHE_TTL_SECONDS', '60'))
+    LISTINGS_CACHE_MAX_ENTRIES = int(os.getenv('LISTINGS_CACHE_MAX_ENTRIES', '1024'))
+
+    # TTL (сек) кэша статистики заказов для админ-дашборда (0 — без кэша)
+    ADMIN_STATS_CACHE_TTL_SECONDS = int(os.getenv('ADMIN_STATS_CACHE_TTL_SECONDS', '15'))
+
+    # Страница заказа (/shipments/{tracking_number}): TTL кэша проекции и
+    # минимальный интервал между запросами снимка доставки в delivery-service
+    TRACKING_PAGE_CACHE_TTL_SECONDS = int(os.getenv('TRACKING_PAGE_CACHE_TTL_SECONDS', '5'))
+    TRACKING_DELIVERY_REFRESH_SECONDS = int(os.getenv('TRACKING_DELIVERY_REFRESH_SECONDS', '60'))
+
     # Test payment mode (Stripe test payment_method)
     PAYMENTS_TEST_MODE = os.getenv("PAYMENTS_TEST_MODE", "true").lower() == "true"
     
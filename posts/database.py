@@ -18,6 +18,7 @@ except ImportError:
 # These imports MUST come BEFORE create_engine!
 import models  # Old models
 import models_v2  # New models (Product, Order, OrderIssue, etc.)
+import outbox  # OutboxEvent, ProcessedEvent (шина событий)
 
 # Check which database to use (SQLite or PostgreSQL)
 USE_POSTGRES = os.getenv("USE_POSTGRES", "false").lower() == "true"
@@ -47,192 +48,20 @@ else:
 
 # Функция для создания всех таблиц
 def create_db_and_tables():
-    """Создает все таблицы в базе данных при запуске приложения."""
-    if USE_POSTGRES:
-        with engine.begin() as connection:
-            connection.exec_driver_sql("CREATE SCHEMA IF NOT EXISTS posts_db")
-    SQLModel.metadata.create_all(engine)
-
-    if USE_POSTGRES:
-        try:
-            with engine.begin() as connection:
-                connection.exec_driver_sql(
-                    """
-                    DELETE FROM postview pv
-                    WHERE NOT EXISTS (
-                        SELECT 1 FROM products p WHERE p.id = pv.post_id
-                    )
-                    """
-                )
-                connection.exec_driver_sql(
-                    "ALTER TABLE postview DROP CONSTRAINT IF EXISTS postview_post_id_fkey"
-                )
-                connection.exec_driver_sql(
-                    """
-                    ALTER TABLE postview
-                    ADD CONSTRAINT postview_post_id_fkey
-                    FOREIGN KEY (post_id) REFERENCES products(id) ON DELETE CASCADE
-                    """
-                )
-            logger.info("PostView FK check: postview_post_id_fkey -> products(id)")
-        except Exception as exc:
-            logger.warning(f"PostView FK check skipped/failed: {exc}")
-
-        try:
-            with engine.begin() as connection:
-                connection.exec_driver_sql(
-                    """
-                    DELETE FROM "order" o
-                    WHERE NOT EXISTS (
-                        SELECT 1 FROM products p WHERE p.id = o.post_id
-                    )
-                    """
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE "order" DROP CONSTRAINT IF EXISTS order_post_id_fkey'
-                )
-                connection.exec_driver_sql(
-                    """
-                    ALTER TABLE "order"
-                    ADD CONSTRAINT order_post_id_fkey
-                    FOREIGN KEY (post_id) REFERENCES products(id) ON DELETE CASCADE
-                    """
-                )
-            logger.info('Order FK check: order_post_id_fkey -> products(id)')
-        except Exception as exc:
-            logger.warning(f"Order FK check skipped/failed: {type(exc).__name__}")
+    """
+    Готовит схему при запуске приложения.
 
-        try:
-            with engine.begin() as connection:
-                connection.exec_driver_sql(
-                    """
-                    DELETE FROM postreport pr
-                    WHERE NOT EXISTS (
-                        SELECT 1 FROM products p WHERE p.id = pr.post_id
-                    )
-                    """
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE postreport DROP CONSTRAINT IF EXISTS postreport_post_id_fkey'
-                )
-                connection.exec_driver_sql(
-                    """
-                    ALTER TABLE postreport
-                    ADD CONSTRAINT postreport_post_id_fkey
-                    FOREIGN KEY (post_id) REFERENCES products(id) ON DELETE CASCADE
-                    """
-                )
-            logger.info('PostReport FK check: postreport_post_id_fkey -> products(id)')
-        except Exception as exc:
-            logger.warning(f"PostReport FK check skipped/failed: {type(exc).__name__}")
+    SQLite (локальная разработка) — просто create_all.
+    PostgreSQL — версионированные миграции из schema_migrations.py: DDL выполняется один раз,
+    а обычный старт сводится к проверке версии схемы.
+    """
+    if not USE_POSTGRES:
+        SQLModel.metadata.create_all(engine)
+        return
 
-        try:
-            with engine.begin() as connection:
-                # buyer_id должен поддерживать анонимные заказы и не зависеть от user-таблиц
-                connection.exec_driver_sql(
-                    'ALTER TABLE IF EXISTS "order" ALTER COLUMN buyer_id DROP NOT NULL'
-                )
-                connection.exec_driver_sql(
-                    """
-                    DO $$
-                    DECLARE
-                        constraint_name text;
-                    BEGIN
-                        FOR constraint_name IN
-                            SELECT con.conname
-                            FROM pg_constraint con
-                            JOIN pg_class rel ON rel.oid = con.conrelid
-                            JOIN pg_namespace nsp ON nsp.oid = rel.relnamespace
-                            JOIN pg_attribute att ON att.attrelid = rel.oid
-                            WHERE con.contype = 'f'
-                              AND nsp.nspname = 'public'
-                              AND rel.relname = 'order'
-                              AND att.attname = 'buyer_id'
-                              AND att.attnum = ANY (con.conkey)
-                        LOOP
-                            EXECUTE format(
-                                'ALTER TABLE "order" DROP CONSTRAINT IF EXISTS %%I',
-                                constraint_name
-                            );
-                        END LOOP;
-                    END$$;
-                    """
-                )
-            logger.info('Order buyer_id policy applied: nullable + no FK constraints')
-        except Exception as exc:
-            logger.warning(f"Order buyer_id policy apply skipped/failed: {type(exc).__name__}")
-        
-        # === ФАЗА 2: Добавляем новые столбцы для системы доставки и скидок ===
-        try:
-            with engine.begin() as connection:
-                # Таблица "order" находится в public схеме (не в posts_db)
-                # Добавляем столбцы для доставки (если их еще нет)
-                connection.exec_driver_sql(
-                    'ALTER TABLE public."order" ADD COLUMN IF NOT EXISTS delivery_cost NUMERIC(10, 2) DEFAULT 0'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public."order" ADD COLUMN IF NOT EXISTS selected_locker_id VARCHAR(100)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public."order" ADD COLUMN IF NOT EXISTS selected_locker_name VARCHAR(255)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public."order" ADD COLUMN IF NOT EXISTS order_confirmed_at TIMESTAMP'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public."order" ADD COLUMN IF NOT EXISTS discount_offered NUMERIC(10, 2)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public."order" ADD COLUMN IF NOT EXISTS discount_status VARCHAR(50)'
-                )
-            logger.info('Order delivery/discount columns added: success')
-        except Exception as exc:
-            logger.warning(f"Order delivery/discount columns add failed: {type(exc).__name__}: {exc}")
+    from schema_migrations import apply_migrations
 
-        try:
-            with engine.begin() as connection:
-                connection.exec_driver_sql(
-                    "ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS buyer_media_urls JSONB DEFAULT '[]'::jsonb"
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS seller_response_action VARCHAR(30)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS seller_response_text VARCHAR(2000)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS seller_discount_amount NUMERIC(10, 2)'
-                )
-                connection.exec_driver_sql(
-                    "ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS seller_media_urls JSONB DEFAULT '[]'::jsonb"
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS seller_response_deadline TIMESTAMP'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS seller_responded_at TIMESTAMP'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS escalated_to_admin_at TIMESTAMP'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS admin_verdict VARCHAR(30)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS admin_comment VARCHAR(2000)'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS admin_verdict_at TIMESTAMP'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS return_received_at TIMESTAMP'
-                )
-                connection.exec_driver_sql(
-                    'ALTER TABLE public.orderissue ADD COLUMN IF NOT EXISTS refund_payment_id INTEGER'
-                )
-            logger.info('OrderIssue dispute columns added: success')
-        except Exception as exc:
-            logger.warning(f"OrderIssue dispute columns add failed: {type(exc).__name__}: {exc}")
+    apply_migrations(engine)
 
 # Функция для получения сессии базы данных
 def get_session() -> Generator[Session, None, None]:
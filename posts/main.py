@@ -2,15 +2,23 @@
 
 import os
 import logging
-import asyncio
 from fastapi import FastAPI
 from fastapi import HTTPException
 from post_router_v2 import api_router
 from bought_router import bought_router
 from order_router import order_router
-from order_router import process_auto_accept_discount_disputes, process_auto_confirm_picked_up_orders
+from order_router import (
+    DELIVERY_EVENT_HANDLERS,
+    OUTBOX_SOURCE,
+    process_auto_accept_discount_disputes,
+    process_auto_confirm_picked_up_orders,
+    process_dispute_escalations,
+    sweep_metrics,
+)
 from starlette.middleware.cors import CORSMiddleware
-from database import create_db_and_tables
+from database import create_db_and_tables, engine
+from scheduler import JobScheduler
+from outbox import OutboxRelay, StreamConsumer
 from configs import Configs
 from middlewares import RequestContextMiddleware, http_exception_handler
 
@@ -20,8 +28,15 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 logger = logging.getLogger("posts.main")
-auto_dispute_task = None
-auto_confirm_task = None
+scheduler = JobScheduler(engine)
+outbox_relay = OutboxRelay(engine, Configs.REDIS_URL, OUTBOX_SOURCE)
+delivery_events_consumer = StreamConsumer(
+    engine,
+    Configs.REDIS_URL,
+    source="delivery",
+    group="posts",
+    handlers=DELIVERY_EVENT_HANDLERS,
+)
 
 # Раз при старте: проверяем загрузку Cloudflare конфигурации
 logger.info(
@@ -73,61 +88,73 @@ app.include_router(bought_router)
 app.include_router(order_router)
 
 
-async def _dispute_auto_accept_loop():
+# Фоновые задачи: каждая выполняется одной репликой за запуск (см. scheduler.py)
+scheduler.add_interval_job(
+    "posts.dispute_auto_accept",
+    process_auto_accept_discount_disputes,
+    max(5, Configs.DISPUTE_AUTO_CHECK_INTERVAL_SECONDS),
+    jitter_seconds=5,
+    run_immediately=True,
+)
+# Споры без ответа продавца до дедлайна -> админу (раньше делалось при открытии страницы заказа)
+scheduler.add_interval_job(
+    "posts.dispute_escalation",
+    process_dispute_escalations,
+    max(5, Configs.DISPUTE_AUTO_CHECK_INTERVAL_SECONDS),
+    jitter_seconds=5,
+    run_immediately=True,
+)
+# Auto-confirm orders picked_up > ORDER_AUTO_CONFIRM_HOURS ago, check every hour
+scheduler.add_interval_job(
+    "posts.order_auto_confirm",
+    process_auto_confirm_picked_up_orders,
+    3600,
+    jitter_seconds=60,
+    run_immediately=True,
+)
+
+
+@app.on_event("startup")
+async def _startup_scheduler():
     logger.info(
-        "Dispute auto-accept loop started | timeout_minutes=%s | interval_seconds=%s",
+        "Background jobs | dispute_timeout_minutes=%s | dispute_interval_seconds=%s | auto_confirm_hours=%s",
         Configs.DISPUTE_DISCOUNT_AUTO_ACCEPT_MINUTES,
         Configs.DISPUTE_AUTO_CHECK_INTERVAL_SECONDS,
+        Configs.ORDER_AUTO_CONFIRM_HOURS,
     )
-    while True:
-        try:
-            processed = await process_auto_accept_discount_disputes()
-            if processed:
-                logger.info("Dispute auto-accept processed | count=%s", processed)
-        except Exception as exc:
-            logger.warning("Dispute auto-accept loop error | error_type=%s", type(exc).__name__)
+    await scheduler.start()
+    await outbox_relay.start()
+    await delivery_events_consumer.start()
 
-        await asyncio.sleep(max(5, Configs.DISPUTE_AUTO_CHECK_INTERVAL_SECONDS))
 
-
-async def _auto_confirm_loop():
-    """Check every hour for orders to auto-confirm (picked_up > ORDER_AUTO_CONFIRM_HOURS ago)."""
-    logger.info(
-        "Auto-confirm loop started | auto_confirm_hours=%s",
-        Configs.ORDER_AUTO_CONFIRM_HOURS,
-    )
-    while True:
-        try:
-            processed = await process_auto_confirm_picked_up_orders()
-            if processed:
-                logger.info("Auto-confirm processed | count=%s", processed)
-        except Exception as exc:
-            logger.warning("Auto-confirm loop error | error_type=%s", type(exc).__name__)
-        await asyncio.sleep(3600)  # Check every hour
+@app.on_event("shutdown")
+async def _shutdown_scheduler():
+    await delivery_events_consumer.stop()
+    await outbox_relay.stop()
+    await scheduler.stop()
 
 
-@app.on_event("startup")
-async def _startup_dispute_auto_accept_task():
-    global auto_dispute_task, auto_confirm_task
-    auto_dispute_task = asyncio.create_task(_dispute_auto_accept_loop())
-    auto_confirm_task = asyncio.create_task(_auto_confirm_loop())
+@app.get("/scheduler/jobs")
+async def get_scheduler_jobs():
+    """Метрики фоновых задач этой реплики: запуски, длительность, пропуски (не лидер)."""
+    return {
+        "status": "success",
+        "data": {"jobs": scheduler.metrics(), "sweeps": sweep_metrics},
+        "request_id": "",
+    }
 
 
-@app.on_event("shutdown")
-async def _shutdown_dispute_auto_accept_task():
-    global auto_dispute_task, auto_confirm_task
-    if auto_dispute_task:
-        auto_dispute_task.cancel()
-        try:
-            await auto_dispute_task
-        except asyncio.CancelledError:
-            pass
-    if auto_confirm_task:
-        auto_confirm_task.cancel()
-        try:
-            await auto_confirm_task
-        except asyncio.CancelledError:
-            pass
+@app.get("/events/metrics")
+async def get_event_bus_metrics():
+    """Метрики шины событий: outbox relay и потребитель событий доставки (с отставанием группы)."""
+    return {
+        "status": "success",
+        "data": {
+            "outbox_relay": outbox_relay.metrics,
+            "consumers": {delivery_events_consumer.stream: await delivery_events_consumer.stats()},
+        },
+        "request_id": "",
+    }
 
 # Configuration endpoints
 @app.get("/delivery-costs")
@@ -207,7 +207,7 @@ class Order(SQLModel, table=True):
     delivery_country: Optional[str] = Field(default=None, max_length=100)
 
     pickup_code: Optional[str] = Field(default=None, max_length=10)
-    tracking_number: Optional[str] = Field(default=None, max_length=100)
+    tracking_number: Optional[str] = Field(default=None, max_length=100, index=True)
 
     status: str = Field(default=OrderStatus.PENDING_PAYMENT.value, max_length=20, index=True)
 
@@ -295,6 +295,32 @@ class User(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 
+class SellerStats(SQLModel, table=True):
+    """Инкрементальные агрегаты продавца: обновляются в той же транзакции, что и отзыв/продажа."""
+    __tablename__ = "seller_stats"
+
+    seller_id: int = Field(primary_key=True)
+    review_count: int = Field(default=0, ge=0)
+    rating_sum: int = Field(default=0, ge=0)
+    sells_count: int = Field(default=0, ge=0)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class OrderTrackingView(SQLModel, table=True):
+    """Денормализованная проекция публичной страницы заказа (см. order_tracking_view.py)."""
+    __tablename__ = "order_tracking_view"
+
+    order_id: int = Field(primary_key=True)
+    tracking_number: Optional[str] = Field(default=None, max_length=100, unique=True, index=True)
+    seller_id: int = Field()
+    buyer_id: Optional[int] = Field(default=None)
+    status: str = Field(max_length=20)
+    page: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+    delivery: Optional[Dict[str, Any]] = Field(default=None, sa_column=Column(JSON))
+    delivery_synced_at: Optional[datetime] = Field(default=None)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
 class OrderIssueType(str, Enum):
     COMPLAINT = "complaint"
     RETURN = "return"
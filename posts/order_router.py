@@ -1,10 +1,14 @@
 # order_router.py - Роутер для системы покупки и доставки
 
+import asyncio
 import logging
 import os
+import time
 from fastapi import APIRouter, Depends, HTTPException, Request, Cookie, Query, UploadFile, File, Form
 from fastapi.responses import RedirectResponse
 from sqlmodel import Session, select
+from sqlalchemy import func, literal_column, update
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from typing import Optional, Any, Dict, List
 from jose import jwt
@@ -14,19 +18,30 @@ import uuid
 from datetime import datetime, timedelta
 import httpx
 
-from database import get_session, engine
+from database import USE_POSTGRES, get_session, engine
 from models_v2 import (
     Order, OrderCreate, OrderResponse,
     Product, DeliveryMethod, OrderStatus, User,
-    OrderReview, OrderIssue, OrderPageReviewCreate,
+    OrderIssue, OrderPageReviewCreate,
     OrderIssueCreate, OrderIssueStatus, PostReport,
     SellerDisputeAction, AdminDisputeVerdict
 )
 from configs import Configs
 from cloudflare_r2 import r2_client
+from post_service_v2 import TTLCache, listings_cache
+from seller_stats_service import record_seller_review, record_seller_sale
+from outbox import add_outbox_event
+from order_tracking_view import (
+    expire_tracking_delivery, load_tracking_view, mark_tracking_view_stale,
+    product_name, store_tracking_delivery, tracking_delivery_is_stale
+)
 
 order_router = APIRouter(prefix="/api/v1/orders", tags=["Orders"])
 logger = logging.getLogger("posts.order_router")
+admin_stats_cache = TTLCache(ttl_seconds=Configs.ADMIN_STATS_CACHE_TTL_SECONDS)
+
+# Источник событий posts-service в outbox (поток events:posts)
+OUTBOX_SOURCE = "posts"
 
 
 def safe_exception_name(exc: Exception) -> str:
@@ -46,13 +61,6 @@ def extract_pg_integrity_meta(exc: IntegrityError) -> dict:
     }
 
 
-def product_name(product: Optional[Product]) -> str:
-    if not product:
-        return "Product"
-    attrs = product.attributes or {}
-    return attrs.get("model") or product.title or "Product"
-
-
 def product_model_text(product: Optional[Product]) -> Optional[str]:
     if not product:
         return None
@@ -64,34 +72,13 @@ def product_model_text(product: Optional[Product]) -> Optional[str]:
     return None
 
 
-async def send_notification_async(endpoint: str, data: dict):
-    """Асинхронная отправка уведомления через notification service"""
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            # Используем прямой endpoint для отправки SMS
-            response = await client.post(
-                f"{Configs.NOTIFICATION_SERVICE_URL}/api/v1/notifications/{endpoint}",
-                json=data
-            )
-            if response.status_code == 200:
-                result = response.json()
-                logger.info(
-                    f"Notification sent | type={endpoint} | order_id={data.get('order_id')} | "
-                    f"ids={result.get('notification_ids', [])}"
-                )
-                return result
-            else:
-                logger.warning(
-                    f"Notification failed | type={endpoint} | order_id={data.get('order_id')} | "
-                    f"HTTP {response.status_code}"
-                )
-                return None
-    except Exception as e:
-        logger.error(
-            f"Notification error | type={endpoint} | order_id={data.get('order_id')} | "
-            f"error_type={safe_exception_name(e)}"
-        )
-        return None
+def queue_notification(db: Session, endpoint: str, data: dict) -> None:
+    """Ставит уведомление в outbox текущей транзакции db.
+
+    notifications-service получит его из потока events:posts (тип notification.<endpoint>)
+    после коммита — ответ пользователю не ждёт notifications-service.
+    """
+    add_outbox_event(db, OUTBOX_SOURCE, f"notification.{endpoint}", data)
 
 
 async def get_delivery_info(order_id: int) -> Optional[dict]:
@@ -319,7 +306,7 @@ def _build_dispute_notification_data(db: Session, order: Order, dispute: OrderIs
     }
 
 
-async def _send_dispute_event_notification(
+def _queue_dispute_event_notification(
     db: Session,
     order: Order,
     dispute: OrderIssue,
@@ -333,7 +320,7 @@ async def _send_dispute_event_notification(
         payload["event_type"] = event_type
         if verdict:
             payload["verdict"] = verdict
-        await send_notification_async("dispute-event", payload)
+        queue_notification(db, "dispute-event", payload)
     except Exception as exc:
         logger.warning(
             f"Dispute notification skipped | order_id={order.id} | dispute_id={dispute.id} | event={event_type} | error_type={safe_exception_name(exc)}"
@@ -406,15 +393,14 @@ async def _accept_discount_and_close_dispute(
     dispute.updated_at = now
     _sync_dispute_report_status(db, dispute, "resolved")
     db.add(dispute)
-    db.commit()
-    db.refresh(dispute)
-
-    await _send_dispute_event_notification(
+    _queue_dispute_event_notification(
         db,
         order,
         dispute,
         "dispute_discount_closed_seller",
     )
+    db.commit()
+    db.refresh(dispute)
 
     return {
         "discount_amount": discount_value,
@@ -516,121 +502,280 @@ async def _finalize_return_received_and_refund(db: Session, order: Order, disput
     }
 
 
-async def process_auto_accept_discount_disputes() -> int:
-    now = datetime.utcnow()
-    threshold = now - timedelta(minutes=Configs.DISPUTE_DISCOUNT_AUTO_ACCEPT_MINUTES)
-    processed = 0
+# Статусы спора, при которых заказ нельзя авто-подтверждать
+_ACTIVE_DISPUTE_STATUSES = [
+    OrderIssueStatus.OPEN.value,
+    OrderIssueStatus.IN_REVIEW.value,
+    OrderIssueStatus.SELLER_RESPONDED.value,
+    OrderIssueStatus.AWAITING_RETURN.value,
+]
+
+# Метрики последнего прогона фоновых sweep-задач (по имени задачи)
+sweep_metrics: Dict[str, Dict[str, Any]] = {}
+
+
+def _record_sweep_metrics(name: str, started: float, *, claimed: int, processed: int, failed: int, batches: int) -> None:
+    duration = time.monotonic() - started
+    metrics = {
+        "claimed": claimed,
+        "processed": processed,
+        "failed": failed,
+        "batches": batches,
+        "duration_ms": int(duration * 1000),
+        "throughput_per_s": round(processed / duration, 2) if duration > 0 else None,
+        "finished_at": datetime.utcnow().isoformat(),
+    }
+    sweep_metrics[name] = metrics
+    if claimed:
+        logger.info(
+            f"Sweep finished | name={name} | claimed={claimed} | processed={processed} | failed={failed} | "
+            f"batches={batches} | duration_ms={metrics['duration_ms']} | throughput_per_s={metrics['throughput_per_s']}"
+        )
 
+
+async def _run_bounded(items: List[Any], worker, concurrency: int) -> List[bool]:
+    """Запускает worker(item) для всех items, не больше concurrency одновременно."""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _guarded(item: Any) -> bool:
+        async with semaphore:
+            return await worker(item)
+
+    return await asyncio.gather(*[_guarded(item) for item in items])
+
+
+async def _auto_accept_dispute(dispute_id: int) -> bool:
+    # Своя сессия на спор: строка спора захватывается FOR UPDATE SKIP LOCKED и держится
+    # до коммита, поэтому параллельная реплика этот же спор не возьмёт
     with Session(engine) as db:
-        stale_disputes = db.exec(
-            select(OrderIssue).where(
+        dispute = db.exec(
+            select(OrderIssue)
+            .where(
+                OrderIssue.id == dispute_id,
                 OrderIssue.status == OrderIssueStatus.SELLER_RESPONDED.value,
-                OrderIssue.seller_response_action == SellerDisputeAction.OFFER_DISCOUNT.value,
-                OrderIssue.seller_responded_at != None,
-                OrderIssue.seller_responded_at <= threshold,
             )
-        ).all()
+            .with_for_update(skip_locked=True)
+        ).first()
+        if not dispute:
+            return False
 
-        for dispute in stale_disputes:
-            order = db.get(Order, dispute.order_id)
-            if not order:
-                continue
+        order = db.get(Order, dispute.order_id)
+        if not order:
+            db.rollback()
+            return False
 
-            try:
-                await _accept_discount_and_close_dispute(
-                    db,
-                    order,
-                    dispute,
-                    source="discount_auto_accept_timeout",
-                )
-                processed += 1
-                logger.info(
-                    f"Dispute auto-accepted | order_id={order.id} | dispute_id={dispute.id} | timeout_minutes={Configs.DISPUTE_DISCOUNT_AUTO_ACCEPT_MINUTES}"
-                )
-            except Exception as exc:
-                logger.warning(
-                    f"Dispute auto-accept failed | order_id={order.id} | dispute_id={dispute.id} | error_type={safe_exception_name(exc)}"
+        try:
+            await _accept_discount_and_close_dispute(
+                db,
+                order,
+                dispute,
+                source="discount_auto_accept_timeout",
+            )
+            logger.info(
+                f"Dispute auto-accepted | order_id={order.id} | dispute_id={dispute.id} | timeout_minutes={Configs.DISPUTE_DISCOUNT_AUTO_ACCEPT_MINUTES}"
+            )
+            return True
+        except Exception as exc:
+            db.rollback()
+            logger.warning(
+                f"Dispute auto-accept failed | order_id={order.id} | dispute_id={dispute_id} | error_type={safe_exception_name(exc)}"
+            )
+            return False
+
+
+async def process_auto_accept_discount_disputes() -> int:
+    started = time.monotonic()
+    threshold = datetime.utcnow() - timedelta(minutes=Configs.DISPUTE_DISCOUNT_AUTO_ACCEPT_MINUTES)
+    batch_size = Configs.AUTO_SWEEP_BATCH_SIZE
+    claimed = processed = failed = batches = 0
+    last_id = 0
+
+    while True:
+        # Один запрос на батч: только id подходящих споров, у которых есть заказ
+        with Session(engine) as db:
+            dispute_ids = db.exec(
+                select(OrderIssue.id)
+                .join(Order, Order.id == OrderIssue.order_id)
+                .where(
+                    OrderIssue.id > last_id,
+                    OrderIssue.status == OrderIssueStatus.SELLER_RESPONDED.value,
+                    OrderIssue.seller_response_action == SellerDisputeAction.OFFER_DISCOUNT.value,
+                    OrderIssue.seller_responded_at != None,
+                    OrderIssue.seller_responded_at <= threshold,
                 )
+                .order_by(OrderIssue.id)
+                .limit(batch_size)
+            ).all()
+        if not dispute_ids:
+            break
 
+        batches += 1
+        last_id = dispute_ids[-1]
+        results = await _run_bounded(dispute_ids, _auto_accept_dispute, Configs.AUTO_SWEEP_CONCURRENCY)
+        claimed += len(dispute_ids)
+        processed += sum(1 for ok in results if ok)
+        failed += sum(1 for ok in results if not ok)
+
+        if len(dispute_ids) < batch_size:
+            break
+
+    _record_sweep_metrics(
+        "dispute_auto_accept", started, claimed=claimed, processed=processed, failed=failed, batches=batches
+    )
     return processed
 
 
-async def _release_payment_for_order(order_id: int) -> None:
+async def process_dispute_escalations() -> int:
+    """Передаёт админу споры, по которым продавец не ответил до seller_response_deadline."""
+    started = time.monotonic()
+    batch_size = Configs.AUTO_SWEEP_BATCH_SIZE
+    claimed = batches = 0
+
+    while True:
+        now = datetime.utcnow()
+        with Session(engine) as db:
+            disputes = db.exec(
+                select(OrderIssue)
+                .where(
+                    OrderIssue.status == OrderIssueStatus.OPEN.value,
+                    OrderIssue.seller_response_deadline != None,
+                    OrderIssue.seller_response_deadline < now,
+                )
+                .order_by(OrderIssue.seller_response_deadline)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not disputes:
+                break
+
+            for dispute in disputes:
+                dispute.status = OrderIssueStatus.IN_REVIEW.value
+                dispute.escalated_to_admin_at = dispute.escalated_to_admin_at or now
+                dispute.updated_at = now
+                _sync_dispute_report_status(db, dispute, "pending")
+                db.add(dispute)
+            db.commit()
+
+        batches += 1
+        claimed += len(disputes)
+        if len(disputes) < batch_size:
+            break
+
+    _record_sweep_metrics(
+        "dispute_escalation", started, claimed=claimed, processed=claimed, failed=0, batches=batches
+    )
+    return claimed
+
+
+async def _release_payment_for_order(order_id: int, client: Optional[httpx.AsyncClient] = None) -> bool:
     """Call payments-service to transfer held funds to seller."""
+    if client is None:
+        async with httpx.AsyncClient(timeout=10.0) as own_client:
+            return await _release_payment_for_order(order_id, own_client)
+
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{Configs.PAYMENT_SERVICE_URL}/api/v1/payments/order/{order_id}"
-            )
-            if resp.status_code != 200:
-                logger.warning(f"Release payment: lookup failed | order_id={order_id} | status={resp.status_code}")
-                return
-            data = resp.json()
-            payment = data.get("data", data)
-            payment_id = payment.get("id")
-            if not payment_id:
-                logger.warning(f"Release payment: no payment_id | order_id={order_id}")
-                return
-            release_resp = await client.post(
-                f"{Configs.PAYMENT_SERVICE_URL}/api/v1/payments/{payment_id}/release-to-seller"
-            )
-            if release_resp.status_code in (200, 202):
-                logger.info(f"Payment released to seller | order_id={order_id} | payment_id={payment_id}")
-            else:
-                logger.warning(f"Release payment failed | order_id={order_id} | payment_id={payment_id} | status={release_resp.status_code} | body={release_resp.text[:200]}")
+        resp = await client.get(
+            f"{Configs.PAYMENT_SERVICE_URL}/api/v1/payments/order/{order_id}"
+        )
+        if resp.status_code != 200:
+            logger.warning(f"Release payment: lookup failed | order_id={order_id} | status={resp.status_code}")
+            return False
+        data = resp.json()
+        payment = data.get("data", data)
+        payment_id = payment.get("id")
+        if not payment_id:
+            logger.warning(f"Release payment: no payment_id | order_id={order_id}")
+            return False
+        release_resp = await client.post(
+            f"{Configs.PAYMENT_SERVICE_URL}/api/v1/payments/{payment_id}/release-to-seller"
+        )
+        if release_resp.status_code in (200, 202):
+            logger.info(f"Payment released to seller | order_id={order_id} | payment_id={payment_id}")
+            return True
+        logger.warning(f"Release payment failed | order_id={order_id} | payment_id={payment_id} | status={release_resp.status_code} | body={release_resp.text[:200]}")
+        return False
     except Exception as exc:
         logger.warning(f"Release payment error | order_id={order_id} | error={safe_exception_name(exc)}")
+        return False
+
 
 async def process_auto_confirm_picked_up_orders() -> int:
-    """Auto-confirm orders that have been in picked_up status for > 24h with no active dispute."""
-    now = datetime.utcnow()
-    threshold = now - timedelta(hours=Configs.ORDER_AUTO_CONFIRM_HOURS)
-    processed = 0
+    """Auto-confirm orders that have been in picked_up status for > 24h with no active dispute.
 
-    with Session(engine) as db:
-        stale_orders = db.exec(
-            select(Order).where(
-                Order.status == OrderStatus.PICKED_UP.value,
-                Order.order_confirmed_at == None,
-                Order.delivered_at != None,
-                Order.delivered_at <= threshold,
+    Заказы захватываются батчами одним UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED)
+    с anti-join по активным спорам, затем выплаты продавцам идут с ограниченной параллельностью.
+    """
+    started = time.monotonic()
+    batch_size = Configs.AUTO_SWEEP_BATCH_SIZE
+    claimed = processed = failed = batches = 0
+
+    async with httpx.AsyncClient(timeout=10.0) as client:
+        while True:
+            now = datetime.utcnow()
+            threshold = now - timedelta(hours=Configs.ORDER_AUTO_CONFIRM_HOURS)
+            # Алиас: иначе подзапрос скоррелируется с таблицей самого UPDATE
+            candidate = aliased(Order)
+            active_dispute = (
+                select(OrderIssue.id)
+                .where(
+                    OrderIssue.order_id == candidate.id,
+                    OrderIssue.status.in_(_ACTIVE_DISPUTE_STATUSES),
+                )
+                .exists()
             )
-        ).all()
-
-        for order in stale_orders:
-            active_dispute = db.exec(
-                select(OrderIssue).where(
-                    OrderIssue.order_id == order.id,
-                    OrderIssue.status.in_([
-                        OrderIssueStatus.OPEN.value,
-                        OrderIssueStatus.IN_REVIEW.value,
-                        OrderIssueStatus.SELLER_RESPONDED.value,
-                        OrderIssueStatus.AWAITING_RETURN.value,
-                    ])
+            eligible_ids = (
+                select(candidate.id)
+                .where(
+                    candidate.status == OrderStatus.PICKED_UP.value,
+                    candidate.order_confirmed_at == None,
+                    candidate.delivered_at != None,
+                    candidate.delivered_at <= threshold,
+                    ~active_dispute,
                 )
-            ).first()
-            if active_dispute:
-                continue
+                .order_by(candidate.delivered_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
 
-            try:
-                order.order_confirmed_at = now
-                order.confirmed_by_buyer = True
-                order.status = OrderStatus.CONFIRMED.value
-                order.completed_at = now
-                db.add(order)
+            with Session(engine) as db:
+                confirmed_rows = db.execute(
+                    update(Order)
+                    .where(Order.id.in_(eligible_ids.scalar_subquery()))
+                    .values(
+                        order_confirmed_at=now,
+                        confirmed_by_buyer=True,
+                        status=OrderStatus.CONFIRMED.value,
+                        completed_at=now,
+                    )
+                    .returning(Order.id, Order.delivery_method)
+                    .execution_options(synchronize_session=False)
+                ).all()
+                for order_id, _ in confirmed_rows:
+                    mark_tracking_view_stale(db, order_id)
                 db.commit()
 
-                await _release_payment_for_order(order.id)
-                processed += 1
-                logger.info(
-                    f"Order auto-confirmed | order_id={order.id} | "
-                    f"delivered_at={order.delivered_at} | method={order.delivery_method}"
-                )
-            except Exception as exc:
-                logger.warning(
-                    f"Order auto-confirm failed | order_id={order.id} | error_type={safe_exception_name(exc)}"
-                )
+            if not confirmed_rows:
+                break
+
+            batches += 1
+            claimed += len(confirmed_rows)
+            for order_id, delivery_method in confirmed_rows:
+                logger.info(f"Order auto-confirmed | order_id={order_id} | method={delivery_method}")
+
+            results = await _run_bounded(
+                [order_id for order_id, _ in confirmed_rows],
+                lambda order_id: _release_payment_for_order(order_id, client),
+                Configs.AUTO_SWEEP_CONCURRENCY,
+            )
+            processed += len(confirmed_rows)
+            failed += sum(1 for ok in results if not ok)
 
+            if len(confirmed_rows) < batch_size:
+                break
+
+    _record_sweep_metrics(
+        "order_auto_confirm", started, claimed=claimed, processed=processed, failed=failed, batches=batches
+    )
     return processed
 
 async def finalize_order_after_successful_payment(
@@ -656,8 +801,40 @@ async def finalize_order_after_successful_payment(
     if post:
         post.active = False
 
+    # === ФАЗА 3: УВЕДОМЛЕНИЕ ПРОДАВЦУ ДЛЯ PERSONAL_PICKUP ===
+    if order.delivery_method == "personal_pickup":
+        try:
+            post = db.get(Product, order.post_id)
+            seller = db.get(User, order.seller_id)
+            
+            # Получаем данные о встрече из атрибутов товара
+            meeting_address = post.attributes.get("seller_meeting_address", "Адрес не указан") if post and post.attributes else "Адрес не указан"
+            contact_preference = post.attributes.get("seller_contact_preference", "email") if post and post.attributes else "email"
+            
+            seller_notification_data = {
+                "order_id": order.id,
+                "seller_id": order.seller_id,
+                "seller_email": seller.email if seller else None,
+                "seller_phone": seller.phone if seller else None,
+                "buyer_name": f"{order.buyer_first_name} {order.buyer_last_name}",
+                "buyer_email": order.buyer_email,
+                "buyer_phone": order.buyer_phone,
+                "meeting_address": meeting_address,
+                "contact_preference": contact_preference,
+                "product_name": product_name(post),
+            }
+            
+            # Отправляем специальное уведомление для личной встречи
+            queue_notification(db, "pickup-notification", seller_notification_data)
+            logger.info(f"Pickup notification queued | order_id={order.id} | seller_id={order.seller_id}")
+        except Exception as e:
+            logger.warning(
+                f"Pickup notification failed | order_id={order.id} | error_type={safe_exception_name(e)}"
+            )
+
     db.commit()
     db.refresh(order)
+    listings_cache.invalidate()
 
     if order.delivery_method in [DeliveryMethod.DPD.value, DeliveryMethod.OMNIVA.value]:
         logger.info(f"Delivery create | order_id={order.id} | method={order.delivery_method}")
@@ -692,17 +869,9 @@ async def finalize_order_after_successful_payment(
                 if response.status_code == 201:
                     delivery_info = response.json()
                     order.tracking_number = delivery_info.get("tracking_number")
-                    db.commit()
-                    logger.info(f"Delivery created | order_id={order.id}")
 
                     # Trigger DPD simulation — Stripe webhook may not fire in test/dev mode
-                    try:
-                        async with httpx.AsyncClient(timeout=3.0) as sim_client:
-                            await sim_client.post(
-                                f"{Configs.DELIVERY_SERVICE_URL}/api/v1/delivery/orders/{order.id}/after-payment"
-                            )
-                    except Exception:
-                        pass
+                    add_outbox_event(db, OUTBOX_SOURCE, "order.paid", {"order_id": order.id})
 
                     try:
                         seller = db.get(User, order.seller_id)
@@ -725,7 +894,7 @@ async def finalize_order_after_successful_payment(
                             "tracking_number": order.tracking_number,
                             "language": lang,
                         }
-                        await send_notification_async("order-paid", notification_data)
+                        queue_notification(db, "order-paid", notification_data)
                         
                         # 🔑 PIN-код для DPD PICKUP: отправляем SMS продавцу
                         pin_code = delivery_info.get("pickup_code")
@@ -740,9 +909,9 @@ async def finalize_order_after_successful_payment(
                                     "tracking_number": order.tracking_number,
                                     "language": lang,
                                 }
-                                await send_notification_async("dpd-pin-code", pin_notification_data)
+                                queue_notification(db, "dpd-pin-code", pin_notification_data)
                                 logger.info(
-                                    f"PIN code SMS sent to seller | order_id={order.id} | seller_id={seller.id} | pin={pin_code}"
+                                    f"PIN code SMS queued for seller | order_id={order.id} | seller_id={seller.id} | pin={pin_code}"
                                 )
                             else:
                                 logger.warning(
@@ -753,6 +922,9 @@ async def finalize_order_after_successful_payment(
                             f"Payment notification failed | order_id={order.id} | error_type={safe_exception_name(e)}"
                         )
 
+                    db.commit()
+                    logger.info(f"Delivery created | order_id={order.id}")
+
                     return f"{Configs.FRONTEND_URL.rstrip('/')}/order?tracking={order.tracking_number}"
                 else:
                     # ❌ ОТКАТ: Доставка не создана - откатываем заказ и платёж
@@ -775,6 +947,7 @@ async def finalize_order_after_successful_payment(
                         post.active = True
                     order.status = OrderStatus.FAILURE.value
                     db.commit()
+                    listings_cache.invalidate()
                     
                     # Отправляем запрос на возврат платежа
                     try:
@@ -837,41 +1010,11 @@ async def finalize_order_after_successful_payment(
             if post:
                 post.active = True
             db.commit()
+            listings_cache.invalidate()
             return f"{Configs.FRONTEND_URL.rstrip('/')}/my-orders?order_id={order.id}&payment=failure"
     else:
         logger.info(f"Delivery skipped | order_id={order.id} | method={order.delivery_method}")
 
-    # === ФАЗА 3: УВЕДОМЛЕНИЕ ПРОДАВЦУ ДЛЯ PERSONAL_PICKUP ===
-    if order.delivery_method == "personal_pickup":
-        try:
-            post = db.get(Product, order.post_id)
-            seller = db.get(User, order.seller_id)
-            
-            # Получаем данные о встрече из атрибутов товара
-            meeting_address = post.attributes.get("seller_meeting_address", "Адрес не указан") if post and post.attributes else "Адрес не указан"
-            contact_preference = post.attributes.get("seller_contact_preference", "email") if post and post.attributes else "email"
-            
-            seller_notification_data = {
-                "order_id": order.id,
-                "seller_id": order.seller_id,
-                "seller_email": seller.email if seller else None,
-                "seller_phone": seller.phone if seller else None,
-                "buyer_name": f"{order.buyer_first_name} {order.buyer_last_name}",
-                "buyer_email": order.buyer_email,
-                "buyer_phone": order.buyer_phone,
-                "meeting_address": meeting_address,
-                "contact_preference": contact_preference,
-                "product_name": product_name(post),
-            }
-            
-            # Отправляем специальное уведомление для личной встречи
-            await send_notification_async("pickup-notification", seller_notification_data)
-            logger.info(f"Pickup notification sent | order_id={order.id} | seller_id={order.seller_id}")
-        except Exception as e:
-            logger.warning(
-                f"Pickup notification failed | order_id={order.id} | error_type={safe_exception_name(e)}"
-            )
-
     if not order.tracking_number:
         order.tracking_number = f"ORD{order.id}"
         db.commit()
@@ -1073,7 +1216,7 @@ async def create_order(
             }
             
             # Примечание: уведомления отправляются после оплаты в /pay endpoint
-            # await send_notification_async("order-paid", notification_data)
+            # queue_notification(db, "order-paid", notification_data)
             
         except Exception as e:
             logger.warning(
@@ -1336,226 +1479,51 @@ async def get_order_page_by_tracking(
     - текущую стадию доставки
     - отзыв (если оставлен)
     - жалобы/возвраты по заказу
-    """
-    order = db.exec(
-        select(Order).where(Order.tracking_number == tracking_number)
-    ).first()
-
-    # Fallback: поддерживаем старые/альтернативные ссылки вида /orders/{order_id} или /orders/ORD{order_id}
-    if not order:
-        resolved_order_id = None
-
-        if tracking_number.isdigit():
-            resolved_order_id = int(tracking_number)
-        elif tracking_number.startswith("ORD") and tracking_number[3:].isdigit():
-            resolved_order_id = int(tracking_number[3:])
-
-        if resolved_order_id is not None:
-            order = db.get(Order, resolved_order_id)
 
-    delivery_data = await get_delivery_by_tracking(tracking_number)
+    Данные читаются из проекции order_tracking_view (см. order_tracking_view.py);
+    здесь только дорисовываются поля, зависящие от текущего пользователя.
+    """
+    view = load_tracking_view(db, tracking_number)
 
-    if not order and delivery_data:
-        order = db.get(Order, delivery_data.get("order_id"))
+    if view is None:
+        # Последний шанс: заказ известен только delivery-service (например, по трек-номеру DPD)
+        delivery_data = await get_delivery_by_tracking(tracking_number)
+        if delivery_data and delivery_data.get("order_id"):
+            view = load_tracking_view(db, tracking_number, order_id=delivery_data["order_id"])
+            if view is not None:
+                view = store_tracking_delivery(db, tracking_number, view, delivery_data)
 
-    if not order:
+    if view is None:
         raise HTTPException(status_code=404, detail="Заказ не найден")
 
-    post = db.get(Product, order.post_id)
-
-    review = db.exec(
-        select(OrderReview).where(OrderReview.order_id == order.id)
-    ).first()
-
-    issues = db.exec(
-        select(OrderIssue)
-        .where(OrderIssue.order_id == order.id)
-        .order_by(OrderIssue.created_at.desc())
-    ).all()
-
-    now_utc = datetime.utcnow()
-    escalated_any = False
-    for issue in issues:
-        if (
-            issue.status == OrderIssueStatus.OPEN.value
-            and issue.seller_response_deadline
-            and issue.seller_response_deadline < now_utc
-        ):
-            issue.status = OrderIssueStatus.IN_REVIEW.value
-            issue.escalated_to_admin_at = issue.escalated_to_admin_at or now_utc
-            issue.updated_at = now_utc
-            _sync_dispute_report_status(db, issue, "pending")
-            db.add(issue)
-            escalated_any = True
-
-    if escalated_any:
-        db.commit()
-
-    status_stage_map = {
-        OrderStatus.PENDING_PAYMENT.value: "payment_pending",
-        OrderStatus.PAID.value: "paid",
-        OrderStatus.IN_TRANSIT.value: "in_transit",
-        OrderStatus.READY_FOR_PICKUP.value: "ready_for_pickup",
-        OrderStatus.PICKED_UP.value: "picked_up",
-        OrderStatus.CONFIRMED.value: "confirmed",
-        OrderStatus.CANCELLED.value: "cancelled",
-        OrderStatus.FAILURE.value: "failure",
-        OrderStatus.REFUNDED.value: "refunded"
-    }
-
-    # Используем order.status как источник истины (это обновляется мгновенно при подтверждении)
-    # delivery.status может быть асинхронно синхронизирован
-    
-    # === КОНСИСТЕНТНОСТЬ: Проверяем и синхронизируем расходящиеся статусы ===
-    # ВАЖНО: Синхронизируем ТОЛЬКО если order еще не подтвержден!
-    # Идея: delivery -> order (одностороннее)
-    # Не перезаписываем if order.status == CONFIRMED
-    if delivery_data:
-        delivery_status = delivery_data.get("status")
-        order_status = order.status
-
-        _TERMINAL_ORDER_STATUSES = {
-            OrderStatus.CONFIRMED.value,
-            OrderStatus.REFUNDED.value,
-            OrderStatus.CANCELLED.value,
-        }
+    if tracking_delivery_is_stale(view):
+        delivery_data = await get_delivery_by_tracking(tracking_number)
+        view = store_tracking_delivery(db, tracking_number, view, delivery_data)
 
-        if delivery_status and delivery_status != order_status:
-            if order_status not in _TERMINAL_ORDER_STATUSES:
-                logger.warning(
-                    f"Status mismatch | tracking={tracking_number} | order_status={order_status} | delivery_status={delivery_status}"
-                )
-
-            # Если доставка уже прошла в статус picked_up, но order еще не обновлен (и еще не подтвержден), обновляем order
-            # ВАЖНО: Не перезаписываем если order уже был подтвержден (status == CONFIRMED)
-            if delivery_status == "picked_up" and order_status not in [OrderStatus.PICKED_UP.value, OrderStatus.CONFIRMED.value]:
-                logger.info(
-                    f"Auto-syncing order status | tracking={tracking_number} | from {order_status} to picked_up"
-                )
-                order.status = OrderStatus.PICKED_UP.value
-                order.delivered_at = datetime.utcnow()
-                db.add(order)
-                db.commit()
-                db.refresh(order)
-    
-    # ВАЖНО: Если пользователь подтвердил заказ (order_confirmed_at != None),
-    # то effective_status = CONFIRMED, даже если order.status в БД еще не обновился!
-    # Это критично для правильного расчета actions в frontend
-    effective_status = OrderStatus.CONFIRMED.value if order.order_confirmed_at is not None else order.status
-
-    # SECURITY: Передаем данные продавца о встречи и контактах ТОЛЬКО если заказ еще не забран (not picked_up)
-    seller_meeting_address = None
-    seller_contact_preference = None
-    seller_phone = None
-    seller_email = None
-    
-    # SECURITY: Отправляем контакты ТОЛЬКО если:
-    # 1. Это личная встреча (pickup)
-    # 2. Заказ еще НЕ забран (picked_up)
-    # 3. Заказ еще НЕ подтвержден (confirmed)
-    if (order.delivery_method == "pickup" and 
-        effective_status != "picked_up" and 
-        effective_status != "confirmed"):
-        # Получаем данные продавца из attributes поста
-        if post and post.attributes:
-            seller_meeting_address = post.attributes.get("seller_meeting_address")
-            seller_contact_preference = post.attributes.get("seller_contact_preference")
-            seller_phone = post.attributes.get("seller_phone")
-            seller_email = post.attributes.get("seller_email")
-
-    # === ДИНАМИЧЕСКАЯ ЛОГИКА: Видимость форм зависит от статуса ===
-    is_pickup = order.delivery_method == "pickup"
-    is_delivery = order.delivery_method in ["dpd", "omniva"]
-    order_confirmed = order.order_confirmed_at is not None
-    
-    # PICKUP: жалоба ДО подтверждения (status=PAID и заказ не подтвержден)
-    can_open_issue_pickup = effective_status == OrderStatus.PAID.value and not order_confirmed
-    
-    # DPD/OMNIVA: жалоба ТОЛЬКО когда забран (status=PICKED_UP и заказ не подтвержден)
-    can_open_issue_delivery = effective_status == OrderStatus.PICKED_UP.value and not order_confirmed
-    
-    # Выбираем правильное значение в зависимости от способа доставки
-    if is_pickup:
-        can_open_issue = can_open_issue_pickup
-    elif is_delivery:
-        can_open_issue = can_open_issue_delivery
-    else:
-        can_open_issue = False
-    
-    # Отзыв: ТОЛЬКО если заказ подтвержден И еще нет отзыва
-    # (order.review_rating = None гарантирует один отзыв)
-    can_leave_review = order_confirmed and order.review_rating is None
+    page = view["page"]
 
     current_user = _decode_user_optional(access_token)
     current_user_id = current_user.get("user_id") if current_user else None
     current_user_type = current_user.get("user_type") if current_user else "guest"
-    is_seller = bool(current_user_id and order.seller_id == current_user_id)
-    is_buyer = bool(current_user_id and order.buyer_id == current_user_id)
+    is_seller = bool(current_user_id and view["seller_id"] == current_user_id)
+    is_buyer = bool(current_user_id and view["buyer_id"] == current_user_id)
     is_admin = current_user_type in ["admin", "support"]
 
-    active_disputes = [item for item in issues if item.status in [OrderIssueStatus.OPEN.value, OrderIssueStatus.IN_REVIEW.value, OrderIssueStatus.AWAITING_RETURN.value]]
+    now_utc = datetime.utcnow()
     can_seller_respond_dispute = is_seller and any(
-        item.status == OrderIssueStatus.OPEN.value and
-        item.seller_response_deadline and item.seller_response_deadline >= datetime.utcnow()
-        for item in active_disputes
+        item["status"] == OrderIssueStatus.OPEN.value and
+        item["seller_response_deadline"] and
+        datetime.fromisoformat(item["seller_response_deadline"]) >= now_utc
+        for item in page["issues"]
     )
-    
+
     return {
-        "order": {
-            "order_id": order.id,
-            "post_id": order.post_id,
-            "tracking_number": order.tracking_number,
-            "status": effective_status,
-            "delivery_method": order.delivery_method,
-            "product_name": product_name(post),
-            "price": order.price,
-            "created_at": order.created_at,
-            "paid_at": order.paid_at,
-            "shipped_at": order.shipped_at,
-            "delivered_at": order.delivered_at,
-            "completed_at": order.completed_at,
-            "order_confirmed_at": order.order_confirmed_at,  # ✅ ДОБАВЛЕНО: Критично для frontend!
-            "review_rating": order.review_rating,            # ✅ ДОБАВЛЕНО: Для проверки один раз
-            # SECURITY: Продавец информация о встречи
-            "seller_meeting_address": seller_meeting_address,
-            "seller_contact_preference": seller_contact_preference,
-            "seller_phone": seller_phone,
-            "seller_email": seller_email
-        },
-        "delivery": delivery_data,
-        "review": {
-            "id": review.id if review else order.id,
-            "rating": order.review_rating if order.review_rating is not None else (review.seller_rating if review else None),
-            "review_text": order.review_text if order.review_text is not None else (review.review_text if review else None),
-            "updated_at": review.updated_at if review else order.completed_at or order.delivered_at or order.created_at
-        } if order.review_rating is not None or order.review_text or review else None,
-        "issues": [
-            {
-                "id": issue.id,
-                "issue_type": issue.issue_type,
-                "reason": issue.reason,
-                "description": issue.description,
-                "status": issue.status,
-                "buyer_media_urls": issue.buyer_media_urls or [],
-                "seller_response_action": issue.seller_response_action,
-                "seller_response_text": issue.seller_response_text,
-                "seller_discount_amount": issue.seller_discount_amount,
-                "seller_media_urls": issue.seller_media_urls or [],
-                "seller_response_deadline": issue.seller_response_deadline,
-                "seller_responded_at": issue.seller_responded_at,
-                "escalated_to_admin_at": issue.escalated_to_admin_at,
-                "admin_verdict": issue.admin_verdict,
-                "admin_comment": issue.admin_comment,
-                "admin_verdict_at": issue.admin_verdict_at,
-                "return_received_at": issue.return_received_at,
-                "created_at": issue.created_at,
-                "updated_at": issue.updated_at
-            }
-            for issue in issues
-        ],
+        "order": page["order"],
+        "delivery": view["delivery"],
+        "review": page["review"],
+        "issues": page["issues"],
         "actions": {
-            "can_leave_review": can_leave_review,      # ✅ ДИНАМИЧЕСКОЕ: зависит от статуса
-            "can_open_issue": can_open_issue,
+            **page["actions"],
             "can_seller_respond_dispute": can_seller_respond_dispute,
             "current_user_role": "admin" if is_admin else ("seller" if is_seller else ("buyer" if is_buyer else "guest"))
         }
@@ -1594,29 +1562,26 @@ async def leave_tracking_review(
             detail="Вы уже оставили отзыв для этого заказа. Один отзыв на сделку."
         )
 
-    # Используем существующий функционал отзывов на заказе
-    order.review_rating = review_data.rating
-    order.review_text = review_data.review_text
-    db.add(order)
+    # Используем существующий функционал отзывов на заказе.
+    # Условный UPDATE: параллельный повторный отзыв не попадёт в агрегаты продавца дважды
+    result = db.execute(
+        update(Order)
+        .where(Order.id == order.id, Order.review_rating.is_(None))
+        .values(review_rating=review_data.rating, review_text=review_data.review_text)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail="Вы уже оставили отзыв для этого заказа. Один отзыв на сделку."
+        )
 
+    # Рейтинг продавца — инкрементально, в той же транзакции, что и отзыв
+    record_seller_review(db, order.seller_id, review_data.rating)
+    mark_tracking_view_stale(db, order.id)
     db.commit()
     db.refresh(order)
 
-    # Пересчет рейтинга продавца
-    seller = db.exec(select(User).where(User.id == order.seller_id)).first()
-    if seller:
-        rated_orders = db.exec(
-            select(Order).where(
-                Order.seller_id == order.seller_id,
-                Order.review_rating.isnot(None)
-            )
-        ).all()
-        if rated_orders:
-            total = sum(item.review_rating for item in rated_orders if item.review_rating is not None)
-            seller.rating = round(total / len(rated_orders), 2)
-            db.add(seller)
-            db.commit()
-
     return {
         "success": True,
         "order_id": order.id,
@@ -1828,14 +1793,13 @@ async def create_tracking_dispute(
         status="pending",
     )
     db.add(report)
-    db.commit()
-
-    await _send_dispute_event_notification(
+    _queue_dispute_event_notification(
         db,
         order,
         dispute,
         "dispute_opened_seller",
     )
+    db.commit()
 
     return {
         "success": True,
@@ -1928,15 +1892,14 @@ async def seller_respond_to_dispute(
         _sync_dispute_report_status(db, dispute, "waiting_buyer")
     else:
         _sync_dispute_report_status(db, dispute, "pending")
-    db.commit()
-    db.refresh(dispute)
-
-    await _send_dispute_event_notification(
+    _queue_dispute_event_notification(
         db,
         order,
         dispute,
         "dispute_seller_response_buyer",
     )
+    db.commit()
+    db.refresh(dispute)
 
     return {
         "success": True,
@@ -2002,20 +1965,19 @@ async def admin_dispute_verdict(
 
     db.add(order)
     db.add(dispute)
-    db.commit()
-    db.refresh(dispute)
-
-    # При seller_wins — разблокируем платёж продавцу; при buyer_wins — возврат обрабатывается позже
-    if verdict_raw == AdminDisputeVerdict.SELLER_WINS.value:
-        await _release_payment_for_order(order.id)
-
-    await _send_dispute_event_notification(
+    _queue_dispute_event_notification(
         db,
         order,
         dispute,
         "dispute_platform_result_both",
         verdict=verdict_raw,
     )
+    db.commit()
+    db.refresh(dispute)
+
+    # При seller_wins — разблокируем платёж продавцу; при buyer_wins — возврат обрабатывается позже
+    if verdict_raw == AdminDisputeVerdict.SELLER_WINS.value:
+        await _release_payment_for_order(order.id)
 
     return {
         "success": True,
@@ -2335,41 +2297,23 @@ async def leave_review(
     if order.review_rating is not None:
         raise HTTPException(status_code=400, detail="Вы уже оставили отзыв на этот заказ")
     
-    # Сохраняем отзыв
-    order.review_rating = rating
-    order.review_text = review_text
-    
-    db.add(order)
+    # Сохраняем отзыв (условный UPDATE защищает агрегаты продавца от двойного учёта)
+    result = db.execute(
+        update(Order)
+        .where(Order.id == order.id, Order.review_rating.is_(None))
+        .values(review_rating=rating, review_text=review_text)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Вы уже оставили отзыв на этот заказ")
+
+    # Обновляем рейтинг продавца инкрементально, в той же транзакции
+    record_seller_review(db, order.seller_id, rating)
+    mark_tracking_view_stale(db, order.id)
     db.commit()
     
     logger.info(f"Review saved | order_id={order.id} | rating={rating}/5")
     
-    # Обновляем рейтинг продавца
-    try:
-        seller_statement = select(User).where(User.id == order.seller_id)
-        seller = db.exec(seller_statement).first()
-        
-        if seller:
-            # Обновляем рейтинг (среднее арифметическое)
-            completed_orders = db.exec(
-                select(Order).where(
-                    Order.seller_id == order.seller_id,
-                    Order.review_rating.isnot(None)
-                )
-            ).all()
-            
-            if completed_orders:
-                total_rating = sum(o.review_rating for o in completed_orders if o.review_rating is not None)
-                seller.rating = round(total_rating / len(completed_orders), 2)
-                db.add(seller)
-                db.commit()
-            
-            logger.info(f"Seller rating updated | order_id={order.id}")
-    except Exception as e:
-        logger.warning(
-            f"Seller rating update failed | order_id={order.id} | error_type={safe_exception_name(e)}"
-        )
-    
     return {
         "success": True,
         "message": "Спасибо за ваш отзыв!",
@@ -2495,14 +2439,66 @@ async def get_my_sales(
     return {"sales": safe_sales}
 
 
+def _order_time_bucket_expr(bucket: str):
+    if bucket not in ("hour", "day"):
+        raise ValueError(f"Unsupported bucket: {bucket}")
+    if USE_POSTGRES:
+        # Единица — литералом, а не bind-параметром: иначе Postgres не сопоставит выражение в SELECT и GROUP BY
+        return func.date_trunc(literal_column(f"'{bucket}'"), Order.created_at)
+    fmt = "%Y-%m-%d %H:00:00" if bucket == "hour" else "%Y-%m-%d 00:00:00"
+    return func.strftime(fmt, Order.created_at)
+
+
+def _compute_admin_order_stats(db: Session, start_at: datetime, end_at: datetime, bucket: str) -> Dict[str, Any]:
+    window = [Order.created_at >= start_at, Order.created_at < end_at]
+
+    status_rows = db.exec(
+        select(Order.status, func.count(Order.id), func.coalesce(func.sum(Order.price), 0))
+        .where(*window)
+        .group_by(Order.status)
+    ).all()
+
+    bucket_expr = _order_time_bucket_expr(bucket).label("bucket_start")
+    bucket_rows = db.exec(
+        select(bucket_expr, func.count(Order.id), func.coalesce(func.sum(Order.price), 0))
+        .where(*window)
+        .group_by(bucket_expr)
+        .order_by(bucket_expr)
+    ).all()
+
+    by_status = [
+        {"status": status_value, "count": count, "gmv": round(float(gmv), 2)}
+        for status_value, count, gmv in status_rows
+    ]
+    return {
+        "new_orders": sum(item["count"] for item in by_status),
+        "gmv": round(sum(item["gmv"] for item in by_status), 2),
+        "by_status": by_status,
+        "bucket": bucket,
+        "buckets": [
+            {
+                "bucket_start": bucket_start.isoformat() if isinstance(bucket_start, datetime) else str(bucket_start),
+                "count": count,
+                "gmv": round(float(gmv), 2),
+            }
+            for bucket_start, count, gmv in bucket_rows
+        ],
+    }
+
+
 @order_router.get("")
 async def get_admin_orders_today_stats(
     start_at: datetime = Query(..., description="Начало периода в ISO формате UTC"),
     end_at: datetime = Query(..., description="Конец периода в ISO формате UTC"),
+    bucket: str = Query("hour", pattern="^(hour|day)$", description="Шаг разбивки: hour или day"),
     access_token: str = Cookie(None),
     db: Session = Depends(get_session)
 ):
-    """Статистика заказов за период через start_at/end_at, только для admin/support."""
+    """Статистика заказов за период через start_at/end_at, только для admin/support.
+
+    Считается агрегатами в SQL (индекс order(created_at, status)): количество и GMV
+    по статусам плюс разбивка по часам/дням. Результат кэшируется на несколько секунд.
+    """
     user = get_current_user(access_token)
     if user.get("user_type", "regular") not in ["admin", "support"]:
         raise HTTPException(status_code=403, detail="Недостаточно прав")
@@ -2510,17 +2506,16 @@ async def get_admin_orders_today_stats(
     if end_at <= start_at:
         raise HTTPException(status_code=422, detail="end_at должен быть больше start_at")
 
-    today_orders = db.exec(
-        select(Order).where(
-            Order.created_at >= start_at,
-            Order.created_at < end_at,
-        )
-    ).all()
+    cache_key = (start_at, end_at, bucket)
+    stats = admin_stats_cache.get(cache_key)
+    if stats is None:
+        stats = _compute_admin_order_stats(db, start_at, end_at, bucket)
+        admin_stats_cache.set(cache_key, stats)
 
     return {
         "status": "success",
         "data": {
-            "new_orders": len(today_orders),
+            **stats,
             "start_at": start_at.isoformat(),
             "end_at": end_at.isoformat(),
         }
@@ -2569,6 +2564,8 @@ async def delivery_created_webhook(
             order.tracking_number = tracking_number
             db.add(order)
             db.commit()
+        if order:
+            expire_tracking_delivery(db, order.id, order.tracking_number)
     return {"ok": True}
 
 
@@ -2631,43 +2628,47 @@ async def delivery_received_webhook(
     # Обновляем статус на PICKED_UP (автоматическое обновление при получении с пакомата)
     order.status = OrderStatus.PICKED_UP.value
     order.delivered_at = datetime.utcnow()
-    
     db.add(order)
-    db.commit()
-    db.refresh(order)
-    
-    logger.info(f"Order picked up | order_id={order_id} | status={order.status}")
-    
-    # Обновляем статистику продавца (автоматически, как при подтверждении)
+
+    # +1 к продажам продавца — в той же транзакции, что и смена статуса
+    # (рейтинг от этого не меняется, он пересчитывается только при новом отзыве)
+    record_seller_sale(db, order.seller_id)
+
+    # Отправляем SMS с благодарностью и ссылкой на отзыв
     try:
-        seller_statement = select(User).where(User.id == order.seller_id)
-        seller = db.exec(seller_statement).first()
+        seller = db.get(User, order.seller_id)
+        post = db.get(Product, order.post_id)
         
-        if seller:
-            # +1 к продажам
-            seller.sells_count += 1
-            
-            # Обновляем рейтинг (среднее арифметическое всех завершенных заказов с отзывами)
-            completed_orders = db.exec(
-                select(Order).where(
-                    Order.seller_id == order.seller_id,
-                    Order.review_rating.isnot(None)
-                )
-            ).all()
-            
-            if completed_orders:
-                total_rating = sum(o.review_rating for o in completed_orders if o.review_rating is not None)
-                seller.rating = round(total_rating / len(completed_orders), 2)
-            
-            db.add(seller)
-            db.commit()
-            
-            logger.info(f"Seller stats updated | order_id={order_id}")
+        notification_data = {
+            "post_id": order.post_id,
+            "order_id": order.id,
+            "seller_name": seller.name or seller.username if seller else "Продавец",
+            "seller_email": seller.email if seller else None,
+            "seller_phone": seller.phone if seller else None,
+            "buyer_name": f"{order.buyer_first_name} {order.buyer_last_name}",
+            "buyer_email": order.buyer_email,
+            "buyer_phone": order.buyer_phone,
+            "product_name": product_name(post),
+            "product_model": product_model_text(post),
+            "order_price": order.price,
+            "delivery_method": order.delivery_method,
+            "tracking_number": order.tracking_number or f"ORD{order.id}",
+            "language": language,
+            "review_url": f"{Configs.FRONTEND_URL.rstrip('/')}/order?tracking={order.tracking_number or f'ORD{order.id}'}"
+        }
+        
+        queue_notification(db, "order-delivered", notification_data)
     except Exception as e:
         logger.warning(
-            f"Seller stats update failed | order_id={order_id} | error_type={safe_exception_name(e)}"
+            f"Review request SMS failed | order_id={order.id} | error_type={safe_exception_name(e)}"
         )
     
+    db.commit()
+    db.refresh(order)
+    expire_tracking_delivery(db, order.id, order.tracking_number)
+    
+    logger.info(f"Order picked up | order_id={order_id} | status={order.status}")
+    
     # Скрываем чаты связанные с этим заказом
     if order.buyer_id:
         try:
@@ -2695,36 +2696,6 @@ async def delivery_received_webhook(
                 f"Chat hide error | post_id={order.post_id} | error_type={safe_exception_name(e)}"
             )
     
-    # Отправляем SMS с благодарностью и ссылкой на отзыв
-    try:
-        seller = db.get(User, order.seller_id)
-        post = db.get(Product, order.post_id)
-        
-        notification_data = {
-            "post_id": order.post_id,
-            "order_id": order.id,
-            "seller_name": seller.name or seller.username if seller else "Продавец",
-            "seller_email": seller.email if seller else None,
-            "seller_phone": seller.phone if seller else None,
-            "buyer_name": f"{order.buyer_first_name} {order.buyer_last_name}",
-            "buyer_email": order.buyer_email,
-            "buyer_phone": order.buyer_phone,
-            "product_name": product_name(post),
-            "product_model": product_model_text(post),
-            "order_price": order.price,
-            "delivery_method": order.delivery_method,
-            "tracking_number": order.tracking_number or f"ORD{order.id}",
-            "language": language,
-            "review_url": f"{Configs.FRONTEND_URL.rstrip('/')}/order?tracking={order.tracking_number or f'ORD{order.id}'}"
-        }
-        
-        # Отправляем асинхронно SMS с благодарностью и ссылкой на отзыв
-        await send_notification_async("order-delivered", notification_data)
-    except Exception as e:
-        logger.warning(
-            f"Review request SMS failed | order_id={order.id} | error_type={safe_exception_name(e)}"
-        )
-    
     return {
         "success": True,
         "message": "Заказ автоматически завершён (получен покупателем)",
@@ -2735,6 +2706,23 @@ async def delivery_received_webhook(
     }
 
 
+# === Потребитель событий delivery-service (поток events:delivery) ===
+# Те же обработчики, что и у HTTP webhook'ов выше: webhook'и оставлены для совместимости
+
+async def _on_delivery_created(db: Session, payload: Dict[str, Any]) -> None:
+    await delivery_created_webhook(payload, db)
+
+
+async def _on_delivery_picked_up(db: Session, payload: Dict[str, Any]) -> None:
+    await delivery_received_webhook(payload, db)
+
+
+DELIVERY_EVENT_HANDLERS = {
+    "delivery.created": _on_delivery_created,
+    "delivery.picked_up": _on_delivery_picked_up,
+}
+
+
 # === ФАЗА 4: ENDPOINT ДЛЯ ПОДТВЕРЖДЕНИЯ СОСТОЯНИЯ (PICKUP) ===
 @order_router.post("/shipments/{tracking_number}/confirm-condition")
 async def confirm_order_condition(
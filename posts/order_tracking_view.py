@@ -0,0 +1,331 @@
+# order_tracking_view.py - Read model публичной страницы заказа (/shipments/{tracking_number})
+#
+# Покупатели обновляют страницу заказа постоянно, поэтому её данные лежат денормализованно
+# в order_tracking_view: одна строка на заказ, уникальный индекс по tracking_number.
+# - Проекция пересобирается после коммита любой транзакции, изменившей Order / OrderIssue /
+#   OrderReview (слушатели Session ниже). Изменения в обход ORM (update()) помечаются явно
+#   через mark_tracking_view_stale.
+# - Снимок доставки хранится там же: сбрасывается событиями доставки и перезапрашивается
+#   в delivery-service не чаще TRACKING_DELIVERY_REFRESH_SECONDS.
+# - Чтение: процессный TTL-кэш -> один SELECT по индексу. Заказы, созданные до появления
+#   проекции, собираются лениво при первом открытии страницы.
+
+import itertools
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, select
+
+from configs import Configs
+from database import engine
+from models_v2 import (
+    Order, OrderIssue, OrderReview,
+    OrderStatus, OrderTrackingView, Product
+)
+from post_service_v2 import TTLCache
+
+logger = logging.getLogger("posts.order_tracking_view")
+
+tracking_page_cache = TTLCache(ttl_seconds=Configs.TRACKING_PAGE_CACHE_TTL_SECONDS)
+
+_PENDING_ORDER_IDS = "tracking_view_pending_order_ids"
+
+# После этих статусов доставка уже не меняется — снимок не перезапрашиваем
+_FINAL_ORDER_STATUSES = {
+    OrderStatus.CONFIRMED.value,
+    OrderStatus.REFUNDED.value,
+    OrderStatus.CANCELLED.value,
+}
+
+
+def product_name(product: Optional[Product]) -> str:
+    if not product:
+        return "Product"
+    attrs = product.attributes or {}
+    return attrs.get("model") or product.title or "Product"
+
+
+def _order_id_from_alias(key: str) -> Optional[int]:
+    # Старые/альтернативные ссылки вида /orders/{order_id} или /orders/ORD{order_id}
+    if key.isdigit():
+        return int(key)
+    if key.startswith("ORD") and key[3:].isdigit():
+        return int(key[3:])
+    return None
+
+
+def _build_page(db: Session, order: Order) -> Dict[str, Any]:
+    """Часть страницы, не зависящая от текущего пользователя."""
+    post = db.get(Product, order.post_id)
+
+    review = db.exec(
+        select(OrderReview).where(OrderReview.order_id == order.id)
+    ).first()
+
+    issues = db.exec(
+        select(OrderIssue)
+        .where(OrderIssue.order_id == order.id)
+        .order_by(OrderIssue.created_at.desc())
+    ).all()
+
+    # ВАЖНО: Если пользователь подтвердил заказ (order_confirmed_at != None),
+    # то effective_status = CONFIRMED, даже если order.status в БД еще не обновился!
+    # Это критично для правильного расчета actions в frontend
+    effective_status = OrderStatus.CONFIRMED.value if order.order_confirmed_at is not None else order.status
+
+    # SECURITY: Отправляем контакты продавца ТОЛЬКО если:
+    # 1. Это личная встреча (pickup)
+    # 2. Заказ еще НЕ забран (picked_up)
+    # 3. Заказ еще НЕ подтвержден (confirmed)
+    seller_contacts: Dict[str, Any] = {}
+    if (order.delivery_method == "pickup" and
+        effective_status != "picked_up" and
+        effective_status != "confirmed"):
+        if post and post.attributes:
+            seller_contacts = post.attributes
+
+    # === ДИНАМИЧЕСКАЯ ЛОГИКА: Видимость форм зависит от статуса ===
+    is_pickup = order.delivery_method == "pickup"
+    is_delivery = order.delivery_method in ["dpd", "omniva"]
+    order_confirmed = order.order_confirmed_at is not None
+
+    if is_pickup:
+        # PICKUP: жалоба ДО подтверждения (status=PAID и заказ не подтвержден)
+        can_open_issue = effective_status == OrderStatus.PAID.value and not order_confirmed
+    elif is_delivery:
+        # DPD/OMNIVA: жалоба ТОЛЬКО когда забран (status=PICKED_UP и заказ не подтвержден)
+        can_open_issue = effective_status == OrderStatus.PICKED_UP.value and not order_confirmed
+    else:
+        can_open_issue = False
+
+    # Отзыв: ТОЛЬКО если заказ подтвержден И еще нет отзыва
+    # (order.review_rating = None гарантирует один отзыв)
+    can_leave_review = order_confirmed and order.review_rating is None
+
+    return jsonable_encoder({
+        "order": {
+            "order_id": order.id,
+            "post_id": order.post_id,
+            "tracking_number": order.tracking_number,
+            "status": effective_status,
+            "delivery_method": order.delivery_method,
+            "product_name": product_name(post),
+            "price": order.price,
+            "created_at": order.created_at,
+            "paid_at": order.paid_at,
+            "shipped_at": order.shipped_at,
+            "delivered_at": order.delivered_at,
+            "completed_at": order.completed_at,
+            "order_confirmed_at": order.order_confirmed_at,
+            "review_rating": order.review_rating,
+            # SECURITY: Продавец информация о встречи
+            "seller_meeting_address": seller_contacts.get("seller_meeting_address"),
+            "seller_contact_preference": seller_contacts.get("seller_contact_preference"),
+            "seller_phone": seller_contacts.get("seller_phone"),
+            "seller_email": seller_contacts.get("seller_email"),
+        },
+        "review": {
+            "id": review.id if review else order.id,
+            "rating": order.review_rating if order.review_rating is not None else (review.seller_rating if review else None),
+            "review_text": order.review_text if order.review_text is not None else (review.review_text if review else None),
+            "updated_at": review.updated_at if review else order.completed_at or order.delivered_at or order.created_at
+        } if order.review_rating is not None or order.review_text or review else None,
+        "issues": [
+            {
+                "id": issue.id,
+                "issue_type": issue.issue_type,
+                "reason": issue.reason,
+                "description": issue.description,
+                "status": issue.status,
+                "buyer_media_urls": issue.buyer_media_urls or [],
+                "seller_response_action": issue.seller_response_action,
+                "seller_response_text": issue.seller_response_text,
+                "seller_discount_amount": issue.seller_discount_amount,
+                "seller_media_urls": issue.seller_media_urls or [],
+                "seller_response_deadline": issue.seller_response_deadline,
+                "seller_responded_at": issue.seller_responded_at,
+                "escalated_to_admin_at": issue.escalated_to_admin_at,
+                "admin_verdict": issue.admin_verdict,
+                "admin_comment": issue.admin_comment,
+                "admin_verdict_at": issue.admin_verdict_at,
+                "return_received_at": issue.return_received_at,
+                "created_at": issue.created_at,
+                "updated_at": issue.updated_at
+            }
+            for issue in issues
+        ],
+        "actions": {
+            "can_leave_review": can_leave_review,
+            "can_open_issue": can_open_issue,
+        },
+    })
+
+
+def _snapshot(view: OrderTrackingView) -> Dict[str, Any]:
+    return {
+        "order_id": view.order_id,
+        "tracking_number": view.tracking_number,
+        "seller_id": view.seller_id,
+        "buyer_id": view.buyer_id,
+        "status": view.status,
+        "page": view.page or {},
+        "delivery": view.delivery,
+        "delivery_synced_at": view.delivery_synced_at,
+    }
+
+
+def _forget(order_id: int, *tracking_numbers: Optional[str]) -> None:
+    tracking_page_cache.discard(str(order_id))
+    tracking_page_cache.discard(f"ORD{order_id}")
+    for tracking_number in tracking_numbers:
+        if tracking_number:
+            tracking_page_cache.discard(tracking_number)
+
+
+def refresh_tracking_view(db: Session, order_id: int) -> Optional[OrderTrackingView]:
+    """Пересобирает проекцию заказа и коммитит её. Снимок доставки не трогает."""
+    order = db.get(Order, order_id)
+    view = db.get(OrderTrackingView, order_id)
+
+    if order is None:
+        if view is not None:
+            db.delete(view)
+            db.commit()
+            _forget(order_id, view.tracking_number)
+        return None
+
+    previous_tracking = view.tracking_number if view else None
+    if view is None:
+        view = OrderTrackingView(order_id=order.id, seller_id=order.seller_id, status=order.status)
+
+    view.tracking_number = order.tracking_number
+    view.seller_id = order.seller_id
+    view.buyer_id = order.buyer_id
+    view.status = order.status
+    view.page = _build_page(db, order)
+    view.updated_at = datetime.utcnow()
+    db.add(view)
+    db.commit()
+    db.refresh(view)
+
+    _forget(order.id, previous_tracking, order.tracking_number)
+    return view
+
+
+def refresh_tracking_views(order_ids: Iterable[int]) -> None:
+    for order_id in sorted(set(order_ids)):
+        # Своя сессия на заказ: ошибка одной проекции не мешает остальным
+        with Session(engine) as db:
+            try:
+                refresh_tracking_view(db, order_id)
+            except Exception as exc:
+                db.rollback()
+                logger.warning(
+                    f"Tracking view refresh failed | order_id={order_id} | error_type={type(exc).__name__}"
+                )
+
+
+def mark_tracking_view_stale(db: Session, order_id: Optional[int]) -> None:
+    """Для изменений в обход ORM (update()): проекция заказа пересоберётся после коммита db."""
+    if order_id is not None:
+        db.info.setdefault(_PENDING_ORDER_IDS, set()).add(order_id)
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_changed_orders(session: OrmSession, flush_context: Any) -> None:
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Order):
+            mark_tracking_view_stale(session, obj.id)
+        elif isinstance(obj, (OrderIssue, OrderReview)):
+            mark_tracking_view_stale(session, obj.order_id)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _refresh_after_commit(session: OrmSession) -> None:
+    order_ids = session.info.pop(_PENDING_ORDER_IDS, None)
+    if order_ids:
+        refresh_tracking_views(order_ids)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_after_rollback(session: OrmSession) -> None:
+    session.info.pop(_PENDING_ORDER_IDS, None)
+
+
+def load_tracking_view(db: Session, key: str, order_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Проекция страницы заказа по tracking_number (или ORD{id} / {id}).
+
+    order_id — подсказка, когда заказ найден только через delivery-service.
+    """
+    cached = tracking_page_cache.get(key)
+    if cached is not None:
+        return cached
+
+    view = db.exec(
+        select(OrderTrackingView).where(OrderTrackingView.tracking_number == key)
+    ).first()
+
+    alias_order_id = order_id or _order_id_from_alias(key)
+    if view is None and alias_order_id is not None:
+        view = db.get(OrderTrackingView, alias_order_id)
+
+    if view is None:
+        # Заказ старше проекции (или пересборка не удалась) — собираем её один раз
+        order = db.exec(select(Order).where(Order.tracking_number == key)).first()
+        if order is None and alias_order_id is not None:
+            order = db.get(Order, alias_order_id)
+        if order is not None:
+            view = refresh_tracking_view(db, order.id)
+
+    if view is None:
+        return None
+
+    snapshot = _snapshot(view)
+    tracking_page_cache.set(key, snapshot)
+    return snapshot
+
+
+def tracking_delivery_is_stale(snapshot: Dict[str, Any]) -> bool:
+    synced_at = snapshot.get("delivery_synced_at")
+    if synced_at is None:
+        return True
+    if snapshot.get("status") in _FINAL_ORDER_STATUSES:
+        return False
+    return synced_at < datetime.utcnow() - timedelta(seconds=Configs.TRACKING_DELIVERY_REFRESH_SECONDS)
+
+
+def store_tracking_delivery(
+    db: Session,
+    key: str,
+    snapshot: Dict[str, Any],
+    delivery: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Сохраняет свежий снимок доставки в проекцию и возвращает обновлённый snapshot."""
+    now = datetime.utcnow()
+    db.execute(
+        update(OrderTrackingView)
+        .where(OrderTrackingView.order_id == snapshot["order_id"])
+        .values(delivery=delivery, delivery_synced_at=now)
+    )
+    db.commit()
+
+    refreshed = {**snapshot, "delivery": delivery, "delivery_synced_at": now}
+    _forget(snapshot["order_id"], snapshot.get("tracking_number"))
+    tracking_page_cache.set(key, refreshed)
+    return refreshed
+
+
+def expire_tracking_delivery(db: Session, order_id: int, tracking_number: Optional[str] = None) -> None:
+    """Событие доставки: следующий показ страницы перезапросит снимок в delivery-service."""
+    db.execute(
+        update(OrderTrackingView)
+        .where(OrderTrackingView.order_id == order_id)
+        .values(delivery_synced_at=None)
+    )
+    db.commit()
+    _forget(order_id, tracking_number)
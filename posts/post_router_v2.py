@@ -6,14 +6,15 @@ from typing import Any, Dict, List, Optional
 from fastapi import APIRouter, Body, Cookie, Depends, File, Form, HTTPException, Query, Request, UploadFile, status
 import httpx
 from jose import jwt
+from sqlalchemy import case, func, literal_column, or_, tuple_
 from sqlalchemy.exc import SQLAlchemyError
 from sqlmodel import Session, and_, select
 
 from api_response import ok_response, error_response
 from configs import Configs
-from database import get_session
+from database import USE_POSTGRES, get_session
 from models_v2 import PostReport, PostUpdateData, PostView, Product, ProductPublic, ProductStatus, ReportCreate
-from post_service_v2 import create_product_creating, enqueue_or_run, get_post, save_uploads_to_temp, update_product
+from post_service_v2 import create_product_creating, enqueue_or_run, get_post, listings_cache, save_uploads_to_temp, update_product
 
 api_router = APIRouter(prefix="/api/v1", tags=["Posts"])
 logger = logging.getLogger("posts.post_router_v2")
@@ -25,6 +26,12 @@ CF_IMAGE_DELIVERY_URL = Configs.CF_IMAGE_DELIVERY_URL
 CF_BASE_URL = Configs.CF_BASE_URL
 http_client = httpx.AsyncClient()
 
+# Генерируемая колонка products.search_tsv (см. database.create_db_and_tables), в модели её нет
+SEARCH_TSV = literal_column("products.search_tsv")
+
+# Границы ценовых диапазонов для фасетов (EUR); последний диапазон открыт сверху
+PRICE_FACET_BUCKETS = [0, 200, 400, 600, 800, 1000, 1500]
+
 
 def _decode_user(access_token: Optional[str]) -> Dict[str, Any]:
     if not access_token:
@@ -58,6 +65,31 @@ def _attrs_query_expr(key: str, value: Any):
     return Product.attributes.op("->>")(key) == str(value)
 
 
+def _search_expr(search_text: str):
+    """Условие и релевантность для поиска по q.
+
+    Postgres: tsvector по модели/title/памяти/цвету/описанию плюс pg_trgm по модели,
+    чтобы запросы с опечатками ("iphnoe 13 pro") тоже находили объявления.
+    SQLite (локальная разработка): каждое слово должно встречаться в title/description/model,
+    без ранжирования.
+    """
+    model_expr = Product.attributes.op("->>")("model")
+    if USE_POSTGRES:
+        ts_query = func.websearch_to_tsquery("simple", search_text)
+        condition = or_(SEARCH_TSV.op("@@")(ts_query), model_expr.op("%")(search_text))
+        rank = func.ts_rank_cd(SEARCH_TSV, ts_query) + func.similarity(model_expr, search_text)
+        return condition, rank
+
+    term_filters = []
+    for term in search_text.lower().split():
+        term_filters.append(or_(
+            func.lower(Product.title).contains(term, autoescape=True),
+            func.lower(Product.description).contains(term, autoescape=True),
+            func.lower(model_expr).contains(term, autoescape=True),
+        ))
+    return and_(*term_filters), None
+
+
 def _is_admin_payload(payload: Optional[Dict[str, Any]]) -> bool:
     if not payload:
         return False
@@ -201,24 +233,19 @@ async def create_post(
     )
 
 
-@api_router.get("/posts")
-def list_posts(
-    request: Request,
-    skip: int = Query(0, ge=0),
-    limit: int = Query(20, ge=1, le=100),
-    category_id: Optional[int] = Query(None),
-    seller_id: Optional[int] = Query(None),
-    status_filter: Optional[str] = Query(ProductStatus.PUBLISHED.value),
-    price_min: Optional[float] = Query(None, ge=0),
-    price_max: Optional[float] = Query(None, ge=0),
-    model: Optional[str] = Query(None),
-    color: Optional[str] = Query(None),
-    memory: Optional[int] = Query(None),
-    sort_price: Optional[str] = Query(None),
-    sort_date: Optional[str] = Query("desc"),
-    db: Session = Depends(get_session),
+def _listing_filters(
+    status_filter: Optional[str],
+    category_id: Optional[int],
+    seller_id: Optional[int],
+    price_min: Optional[float],
+    price_max: Optional[float],
+    model: Optional[str],
+    color: Optional[str],
+    memory: Optional[int],
+    q: Optional[str],
 ):
-    query = select(Product)
+    """Общие фильтры каталога для списка объявлений и фасетов."""
+    search_rank = None
 
     filters = [Product.active == True]
     if status_filter:
@@ -238,9 +265,107 @@ def list_posts(
     if memory is not None:
         filters.append(_attrs_query_expr("memory", memory))
 
+    search_text = (q or "").strip()
+    if search_text:
+        search_condition, search_rank = _search_expr(search_text)
+        filters.append(search_condition)
+
+    return filters, search_rank
+
+
+def _price_bucket_expr():
+    edges = PRICE_FACET_BUCKETS
+    return case(
+        *[(Product.price < upper, index) for index, upper in enumerate(edges[1:])],
+        else_=len(edges) - 1,
+    )
+
+
+def _price_bucket_bounds(index: int) -> Dict[str, Optional[float]]:
+    edges = PRICE_FACET_BUCKETS
+    upper = edges[index + 1] if index + 1 < len(edges) else None
+    return {"min": edges[index], "max": upper}
+
+
+def _facet_value_sort_key(value: str):
+    return (0, int(value), "") if value.isdigit() else (1, 0, value.lower())
+
+
+def _compute_facets(db: Session, filters: List[Any]) -> Dict[str, Any]:
+    # Выражения считаем в подзапросе, чтобы GROUP BY ссылался на колонки, а не на выражения с параметрами
+    base = select(
+        Product.attributes.op("->>")("model").label("model"),
+        Product.attributes.op("->>")("memory").label("memory"),
+        Product.attributes.op("->>")("color").label("color"),
+        _price_bucket_expr().label("price"),
+    ).where(and_(*filters)).subquery()
+    dimensions = [("model", base.c.model), ("memory", base.c.memory), ("color", base.c.color), ("price", base.c.price)]
+
+    counts: Dict[str, Dict[Any, int]] = {name: {} for name, _ in dimensions}
+    if USE_POSTGRES:
+        # Один проход по таблице: GROUPING SETS, grouping() показывает, к какому фасету относится строка
+        columns = [column for _, column in dimensions]
+        statement = select(func.grouping(*columns), *columns, func.count()).group_by(
+            func.grouping_sets(*[tuple_(column) for column in columns])
+        )
+        full_mask = (1 << len(dimensions)) - 1
+        for row in db.exec(statement).all():
+            for position, (name, _) in enumerate(dimensions):
+                if row[0] == full_mask ^ (1 << (len(dimensions) - 1 - position)):
+                    counts[name][row[position + 1]] = row[-1]
+                    break
+    else:
+        for name, column in dimensions:
+            statement = select(column, func.count()).group_by(column)
+            for value, count in db.exec(statement).all():
+                counts[name][value] = count
+
+    facets: Dict[str, Any] = {}
+    for name in ("model", "memory", "color"):
+        values = [(str(value), count) for value, count in counts[name].items() if value not in (None, "")]
+        values.sort(key=lambda item: _facet_value_sort_key(item[0]))
+        facets[name] = [{"value": value, "count": count} for value, count in values]
+
+    facets["price"] = [
+        {**_price_bucket_bounds(index), "count": count}
+        for index, count in sorted(counts["price"].items())
+        if index is not None
+    ]
+    facets["total"] = sum(item["count"] for item in facets["price"])
+    return facets
+
+
+@api_router.get("/posts")
+def list_posts(
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    category_id: Optional[int] = Query(None),
+    seller_id: Optional[int] = Query(None),
+    status_filter: Optional[str] = Query(ProductStatus.PUBLISHED.value),
+    price_min: Optional[float] = Query(None, ge=0),
+    price_max: Optional[float] = Query(None, ge=0),
+    model: Optional[str] = Query(None),
+    color: Optional[str] = Query(None),
+    memory: Optional[int] = Query(None),
+    sort_price: Optional[str] = Query(None),
+    sort_date: Optional[str] = Query("desc"),
+    q: Optional[str] = Query(None, max_length=200),
+    db: Session = Depends(get_session),
+):
+    query = select(Product)
+
+    filters, search_rank = _listing_filters(
+        status_filter, category_id, seller_id, price_min, price_max, model, color, memory, q
+    )
+
     if filters:
         query = query.where(and_(*filters))
 
+    # В режиме поиска сначала релевантность, остальные сортировки — как тай-брейк
+    if search_rank is not None:
+        query = query.order_by(search_rank.desc())
+
     if sort_date == "asc":
         query = query.order_by(Product.created_at.asc())
     else:
@@ -265,6 +390,35 @@ def list_posts(
     return ok_response(request, payload)
 
 
+@api_router.get("/posts/facets")
+def get_posts_facets(
+    request: Request,
+    category_id: Optional[int] = Query(None),
+    seller_id: Optional[int] = Query(None),
+    status_filter: Optional[str] = Query(ProductStatus.PUBLISHED.value),
+    price_min: Optional[float] = Query(None, ge=0),
+    price_max: Optional[float] = Query(None, ge=0),
+    model: Optional[str] = Query(None),
+    color: Optional[str] = Query(None),
+    memory: Optional[int] = Query(None),
+    q: Optional[str] = Query(None, max_length=200),
+    db: Session = Depends(get_session),
+):
+    """Счётчики для сайдбара фильтров (модель, память, цвет, ценовые диапазоны) по текущему набору фильтров."""
+    cache_key = (
+        "facets", category_id, seller_id, status_filter, price_min, price_max,
+        model, color, memory, (q or "").strip().lower(),
+    )
+    facets = listings_cache.get(cache_key)
+    if facets is None:
+        filters, _ = _listing_filters(
+            status_filter, category_id, seller_id, price_min, price_max, model, color, memory, q
+        )
+        facets = _compute_facets(db, filters)
+        listings_cache.set(cache_key, facets)
+    return ok_response(request, facets)
+
+
 @api_router.get("/posts/{post_id}")
 def get_post_by_id(
     request: Request,
@@ -531,6 +685,8 @@ def update_report(
     db.add(report)
     db.commit()
     db.refresh(report)
+    if action == "deactivate_post":
+        listings_cache.invalidate()
     return ok_response(request, _serialize_report(db, report))
 
 
@@ -2,9 +2,11 @@ import asyncio
 import os
 import shutil
 import tempfile
+import threading
 import time
 import uuid
 import logging
+from collections import OrderedDict
 from datetime import datetime
 from urllib.parse import urlparse
 from typing import Any, Dict, List, Optional
@@ -97,6 +99,58 @@ class ImeiCircuitBreaker:
 imei_breaker = ImeiCircuitBreaker()
 
 
+class TTLCache:
+    """Процессный TTL-кэш (фасеты каталога, статистика админки).
+
+    invalidate() сбрасывает кэш целиком; TTL ограничивает устаревание на других
+    репликах и при изменениях в обход сервисных функций. ttl_seconds <= 0 — кэш выключен.
+    Число ключей ограничено max_entries: при переполнении вытесняется давно не читанный (LRU),
+    поэтому произвольные комбинации фильтров не раздувают память процесса.
+    Общий для потоков threadpool-эндпоинтов, поэтому все операции — под замком.
+    """
+
+    def __init__(self, ttl_seconds: int = 60, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(max_entries, 1)
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, key: Any) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+listings_cache = TTLCache(
+    ttl_seconds=Configs.LISTINGS_CACHE_TTL_SECONDS,
+    max_entries=Configs.LISTINGS_CACHE_MAX_ENTRIES,
+)
+
+
 def get_post(db: Session, post_id: int) -> Optional[Product]:
     statement = select(Product).where(Product.id == post_id)
     return db.exec(statement).first()
@@ -250,6 +304,7 @@ def create_product_creating(
     db.add(product)
     db.commit()
     db.refresh(product)
+    listings_cache.invalidate()
     return product
 
 
@@ -328,6 +383,7 @@ async def process_product_task(product_id: int, file_paths: List[str]) -> None:
         db.add(product)
         db.commit()
         db.refresh(product)
+        listings_cache.invalidate()
 
 
 async def enqueue_or_run(product_id: int, file_paths: List[str]) -> None:
@@ -351,4 +407,5 @@ def update_product(db: Session, post_id: int, updates: Dict[str, Any]) -> Produc
     db.add(existing)
     db.commit()
     db.refresh(existing)
+    listings_cache.invalidate()
     return existing
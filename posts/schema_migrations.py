@@ -0,0 +1,441 @@
+# schema_migrations.py - Версионированные миграции схемы posts_db (только PostgreSQL)
+#
+# Раньше create_db_and_tables на каждом старте чистил "осиротевшие" строки, пересоздавал FK
+# (с полной проверкой таблиц под тяжёлой блокировкой) и гонял десятки ADD COLUMN IF NOT EXISTS.
+# Теперь каждый шаг схемы — миграция с номером версии; применённые версии записаны в
+# posts_db.schema_migrations, и обычный старт сводится к одному SELECT применённых версий.
+#
+# Правила:
+# - миграции только добавляются в конец MIGRATIONS, номера не переиспользуются и не меняются;
+# - каждый шаг идемпотентен: если реплика упала посреди миграции, повторный прогон безопасен;
+# - реплики, стартующие одновременно, сериализуются через pg_advisory_lock;
+# - упавшая миграция не блокирует следующие: она не записывается и повторяется на следующем старте,
+#   остальные применяются как обычно;
+# - таблицы без схемы в имени: create_all создаёт их по search_path (posts_db, public), поэтому
+#   на чистой БД "order" и orderissue лежат в posts_db, а на старых — в public;
+# - FK добавляются как NOT VALID (короткая блокировка) и проверяются отдельным шагом
+#   VALIDATE CONSTRAINT, который не блокирует запись в таблицу;
+# - индексы на больших таблицах строятся CREATE INDEX CONCURRENTLY (вне транзакции); INVALID-индекс,
+#   оставшийся от прерванной сборки, перед повтором удаляется (IF NOT EXISTS его бы пропустил).
+
+import hashlib
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlmodel import Session, SQLModel
+
+logger = logging.getLogger("posts.migrations")
+
+MIGRATIONS_TABLE = "posts_db.schema_migrations"
+MIGRATIONS_LOCK_KEY = int.from_bytes(
+    hashlib.sha1(b"posts_db:schema_migrations").digest()[:8], "big", signed=True
+)
+
+
+@dataclass(frozen=True)
+class MigrationStep:
+    sql: Optional[str] = None
+    func: Optional[Callable[[Connection], None]] = None
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    autocommit: bool = False
+    # Имя индекса, который строит шаг: невалидный остаток прерванной сборки удаляется перед ней
+    index: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    steps: Tuple[MigrationStep, ...]
+
+
+def _sql(statement: str, *, autocommit: bool = False) -> MigrationStep:
+    return MigrationStep(sql=statement, autocommit=autocommit)
+
+
+def _concurrent_index(name: str, statement: str) -> MigrationStep:
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS <name>: вне транзакции, с очисткой INVALID-остатка"""
+    return MigrationStep(sql=statement, autocommit=True, index=name)
+
+
+def _drop_invalid_index(connection: Connection, name: str) -> None:
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет индекс с indisvalid = false: IF NOT EXISTS
+    # его пропустил бы, а планировщик не использует
+    valid = connection.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": name},
+    ).scalar()
+    if valid is False:
+        logger.warning("Dropping invalid index before rebuild | index=%s", name)
+        connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _create_all_tables(connection: Connection) -> None:
+    SQLModel.metadata.create_all(connection)
+
+
+def _create_table(name: str) -> Callable[[Connection], None]:
+    def apply(connection: Connection) -> None:
+        SQLModel.metadata.tables[name].create(connection, checkfirst=True)
+
+    return apply
+
+
+def _backfill_seller_stats(connection: Connection) -> None:
+    # Импорт здесь: seller_stats_service тянет database, который сам вызывает миграции
+    from seller_stats_service import backfill_seller_stats
+
+    with Session(bind=connection) as db:
+        backfill_seller_stats(db)
+
+
+def _post_fk_cascade(table: str, constraint: str) -> Callable[[Connection], None]:
+    def apply(connection: Connection) -> None:
+        # FK уже с ON DELETE CASCADE — ничего не трогаем (типично для БД, поднятых старым кодом)
+        delete_type = connection.execute(
+            text(
+                "SELECT confdeltype FROM pg_constraint "
+                "WHERE conname = :name AND conrelid = to_regclass(:table)"
+            ),
+            {"name": constraint, "table": table},
+        ).scalar()
+        if delete_type == "c":
+            return
+        connection.exec_driver_sql(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}")
+        connection.exec_driver_sql(
+            f"""
+            ALTER TABLE {table}
+            ADD CONSTRAINT {constraint}
+            FOREIGN KEY (post_id) REFERENCES products(id) ON DELETE CASCADE
+            NOT VALID
+            """
+        )
+
+    return apply
+
+
+def _post_fk_migration(version: int, table: str, constraint: str) -> Migration:
+    return Migration(
+        version=version,
+        name=f"{constraint}_cascade",
+        steps=(
+            # Разовая чистка сирот: иначе VALIDATE CONSTRAINT упадёт
+            _sql(
+                f"""
+                DELETE FROM {table} t
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM products p WHERE p.id = t.post_id
+                )
+                """
+            ),
+            MigrationStep(func=_post_fk_cascade(table, constraint)),
+            _sql(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}"),
+        ),
+    )
+
+
+MIGRATIONS: Tuple[Migration, ...] = (
+    Migration(
+        version=1,
+        name="baseline_tables",
+        steps=(
+            _sql("CREATE SCHEMA IF NOT EXISTS posts_db"),
+            MigrationStep(func=_create_all_tables),
+        ),
+    ),
+    _post_fk_migration(2, "postview", "postview_post_id_fkey"),
+    _post_fk_migration(3, '"order"', "order_post_id_fkey"),
+    _post_fk_migration(4, "postreport", "postreport_post_id_fkey"),
+    Migration(
+        version=5,
+        name="order_buyer_id_policy",
+        steps=(
+            # buyer_id должен поддерживать анонимные заказы и не зависеть от user-таблиц
+            _sql('ALTER TABLE IF EXISTS "order" ALTER COLUMN buyer_id DROP NOT NULL'),
+            _sql(
+                """
+                DO $$
+                DECLARE
+                    constraint_name text;
+                BEGIN
+                    FOR constraint_name IN
+                        SELECT con.conname
+                        FROM pg_constraint con
+                        JOIN pg_class rel ON rel.oid = con.conrelid
+                        JOIN pg_attribute att ON att.attrelid = rel.oid
+                        WHERE con.contype = 'f'
+                          AND rel.oid = to_regclass('"order"')
+                          AND att.attname = 'buyer_id'
+                          AND att.attnum = ANY (con.conkey)
+                    LOOP
+                        EXECUTE format(
+                            'ALTER TABLE "order" DROP CONSTRAINT IF EXISTS %%I',
+                            constraint_name
+                        );
+                    END LOOP;
+                END$$;
+                """
+            ),
+        ),
+    ),
+    Migration(
+        version=6,
+        name="order_delivery_discount_columns",
+        steps=(
+            # "order" — по search_path: posts_db на чистой БД, public на старых
+            _sql(
+                """
+                ALTER TABLE IF EXISTS "order"
+                    ADD COLUMN IF NOT EXISTS delivery_cost NUMERIC(10, 2) DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS selected_locker_id VARCHAR(100),
+                    ADD COLUMN IF NOT EXISTS selected_locker_name VARCHAR(255),
+                    ADD COLUMN IF NOT EXISTS order_confirmed_at TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS discount_offered NUMERIC(10, 2),
+                    ADD COLUMN IF NOT EXISTS discount_status VARCHAR(50)
+                """
+            ),
+        ),
+    ),
+    Migration(
+        version=7,
+        name="orderissue_dispute_columns",
+        steps=(
+            _sql(
+                """
+                ALTER TABLE IF EXISTS orderissue
+                    ADD COLUMN IF NOT EXISTS buyer_media_urls JSONB DEFAULT '[]'::jsonb,
+                    ADD COLUMN IF NOT EXISTS seller_response_action VARCHAR(30),
+                    ADD COLUMN IF NOT EXISTS seller_response_text VARCHAR(2000),
+                    ADD COLUMN IF NOT EXISTS seller_discount_amount NUMERIC(10, 2),
+                    ADD COLUMN IF NOT EXISTS seller_media_urls JSONB DEFAULT '[]'::jsonb,
+                    ADD COLUMN IF NOT EXISTS seller_response_deadline TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS seller_responded_at TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS escalated_to_admin_at TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS admin_verdict VARCHAR(30),
+                    ADD COLUMN IF NOT EXISTS admin_comment VARCHAR(2000),
+                    ADD COLUMN IF NOT EXISTS admin_verdict_at TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS return_received_at TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS refund_payment_id INTEGER
+                """
+            ),
+        ),
+    ),
+    Migration(
+        version=8,
+        name="products_search",
+        steps=(
+            _sql("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+            # Генерируемая колонка: пересчитывается Postgres при каждом INSERT/UPDATE,
+            # приложению не нужно её поддерживать
+            _sql(
+                """
+                ALTER TABLE products ADD COLUMN IF NOT EXISTS search_tsv tsvector
+                GENERATED ALWAYS AS (
+                    setweight(to_tsvector('simple',
+                        coalesce(attributes->>'model', '') || ' ' || coalesce(title, '')), 'A')
+                    || setweight(to_tsvector('simple',
+                        coalesce(attributes->>'memory', '') || ' ' || coalesce(attributes->>'color', '')), 'B')
+                    || setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+                ) STORED
+                """
+            ),
+            _concurrent_index(
+                "ix_products_search_tsv",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_search_tsv ON products USING GIN (search_tsv)",
+            ),
+            _concurrent_index(
+                "ix_products_model_trgm",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_model_trgm ON products "
+                "USING GIN ((attributes->>'model') gin_trgm_ops)",
+            ),
+        ),
+    ),
+    Migration(
+        version=9,
+        name="order_seller_reviewed_index",
+        steps=(
+            # Отзывы по продавцу: частичный индекс только по заказам с оценкой
+            _concurrent_index(
+                "ix_order_seller_reviewed",
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_seller_reviewed
+                ON "order" (seller_id, created_at DESC)
+                INCLUDE (review_rating)
+                WHERE review_rating IS NOT NULL
+                """,
+            ),
+        ),
+    ),
+    Migration(
+        version=10,
+        name="order_created_at_status_index",
+        steps=(
+            # Статистика админки: диапазон по created_at + группировка по статусу
+            _concurrent_index(
+                "ix_order_created_at_status",
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_created_at_status '
+                'ON "order" (created_at, status) INCLUDE (price)',
+            ),
+        ),
+    ),
+    Migration(
+        version=11,
+        name="order_auto_confirm_index",
+        steps=(
+            # Авто-подтверждение: кандидаты — только неподтверждённые picked_up заказы
+            _concurrent_index(
+                "ix_order_auto_confirm_candidates",
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_auto_confirm_candidates
+                ON "order" (delivered_at)
+                WHERE status = 'picked_up' AND order_confirmed_at IS NULL
+                """,
+            ),
+        ),
+    ),
+    Migration(
+        version=12,
+        name="order_tracking_number_index",
+        steps=(
+            _concurrent_index(
+                "ix_order_tracking_number",
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_tracking_number ON "order" (tracking_number)',
+            ),
+        ),
+    ),
+    Migration(
+        version=13,
+        name="order_tracking_view",
+        steps=(MigrationStep(func=_create_table("order_tracking_view")),),
+    ),
+    Migration(
+        version=14,
+        name="orderissue_escalation_index",
+        steps=(
+            # Эскалация споров: только открытые споры с дедлайном ответа продавца
+            _concurrent_index(
+                "ix_orderissue_open_response_deadline",
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orderissue_open_response_deadline
+                ON orderissue (seller_response_deadline)
+                WHERE status = 'open'
+                """,
+            ),
+        ),
+    ),
+    Migration(
+        version=15,
+        name="outbox_tables",
+        steps=(
+            MigrationStep(func=_create_table("outbox_event")),
+            MigrationStep(func=_create_table("processed_event")),
+        ),
+    ),
+    Migration(
+        version=16,
+        name="seller_stats_backfill",
+        steps=(
+            # Инкрементальные агрегаты начинаются с уже накопленных отзывов и продаж: иначе первый
+            # отзыв после выкатки перезаписал бы User.rating одной оценкой
+            MigrationStep(func=_create_table("seller_stats")),
+            MigrationStep(func=_backfill_seller_stats),
+        ),
+    ),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _applied_versions(engine: Engine) -> Set[int]:
+    with engine.connect() as connection:
+        try:
+            return set(connection.execute(text(f"SELECT version FROM {MIGRATIONS_TABLE}")).scalars())
+        except DBAPIError:
+            # Таблицы версий ещё нет — чистая БД или первый запуск после перехода на миграции
+            return set()
+
+
+def _run_step(engine: Engine, step: MigrationStep) -> None:
+    with engine.connect() as connection:
+        if step.autocommit:
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if step.index is not None:
+            _drop_invalid_index(connection, step.index)
+        if step.sql is not None:
+            connection.exec_driver_sql(step.sql)
+        if step.func is not None:
+            step.func(connection)
+        if not step.autocommit:
+            connection.commit()
+
+
+def _apply(engine: Engine, migration: Migration) -> None:
+    for step in migration.steps:
+        _run_step(engine, step)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"INSERT INTO {MIGRATIONS_TABLE} (version, name, applied_at) "
+                "VALUES (:version, :name, :applied_at) ON CONFLICT (version) DO NOTHING"
+            ),
+            {"version": migration.version, "name": migration.name, "applied_at": datetime.utcnow()},
+        )
+
+
+def apply_migrations(engine: Engine) -> int:
+    """
+    Применяет все ещё не записанные миграции и возвращает наибольшую применённую версию.
+
+    Быстрый путь (схема актуальна) — один SELECT без блокировок.
+    Ошибка миграции не роняет сервис и не останавливает остальные: упавшая версия не записывается,
+    следующий старт повторит попытку.
+    """
+    all_versions = {migration.version for migration in MIGRATIONS}
+    applied = _applied_versions(engine)
+    if all_versions <= applied:
+        logger.info("Schema is up to date | version=%s", LATEST_VERSION)
+        return LATEST_VERSION
+
+    with engine.connect() as lock_connection:
+        # Ждём, пока другая реплика закончит миграции, затем перечитываем версию
+        lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        lock_connection.commit()
+        try:
+            with engine.begin() as connection:
+                connection.exec_driver_sql("CREATE SCHEMA IF NOT EXISTS posts_db")
+                connection.exec_driver_sql(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+                        version INTEGER PRIMARY KEY,
+                        name VARCHAR(200) NOT NULL,
+                        applied_at TIMESTAMP NOT NULL
+                    )
+                    """
+                )
+            applied = _applied_versions(engine)
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                try:
+                    _apply(engine, migration)
+                except Exception as exc:
+                    logger.error(
+                        "Schema migration failed | version=%s | name=%s | error=%s: %s",
+                        migration.version,
+                        migration.name,
+                        type(exc).__name__,
+                        exc,
+                    )
+                    continue
+                applied.add(migration.version)
+                logger.info("Schema migration applied | version=%s | name=%s", migration.version, migration.name)
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+            lock_connection.commit()
+
+    return max(applied, default=0)
@@ -0,0 +1,116 @@
+# seller_stats_service.py - Инкрементальные агрегаты рейтинга и продаж продавца
+
+import logging
+from datetime import datetime
+from typing import Tuple
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select
+
+from database import USE_POSTGRES, engine
+from models_v2 import Order, SellerStats, User
+
+logger = logging.getLogger("posts.seller_stats_service")
+
+
+def _rating_from_stats(review_count: int, rating_sum: int) -> float:
+    return round(rating_sum / review_count, 2)
+
+
+def _upsert_seller_stats(
+    db: Session,
+    seller_id: int,
+    *,
+    review_delta: int = 0,
+    rating_delta: int = 0,
+    sells_delta: int = 0,
+) -> Tuple[int, int]:
+    """Атомарно прибавляет дельты к seller_stats и возвращает (review_count, rating_sum)."""
+    insert_fn = pg_insert if USE_POSTGRES else sqlite_insert
+    statement = insert_fn(SellerStats).values(
+        seller_id=seller_id,
+        review_count=review_delta,
+        rating_sum=rating_delta,
+        sells_count=sells_delta,
+        updated_at=datetime.utcnow(),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[SellerStats.seller_id],
+        set_={
+            "review_count": SellerStats.review_count + statement.excluded.review_count,
+            "rating_sum": SellerStats.rating_sum + statement.excluded.rating_sum,
+            "sells_count": SellerStats.sells_count + statement.excluded.sells_count,
+            "updated_at": statement.excluded.updated_at,
+        },
+    ).returning(SellerStats.review_count, SellerStats.rating_sum)
+    row = db.execute(statement).one()
+    return row[0], row[1]
+
+
+def record_seller_review(db: Session, seller_id: int, rating: int) -> None:
+    """Учитывает новый отзыв. Коммит — на вызывающей стороне, вместе с самим отзывом."""
+    review_count, rating_sum = _upsert_seller_stats(
+        db, seller_id, review_delta=1, rating_delta=int(rating)
+    )
+    db.execute(
+        update(User)
+        .where(User.id == seller_id)
+        .values(rating=_rating_from_stats(review_count, rating_sum))
+    )
+
+
+def record_seller_sale(db: Session, seller_id: int) -> None:
+    """Учитывает завершённую продажу. Коммит — на вызывающей стороне."""
+    _upsert_seller_stats(db, seller_id, sells_delta=1)
+    db.execute(
+        update(User)
+        .where(User.id == seller_id)
+        .values(sells_count=User.sells_count + 1)
+    )
+
+
+def backfill_seller_stats(db: Session) -> int:
+    """Пересчитывает seller_stats с нуля по заказам с отзывами и User.sells_count.
+
+    Выполняется миграцией seller_stats_backfill (schema_migrations.py) до того, как агрегаты
+    начнут обновляться инкрементально; вручную — для сверки.
+    """
+    review_rows = db.exec(
+        select(Order.seller_id, func.count(Order.review_rating), func.sum(Order.review_rating))
+        .where(Order.review_rating.isnot(None))
+        .group_by(Order.seller_id)
+    ).all()
+    reviews = {seller_id: (count, int(total or 0)) for seller_id, count, total in review_rows}
+
+    sells_rows = db.exec(select(User.id, User.sells_count).where(User.sells_count > 0)).all()
+    sells = {seller_id: sells_count for seller_id, sells_count in sells_rows}
+
+    now = datetime.utcnow()
+    seller_ids = set(reviews) | set(sells)
+    for seller_id in seller_ids:
+        review_count, rating_sum = reviews.get(seller_id, (0, 0))
+        stats = db.get(SellerStats, seller_id) or SellerStats(seller_id=seller_id)
+        stats.review_count = review_count
+        stats.rating_sum = rating_sum
+        stats.sells_count = sells.get(seller_id, 0)
+        stats.updated_at = now
+        db.add(stats)
+        if review_count:
+            db.execute(
+                update(User)
+                .where(User.id == seller_id)
+                .values(rating=_rating_from_stats(review_count, rating_sum))
+            )
+
+    db.commit()
+    logger.info("Seller stats backfill done | sellers=%s", len(seller_ids))
+    return len(seller_ids)
+
+
+if __name__ == "__main__":
+    # python seller_stats_service.py — ручной пересчёт seller_stats (сверка)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    with Session(engine) as session:
+        backfill_seller_stats(session)